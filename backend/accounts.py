@@ -0,0 +1,214 @@
+"""Pool of Telegram accounts per user and the scheduler that spreads scrapes over them.
+
+Telegram applies flood limits per account, so one login caps the scrape
+rate of every channel its user follows. Besides the primary account from
+/telegram-credentials a user can register more through /telegram-accounts;
+each has its own session file and its own request budget.
+
+Scrapes lease an account for as long as they run. The pool hands out the
+account with the lowest score: the leases it already holds on this worker
+plus a penalty for the FloodWaits it hit recently, each counted for its
+length and fading out linearly over FLOOD_HISTORY_SECONDS. Accounts still
+inside a flood wait are not handed out until it expires. Flood history is
+kept in MongoDB so every worker schedules with the same picture.
+
+Large backfills are cut into segments of consecutive message ids that run
+on different accounts in parallel (see ``split_segments``). Channel message
+ids are sequential, so the id span is the size of a backfill.
+"""
+import os
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+PRIMARY_ACCOUNT = "primary"
+
+FLOOD_HISTORY_SECONDS = int(os.environ.get("FLOOD_HISTORY_SECONDS", 3600))
+FLOOD_HISTORY_SIZE = 20
+# Seconds of recent flood wait that weigh as much as one running scrape.
+FLOOD_PENALTY_SECONDS = float(os.environ.get("FLOOD_PENALTY_SECONDS", 60))
+BACKFILL_SEGMENT_MIN = int(os.environ.get("BACKFILL_SEGMENT_MIN", 5000))
+
+CREDENTIAL_FIELDS = ("api_id", "api_hash", "phone")
+
+
+class NoAccountAvailable(Exception):
+    """Every account of the user is inside a flood wait (or none is set up)."""
+
+    def __init__(self, retry_after: Optional[float] = None):
+        super().__init__("No Telegram account available" +
+                         (f", retry in {retry_after:.0f}s" if retry_after is not None else ""))
+        self.retry_after = retry_after
+
+
+def split_segments(after_id: int, last_id: int, parts: int) -> List[Tuple[int, int]]:
+    """Cut the message ids after ``after_id`` up to ``last_id`` into ``parts`` even runs.
+
+    Returns ``(after_id, last_id)`` pairs: a segment covers the ids greater
+    than its ``after_id`` up to and including its ``last_id``.
+    """
+    span = last_id - after_id
+    if span <= 0:
+        return []
+    parts = max(1, min(parts, span))
+    bounds = [after_id + span * part // parts for part in range(parts + 1)]
+    return list(zip(bounds, bounds[1:]))
+
+
+def segment_count(total_messages: int, accounts: int) -> int:
+    return max(1, min(accounts, total_messages // BACKFILL_SEGMENT_MIN))
+
+
+def resume_segments(snapshot: List[List], last_id: int) -> List[Tuple[int, int]]:
+    """What is left of an interrupted backfill (a SegmentProgress.snapshot).
+
+    Finished segments are dropped and unfinished ones start where they
+    stopped. The last segment also took messages posted during the scrape,
+    so it resumes from where it got to and now runs up to ``last_id``.
+    """
+    *inner, (tail_position, _, _) = snapshot
+    segments = [(position, end) for position, end, finished in inner if not finished and position < end]
+    if tail_position < last_id:
+        segments.append((tail_position, last_id))
+    return segments
+
+
+class SegmentProgress:
+    """Channel offset of a backfill running as parallel segments.
+
+    The stored offset may only move past messages that are saved, so it
+    follows the first segment that has not finished yet.
+    """
+
+    def __init__(self, segments: List[Tuple[int, int]]):
+        self.segments = segments
+        self.positions = [after_id for after_id, _ in segments]
+        self.finished = [False] * len(segments)
+        self.checkpoint = segments[0][0] if segments else 0
+
+    def advance(self, index, message_id) -> Optional[int]:
+        """Record a saved message; return the new offset if it moved."""
+        self.positions[index] = max(self.positions[index], message_id)
+        return self._move()
+
+    def finish(self, index) -> Optional[int]:
+        self.finished[index] = True
+        self.positions[index] = max(self.positions[index], self.segments[index][1])
+        return self._move()
+
+    def snapshot(self) -> List[List]:
+        """``[position, last_id, finished]`` per segment, for resume_segments."""
+        return [[position, end, finished]
+                for position, (_, end), finished in zip(self.positions, self.segments, self.finished)]
+
+    def _move(self):
+        mark = self.checkpoint
+        for position, finished in zip(self.positions, self.finished):
+            mark = max(mark, position)
+            if not finished:
+                break
+        if mark == self.checkpoint:
+            return None
+        self.checkpoint = mark
+        return mark
+
+
+class AccountPool:
+    def __init__(self, collection):
+        self.collection = collection
+        self._leases: Dict[Tuple[str, str], int] = {}
+
+    async def ensure_indexes(self):
+        await self.collection.create_index([("user_id", 1), ("account_id", 1)], unique=True)
+
+    async def add(self, user_id, credentials: dict) -> dict:
+        account = {
+            "user_id": user_id,
+            "account_id": uuid.uuid4().hex[:12],
+            **{field: credentials[field] for field in CREDENTIAL_FIELDS},
+            "flood_until": None,
+            "flood_waits": [],
+            "created_at": datetime.utcnow(),
+        }
+        await self.collection.insert_one(account)
+        account.pop("_id", None)
+        return account
+
+    async def remove(self, user_id, account_id) -> bool:
+        result = await self.collection.delete_one({"user_id": user_id, "account_id": account_id})
+        return result.deleted_count > 0
+
+    async def accounts(self, user) -> List[dict]:
+        """Every account of a user document, the primary one first.
+
+        The primary account's credentials live on the user; only its flood
+        history is kept in the pool's collection.
+        """
+        docs = {
+            doc["account_id"]: doc
+            async for doc in self.collection.find({"user_id": user["id"]}, {"_id": 0})
+        }
+        accounts = []
+        primary = docs.pop(PRIMARY_ACCOUNT, {"flood_until": None, "flood_waits": []})
+        if user.get("telegram_credentials"):
+            accounts.append({**primary, **user["telegram_credentials"],
+                             "user_id": user["id"], "account_id": PRIMARY_ACCOUNT})
+        accounts.extend(doc for doc in docs.values() if all(doc.get(field) for field in CREDENTIAL_FIELDS))
+        return accounts
+
+    def leases(self, user_id, account_id) -> int:
+        return self._leases.get((user_id, account_id), 0)
+
+    def score(self, account, now=None) -> float:
+        now = now or datetime.utcnow()
+        window = timedelta(seconds=FLOOD_HISTORY_SECONDS)
+        penalty = 0.0
+        for wait in account.get("flood_waits") or ():
+            age = now - wait["at"]
+            if age < window:
+                penalty += wait["seconds"] * (1 - age / window)
+        return self.leases(account["user_id"], account["account_id"]) + penalty / FLOOD_PENALTY_SECONDS
+
+    def rank(self, accounts, now=None) -> List[dict]:
+        """Accounts that are not in a flood wait, best first."""
+        now = now or datetime.utcnow()
+        available = [a for a in accounts if not a.get("flood_until") or a["flood_until"] <= now]
+        return sorted(available, key=lambda account: self.score(account, now))
+
+    async def assign(self, user, count=1, exclude=()) -> List[dict]:
+        """Up to ``count`` (None: all) distinct accounts to run work on, best first.
+
+        Raises NoAccountAvailable, with the time until the first flood wait
+        ends, when no account can take work right now.
+        """
+        now = datetime.utcnow()
+        accounts = [a for a in await self.accounts(user) if a["account_id"] not in exclude]
+        ranked = self.rank(accounts, now)
+        if not ranked:
+            waits = [(a["flood_until"] - now).total_seconds() for a in accounts if a.get("flood_until")]
+            raise NoAccountAvailable(min(waits) if waits else None)
+        return ranked if count is None else ranked[:max(count, 1)]
+
+    @asynccontextmanager
+    async def lease(self, account):
+        key = (account["user_id"], account["account_id"])
+        self._leases[key] = self._leases.get(key, 0) + 1
+        try:
+            yield account
+        finally:
+            self._leases[key] -= 1
+            if not self._leases[key]:
+                del self._leases[key]
+
+    async def record_flood_wait(self, user_id, account_id, seconds):
+        now = datetime.utcnow()
+        await self.collection.update_one(
+            {"user_id": user_id, "account_id": account_id},
+            {
+                "$set": {"flood_until": now + timedelta(seconds=seconds)},
+                "$push": {"flood_waits": {"$each": [{"at": now, "seconds": seconds}],
+                                          "$slice": -FLOOD_HISTORY_SIZE}},
+            },
+            upsert=True,
+        )
@@ -0,0 +1,265 @@
+"""Per-user admission control and fair sharing of scrape and export work.
+
+Two mechanisms keep one user from taking a node over:
+
+``RateLimiter``    a token bucket per user; starting work spends a token
+                   and a user out of tokens is turned away until the
+                   bucket refills.
+``FairScheduler``  a fixed number of slots shared among users. Work waits
+                   in a queue per user, and a free slot goes to the user
+                   with the least service so far relative to their weight
+                   (stride scheduling, an approximation of weighted fair
+                   queuing), among those below their own concurrency cap.
+                   A user who was idle re-enters at the current virtual
+                   time, so idle periods do not bank credit.
+
+Both raise ``AdmissionRejected``, which the API answers with 429 and a
+Retry-After header. Background work is keyed, e.g. by (user, channel):
+work for a key that is already queued or running is merged into it.
+"""
+import asyncio
+import logging
+import math
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+
+from metrics import ADMISSION_REJECTIONS, FAIR_QUEUE_RUNNING, FAIR_QUEUE_WAITING
+
+logger = logging.getLogger(__name__)
+
+# Scrapes: slots per node, running and queued scrapes per user, and how
+# many scrape requests (single, bulk backfill, continuous start) a user
+# may make per minute beyond a burst
+SCRAPE_SLOTS = int(os.environ.get("SCRAPE_SLOTS", 16))
+SCRAPE_USER_CONCURRENCY = int(os.environ.get("SCRAPE_USER_CONCURRENCY", 4))
+SCRAPE_USER_QUEUE = int(os.environ.get("SCRAPE_USER_QUEUE", 10000))
+SCRAPE_RATE_PER_MINUTE = float(os.environ.get("SCRAPE_RATE_PER_MINUTE", 30))
+SCRAPE_RATE_BURST = int(os.environ.get("SCRAPE_RATE_BURST", 10))
+
+# Exports run while the request waits: at most EXPORT_QUEUE_TIMEOUT
+# seconds for a slot, with few queued per user
+EXPORT_SLOTS = int(os.environ.get("EXPORT_SLOTS", 2))
+EXPORT_USER_CONCURRENCY = int(os.environ.get("EXPORT_USER_CONCURRENCY", 1))
+EXPORT_USER_QUEUE = int(os.environ.get("EXPORT_USER_QUEUE", 2))
+EXPORT_RATE_PER_MINUTE = float(os.environ.get("EXPORT_RATE_PER_MINUTE", 10))
+EXPORT_RATE_BURST = int(os.environ.get("EXPORT_RATE_BURST", 5))
+EXPORT_QUEUE_TIMEOUT = float(os.environ.get("EXPORT_QUEUE_TIMEOUT", 30))
+
+
+class AdmissionRejected(Exception):
+    """The user is over a quota; retry after ``retry_after`` seconds."""
+
+    def __init__(self, detail, retry_after):
+        super().__init__(detail)
+        self.retry_after = max(int(math.ceil(retry_after)), 1)
+
+    @property
+    def headers(self):
+        return {"Retry-After": str(self.retry_after)}
+
+
+class RateLimiter:
+    def __init__(self, name, per_minute: float, burst: int):
+        self.name = name
+        self.rate = per_minute / 60.0
+        self.burst = max(burst, 1)
+        self._buckets: Dict[str, tuple] = {}
+
+    def check(self, user_id, cost=1):
+        """Spend ``cost`` tokens of the user's bucket, or raise AdmissionRejected."""
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(user_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < cost:
+            self._buckets[user_id] = (tokens, now)
+            ADMISSION_REJECTIONS.labels(self.name, "rate").inc()
+            raise AdmissionRejected(f"Too many {self.name} requests", (cost - tokens) / self.rate)
+        self._buckets[user_id] = (tokens - cost, now)
+        if len(self._buckets) > 10000:
+            self._forget_full(now)
+
+    def _forget_full(self, now):
+        """Drop buckets that have refilled; they are indistinguishable from new ones."""
+        for user_id, (tokens, updated) in list(self._buckets.items()):
+            if tokens + (now - updated) * self.rate >= self.burst:
+                del self._buckets[user_id]
+
+
+class _Tenant:
+    __slots__ = ('waiting', 'running', 'weight', 'limit', 'pass_')
+
+    def __init__(self, virtual_time):
+        self.waiting: deque = deque()
+        self.running = 0
+        self.weight = 1.0
+        self.limit = None
+        self.pass_ = virtual_time
+
+
+class FairScheduler:
+    def __init__(self, name, slots: int, per_user: int, max_waiting: int):
+        self.name = name
+        self.slots = max(slots, 1)
+        self.per_user = max(per_user, 1)
+        self.max_waiting = max(max_waiting, 0)
+        self.running = 0
+        self._tenants: Dict[str, _Tenant] = {}
+        self._virtual = 0.0
+        self._work: Dict[Hashable, tuple] = {}
+        # Submitted work per user whose task has not asked for a slot yet
+        self._unstarted: Dict[str, int] = {}
+        # Moving average of how long work holds a slot, for Retry-After
+        self._hold_seconds = 1.0
+
+    def waiting(self, user_id) -> int:
+        """Units of the user's work waiting for a slot, including submitted work not started yet."""
+        tenant = self._tenants.get(user_id)
+        queued = sum(1 for f in tenant.waiting if not f.done()) if tenant else 0
+        return queued + self._unstarted.get(user_id, 0)
+
+    def retry_after(self, user_id) -> float:
+        """Rough time until the user's queue has moved on by one slot."""
+        tenant = self._tenants.get(user_id)
+        limit = min(tenant.limit or self.per_user, self.per_user) if tenant else self.per_user
+        return self._hold_seconds * (self.waiting(user_id) + 1) / limit
+
+    def admit(self, user_id, count=1):
+        """Raise AdmissionRejected if the user cannot queue ``count`` more units of work."""
+        if self.waiting(user_id) + count > self.max_waiting:
+            ADMISSION_REJECTIONS.labels(self.name, "queue_full").inc()
+            raise AdmissionRejected(f"Too much {self.name} work queued", self.retry_after(user_id))
+
+    @asynccontextmanager
+    async def slot(self, user_id, weight=1.0, limit=None, timeout=None):
+        """Hold one slot for the body; waits for its fair turn, at most ``timeout`` seconds.
+
+        ``limit`` lowers the user's concurrency below ``per_user``, e.g. to
+        the number of Telegram accounts the user has.
+        """
+        tenant = self._tenants.get(user_id)
+        if tenant is None:
+            tenant = self._tenants[user_id] = _Tenant(self._virtual)
+        elif not tenant.waiting and not tenant.running:
+            tenant.pass_ = max(tenant.pass_, self._virtual)
+        tenant.weight = max(weight or 1.0, 0.01)
+        tenant.limit = limit
+        granted = asyncio.get_running_loop().create_future()
+        tenant.waiting.append(granted)
+        FAIR_QUEUE_WAITING.labels(self.name).inc()
+        self._dispatch()
+        try:
+            await asyncio.wait_for(granted, timeout)
+        except BaseException as e:
+            if granted.done() and not granted.cancelled():
+                self._release(user_id, tenant, None)
+            else:
+                granted.cancel()
+                FAIR_QUEUE_WAITING.labels(self.name).dec()
+                self._forget(user_id, tenant)
+            if isinstance(e, asyncio.TimeoutError):
+                ADMISSION_REJECTIONS.labels(self.name, "timeout").inc()
+                raise AdmissionRejected(f"No {self.name} slot free", self.retry_after(user_id))
+            raise
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(user_id, tenant, time.monotonic() - started)
+
+    def _dispatch(self):
+        while self.running < self.slots:
+            best = None
+            for tenant in self._tenants.values():
+                if not tenant.waiting or tenant.running >= min(tenant.limit or self.per_user, self.per_user):
+                    continue
+                if best is None or tenant.pass_ < best.pass_:
+                    best = tenant
+            if best is None:
+                return
+            granted = best.waiting.popleft()
+            if granted.done():
+                continue  # gave up waiting
+            best.running += 1
+            self.running += 1
+            self._virtual = best.pass_
+            best.pass_ += 1.0 / best.weight
+            FAIR_QUEUE_WAITING.labels(self.name).dec()
+            FAIR_QUEUE_RUNNING.labels(self.name).inc()
+            granted.set_result(None)
+
+    def _release(self, user_id, tenant, held):
+        tenant.running -= 1
+        self.running -= 1
+        FAIR_QUEUE_RUNNING.labels(self.name).dec()
+        if held is not None:
+            self._hold_seconds = 0.8 * self._hold_seconds + 0.2 * held
+        self._forget(user_id, tenant)
+        self._dispatch()
+
+    def _forget(self, user_id, tenant):
+        while tenant.waiting and tenant.waiting[0].done():
+            tenant.waiting.popleft()
+        if not tenant.waiting and not tenant.running and self._tenants.get(user_id) is tenant:
+            del self._tenants[user_id]
+
+    def pending(self, key) -> Optional[Any]:
+        """The tag of the work queued or running under ``key``, if any."""
+        entry = self._work.get(key)
+        return entry[1] if entry else None
+
+    def task(self, key) -> Optional[asyncio.Task]:
+        """The task of the work queued or running under ``key``, if any."""
+        entry = self._work.get(key)
+        return entry[0] if entry else None
+
+    def submitted(self) -> List[tuple]:
+        """(task, tag) of the work submitted and not finished yet."""
+        return list(self._work.values())
+
+    def submit(self, key, user_id, work: Callable[[], Awaitable], tag=None, weight=1.0, limit=None) -> asyncio.Task:
+        """Run ``work()`` in the background in a slot of the user's.
+
+        The task of work already queued or running under ``key`` is returned
+        instead of starting it again. Call ``admit`` first to enforce the queue limit.
+        """
+        entry = self._work.get(key)
+        if entry is not None:
+            return entry[0]
+
+        started = False
+
+        async def run():
+            nonlocal started
+            # slot() queues the work before it first waits, so it is counted once throughout
+            started = True
+            self._started(user_id)
+            try:
+                async with self.slot(user_id, weight, limit):
+                    await work()
+            except Exception as e:
+                logger.error(f"{self.name} work {key!r} failed: {str(e)}")
+            finally:
+                self._work.pop(key, None)
+
+        def cancelled_unstarted(task):
+            if not started:
+                self._started(user_id)
+                self._work.pop(key, None)
+
+        task = asyncio.ensure_future(run())
+        task.add_done_callback(cancelled_unstarted)
+        self._work[key] = (task, tag)
+        self._unstarted[user_id] = self._unstarted.get(user_id, 0) + 1
+        return task
+
+    def _started(self, user_id):
+        left = self._unstarted.get(user_id, 0) - 1
+        if left > 0:
+            self._unstarted[user_id] = left
+        else:
+            self._unstarted.pop(user_id, None)
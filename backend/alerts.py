@@ -0,0 +1,98 @@
+"""Watch rules of a user and the messages they matched.
+
+Rules are matched by the scraper as messages are saved (see watch); the
+endpoints here manage the rules and list their hits.
+"""
+from datetime import datetime
+from typing import List, Literal, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, status
+from pydantic import BaseModel
+
+import state
+from auth import User, get_current_user
+from watch import MAX_WATCH_RULES, validate_rule
+
+router = APIRouter()
+
+class WatchRuleIn(BaseModel):
+    pattern: str
+    kind: Literal["keyword", "regex"] = "keyword"
+    name: Optional[str] = None
+    # Channels the rule applies to; all of the user's channels if not set
+    channels: Optional[List[str]] = None
+    case_sensitive: bool = False
+    whole_word: bool = True
+
+class WatchRulesIn(BaseModel):
+    rules: List[WatchRuleIn]
+
+def check_rules(rules: List[WatchRuleIn]) -> List[dict]:
+    checked = []
+    for index, rule in enumerate(rules):
+        fields = rule.dict()
+        try:
+            validate_rule(fields)
+        except ValueError as e:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Rule {index}: {str(e)}" if len(rules) > 1 else str(e)
+            )
+        checked.append(fields)
+    return checked
+
+async def create_rules(user_id, rules: List[WatchRuleIn]) -> List[dict]:
+    checked = check_rules(rules)
+    if await state.watch_rules.count(user_id) + len(checked) > MAX_WATCH_RULES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {MAX_WATCH_RULES} watch rules per user"
+        )
+    return await state.watch_rules.create_many(user_id, checked)
+
+@router.get("/watch-rules")
+async def list_watch_rules(current_user: User = Depends(get_current_user)):
+    return {"rules": await state.watch_rules.list(current_user.id)}
+
+@router.post("/watch-rules")
+async def add_watch_rule(rule: WatchRuleIn, current_user: User = Depends(get_current_user)):
+    created = await create_rules(current_user.id, [rule])
+    return created[0]
+
+@router.post("/watch-rules/bulk")
+async def add_watch_rules(request: WatchRulesIn, current_user: User = Depends(get_current_user)):
+    created = await create_rules(current_user.id, request.rules)
+    return {"created": [rule["id"] for rule in created]}
+
+@router.put("/watch-rules/{rule_id}")
+async def update_watch_rule(rule_id: str, rule: WatchRuleIn, current_user: User = Depends(get_current_user)):
+    updated = await state.watch_rules.update(current_user.id, rule_id, check_rules([rule])[0])
+    if not updated:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Watch rule {rule_id} not found"
+        )
+    return updated
+
+@router.delete("/watch-rules/{rule_id}")
+async def delete_watch_rule(rule_id: str, current_user: User = Depends(get_current_user)):
+    if not await state.watch_rules.delete(current_user.id, rule_id):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Watch rule {rule_id} not found"
+        )
+    return {"message": f"Watch rule {rule_id} deleted"}
+
+@router.get("/watch-matches")
+async def list_watch_matches(
+    channel_id: Optional[str] = None,
+    rule_id: Optional[str] = None,
+    before: Optional[datetime] = None,
+    limit: int = 100,
+    current_user: User = Depends(get_current_user)
+):
+    """Hits of the user's rules, newest first; pass the last created_at as ``before`` for the next page."""
+    matches = await state.watch_rules.list_matches(
+        current_user.id, channel_id=channel_id, rule_id=rule_id, before=before, limit=min(max(limit, 1), 1000)
+    )
+    return {"matches": matches}
@@ -0,0 +1,120 @@
+"""Compressed, immutable archive segments for old channel messages.
+
+A segment holds a run of consecutive messages of one channel, ordered by
+message_id, as one compressed JSON document. Segments are written once to
+a temporary file and renamed into place, and never modified afterwards,
+so readers can cache their decoded rows freely.
+
+zstd is used when the ``zstandard`` package is installed, zlib otherwise.
+The codec is part of the file name, so segments written with either can
+be read back as long as the codec is available.
+"""
+import json
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Callable, List, Sequence
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ARCHIVE_SEGMENT_ROWS = int(os.environ.get("ARCHIVE_SEGMENT_ROWS", 10000))
+ARCHIVE_CACHE_SEGMENTS = int(os.environ.get("ARCHIVE_CACHE_SEGMENTS", 8))
+ZSTD_LEVEL = 9
+
+
+def default_codec():
+    return "zstd" if zstandard is not None else "zlib"
+
+
+def compress(data: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL, write_checksum=True).compress(data)
+    if codec == "zlib":
+        return zlib.compress(data, 9)
+    raise ValueError(f"Unknown segment codec {codec!r}")
+
+
+def decompress(data: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("The zstandard package is required to read zstd archive segments")
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == "zlib":
+        return zlib.decompress(data)
+    raise ValueError(f"Unknown segment codec {codec!r}")
+
+
+def write_segment(directory, columns: Sequence[str], rows: List[Sequence], codec=None) -> dict:
+    """Write rows (ordered by message_id) as a new segment; return its index entry."""
+    codec = codec or default_codec()
+    message_id = columns.index("message_id")
+    date = columns.index("date")
+    payload = json.dumps({"columns": list(columns), "rows": [list(row) for row in rows]},
+                         ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    data = compress(payload, codec)
+
+    first_id, last_id = rows[0][message_id], rows[-1][message_id]
+    name = f"{first_id:012d}-{last_id:012d}.{codec}"
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, name)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+    dates = [row[date] for row in rows if row[date] is not None]
+    return {
+        "path": name,
+        "codec": codec,
+        "first_message_id": first_id,
+        "last_message_id": last_id,
+        "first_date": min(dates) if dates else None,
+        "last_date": max(dates) if dates else None,
+        "rows": len(rows),
+        "bytes": len(data),
+        "raw_bytes": len(payload),
+    }
+
+
+def read_segment(path, codec, columns: Sequence[str], row_type: Callable = tuple) -> List[tuple]:
+    """Rows of a segment as ``row_type`` tuples of ``columns``.
+
+    Columns the segment was written without (it predates them) are None.
+    """
+    with open(path, "rb") as f:
+        document = json.loads(decompress(f.read(), codec))
+    stored = document["columns"]
+    if list(stored) == list(columns):
+        return [row_type(row) for row in document["rows"]]
+    indexes = [stored.index(column) if column in stored else None for column in columns]
+    return [row_type(None if index is None else row[index] for index in indexes) for row in document["rows"]]
+
+
+class SegmentCache:
+    """Small LRU of decoded segments, keyed by path."""
+
+    def __init__(self, columns: Sequence[str], row_type: Callable = tuple, size=ARCHIVE_CACHE_SEGMENTS):
+        self.columns = columns
+        self.row_type = row_type
+        self.size = size
+        self._segments: "OrderedDict[str, List[tuple]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def rows(self, path, codec) -> List[tuple]:
+        with self._lock:
+            rows = self._segments.get(path)
+            if rows is not None:
+                self._segments.move_to_end(path)
+                return rows
+        rows = read_segment(path, codec, self.columns, self.row_type)
+        with self._lock:
+            self._segments[path] = rows
+            while len(self._segments) > self.size:
+                self._segments.popitem(last=False)
+        return rows
@@ -0,0 +1,366 @@
+"""User accounts, password and Google login, JWT bearer tokens and media tokens.
+
+bcrypt (passlib), python-jose and google-auth are imported when a request
+first needs them rather than when the API starts.
+"""
+import base64
+import hashlib
+import hmac
+import os
+import time
+import uuid
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
+
+from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
+from pydantic import BaseModel, EmailStr, Field
+
+import state
+
+# JWT Authentication settings
+SECRET_KEY = os.environ.get('SECRET_KEY')
+ALGORITHM = os.environ.get('ALGORITHM', 'HS256')
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.environ.get('ACCESS_TOKEN_EXPIRE_MINUTES', 30))
+# Media tokens last between one and two of these, in seconds
+MEDIA_TOKEN_TTL = int(os.environ.get('MEDIA_TOKEN_TTL', 300))
+
+# Google OAuth settings
+GOOGLE_CLIENT_ID = os.environ.get('GOOGLE_CLIENT_ID')
+
+# OAuth2 token bearer
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/token")
+oauth2_scheme_optional = OAuth2PasswordBearer(tokenUrl="/api/token", auto_error=False)
+
+router = APIRouter()
+
+# Data models
+class UserCreate(BaseModel):
+    email: EmailStr
+    password: str
+    full_name: Optional[str] = None
+
+class UserLogin(BaseModel):
+    email: EmailStr
+    password: str
+
+class GoogleLogin(BaseModel):
+    token: str
+
+class UserResponse(BaseModel):
+    id: str
+    email: EmailStr
+    full_name: Optional[str] = None
+
+class Token(BaseModel):
+    access_token: str
+    token_type: str
+
+class TokenData(BaseModel):
+    email: Optional[str] = None
+
+class ResetPassword(BaseModel):
+    email: EmailStr
+
+class NewPassword(BaseModel):
+    token: str
+    password: str
+
+class TelegramCredentials(BaseModel):
+    api_id: int
+    api_hash: str
+    phone: str
+
+class User(BaseModel):
+    id: str
+    email: str
+    full_name: Optional[str] = None
+    hashed_password: str
+    telegram_credentials: Optional[TelegramCredentials] = None
+    channels: Dict[str, int] = {}
+    scrape_media: bool = True
+    # Share of the node's scrape and export slots relative to other users
+    weight: float = 1.0
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+# Authentication Functions
+@lru_cache(maxsize=None)
+def pwd_context():
+    """Password hashing"""
+    from passlib.context import CryptContext
+    return CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+def verify_password(plain_password, hashed_password):
+    return pwd_context().verify(plain_password, hashed_password)
+
+def get_password_hash(password):
+    return pwd_context().hash(password)
+
+async def get_user(email: str):
+    user = await state.db.users.find_one({"email": email})
+    if user:
+        return User(**user)
+    return None
+
+async def authenticate_user(email: str, password: str):
+    user = await get_user(email)
+    if not user:
+        return False
+    if not verify_password(password, user.hashed_password):
+        return False
+    return user
+
+def create_access_token(data: dict, expires_delta: timedelta = None):
+    from jose import jwt
+    to_encode = data.copy()
+    if expires_delta:
+        expire = datetime.utcnow() + expires_delta
+    else:
+        expire = datetime.utcnow() + timedelta(minutes=15)
+    to_encode.update({"exp": expire})
+    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    return encoded_jwt
+
+async def get_current_user(token: str = Depends(oauth2_scheme)):
+    from jose import JWTError, jwt
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        email: str = payload.get("sub")
+        if email is None:
+            raise credentials_exception
+        token_data = TokenData(email=email)
+    except JWTError:
+        raise credentials_exception
+    user = await get_user(email=token_data.email)
+    if user is None:
+        raise credentials_exception
+    return user
+
+def _media_signature(user_id, channel_id, file_name, expires) -> str:
+    message = "\n".join(("media", user_id, channel_id, file_name, str(expires))).encode()
+    digest = hmac.new(SECRET_KEY.encode(), message, hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+def create_media_token(user_id, channel_id, file_name, now: Optional[float] = None) -> Tuple[str, int]:
+    """Token granting one media file of a user, and its expiry as a Unix time.
+
+    For the URLs of <img> and <video> sources, which cannot send headers.
+    The expiry is rounded up to a multiple of MEDIA_TOKEN_TTL, so tokens for
+    a file minted within one window are the same and so is its URL, which
+    keeps it in the browser cache.
+    """
+    expires = (int(now if now is not None else time.time()) // MEDIA_TOKEN_TTL + 2) * MEDIA_TOKEN_TTL
+    return f"{user_id}.{expires}.{_media_signature(user_id, channel_id, file_name, expires)}", expires
+
+async def get_media_user(
+    channel_id: str,
+    file_name: str,
+    token: Optional[str] = Depends(oauth2_scheme_optional),
+    media_token: Optional[str] = None
+):
+    """get_current_user that also accepts a create_media_token token for the
+    requested file in a ``media_token`` query parameter. Bearer tokens are
+    only taken from the Authorization header."""
+    if token or not media_token:
+        return await get_current_user(token or "")
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Invalid or expired media token",
+    )
+    try:
+        user_id, expires, signature = media_token.rsplit(".", 2)
+        expires = int(expires)
+    except ValueError:
+        raise credentials_exception
+    if expires < time.time() or not hmac.compare_digest(
+        signature, _media_signature(user_id, channel_id, file_name, expires)
+    ):
+        raise credentials_exception
+    user = await state.db.users.find_one({"id": user_id})
+    if user is None:
+        raise credentials_exception
+    return User(**user)
+
+# API Routes
+@router.post("/register", response_model=UserResponse)
+async def register_user(user_data: UserCreate):
+    # Check if user already exists
+    existing_user = await state.db.users.find_one({"email": user_data.email})
+    if existing_user:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Email already registered"
+        )
+
+    # Create new user
+    user_id = str(uuid.uuid4())
+    hashed_password = get_password_hash(user_data.password)
+
+    user = {
+        "id": user_id,
+        "email": user_data.email,
+        "full_name": user_data.full_name,
+        "hashed_password": hashed_password,
+        "telegram_credentials": None,
+        "channels": {},
+        "scrape_media": True,
+        "created_at": datetime.utcnow(),
+        "updated_at": datetime.utcnow()
+    }
+
+    await state.db.users.insert_one(user)
+
+    return {
+        "id": user_id,
+        "email": user_data.email,
+        "full_name": user_data.full_name
+    }
+
+@router.post("/token", response_model=Token)
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
+    user = await authenticate_user(form_data.username, form_data.password)
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Incorrect email or password",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    access_token = create_access_token(
+        data={"sub": user.email}, expires_delta=access_token_expires
+    )
+    return {"access_token": access_token, "token_type": "bearer"}
+
+@router.post("/login", response_model=Token)
+async def login(user_data: UserLogin):
+    user = await authenticate_user(user_data.email, user_data.password)
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Incorrect email or password",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    access_token = create_access_token(
+        data={"sub": user.email}, expires_delta=access_token_expires
+    )
+    return {"access_token": access_token, "token_type": "bearer"}
+
+@router.post("/google-login", response_model=Token)
+async def google_login(data: GoogleLogin):
+    from google.auth.transport import requests
+    from google.oauth2 import id_token
+    try:
+        # Verify the Google token
+        idinfo = id_token.verify_oauth2_token(
+            data.token, requests.Request(), GOOGLE_CLIENT_ID
+        )
+
+        # Extract user info
+        email = idinfo.get('email')
+        if not email:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Email not found in Google token"
+            )
+
+        # Check if user exists, create if not
+        user = await state.db.users.find_one({"email": email})
+        if not user:
+            user_id = str(uuid.uuid4())
+            user = {
+                "id": user_id,
+                "email": email,
+                "full_name": idinfo.get('name'),
+                # No password since this is Google auth
+                "hashed_password": get_password_hash(str(uuid.uuid4())),
+                "telegram_credentials": None,
+                "channels": {},
+                "scrape_media": True,
+                "created_at": datetime.utcnow(),
+                "updated_at": datetime.utcnow()
+            }
+            await state.db.users.insert_one(user)
+
+        # Generate JWT token
+        access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+        access_token = create_access_token(
+            data={"sub": email}, expires_delta=access_token_expires
+        )
+        return {"access_token": access_token, "token_type": "bearer"}
+
+    except ValueError:
+        # Invalid token
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid Google token"
+        )
+
+@router.post("/reset-password")
+async def reset_password(data: ResetPassword):
+    user = await get_user(data.email)
+    if not user:
+        # Don't reveal that the user doesn't exist
+        return {"message": "If your email is registered, a password reset link will be sent"}
+
+    # Generate a token
+    reset_token = create_access_token(
+        data={"sub": user.email, "reset": True},
+        expires_delta=timedelta(hours=1)
+    )
+
+    # For testing, just return the token
+    return {"message": "Password reset requested", "token": reset_token}
+
+@router.post("/set-new-password")
+async def set_new_password(data: NewPassword):
+    from jose import JWTError, jwt
+    try:
+        # Verify token
+        payload = jwt.decode(data.token, SECRET_KEY, algorithms=[ALGORITHM])
+        email = payload.get("sub")
+        is_reset = payload.get("reset")
+
+        if not email or not is_reset:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Invalid token"
+            )
+
+        # Hash new password
+        hashed_password = get_password_hash(data.password)
+
+        # Update user
+        result = await state.db.users.update_one(
+            {"email": email},
+            {"$set": {"hashed_password": hashed_password, "updated_at": datetime.utcnow()}}
+        )
+
+        if result.modified_count == 0:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="User not found"
+            )
+
+        return {"message": "Password updated successfully"}
+
+    except JWTError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid or expired token"
+        )
+
+@router.get("/me", response_model=UserResponse)
+async def read_users_me(current_user: User = Depends(get_current_user)):
+    return {
+        "id": current_user.id,
+        "email": current_user.email,
+        "full_name": current_user.full_name
+    }
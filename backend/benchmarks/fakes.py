@@ -0,0 +1,629 @@
+"""Local stand-ins for Telegram and MongoDB.
+
+These fakes implement just enough of the Telethon client and Motor
+collection APIs for the scraper to run without a live account or a
+database server. They are used by the benchmarks and by the tests.
+"""
+import asyncio
+import os
+import random
+import re
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional
+
+from telethon.tl.types import (
+    MessageFwdHeader,
+    MessageMediaDocument,
+    MessageMediaPhoto,
+    MessageReplyHeader,
+    PeerChannel,
+    User as TelegramUser,
+)
+
+WORDS = (
+    "telegram channel update price market news breaking alert crypto "
+    "release report today weather sport match goal video photo link "
+    "share join discussion announcement event offer free new big"
+).split()
+
+
+@dataclass
+class ChannelSpec:
+    """Shape of a synthetic channel served by FakeTelegramClient."""
+    messages: int = 1000
+    photo_ratio: float = 0.0
+    document_ratio: float = 0.0
+    media_bytes: int = 64 * 1024
+    reply_ratio: float = 0.1
+    forward_ratio: float = 0.0
+    senders: int = 50
+    text_words: int = 30
+    batch_size: int = 100
+    fetch_latency: float = 0.0
+    download_latency: float = 0.0
+    seed: int = 1
+    # Telegram accounts of the scraping user; each gets its own client
+    accounts: int = 1
+
+
+class FakeFile:
+    def __init__(self, name, ext, size):
+        self.name = name
+        self.ext = ext
+        self.size = size
+
+
+class FakeMessage:
+    def __init__(self, client, channel_id, id, date, sender, text, media=None,
+                 reply_to=None, fwd_from=None, media_bytes=0):
+        self._client = client
+        self.channel_id = channel_id
+        self.id = id
+        self.date = date
+        self.edit_date = None
+        self.sender = sender
+        self.message = text
+        self.media = media
+        self.reply_to = reply_to
+        self.fwd_from = fwd_from
+        self._media_bytes = media_bytes
+
+    @property
+    def sender_id(self):
+        return self.sender.id if self.sender else None
+
+    @property
+    def reply_to_msg_id(self):
+        return self.reply_to.reply_to_msg_id if self.reply_to else None
+
+    @property
+    def file(self):
+        if isinstance(self.media, MessageMediaPhoto):
+            return FakeFile(None, ".jpg", self._media_bytes)
+        if isinstance(self.media, MessageMediaDocument):
+            return FakeFile(f"document_{self.id}.bin", ".bin", self._media_bytes)
+        return None
+
+    async def get_sender(self):
+        return self.sender
+
+    async def download_media(self, file=None):
+        spec = self._client.channels[self.channel_id]
+        if spec.download_latency:
+            await asyncio.sleep(spec.download_latency)
+        name = self.file.name or f"photo_{self.id}{self.file.ext}"
+        path = os.path.join(file, name) if file and os.path.isdir(file) else (file or name)
+        with open(path, "wb") as f:
+            f.write(b"\0" * self._media_bytes)
+        self._client.media_bytes_served += self._media_bytes
+        return path
+
+
+class FakeEntity:
+    def __init__(self, channel_id, title):
+        self.id = channel_id
+        self.title = title
+
+
+class FakeDialog:
+    def __init__(self, id, title, date, top_message, pinned=False):
+        self.id = id
+        self.title = title
+        self.name = title
+        self.date = date
+        self.pinned = pinned
+        self.is_channel = True
+        self.is_group = False
+        self.is_user = False
+        self.entity = FakeEntity(id, title)
+        self.message = type("TopMessage", (), {"id": top_message, "date": date})()
+
+
+class FakeTelegramClient:
+    """In-memory replacement for ``telethon.TelegramClient``.
+
+    ``channels`` maps the channel id as used by the API (for example
+    ``"-1001234"`` or ``"somechannel"``) to a ChannelSpec. Messages are
+    generated deterministically from the spec's seed on first access.
+    ``yield_times`` records when each message id was last handed to the
+    caller, which the benchmarks use to compute per-message latency.
+    """
+
+    def __init__(self, channels: Dict[str, ChannelSpec], clock: Callable[[], float] = None):
+        self.channels = channels
+        self.clock = clock or time.perf_counter
+        self.yield_times: Dict[str, Dict[int, float]] = {c: {} for c in channels}
+        self.fetch_requests = 0
+        self.media_bytes_served = 0
+        self.connected = False
+        self.titles: Dict[str, str] = {}
+        self.pinned = set()
+        self.dialog_requests = 0
+        self.dialogs_served = 0
+        self._messages: Dict[str, List[FakeMessage]] = {}
+
+    def add_messages(self, channel_id, count):
+        """Append ``count`` new messages to a channel, as if just posted."""
+        messages = self.messages_for(channel_id)
+        spec = self.channels[channel_id]
+        last = messages[-1] if messages else None
+        for offset in range(1, count + 1):
+            message_id = (last.id if last else 0) + offset
+            messages.append(FakeMessage(
+                self, channel_id, message_id,
+                (last.date if last else datetime(2024, 1, 1)) + timedelta(minutes=offset),
+                last.sender if last else None, f"new message {message_id}",
+            ))
+        spec.messages = len(messages)
+
+    async def start(self, *args, **kwargs):
+        self.connected = True
+        return self
+
+    async def connect(self):
+        self.connected = True
+
+    async def disconnect(self):
+        self.connected = False
+
+    def is_connected(self):
+        return self.connected
+
+    async def is_user_authorized(self):
+        return True
+
+    def _channel_key(self, entity):
+        if isinstance(entity, FakeEntity):
+            return entity.id
+        if isinstance(entity, PeerChannel):
+            entity = str(entity.channel_id)
+        key = str(entity)
+        if key not in self.channels:
+            raise ValueError(f"Cannot find any entity corresponding to \"{key}\"")
+        return key
+
+    async def get_entity(self, entity):
+        key = self._channel_key(entity)
+        return FakeEntity(key, f"Channel {key}")
+
+    def _generate(self, channel_id):
+        spec = self.channels[channel_id]
+        rng = random.Random(spec.seed)
+        senders = [
+            TelegramUser(id=1000 + i, first_name=f"First{i}", last_name=f"Last{i}", username=f"user{i}")
+            for i in range(max(spec.senders, 1))
+        ]
+        start = datetime(2024, 1, 1)
+        messages = []
+        for message_id in range(1, spec.messages + 1):
+            roll = rng.random()
+            media = None
+            if roll < spec.photo_ratio:
+                media = MessageMediaPhoto()
+            elif roll < spec.photo_ratio + spec.document_ratio:
+                media = MessageMediaDocument()
+            reply_to = None
+            if message_id > 1 and rng.random() < spec.reply_ratio:
+                reply_to = MessageReplyHeader(reply_to_msg_id=rng.randint(max(1, message_id - 50), message_id - 1))
+            fwd_from = None
+            if rng.random() < spec.forward_ratio:
+                fwd_from = MessageFwdHeader(
+                    date=start,
+                    from_id=PeerChannel(channel_id=rng.randint(1, 20)),
+                    channel_post=rng.randint(1, 10000),
+                )
+            text = " ".join(rng.choice(WORDS) for _ in range(spec.text_words))
+            messages.append(FakeMessage(
+                self, channel_id, message_id,
+                start + timedelta(minutes=7 * message_id),
+                rng.choice(senders), text, media, reply_to, fwd_from,
+                spec.media_bytes if media else 0,
+            ))
+        return messages
+
+    def messages_for(self, channel_id) -> List[FakeMessage]:
+        if channel_id not in self._messages:
+            self._messages[channel_id] = self._generate(channel_id)
+        return self._messages[channel_id]
+
+    async def iter_messages(self, entity, limit=None, offset_id=0, min_id=0, max_id=0,
+                            reverse=False, **kwargs):
+        key = self._channel_key(entity)
+        spec = self.channels[key]
+        messages = self.messages_for(key)
+        if reverse:
+            selected = [m for m in messages if m.id > max(offset_id, min_id) and (not max_id or m.id < max_id)]
+        else:
+            upper = min(x for x in (offset_id, max_id) if x) if (offset_id or max_id) else None
+            selected = [m for m in reversed(messages) if m.id > min_id and (upper is None or m.id < upper)]
+        if limit is not None:
+            selected = selected[:limit]
+
+        yield_times = self.yield_times[key]
+        for index, message in enumerate(selected):
+            if index % spec.batch_size == 0:
+                self.fetch_requests += 1
+                await asyncio.sleep(spec.fetch_latency)
+            yield_times[message.id] = self.clock()
+            yield message
+
+    async def get_messages(self, entity, limit=None, **kwargs):
+        return [message async for message in self.iter_messages(entity, limit=limit, **kwargs)]
+
+    async def iter_dialogs(self, **kwargs):
+        """Dialogs newest first, like Telegram; a channel's date is its last message."""
+        self.dialog_requests += 1
+        dialogs = []
+        for key, spec in self.channels.items():
+            messages = self.messages_for(key)
+            date = messages[-1].date if messages else datetime(2024, 1, 1)
+            dialogs.append(FakeDialog(key, self.titles.get(key, f"Channel {key}"), date,
+                                      messages[-1].id if messages else 0, pinned=key in self.pinned))
+        dialogs.sort(key=lambda d: (d.pinned, d.date), reverse=True)
+        for dialog in dialogs:
+            self.dialogs_served += 1
+            yield dialog
+
+
+class FakeUpdateResult:
+    def __init__(self, matched_count=0, modified_count=0, upserted_id=None):
+        self.matched_count = matched_count
+        self.modified_count = modified_count
+        self.upserted_id = upserted_id
+
+
+class FakeDeleteResult:
+    def __init__(self, deleted_count):
+        self.deleted_count = deleted_count
+
+
+class FakeBulkWriteResult:
+    def __init__(self, count):
+        self.bulk_api_result = {"nRequests": count}
+
+
+class FakeInsertOneResult:
+    def __init__(self, inserted_id):
+        self.inserted_id = inserted_id
+
+
+def _get_path(doc, path):
+    value = doc
+    for part in path.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return None, False
+        value = value[part]
+    return value, True
+
+
+def _set_path(doc, path, value):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = value
+
+
+def _unset_path(doc, path):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(parts[-1], None)
+
+
+_READS = {"find", "find_one", "count_documents"}
+
+
+def _plain_values(values):
+    return all(value is None or isinstance(value, (str, int, float, bool, datetime)) for value in values)
+
+
+def _with_in_sets(filter):
+    # $in against a set rather than a list, for filters with many values
+    prepared = {}
+    for key, condition in filter.items():
+        if isinstance(condition, dict) and isinstance(condition.get("$in"), (list, tuple)):
+            try:
+                condition = {**condition, "$in": frozenset(condition["$in"])}
+            except TypeError:
+                pass
+        prepared[key] = condition
+    return prepared
+
+
+def _matches(doc, filter):
+    for key, condition in filter.items():
+        value, present = _get_path(doc, key)
+        if isinstance(condition, dict) and condition and all(k.startswith("$") for k in condition):
+            for op, operand in condition.items():
+                if op == "$in" and not (any(item in operand for item in value) if isinstance(value, list)
+                                        else value in operand):
+                    return False
+                if op == "$ne" and value == operand:
+                    return False
+                if op == "$exists" and present != bool(operand):
+                    return False
+                if op == "$nin" and value in operand:
+                    return False
+                if op == "$regex":
+                    flags = re.IGNORECASE if "i" in condition.get("$options", "") else 0
+                    if not isinstance(value, str) or not re.search(operand, value, flags):
+                        return False
+                if op in ("$lt", "$lte", "$gt", "$gte"):
+                    if value is None:
+                        return False
+                    if op == "$lt" and not value < operand:
+                        return False
+                    if op == "$lte" and not value <= operand:
+                        return False
+                    if op == "$gt" and not value > operand:
+                        return False
+                    if op == "$gte" and not value >= operand:
+                        return False
+        elif value != condition and not (isinstance(value, list) and condition in value):
+            return False
+    return True
+
+
+class FakeCollection:
+    """Subset of ``AsyncIOMotorCollection`` backed by a list of dicts."""
+
+    def __init__(self, name, listener: Optional[Callable[..., Any]] = None):
+        self.name = name
+        self.docs: List[dict] = []
+        self.listener = listener
+        self.op_counts: Dict[str, int] = {}
+        # Lookups of documents by field values, valid while no write came in
+        # between: {("key" | "in", fields): (writes when built, lookup)}
+        self._writes = 0
+        self._lookups: Dict[tuple, tuple] = {}
+
+    def _record(self, op, *args):
+        self.op_counts[op] = self.op_counts.get(op, 0) + 1
+        if op not in _READS:
+            self._writes += 1
+        if self.listener:
+            self.listener(self.name, op, *args)
+
+    def _lookup(self, kind, fields):
+        """Documents by their values of ``fields``, or None if some value is not a plain one.
+
+        "key" maps the tuple of values to the first document holding them,
+        "in" maps each value of one field, or of the array in it, to the
+        positions of the documents holding it.
+        """
+        cached = self._lookups.get((kind, fields))
+        if cached is not None and cached[0] == self._writes:
+            return cached[1]
+        lookup = {}
+        for position, doc in enumerate(self.docs):
+            if not self._add_to_lookup(kind, fields, lookup, position, doc):
+                lookup = None
+                break
+        self._lookups[(kind, fields)] = (self._writes, lookup)
+        return lookup
+
+    @staticmethod
+    def _add_to_lookup(kind, fields, lookup, position, doc):
+        values = tuple(_get_path(doc, field)[0] for field in fields)
+        if kind == "key":
+            if not _plain_values(values):
+                return False
+            lookup.setdefault(values, doc)
+            return True
+        value = values[0]
+        items = value if isinstance(value, list) else [value]
+        if not _plain_values(items):
+            return False
+        for item in items:
+            lookup.setdefault(item, []).append(position)
+        return True
+
+    async def find_one(self, filter=None, projection=None):
+        self._record("find_one", filter)
+        for doc in self.docs:
+            if _matches(doc, filter or {}):
+                return dict(doc)
+        return None
+
+    async def insert_one(self, doc):
+        self._record("insert_one", doc)
+        self.docs.append(doc)
+        return FakeInsertOneResult(doc.get("_id"))
+
+    async def insert_many(self, docs, ordered=True):
+        self._record("insert_many", len(docs))
+        self.docs.extend(docs)
+
+    async def update_one(self, filter, update, upsert=False):
+        self._record("update_one", filter, update)
+        for doc in self.docs:
+            if _matches(doc, filter):
+                self._apply(doc, update)
+                return FakeUpdateResult(1, 1)
+        if upsert:
+            doc = {k: v for k, v in filter.items() if not isinstance(v, dict)}
+            self._apply(doc, update, inserting=True)
+            self.docs.append(doc)
+            return FakeUpdateResult(0, 0, doc.get("_id"))
+        return FakeUpdateResult(0, 0)
+
+    async def find_one_and_update(self, filter, update, projection=None, upsert=False,
+                                  return_document=False, **kwargs):
+        self._record("find_one_and_update", filter, update)
+        for doc in self.docs:
+            if _matches(doc, filter):
+                before = dict(doc)
+                self._apply(doc, update)
+                return dict(doc) if return_document else before
+        if upsert:
+            doc = {k: v for k, v in filter.items() if not isinstance(v, dict)}
+            self._apply(doc, update)
+            self.docs.append(doc)
+            return dict(doc) if return_document else None
+        return None
+
+    def find(self, filter=None, projection=None):
+        self._record("find", filter)
+        filter = _with_in_sets(filter or {})
+        docs = self.docs
+        for field, condition in filter.items():
+            if isinstance(condition, dict) and isinstance(condition.get("$in"), frozenset):
+                values = condition["$in"]
+            elif isinstance(condition, int) and not isinstance(condition, bool):
+                # Equality, which also matches an element of an array
+                values = (condition,)
+            else:
+                continue
+            lookup = self._lookup("in", (field,))
+            if lookup is not None:
+                positions = {position for value in values for position in lookup.get(value, ())}
+                docs = [self.docs[position] for position in sorted(positions)]
+                break
+        return FakeCursor([dict(doc) for doc in docs if _matches(doc, filter)])
+
+    async def create_index(self, keys, **kwargs):
+        return keys if isinstance(keys, str) else "_".join(f"{k}_{d}" for k, d in keys)
+
+    async def count_documents(self, filter):
+        self._record("count_documents", filter)
+        return sum(1 for doc in self.docs if _matches(doc, filter))
+
+    async def delete_one(self, filter):
+        self._record("delete_one", filter)
+        for index, doc in enumerate(self.docs):
+            if _matches(doc, filter):
+                del self.docs[index]
+                return FakeDeleteResult(1)
+        return FakeDeleteResult(0)
+
+    async def delete_many(self, filter):
+        self._record("delete_many", filter)
+        kept = [doc for doc in self.docs if not _matches(doc, filter)]
+        deleted = len(self.docs) - len(kept)
+        self.docs = kept
+        return FakeDeleteResult(deleted)
+
+    async def bulk_write(self, requests, ordered=True):
+        """Applies pymongo UpdateOne/InsertOne/DeleteOne request objects."""
+        # Upserts by plain field values, as most are, look their document up
+        # instead of scanning the collection once per request; lookups that
+        # were current are kept so through the requests below
+        lookups = {key: lookup for key, (writes, lookup) in self._lookups.items()
+                   if writes == self._writes and lookup is not None}
+        self._lookups = {}
+        for request in requests:
+            kind = type(request).__name__
+            if kind == "InsertOne":
+                self.docs.append(request._doc)
+                lookups = {}
+            elif kind == "DeleteOne":
+                for index, doc in enumerate(self.docs):
+                    if _matches(doc, request._filter):
+                        del self.docs[index]
+                        break
+                lookups = {}
+            elif kind in ("UpdateOne", "UpdateMany"):
+                fields = tuple(request._filter)
+                lookup = None
+                if kind == "UpdateOne" and _plain_values(request._filter.values()):
+                    if ("key", fields) not in lookups:
+                        lookups[("key", fields)] = self._lookup("key", fields)
+                        self._lookups = {}
+                    lookup = lookups[("key", fields)]
+                if lookup is not None:
+                    found = lookup.get(tuple(request._filter.values()))
+                    matched = [found] if found is not None else []
+                else:
+                    matched = [doc for doc in self.docs if _matches(doc, request._filter)]
+                if kind == "UpdateOne":
+                    matched = matched[:1]
+                for doc in matched:
+                    self._apply(doc, request._doc)
+                if matched:
+                    changed = {path.split(".")[0] for op in request._doc.values() for path in op}
+                    lookups = {key: lookup for key, lookup in lookups.items()
+                               if lookup is not None and not changed & {field.split(".")[0] for field in key[1]}}
+                if not matched and request._upsert:
+                    doc = {k: v for k, v in request._filter.items() if not isinstance(v, dict)}
+                    self._apply(doc, request._doc, inserting=True)
+                    self.docs.append(doc)
+                    lookups = {key: lookup for key, lookup in lookups.items() if lookup is not None and
+                               self._add_to_lookup(*key, lookup, len(self.docs) - 1, doc)}
+        self._record("bulk_write", len(requests))
+        self._lookups = {key: (self._writes, lookup) for key, lookup in lookups.items()}
+        return FakeBulkWriteResult(len(requests))
+
+    def _apply(self, doc, update, inserting=False):
+        if inserting:
+            for path, value in update.get("$setOnInsert", {}).items():
+                _set_path(doc, path, value)
+        for path, value in update.get("$set", {}).items():
+            _set_path(doc, path, value)
+        for path in update.get("$unset", {}):
+            _unset_path(doc, path)
+        for path, amount in update.get("$inc", {}).items():
+            current, _ = _get_path(doc, path)
+            _set_path(doc, path, (current or 0) + amount)
+        for path, value in update.get("$push", {}).items():
+            current, _ = _get_path(doc, path)
+            items = list(current or [])
+            if isinstance(value, dict) and "$each" in value:
+                items.extend(value["$each"])
+                if "$slice" in value:
+                    items = items[value["$slice"]:] if value["$slice"] < 0 else items[:value["$slice"]]
+            else:
+                items.append(value)
+            _set_path(doc, path, items)
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, key, direction=1):
+        keys = [(key, direction)] if isinstance(key, str) else key
+        for field, order in reversed(keys):
+            self.docs.sort(key=lambda d: (_get_path(d, field)[0] is not None, _get_path(d, field)[0]),
+                           reverse=order < 0)
+        return self
+
+    def skip(self, count):
+        self.docs = self.docs[count:]
+        return self
+
+    def limit(self, count):
+        if count:
+            self.docs = self.docs[:count]
+        return self
+
+    async def to_list(self, length=None):
+        return self.docs if length is None else self.docs[:length]
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self.docs:
+            yield doc
+
+
+class FakeDatabase:
+    """Attribute/item access returns a lazily created FakeCollection."""
+
+    def __init__(self, listener: Optional[Callable[..., Any]] = None):
+        self._listener = listener
+        self._collections: Dict[str, FakeCollection] = {}
+
+    def __getitem__(self, name):
+        if name not in self._collections:
+            self._collections[name] = FakeCollection(name, self._listener)
+        return self._collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
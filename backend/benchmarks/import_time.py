@@ -0,0 +1,128 @@
+"""Import-time budget for the entry points of the backend.
+
+Imports each entry point in a fresh interpreter under ``python -X
+importtime`` and checks two things:
+
+``budget``     the cumulative import time of the module, best of
+               ``--repeat`` runs, stays within its budget in milliseconds.
+``forbidden``  none of the modules that entry point must not load were
+               imported: the API starts without Telethon, bcrypt, JWT,
+               Google auth or the MongoDB driver, and the scraping side
+               without the web stack.
+
+The heaviest top-level packages are listed for each entry point. Run from
+the backend directory; the exit status is 1 when a check fails:
+
+    python -m benchmarks.import_time --repeat 5 --budget server=1200
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+from collections import defaultdict
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+WEB_STACK = ("fastapi", "starlette", "jose", "passlib", "google.auth", "google.oauth2", "fastapi_mail")
+
+ENTRY_POINTS = {
+    "server": {
+        "budget_ms": 1500,
+        "forbidden": ("telethon", "scraping", "sessions", "motor", "jose", "passlib",
+                      "google.auth", "google.oauth2", "fastapi_mail"),
+    },
+    "worker": {"budget_ms": 1000, "forbidden": WEB_STACK + ("auth",)},
+    "scraping": {"budget_ms": 1000, "forbidden": WEB_STACK + ("auth",)},
+    "storage": {"budget_ms": 300, "forbidden": WEB_STACK + ("telethon", "motor")},
+}
+
+# Prints the loaded modules after the import; -X importtime goes to stderr
+PROBE = "import sys, json, {module}; print(json.dumps(sorted(sys.modules)))"
+
+
+def import_once(module: str):
+    """Import ``module`` in a fresh interpreter; return (cumulative us, self us per module, loaded modules)."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROBE.format(module=module)],
+        cwd=BACKEND_DIR, capture_output=True, text=True, env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"},
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"importing {module} failed:\n{result.stderr[-2000:]}")
+    cumulative, self_times = None, {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, cumulative_us, name = (part.strip() for part in line[len("import time:"):].split("|"))
+        if not self_us.isdigit():
+            continue  # the header line
+        self_times[name] = int(self_us)
+        if name == module:
+            cumulative = int(cumulative_us)
+    return cumulative, self_times, json.loads(result.stdout.splitlines()[-1])
+
+
+def heaviest(self_times, count=5):
+    """Top-level packages by the import time spent in them, in ms."""
+    packages = defaultdict(int)
+    for name, self_us in self_times.items():
+        packages[name.split(".")[0]] += self_us
+    return [(name, round(us / 1000, 1)) for name, us in sorted(packages.items(), key=lambda p: -p[1])[:count]]
+
+
+def check(module: str, budget_ms=None, repeat=3):
+    spec = ENTRY_POINTS[module]
+    budget_ms = spec["budget_ms"] if budget_ms is None else budget_ms
+    runs = [import_once(module) for _ in range(max(repeat, 1))]
+    cumulative, self_times, loaded = min(runs, key=lambda run: run[0])
+    loaded = set(loaded)
+    forbidden = sorted(name for name in spec["forbidden"] if name in loaded)
+    import_ms = round(cumulative / 1000, 1)
+    return {
+        "import_ms": import_ms,
+        "budget_ms": budget_ms,
+        "modules": len(loaded),
+        "forbidden_loaded": forbidden,
+        "heaviest": heaviest(self_times),
+        "ok": import_ms <= budget_ms and not forbidden,
+    }
+
+
+def run(modules=None, budgets=None, repeat=3):
+    budgets = budgets or {}
+    return {module: check(module, budgets.get(module), repeat) for module in (modules or ENTRY_POINTS)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("modules", nargs="*", help=f"Entry points to check: {', '.join(ENTRY_POINTS)} (all by default)")
+    parser.add_argument("--repeat", type=int, default=3, help="Fresh imports per entry point; the fastest is kept")
+    parser.add_argument("--budget", action="append", default=[], metavar="MODULE=MS",
+                        help="Override the budget of an entry point")
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args(argv)
+    unknown = [module for module in args.modules if module not in ENTRY_POINTS]
+    if unknown:
+        parser.error(f"unknown entry points: {', '.join(unknown)}")
+
+    budgets = {}
+    for override in args.budget:
+        module, _, ms = override.partition("=")
+        budgets[module] = float(ms)
+    report = run(args.modules or None, budgets, args.repeat)
+    for module, result in report.items():
+        status = "ok" if result["ok"] else "OVER" if not result["forbidden_loaded"] else "FORBIDDEN"
+        print(f"{module:9} {result['import_ms']:>8.1f} ms / {result['budget_ms']:>6.0f} ms  {status:9} "
+              f"{result['modules']} modules, heaviest: "
+              + ", ".join(f"{name} {ms}" for name, ms in result["heaviest"]))
+        if result["forbidden_loaded"]:
+            print(f"{'':9} loads {', '.join(result['forbidden_loaded'])}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    return 0 if all(result["ok"] for result in report.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
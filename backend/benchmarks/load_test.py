@@ -0,0 +1,351 @@
+"""API load test against local stand-ins for MongoDB and Telegram.
+
+Runs the FastAPI app in-process, over httpx's ASGI transport, with
+FakeDatabase, a SQLite message store in a temporary directory and a
+FakeTelegramClient per user, so no server, database or Telegram account
+is needed. Each user account logs in once before the clock starts; then
+``--concurrency`` virtual users, spread over the accounts, make requests
+from a weighted mix for ``--duration`` seconds:
+
+``login``         POST /api/login (checks the bcrypt hash)
+``channels``      GET /api/channels
+``channel_crud``  POST /api/channels, then DELETE of the same channel
+``channel_data``  GET /api/channel-data, sending back the ETag it got like
+                  a polling client does
+``export``        GET /api/export-data as CSV or JSON
+``scrape``        POST /api/scrape; the scrape runs on the fake client, in
+                  which ``--post-rate`` new messages a second appear
+
+The report gives, per endpoint (route template), the requests made,
+their status codes, throughput and latency percentiles. Load generator
+and app share one process and event loop, so use it to compare
+deployments and changes rather than as a measure of a real server.
+Rate limits apply as configured; ``--no-rate-limits`` lifts them to find
+the capacity behind them. Run from the backend directory:
+
+    python -m benchmarks.load_test --concurrency 50 --duration 30
+    python -m benchmarks.load_test --mix channel_data=90,export=10 --output load.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from benchmarks.fakes import ChannelSpec, FakeDatabase, FakeTelegramClient  # noqa: E402
+from benchmarks.scrape_throughput import percentile  # noqa: E402
+
+PASSWORD = "load-test-password"
+
+DEFAULT_MIX = {"login": 2, "channels": 10, "channel_crud": 3, "channel_data": 75, "export": 5, "scrape": 5}
+
+_MISSING = object()
+
+
+def parse_mix(text) -> dict:
+    """``name=weight,...`` into a mix; names must be operations of VirtualUser."""
+    mix = {}
+    for part in filter(None, (part.strip() for part in text.split(","))):
+        name, _, weight = part.partition("=")
+        if name not in DEFAULT_MIX:
+            raise ValueError(f"Unknown operation {name!r}; choose from {', '.join(DEFAULT_MIX)}")
+        mix[name] = float(weight or 1)
+    if not mix or not any(mix.values()):
+        raise ValueError("The mix needs at least one operation with a positive weight")
+    return mix
+
+
+class Recorder:
+    """Latency and status of every request, by endpoint."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+
+    def record(self, endpoint, status, seconds):
+        self.latencies[endpoint].append(seconds * 1000)
+        self.statuses[endpoint][status] += 1
+
+    def report(self, elapsed) -> dict:
+        endpoints = {}
+        for endpoint in sorted(self.latencies):
+            latencies = self.latencies[endpoint]
+            statuses = self.statuses[endpoint]
+            endpoints[endpoint] = {
+                "requests": len(latencies),
+                "requests_per_sec": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+                "statuses": {str(code): count for code, count in sorted(statuses.items())},
+                "errors": sum(count for code, count in statuses.items() if code >= 500),
+                "latency_p50_ms": round(percentile(latencies, 50), 3),
+                "latency_p90_ms": round(percentile(latencies, 90), 3),
+                "latency_p99_ms": round(percentile(latencies, 99), 3),
+                "latency_max_ms": round(max(latencies), 3),
+            }
+        return endpoints
+
+
+class VirtualUser:
+    """One client of the API; each operation is one or two requests."""
+
+    def __init__(self, http, user, token, recorder, rng):
+        self.http = http
+        self.user = user
+        self.recorder = recorder
+        self.rng = rng
+        self.channel_ids = list(user["channels"])
+        self.etags = {}
+        self.created = 0
+        self.headers = {"Authorization": f"Bearer {token}"}
+
+    async def request(self, endpoint, method, url, **kwargs):
+        headers = {**self.headers, **kwargs.pop("headers", {})}
+        started = time.perf_counter()
+        response = await self.http.request(method, url, headers=headers, **kwargs)
+        self.recorder.record(endpoint, response.status_code, time.perf_counter() - started)
+        return response
+
+    async def login(self):
+        response = await self.request("POST /api/login", "POST", "/api/login",
+                                      json={"email": self.user["email"], "password": PASSWORD})
+        if response.status_code == 200:
+            self.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    async def channels(self):
+        await self.request("GET /api/channels", "GET", "/api/channels")
+
+    async def channel_crud(self):
+        self.created += 1
+        channel_id = f"scratch_{id(self):x}_{self.created}"
+        await self.request("POST /api/channels", "POST", "/api/channels", json={"channel_id": channel_id})
+        await self.request("DELETE /api/channels/{channel_id}", "DELETE", f"/api/channels/{channel_id}")
+
+    async def channel_data(self):
+        channel_id = self.rng.choice(self.channel_ids)
+        headers = {"If-None-Match": self.etags[channel_id]} if channel_id in self.etags else {}
+        response = await self.request("GET /api/channel-data/{channel_id}", "GET",
+                                      f"/api/channel-data/{channel_id}", headers=headers)
+        if "etag" in response.headers:
+            self.etags[channel_id] = response.headers["etag"]
+
+    async def export(self):
+        channel_id = self.rng.choice(self.channel_ids)
+        file_format = self.rng.choice(("csv", "json"))
+        await self.request("GET /api/export-data/{channel_id}/{format}", "GET",
+                           f"/api/export-data/{channel_id}/{file_format}")
+
+    async def scrape(self):
+        channel_id = self.rng.choice(self.channel_ids)
+        await self.request("POST /api/scrape/{channel_id}", "POST", f"/api/scrape/{channel_id}")
+
+    async def run(self, mix, deadline):
+        names, weights = list(mix), list(mix.values())
+        while time.perf_counter() < deadline:
+            await getattr(self, self.rng.choices(names, weights)[0])()
+
+
+async def post_messages(clients, rate, deadline, rng):
+    """New messages in random channels of the fake clients, ``rate`` a second."""
+    if rate <= 0:
+        return
+    while time.perf_counter() < deadline:
+        client = rng.choice(clients)
+        client.add_messages(rng.choice(list(client.channels)), 1)
+        await asyncio.sleep(1 / rate)
+
+
+def _install(patches):
+    """Set module attributes; returns what restores them (lazy services stay unbuilt)."""
+    saved = [(module, name, module.__dict__.get(name, _MISSING)) for module, name, _ in patches]
+    for module, name, value in patches:
+        setattr(module, name, value)
+    return saved
+
+
+def _restore(saved):
+    for module, name, value in reversed(saved):
+        if value is _MISSING:
+            delattr(module, name)
+        else:
+            setattr(module, name, value)
+
+
+async def _run(users, channels, messages, concurrency, duration, mix, post_rate, rate_limits, seed, workdir):
+    import httpx
+
+    import auth
+    import scraping
+    import server
+    import state
+    from accounts import AccountPool
+    from admission import (
+        EXPORT_RATE_BURST,
+        EXPORT_RATE_PER_MINUTE,
+        EXPORT_SLOTS,
+        EXPORT_USER_CONCURRENCY,
+        EXPORT_USER_QUEUE,
+        SCRAPE_RATE_BURST,
+        SCRAPE_RATE_PER_MINUTE,
+        SCRAPE_SLOTS,
+        SCRAPE_USER_CONCURRENCY,
+        SCRAPE_USER_QUEUE,
+        FairScheduler,
+        RateLimiter,
+    )
+    from broker import MessageBroker
+    from dialogs import DialogCache
+    from export import ChannelDataCache
+    from jobs import JobRegistry
+    from storage import SQLiteMessageStore
+
+    rng = random.Random(seed)
+    db = FakeDatabase()
+    store = SQLiteMessageStore(base_dir=workdir)
+    channel_ids = [f"channel_{index}" for index in range(channels)]
+    hashed_password = auth.get_password_hash(PASSWORD)
+
+    # Every user follows channels with the same history; records are built once
+    template = FakeTelegramClient({channel_id: ChannelSpec(messages=messages, seed=index)
+                                   for index, channel_id in enumerate(channel_ids)})
+    records = {channel_id: [scraping.message_record(message, message.sender)
+                            for message in template.messages_for(channel_id)] for channel_id in channel_ids}
+    clients, accounts = {}, []
+    for index in range(users):
+        user = {
+            "id": f"load-user-{index}",
+            "email": f"load{index}@example.com",
+            "hashed_password": hashed_password,
+            "telegram_credentials": {"api_id": 1, "api_hash": "load", "phone": f"+1{index:09d}"},
+            "channels": {channel_id: messages for channel_id in channel_ids},
+            "scrape_media": False,
+        }
+        await db.users.insert_one(user)
+        accounts.append(user)
+        clients[user["id"]] = FakeTelegramClient({channel_id: ChannelSpec(messages=messages, seed=position)
+                                                  for position, channel_id in enumerate(channel_ids)})
+        for channel_id in channel_ids:
+            store.save_messages(user["id"], channel_id, records[channel_id])
+    del template, records
+
+    async def get_fake_client(user_id, account=None):
+        return clients[user_id]
+
+    if rate_limits:
+        scrape_rate = RateLimiter("scrape", SCRAPE_RATE_PER_MINUTE, SCRAPE_RATE_BURST)
+        export_rate = RateLimiter("export", EXPORT_RATE_PER_MINUTE, EXPORT_RATE_BURST)
+    else:
+        scrape_rate, export_rate = RateLimiter("scrape", 0, 1), RateLimiter("export", 0, 1)
+    saved = _install([
+        (state, "db", db),
+        (state, "message_store", store),
+        (state, "broker", MessageBroker()),
+        (state, "job_registry", JobRegistry(db.scrape_jobs)),
+        (state, "account_pool", AccountPool(db.telegram_accounts)),
+        (state, "dialog_cache", DialogCache(db.dialog_cache, db.dialog_sync_state)),
+        (state, "channel_cache", ChannelDataCache()),
+        (state, "scrape_scheduler", FairScheduler("scrape", SCRAPE_SLOTS, SCRAPE_USER_CONCURRENCY, SCRAPE_USER_QUEUE)),
+        (state, "export_scheduler", FairScheduler("export", EXPORT_SLOTS, EXPORT_USER_CONCURRENCY, EXPORT_USER_QUEUE)),
+        (state, "scrape_rate", scrape_rate),
+        (state, "export_rate", export_rate),
+        (auth, "SECRET_KEY", auth.SECRET_KEY or "load-test-secret"),
+        (scraping, "get_telegram_client", get_fake_client),
+    ])
+    recorder = Recorder()
+    try:
+        await server.app.router.startup()
+        try:
+            transport = httpx.ASGITransport(app=server.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://load-test", timeout=None) as http:
+                tokens = []
+                for user in accounts:
+                    response = await http.post("/api/login", json={"email": user["email"], "password": PASSWORD})
+                    response.raise_for_status()
+                    tokens.append(response.json()["access_token"])
+                virtual_users = [VirtualUser(http, accounts[index % users], tokens[index % users], recorder,
+                                             random.Random(seed + index)) for index in range(concurrency)]
+                started = time.perf_counter()
+                deadline = started + duration
+                await asyncio.gather(post_messages(list(clients.values()), post_rate, deadline, rng),
+                                     *(user.run(mix, deadline) for user in virtual_users))
+                elapsed = time.perf_counter() - started
+        finally:
+            await server.app.router.shutdown()
+        jobs = await db.scrape_jobs.find({}).to_list(None)
+    finally:
+        _restore(saved)
+
+    endpoints = recorder.report(elapsed)
+    return {
+        "elapsed_sec": round(elapsed, 3),
+        "requests": sum(e["requests"] for e in endpoints.values()),
+        "requests_per_sec": round(sum(e["requests"] for e in endpoints.values()) / elapsed, 2) if elapsed else 0.0,
+        "scrape_jobs": dict(Counter(job["state"] for job in jobs)),
+        "endpoints": endpoints,
+    }
+
+
+def run(users=20, channels=5, messages=1000, concurrency=20, duration=10.0, mix=None, post_rate=20.0,
+        rate_limits=True, seed=1):
+    """Run one load test in the current process and return its report."""
+    workdir = tempfile.mkdtemp(prefix="load-test-")
+    try:
+        return asyncio.run(_run(users, channels, messages, concurrency, duration, mix or DEFAULT_MIX,
+                                post_rate, rate_limits, seed, workdir))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20, help="Accounts the virtual users log in as")
+    parser.add_argument("--channels", type=int, default=5, help="Channels per user")
+    parser.add_argument("--messages", type=int, default=1000, help="Stored messages per channel")
+    parser.add_argument("--concurrency", type=int, default=20, help="Virtual users making requests at once")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds to run for")
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX,
+                        help="Weights of the operations, e.g. channel_data=90,export=10")
+    parser.add_argument("--post-rate", type=float, default=20.0, help="New messages a second in the fake channels")
+    parser.add_argument("--no-rate-limits", action="store_true", help="Lift the per-user scrape and export rate limits")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the request mix")
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    # Not a line per request and per scrape
+    for name in ("httpx", "scraping", "metrics", "storage"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    result = run(args.users, args.channels, args.messages, args.concurrency, args.duration, args.mix,
+                 args.post_rate, not args.no_rate_limits, args.seed)
+    print(f"{result['requests']} requests in {result['elapsed_sec']:.1f}s, {result['requests_per_sec']:.1f} req/s")
+    for endpoint, metrics in result["endpoints"].items():
+        statuses = " ".join(f"{code}:{count}" for code, count in metrics["statuses"].items())
+        print(f"{endpoint:44} {metrics['requests_per_sec']:>9.1f} req/s  p50 {metrics['latency_p50_ms']:>8.2f} ms  "
+              f"p90 {metrics['latency_p90_ms']:>8.2f} ms  p99 {metrics['latency_p99_ms']:>8.2f} ms  {statuses}")
+
+    if args.output:
+        report = {
+            "benchmark": "load_test",
+            "created_at": datetime.utcnow().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "settings": {key: value for key, value in vars(args).items() if key != "output"},
+            **result,
+        }
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
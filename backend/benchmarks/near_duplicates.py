@@ -0,0 +1,153 @@
+"""Near-duplicate index benchmark: cost and accuracy as the corpus grows.
+
+Indexes a synthetic corpus, spread over a few channels, in scrape-sized
+batches through NearDuplicateIndex on the in-memory fake database. Words
+follow a Zipf distribution; a share of the messages repost an earlier one
+with a single edit (a word added, dropped or replaced, or a prefix such as
+"BREAKING:"). At each checkpoint it reports, for the messages indexed since
+the previous one:
+
+``candidates_per_message``  signatures fetched from the band index per
+                            message indexed, which stays flat while the
+                            corpus grows if lookups are sublinear
+``us_per_message``          wall time of NearDuplicateIndex.add
+``recall``                  reposts that joined their original's cluster
+``false_merges``            original messages put in another's cluster
+
+Run from the backend directory:
+
+    python -m benchmarks.near_duplicates --messages 50000
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from benchmarks.fakes import FakeDatabase  # noqa: E402
+from duplicates import NearDuplicateIndex, cluster_key  # noqa: E402
+from storage import MessageRecord  # noqa: E402
+
+USER_ID = "bench"
+BATCH_SIZE = 100
+
+
+def _record(message_id, text, date):
+    fields = dict.fromkeys(MessageRecord._fields)
+    fields.update(message_id=message_id, message=text, date=date)
+    return MessageRecord(**fields)
+
+
+class Corpus:
+    """Synthetic messages; ``origin`` maps reposts to the key of the message they copy."""
+
+    def __init__(self, messages, channels=5, vocabulary=20000, repost_ratio=0.2, seed=1):
+        self.rng = random.Random(seed)
+        self.words = [f"w{index}" for index in range(vocabulary)]
+        self.weights = [1 / (rank + 1) for rank in range(vocabulary)]
+        self.channels = [f"channel{index}" for index in range(channels)]
+        self.origin = {}
+        self.batches = []
+        texts, next_id, start = [], {channel: 1 for channel in self.channels}, datetime(2024, 1, 1)
+        for position in range(0, messages, BATCH_SIZE):
+            channel = self.channels[(position // BATCH_SIZE) % channels]
+            batch = []
+            for _ in range(min(BATCH_SIZE, messages - position)):
+                message_id = next_id[channel]
+                next_id[channel] += 1
+                if texts and self.rng.random() < repost_ratio:
+                    source, words = self.rng.choice(texts)
+                    text = " ".join(self._edit(list(words)))
+                    self.origin[(channel, message_id)] = source
+                else:
+                    words = self.rng.choices(self.words, self.weights, k=self.rng.randint(12, 60))
+                    text = " ".join(words)
+                    texts.append(((channel, message_id), words))
+                batch.append(_record(message_id, text, start + timedelta(seconds=len(texts))))
+            self.batches.append((channel, batch))
+
+    def _edit(self, words):
+        edit = self.rng.randrange(4)
+        position = self.rng.randrange(len(words))
+        if edit == 0:
+            words.append(self.rng.choice(self.words))
+        elif edit == 1:
+            del words[position]
+        elif edit == 2:
+            words[position] = self.rng.choice(self.words)
+        else:
+            words.insert(0, "BREAKING")
+        return words
+
+
+async def _index(corpus, checkpoints):
+    index = NearDuplicateIndex(FakeDatabase().message_signatures)
+    fetched = [0]
+    candidates = index._candidates
+
+    async def counted(user_id, keys):
+        found = await candidates(user_id, keys)
+        fetched[0] += len(found)
+        return found
+
+    index._candidates = counted
+    clusters, report = {}, []
+    window = {"messages": 0, "candidates": 0, "seconds": 0.0}
+    every = max(len(corpus.batches) // checkpoints, 1)
+    for number, (channel, batch) in enumerate(corpus.batches, 1):
+        before = fetched[0]
+        started = time.perf_counter()
+        assigned = await index.add(USER_ID, channel, batch)
+        window["seconds"] += time.perf_counter() - started
+        window["candidates"] += fetched[0] - before
+        window["messages"] += len(batch)
+        clusters.update({(channel, message_id): cluster for message_id, cluster in assigned.items()})
+        if number % every == 0 or number == len(corpus.batches):
+            report.append({
+                "indexed": len(clusters),
+                "candidates_per_message": round(window["candidates"] / window["messages"], 2),
+                "us_per_message": round(window["seconds"] / window["messages"] * 1e6, 1),
+            })
+            window = {"messages": 0, "candidates": 0, "seconds": 0.0}
+    return clusters, report
+
+
+def run(messages: int, checkpoints=4, seed=1):
+    corpus = Corpus(messages, seed=seed)
+    clusters, report = asyncio.run(_index(corpus, checkpoints))
+    reposts = [(key, source) for key, source in corpus.origin.items() if key in clusters and source in clusters]
+    originals = [key for key in clusters if key not in corpus.origin]
+    return {
+        "messages": messages,
+        "checkpoints": report,
+        "recall": round(sum(clusters[key] == clusters[source] for key, source in reposts) / max(len(reposts), 1), 3),
+        "false_merges": round(sum(clusters[key] != cluster_key(*key) for key in originals) / max(len(originals), 1), 4),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=20000, help="Messages in the synthetic corpus")
+    parser.add_argument("--checkpoints", type=int, default=4, help="Times to report along the way")
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    report = run(args.messages, args.checkpoints)
+    for checkpoint in report["checkpoints"]:
+        print("  ".join(f"{key} {value}" for key, value in checkpoint.items()))
+    print(f"recall {report['recall']}  false_merges {report['false_merges']}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
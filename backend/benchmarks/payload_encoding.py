@@ -0,0 +1,130 @@
+"""Encoding benchmark for the message payloads of the API.
+
+Compares the former path of each endpoint with the serialization layer,
+on a synthetic SQLite channel:
+
+``channel_data``  /channel-data: ``latest_messages`` dicts run through
+                  FastAPI's jsonable_encoder and json.dumps, against
+                  ``latest_messages_json`` (rows encoded by SQLite).
+``export_json``   the JSON export: a dict per row dumped with
+                  ``json.dump(indent=4)``, against the streaming
+                  ``export_json``.
+``stream``        one server-sent event per message: json.dumps against
+                  ``serialization.dumps``.
+
+Run from the backend directory:
+
+    python -m benchmarks.payload_encoding --messages 20000
+"""
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from benchmarks.fakes import ChannelSpec, FakeTelegramClient  # noqa: E402
+
+USER_ID = "bench"
+CHANNEL_ID = "bench_channel"
+
+
+def best_of(repeat, function):
+    """Fastest of ``repeat`` runs, in seconds, and the last result."""
+    best, result = None, None
+    for _ in range(max(repeat, 1)):
+        started = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def _fastapi_json(content) -> bytes:
+    """What FastAPI's default JSONResponse does with a returned dict."""
+    from fastapi.encoders import jsonable_encoder
+    return json.dumps(jsonable_encoder(content), ensure_ascii=False, allow_nan=False,
+                      indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def _dict_export(store, path):
+    conn = store.connect(USER_ID, CHANNEL_ID)
+    conn.row_factory = sqlite3.Row
+    try:
+        data = [dict(row) for row in conn.execute("SELECT * FROM message_rows")]
+    finally:
+        conn.close()
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=4)
+
+
+def run(messages: int, limits=(100, 5000), repeat=3):
+    import scraping
+    from serialization import dumps
+    from storage import SQLiteMessageStore
+
+    workdir = tempfile.mkdtemp(prefix="payload-bench-")
+    try:
+        store = SQLiteMessageStore(base_dir=workdir)
+        client = FakeTelegramClient({CHANNEL_ID: ChannelSpec(messages=messages, forward_ratio=0.05)})
+        store.save_messages(USER_ID, CHANNEL_ID, [
+            scraping.message_record(message, message.sender) for message in client.messages_for(CHANNEL_ID)
+        ])
+        del client
+        report = {"messages": messages}
+
+        for limit in limits:
+            old_seconds, old = best_of(repeat, lambda: _fastapi_json(
+                {"messages": store.latest_messages(USER_ID, CHANNEL_ID, limit)}))
+            new_seconds, new = best_of(repeat, lambda: b'{"messages":' + store.latest_messages_json(
+                USER_ID, CHANNEL_ID, limit) + b'}')
+            assert json.loads(old) == json.loads(new), "channel data payloads differ"
+            report[f"channel_data_{limit}"] = {"current_ms": round(old_seconds * 1000, 3),
+                                               "new_ms": round(new_seconds * 1000, 3), "bytes": len(new)}
+
+        paths = {name: os.path.join(workdir, f"{name}.json") for name in ("current", "new")}
+        old_seconds, _ = best_of(repeat, lambda: _dict_export(store, paths["current"]))
+        new_seconds, _ = best_of(repeat, lambda: store.export_json(USER_ID, CHANNEL_ID, paths["new"]))
+        with open(paths["current"], "rb") as old, open(paths["new"], "rb") as new:
+            assert json.load(old) == json.load(new), "JSON exports differ"
+        report["export_json"] = {"current_ms": round(old_seconds * 1000, 3), "new_ms": round(new_seconds * 1000, 3),
+                                 "bytes": os.path.getsize(paths["new"])}
+
+        rows = store.messages_since(USER_ID, CHANNEL_ID, 0, limit=messages)
+        old_seconds, _ = best_of(repeat, lambda: [json.dumps(row, ensure_ascii=False).encode("utf-8") for row in rows])
+        new_seconds, _ = best_of(repeat, lambda: [dumps(row) for row in rows])
+        report["stream"] = {"current_ms": round(old_seconds * 1000, 3), "new_ms": round(new_seconds * 1000, 3),
+                            "events": len(rows)}
+        return report
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=20000, help="Messages in the synthetic channel")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per case; the fastest is kept")
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    report = run(args.messages, repeat=args.repeat)
+    for case, metrics in report.items():
+        if isinstance(metrics, dict):
+            speedup = metrics["current_ms"] / metrics["new_ms"] if metrics["new_ms"] else 0.0
+            print(f"{case:18} current {metrics['current_ms']:>10.3f} ms  new {metrics['new_ms']:>10.3f} ms  "
+                  f"x{speedup:.1f}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,150 @@
+"""Allocation microbenchmark for the message representations of the scraper.
+
+Compares, under tracemalloc, what the scrape pipeline holds per queued
+message and what a JSON export allocates:
+
+``ingest``  every message of a synthetic channel converted to a pipeline
+            item. ``dict`` is the former item: the Telethon message, its
+            row tuple and the saved dict. ``record`` is ScrapedMessage with
+            a MessageRecord, the Telethon message dropped.
+``export``  export of a SQLite channel to JSON. ``dict`` builds a dict per
+            row and dumps the list; ``record`` is the streaming
+            ``export_json``, which has SQLite encode each row.
+
+Run from the backend directory:
+
+    python -m benchmarks.record_memory --messages 20000
+"""
+import argparse
+import gc
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from benchmarks.fakes import ChannelSpec, FakeTelegramClient  # noqa: E402
+
+CHANNEL_ID = "bench_channel"
+
+
+def measure(build):
+    """Run ``build`` once timed, once under tracemalloc; return (result, retained bytes, peak bytes, seconds).
+
+    tracemalloc slows allocation-heavy code down a lot, so it stays off
+    for the timed run.
+    """
+    gc.collect()
+    started = time.perf_counter()
+    build()
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    gc.collect()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, retained, peak, elapsed
+
+
+def _dict_item(message, sender):
+    import scraping
+    from storage import MESSAGE_COLUMNS
+    row = tuple(scraping.message_record(message, sender))
+    return {"message": message, "row": row, "saved": dict(zip(MESSAGE_COLUMNS, (None,) + row))}
+
+
+def _record_item(message, sender):
+    import scraping
+    item = scraping.ScrapedMessage(message)
+    item.record = scraping.message_record(message, sender)
+    item.message = None
+    return item
+
+
+def ingest(messages: int):
+    import scraping  # noqa: F401  imported here so that its import is not measured
+    spec = ChannelSpec(messages=messages, reply_ratio=0.1, forward_ratio=0.05)
+    metrics = {}
+    for name, convert in (("dict", _dict_item), ("record", _record_item)):
+        def build():
+            # Fresh messages per run, as iter_messages hands them over
+            client = FakeTelegramClient({CHANNEL_ID: spec})
+            return [convert(message, message.sender) for message in client.messages_for(CHANNEL_ID)]
+
+        items, retained, peak, elapsed = measure(build)
+        metrics[name] = {
+            "retained_bytes_per_message": round(retained / messages, 1),
+            "peak_mb": round(peak / 2 ** 20, 2),
+            "seconds": round(elapsed, 4),
+        }
+        del items
+    return metrics
+
+
+def _dict_export(store, path):
+    conn = store.connect("bench", CHANNEL_ID)
+    conn.row_factory = sqlite3.Row
+    try:
+        data = [dict(row) for row in conn.execute("SELECT * FROM message_rows")]
+    finally:
+        conn.close()
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=4)
+
+
+def export(messages: int):
+    import scraping
+    from storage import SQLiteMessageStore
+
+    workdir = tempfile.mkdtemp(prefix="record-bench-")
+    try:
+        store = SQLiteMessageStore(base_dir=workdir)
+        client = FakeTelegramClient({CHANNEL_ID: ChannelSpec(messages=messages)})
+        store.save_messages("bench", CHANNEL_ID, [
+            scraping.message_record(message, message.sender) for message in client.messages_for(CHANNEL_ID)
+        ])
+        del client
+        paths = {}
+        metrics = {}
+        for name, run in (("dict", _dict_export), ("record", lambda s, p: s.export_json("bench", CHANNEL_ID, p))):
+            paths[name] = os.path.join(workdir, f"{name}.json")
+            _, _, peak, elapsed = measure(lambda: run(store, paths[name]))
+            metrics[name] = {"peak_mb": round(peak / 2 ** 20, 2), "seconds": round(elapsed, 4)}
+        with open(paths["dict"], "rb") as old, open(paths["record"], "rb") as new:
+            assert json.load(old) == json.load(new), "JSON exports differ"
+        return metrics
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run(messages: int):
+    return {"messages": messages, "ingest": ingest(messages), "export": export(messages)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=20000, help="Messages in the synthetic channel")
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    report = run(args.messages)
+    for case in ("ingest", "export"):
+        for name, metrics in report[case].items():
+            print(f"{case:7} {name:7} " + "  ".join(f"{key} {value}" for key, value in metrics.items()))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,302 @@
+"""Scrape throughput benchmark.
+
+Runs ``scrape_channel_task`` end to end against FakeTelegramClient and an
+in-memory Mongo stand-in, so no Telegram account or database server is
+needed. Every scenario runs in its own interpreter so that peak RSS is
+comparable between scenarios and between runs.
+
+Run from the backend directory:
+
+    python -m benchmarks.scrape_throughput --output bench.json
+    python -m benchmarks.scrape_throughput --compare bench.json
+
+``--compare`` exits with status 1 when any metric regressed by more than
+``--tolerance`` percent against the baseline report.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from bisect import bisect_left
+from dataclasses import asdict, fields
+from datetime import datetime
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from benchmarks.fakes import ChannelSpec, FakeDatabase, FakeTelegramClient  # noqa: E402
+
+BENCH_USER_ID = "bench-user"
+BENCH_CHANNEL_ID = "bench_channel"
+
+SCENARIOS = {
+    "text_only": ChannelSpec(messages=5000),
+    "mixed_media": ChannelSpec(messages=2000, photo_ratio=0.3, document_ratio=0.1, media_bytes=64 * 1024),
+    "slow_network": ChannelSpec(messages=2000, fetch_latency=0.05, photo_ratio=0.1, download_latency=0.01),
+    # Backfill split over four accounts; compare with --accounts 1
+    "multi_account": ChannelSpec(messages=20000, fetch_latency=0.25, accounts=4),
+}
+
+# Metric name -> True when a higher value is better.
+METRIC_DIRECTIONS = {
+    "messages_per_sec": True,
+    "sqlite_rows_per_sec": True,
+    "latency_p50_ms": False,
+    "latency_p99_ms": False,
+    "mongo_checkpoints": False,
+    "peak_rss_mb": False,
+}
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+async def _run(spec: ChannelSpec, scrape_media: bool):
+    import scraping
+    import state
+    from accounts import AccountPool
+    from jobs import JobRegistry
+
+    checkpoints = []
+
+    def listener(collection, op, *args):
+        if collection != "users" or op != "update_one":
+            return
+        update = args[1]
+        value = update.get("$set", {}).get(f"channels.{BENCH_CHANNEL_ID}")
+        if value is not None:
+            checkpoints.append((time.perf_counter(), value))
+
+    fake_db = FakeDatabase(listener)
+    await fake_db.users.insert_one({
+        "id": BENCH_USER_ID,
+        "email": "bench@example.com",
+        "telegram_credentials": {"api_id": 1, "api_hash": "bench", "phone": "+10000000000"},
+        "channels": {BENCH_CHANNEL_ID: 0},
+        "scrape_media": scrape_media,
+    })
+    for index in range(1, spec.accounts):
+        await fake_db.telegram_accounts.insert_one({
+            "user_id": BENCH_USER_ID, "account_id": f"bench-{index}",
+            "api_id": 1, "api_hash": "bench", "phone": f"+1000000000{index}",
+        })
+    # One client per account, all serving the same channel
+    fake_clients = {}
+
+    async def get_fake_client(user_id, account=None):
+        account_id = account["account_id"] if account else "primary"
+        if account_id not in fake_clients:
+            fake_clients[account_id] = FakeTelegramClient({BENCH_CHANNEL_ID: spec})
+        return fake_clients[account_id]
+
+    save_seconds = 0.0
+    original_save = scraping.save_messages_to_db
+
+    def timed_save(*args, **kwargs):
+        nonlocal save_seconds
+        started = time.perf_counter()
+        try:
+            return original_save(*args, **kwargs)
+        finally:
+            save_seconds += time.perf_counter() - started
+
+    job_registry = JobRegistry(fake_db.scrape_jobs)
+    job = await job_registry.create(BENCH_USER_ID, BENCH_CHANNEL_ID, 0)
+
+    patched = [
+        (state, "db", fake_db),
+        (state, "job_registry", job_registry),
+        (state, "account_pool", AccountPool(fake_db.telegram_accounts)),
+        (scraping, "get_telegram_client", get_fake_client),
+        (scraping, "save_messages_to_db", timed_save),
+    ]
+    originals = [(module, name, getattr(module, name)) for module, name, _ in patched]
+    for module, name, value in patched:
+        setattr(module, name, value)
+    try:
+        started = time.perf_counter()
+        await scraping.scrape_channel_task(BENCH_USER_ID, BENCH_CHANNEL_ID, 0, scrape_media, job_id=job["id"])
+        elapsed = time.perf_counter() - started
+    finally:
+        for module, name, value in originals:
+            setattr(module, name, value)
+
+    db_file = os.path.join(os.getcwd(), "data", BENCH_USER_ID, BENCH_CHANNEL_ID, f"{BENCH_CHANNEL_ID}.db")
+    conn = sqlite3.connect(db_file)
+    rows = conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+    conn.close()
+
+    # Per-message latency: from the fake client handing the message over to
+    # the first Mongo checkpoint that covers it.
+    checkpoint_values = [value for _, value in checkpoints]
+    running_max = []
+    for value in checkpoint_values:
+        running_max.append(max(value, running_max[-1]) if running_max else value)
+    yield_times = {}
+    for fake_client in fake_clients.values():
+        yield_times.update(fake_client.yield_times[BENCH_CHANNEL_ID])
+    latencies = []
+    for message_id, yielded_at in yield_times.items():
+        index = bisect_left(running_max, message_id)
+        if index < len(checkpoints):
+            latencies.append((checkpoints[index][0] - yielded_at) * 1000)
+
+    finished_job = await job_registry.get(job["id"], BENCH_USER_ID)
+
+    return {
+        "messages": spec.messages,
+        "rows_written": rows,
+        "elapsed_sec": round(elapsed, 4),
+        "messages_per_sec": round(rows / elapsed, 2) if elapsed else 0.0,
+        "latency_p50_ms": round(percentile(latencies, 50), 3),
+        "latency_p99_ms": round(percentile(latencies, 99), 3),
+        "sqlite_rows_per_sec": round(rows / save_seconds, 2) if save_seconds else 0.0,
+        "mongo_checkpoints": len(checkpoints),
+        "mongo_ops": sum(sum(c.op_counts.values()) for c in fake_db._collections.values()),
+        "fetch_requests": sum(c.fetch_requests for c in fake_clients.values()),
+        "media_bytes": sum(c.media_bytes_served for c in fake_clients.values()),
+        "job_state": finished_job["state"],
+    }
+
+
+def run_scenario(spec: ChannelSpec, scrape_media: bool = True):
+    """Run one scenario in the current process and return its metrics."""
+    workdir = tempfile.mkdtemp(prefix="scrape-bench-")
+    previous_cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        metrics = asyncio.run(_run(spec, scrape_media))
+    finally:
+        os.chdir(previous_cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    metrics["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2)
+    return metrics
+
+
+def run_isolated(name, spec: ChannelSpec, scrape_media: bool):
+    """Run a scenario in a fresh interpreter and return its metrics."""
+    cmd = [
+        sys.executable, "-m", "benchmarks.scrape_throughput",
+        "--child", json.dumps(asdict(spec)),
+    ]
+    if not scrape_media:
+        cmd.append("--no-media")
+    result = subprocess.run(cmd, cwd=BACKEND_DIR, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Scenario {name} failed:\n{result.stderr[-4000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def compare_reports(baseline, current, tolerance):
+    """Return a list of (scenario, metric, old, new, change_pct, regressed)."""
+    rows = []
+    for name, scenario in current["scenarios"].items():
+        old_metrics = baseline.get("scenarios", {}).get(name, {}).get("metrics")
+        if not old_metrics:
+            continue
+        for metric, higher_is_better in METRIC_DIRECTIONS.items():
+            old = old_metrics.get(metric)
+            new = scenario["metrics"].get(metric)
+            if old is None or new is None:
+                continue
+            change = ((new - old) / old * 100) if old else 0.0
+            regressed = (change < -tolerance) if higher_is_better else (change > tolerance)
+            rows.append((name, metric, old, new, change, regressed))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="Scenario to run (repeatable, default: all)")
+    parser.add_argument("--messages", type=int, help="Override the channel size")
+    parser.add_argument("--photo-ratio", type=float, help="Override the share of photo messages")
+    parser.add_argument("--document-ratio", type=float, help="Override the share of document messages")
+    parser.add_argument("--media-bytes", type=int, help="Override the size of each media file")
+    parser.add_argument("--fetch-latency-ms", type=float, help="Override the latency per history request")
+    parser.add_argument("--download-latency-ms", type=float, help="Override the latency per media download")
+    parser.add_argument("--accounts", type=int, help="Override the number of Telegram accounts")
+    parser.add_argument("--no-media", action="store_true", help="Run with scrape_media disabled")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per scenario; the median run is kept")
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    parser.add_argument("--compare", help="Baseline JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=10.0, help="Allowed regression in percent")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        # Keep the scraper's log formatting cost but not the terminal noise.
+        for handler in logging.getLogger().handlers:
+            if isinstance(handler, logging.StreamHandler):
+                handler.setStream(open(os.devnull, "w"))
+        spec = ChannelSpec(**json.loads(args.child))
+        print(json.dumps(run_scenario(spec, scrape_media=not args.no_media)))
+        return 0
+
+    overrides = {
+        "messages": args.messages,
+        "photo_ratio": args.photo_ratio,
+        "document_ratio": args.document_ratio,
+        "media_bytes": args.media_bytes,
+        "fetch_latency": args.fetch_latency_ms / 1000 if args.fetch_latency_ms is not None else None,
+        "download_latency": args.download_latency_ms / 1000 if args.download_latency_ms is not None else None,
+        "accounts": args.accounts,
+    }
+    overrides = {k: v for k, v in overrides.items() if v is not None}
+    spec_fields = {f.name for f in fields(ChannelSpec)}
+    assert set(overrides) <= spec_fields
+
+    report = {
+        "benchmark": "scrape_throughput",
+        "created_at": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scenarios": {},
+    }
+    for name in args.scenario or list(SCENARIOS):
+        spec = ChannelSpec(**{**asdict(SCENARIOS[name]), **overrides})
+        runs = [run_isolated(name, spec, not args.no_media) for _ in range(max(args.repeat, 1))]
+        runs.sort(key=lambda m: m["messages_per_sec"])
+        metrics = runs[len(runs) // 2]
+        report["scenarios"][name] = {"spec": asdict(spec), "metrics": metrics}
+        print(f"{name:14} {metrics['messages_per_sec']:>10.1f} msg/s  "
+              f"p50 {metrics['latency_p50_ms']:>8.3f} ms  p99 {metrics['latency_p99_ms']:>8.3f} ms  "
+              f"sqlite {metrics['sqlite_rows_per_sec']:>10.1f} rows/s  "
+              f"checkpoints {metrics['mongo_checkpoints']:>6}  rss {metrics['peak_rss_mb']:>7.1f} MB")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = 0
+        print(f"\nComparison against {args.compare} (tolerance {args.tolerance:.1f}%):")
+        for name, metric, old, new, change, regressed in compare_reports(baseline, report, args.tolerance):
+            regressions += regressed
+            flag = "REGRESSION" if regressed else ""
+            print(f"  {name:14} {metric:20} {old:>12} -> {new:>12}  {change:+7.1f}%  {flag}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,151 @@
+"""Watch rule benchmark: messages scanned per second as a user's rules grow.
+
+Compiles a synthetic rule set per size and scans the same messages with
+it through RuleMatcher, as the scraper's watch stage does. The rules are
+keywords, some case sensitive, and regular expressions, most of them with
+literal text (``\\bprice\\s+\\d+``) and some without (``\\b[A-Z]{4}\\d{2}\\b``).
+Messages are about 500 characters of Zipf-distributed words, numbers and
+amounts. For each number of rules it reports:
+
+``compile_seconds``   time to build the RuleMatcher
+``messages_per_sec``  scan rate, which stays about flat as rules grow
+                      if a scan does not try every rule
+``hits_per_message``  rule hits found per message
+``mismatches``        messages, among the first ``--verify``, whose hits
+                      differ from searching every rule on its own
+
+Run from the backend directory:
+
+    python -m benchmarks.watch_rules --rules 1000 10000 30000
+"""
+import argparse
+import json
+import random
+import re
+import sys
+import time
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+import regex  # noqa: E402
+
+from watch import RuleMatcher  # noqa: E402
+
+MESSAGE_LENGTH = 500
+_LITERAL_TEMPLATES = [
+    r"\b{word}\s+\d+", r"{word}(?:ing|ed)?\b", r"(?:buy|sell)\s+\w+\s+{word}",
+    r"[$€]\s?\d+(?:\.\d+)?\s*{word}", r"\b{word}\b.*\b{other}\b",
+]
+_UNFILTERED_TEMPLATES = [r"\b\d{{{n}}}[.,]\d{{{m}}}\b", r"\b[A-Z]{{{n}}}\d{{{m}}}\b", r"(?:\d+\s?){{{n}}}%"]
+
+
+class Workload:
+    """Synthetic vocabulary, messages and rule sets."""
+
+    def __init__(self, messages, vocabulary=20000, seed=1):
+        self.rng = random.Random(seed)
+        self.words = sorted({"".join(self.rng.choices("abcdefghijklmnopqrstuvwxyz", k=self.rng.randint(3, 10)))
+                             for _ in range(vocabulary)})
+        self.rng.shuffle(self.words)
+        self.weights = [1 / (rank + 1) for rank in range(len(self.words))]
+        self.messages = [self._message() for _ in range(messages)]
+
+    def _message(self):
+        parts, length = [], 0
+        while length < MESSAGE_LENGTH:
+            roll = self.rng.random()
+            if roll < 0.1:
+                part = str(self.rng.randint(1, 10 ** self.rng.randint(1, 6)))
+            elif roll < 0.13:
+                part = f"${self.rng.randint(1, 999)}.{self.rng.randint(0, 99):02d}"
+            else:
+                part = self.rng.choices(self.words, self.weights)[0]
+                if self.rng.random() < 0.05:
+                    part = part.upper()
+            parts.append(part)
+            length += len(part) + 1
+        return " ".join(parts)
+
+    def rules(self, count):
+        rng = random.Random(count)
+        rules = []
+        for index in range(count):
+            # Users watch for the rarer words rather than the most common ones
+            word = rng.choice(self.words)
+            roll = rng.random()
+            if roll < 0.4:
+                rule = {"kind": "keyword", "pattern": word, "case_sensitive": rng.random() < 0.1}
+            elif roll < 0.95:
+                pattern = rng.choice(_LITERAL_TEMPLATES).format(word=word, other=rng.choice(self.words))
+                rule = {"kind": "regex", "pattern": pattern, "case_sensitive": rng.random() < 0.1}
+            else:
+                n, m = rng.randint(4, 9), rng.randint(1, 4)
+                rule = {"kind": "regex", "pattern": rng.choice(_UNFILTERED_TEMPLATES).format(n=n, m=m),
+                        "case_sensitive": True}
+            rule["id"] = f"r{index}"
+            rules.append(rule)
+        return rules
+
+
+def _brute_force(rules, text):
+    """Ids of the rules matching ``text``, each searched on its own."""
+    matched = set()
+    for rule in rules:
+        flags = 0 if rule.get("case_sensitive") else regex.IGNORECASE
+        if rule["kind"] == "keyword":
+            pattern = r"(?<!\w)" + re.escape(rule["pattern"]) + r"(?!\w)"
+        else:
+            pattern = rule["pattern"]
+        if regex.search(pattern, text, flags):
+            matched.add(rule["id"])
+    return matched
+
+
+def run(rule_counts=(1000, 10000), messages=300, verify=20, seed=1):
+    workload = Workload(messages, seed=seed)
+    report = []
+    for count in rule_counts:
+        rules = workload.rules(count)
+        started = time.perf_counter()
+        matcher = RuleMatcher(rules)
+        compile_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        found = [{rule_id for rule_id, _ in matcher.scan("c1", text)} for text in workload.messages]
+        seconds = time.perf_counter() - started
+
+        mismatches = sum(found[index] != _brute_force(rules, text)
+                         for index, text in enumerate(workload.messages[:verify]))
+        report.append({
+            "rules": count,
+            "compile_seconds": round(compile_seconds, 2),
+            "messages_per_sec": round(len(workload.messages) / seconds, 1),
+            "hits_per_message": round(sum(map(len, found)) / len(found), 2),
+            "mismatches": mismatches,
+        })
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rules", type=int, nargs="+", default=[1000, 10000, 30000],
+                        help="Rule set sizes to measure")
+    parser.add_argument("--messages", type=int, default=1000, help="Messages scanned per rule set")
+    parser.add_argument("--verify", type=int, default=20, help="Messages checked against a rule-by-rule search")
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    report = run(args.rules, args.messages, args.verify)
+    for row in report:
+        print("  ".join(f"{key} {value}" for key, value in row.items()))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
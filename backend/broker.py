@@ -0,0 +1,110 @@
+"""Pub/sub fan-out of newly scraped messages.
+
+The scraper publishes every committed message; streaming endpoints
+subscribe per (user, channel). Delivery is in-process by default. When
+REDIS_URL is set, messages go through Redis pub/sub instead, so a client
+connected to one API worker sees messages scraped on any other worker.
+
+Callbacks added with ``watch`` are called with (user, channel) for
+every message delivered to this process, whether or not anyone subscribed
+to that channel; the API uses this to drop cached responses.
+
+Subscribers get a bounded queue. A subscriber that falls behind is marked
+as overflowed instead of blocking the scraper; it is expected to catch up
+from storage and carry on.
+"""
+import asyncio
+import json
+import logging
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+REDIS_CHANNEL_PREFIX = "messages:"
+
+
+class Subscription:
+    def __init__(self, maxsize):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self.overflowed = False
+
+    def deliver(self, payload):
+        try:
+            self.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            self.overflowed = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+
+
+class MessageBroker:
+    def __init__(self, redis_url: Optional[str] = None, queue_size: int = 1000):
+        self.redis_url = redis_url
+        self.queue_size = queue_size
+        self._subscribers: Dict[Tuple[str, str], Set[Subscription]] = {}
+        self._watchers: List[Callable[[str, str], None]] = []
+        self._redis = None
+        self._listener: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if not self.redis_url or self._redis is not None:
+            return
+        import redis.asyncio as redis
+
+        self._redis = redis.from_url(self.redis_url)
+        pubsub = self._redis.pubsub()
+        await pubsub.psubscribe(f"{REDIS_CHANNEL_PREFIX}*")
+        self._listener = asyncio.create_task(self._listen(pubsub))
+
+    async def close(self):
+        if self._listener:
+            self._listener.cancel()
+            self._listener = None
+        if self._redis is not None:
+            await self._redis.close()
+            self._redis = None
+
+    async def _listen(self, pubsub):
+        async for message in pubsub.listen():
+            if message["type"] != "pmessage":
+                continue
+            try:
+                channel = message["channel"].decode()
+                _, user_id, channel_id = channel.split(":", 2)
+                self._dispatch(user_id, channel_id, json.loads(message["data"]))
+            except Exception as e:
+                logger.warning(f"Dropping malformed broker message: {str(e)}")
+
+    def watch(self, callback: Callable[[str, str], None]):
+        self._watchers.append(callback)
+
+    def _dispatch(self, user_id, channel_id, payload):
+        for callback in self._watchers:
+            callback(user_id, channel_id)
+        for subscription in self._subscribers.get((user_id, channel_id), ()):
+            subscription.deliver(payload)
+
+    def has_subscribers(self, user_id, channel_id):
+        """Whether publishing can reach anyone; always true with Redis."""
+        return self._redis is not None or bool(self._subscribers.get((user_id, channel_id)))
+
+    async def publish(self, user_id, channel_id, payload):
+        if self._redis is not None:
+            await self._redis.publish(f"{REDIS_CHANNEL_PREFIX}{user_id}:{channel_id}", json.dumps(payload))
+        else:
+            self._dispatch(user_id, channel_id, payload)
+
+    @asynccontextmanager
+    async def subscribe(self, user_id, channel_id):
+        key = (user_id, channel_id)
+        subscription = Subscription(self.queue_size)
+        self._subscribers.setdefault(key, set()).add(subscription)
+        try:
+            yield subscription
+        finally:
+            subscribers = self._subscribers.get(key)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[key]
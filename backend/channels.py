@@ -0,0 +1,533 @@
+"""Telegram accounts, the channels of a user, and the scrape jobs run on them.
+
+Starting a scrape imports the scraping module, and with it Telethon, on
+first use; API processes that only serve data never load it.
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime
+from functools import partial
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+import jobs
+import state
+from accounts import PRIMARY_ACCOUNT
+from auth import TelegramCredentials, User, get_current_user
+from dialogs import DIALOG_BUSY_RETRY_AFTER, DIALOG_SESSION_WAIT
+from serialization import dumps
+
+logger = logging.getLogger(__name__)
+
+# Most channels one bulk request may change
+MAX_BULK_CHANNELS = int(os.environ.get('MAX_BULK_CHANNELS', 5000))
+
+# Where continuous scraping runs: "api" in the process that got the start
+# request, "worker" in the worker.py processes, which pick up every user
+# flagged for it. With "api", an API process restarts the loops of every
+# flagged user when it starts, so run several API processes with "worker"
+CONTINUOUS_SCRAPE_RUNNER = os.environ.get('CONTINUOUS_SCRAPE_RUNNER', 'api')
+
+router = APIRouter()
+
+class ChannelModel(BaseModel):
+    channel_id: str
+    last_message_id: int = 0
+
+class BulkChannels(BaseModel):
+    channels: List[ChannelModel]
+    backfill: bool = False
+
+class ChannelIds(BaseModel):
+    channel_ids: List[str]
+
+class ChannelOffsets(BaseModel):
+    channel_ids: List[str]
+    last_message_id: int = 0
+
+class ScrapeSettings(BaseModel):
+    scrape_media: bool
+
+@router.post("/telegram-credentials")
+async def set_telegram_credentials(credentials: TelegramCredentials, current_user: User = Depends(get_current_user)):
+    result = await state.db.users.update_one(
+        {"id": current_user.id},
+        {
+            "$set": {
+                "telegram_credentials": credentials.dict(),
+                "updated_at": datetime.utcnow()
+            }
+        }
+    )
+    
+    if result.modified_count == 0:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to update credentials"
+        )
+    
+    return {"message": "Telegram credentials set successfully"}
+
+@router.get("/telegram-credentials")
+async def get_telegram_credentials(current_user: User = Depends(get_current_user)):
+    if not current_user.telegram_credentials:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Telegram credentials not set"
+        )
+    
+    return current_user.telegram_credentials
+
+def public_account(account):
+    return {
+        "account_id": account["account_id"],
+        "phone": account["phone"],
+        "api_id": account["api_id"],
+        "primary": account["account_id"] == PRIMARY_ACCOUNT,
+        "flood_until": account.get("flood_until"),
+        "recent_flood_waits": len(account.get("flood_waits") or ()),
+        "active_scrapes": state.account_pool.leases(account["user_id"], account["account_id"]),
+        "score": round(state.account_pool.score(account), 3),
+    }
+
+@router.get("/telegram-accounts")
+async def list_telegram_accounts(current_user: User = Depends(get_current_user)):
+    """Telegram accounts scrapes are spread over, with their recent flood history."""
+    accounts = await state.account_pool.accounts(current_user.dict())
+    return {"accounts": [public_account(account) for account in accounts]}
+
+@router.post("/telegram-accounts")
+async def add_telegram_account(credentials: TelegramCredentials, current_user: User = Depends(get_current_user)):
+    if not current_user.telegram_credentials:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Set the primary account with /telegram-credentials first"
+        )
+    
+    accounts = await state.account_pool.accounts(current_user.dict())
+    if any(account["phone"] == credentials.phone for account in accounts):
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Account {credentials.phone} is already registered"
+        )
+    
+    account = await state.account_pool.add(current_user.id, credentials.dict())
+    return public_account(account)
+
+@router.delete("/telegram-accounts/{account_id}")
+async def remove_telegram_account(account_id: str, current_user: User = Depends(get_current_user)):
+    if account_id == PRIMARY_ACCOUNT:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="The primary account is managed through /telegram-credentials"
+        )
+    
+    if not await state.account_pool.remove(current_user.id, account_id):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Account {account_id} not found"
+        )
+    
+    return {"message": f"Account {account_id} removed successfully"}
+
+@router.get("/channels")
+async def get_channels(current_user: User = Depends(get_current_user)):
+    return {"channels": current_user.channels}
+
+@router.post("/channels")
+async def add_channel(channel: ChannelModel, current_user: User = Depends(get_current_user)):
+    channels = current_user.channels.copy()
+    channels[channel.channel_id] = channel.last_message_id
+    
+    result = await state.db.users.update_one(
+        {"id": current_user.id},
+        {
+            "$set": {
+                f"channels.{channel.channel_id}": channel.last_message_id,
+                "updated_at": datetime.utcnow()
+            }
+        }
+    )
+    
+    if result.modified_count == 0:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to add channel"
+        )
+    
+    return {"message": f"Channel {channel.channel_id} added successfully"}
+
+@router.delete("/channels/{channel_id}")
+async def remove_channel(channel_id: str, current_user: User = Depends(get_current_user)):
+    if channel_id not in current_user.channels:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Channel {channel_id} not found"
+        )
+    
+    result = await state.db.users.update_one(
+        {"id": current_user.id},
+        {
+            "$unset": {f"channels.{channel_id}": ""},
+            "$set": {"updated_at": datetime.utcnow()}
+        }
+    )
+    
+    if result.modified_count == 0:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to remove channel"
+        )
+    
+    return {"message": f"Channel {channel_id} removed successfully"}
+
+@router.get("/scrape-settings")
+async def get_scrape_settings(current_user: User = Depends(get_current_user)):
+    return {"scrape_media": current_user.scrape_media}
+
+@router.post("/scrape-settings")
+async def update_scrape_settings(settings: ScrapeSettings, current_user: User = Depends(get_current_user)):
+    result = await state.db.users.update_one(
+        {"id": current_user.id},
+        {
+            "$set": {
+                "scrape_media": settings.scrape_media,
+                "updated_at": datetime.utcnow()
+            }
+        }
+    )
+    
+    if result.modified_count == 0:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to update scrape settings"
+        )
+    
+    return {"message": "Scrape settings updated successfully"}
+
+def check_bulk_channel_ids(channel_ids):
+    """Deduplicated channel ids of a bulk request; 400 on bad input."""
+    if len(channel_ids) > MAX_BULK_CHANNELS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {MAX_BULK_CHANNELS} channels per request"
+        )
+    
+    # Channel ids become keys of the user's channels document
+    invalid = [c for c in channel_ids if not c or '.' in c or c.startswith('$')]
+    if invalid:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid channel ids: {', '.join(repr(c) for c in invalid[:10])}"
+        )
+    
+    return list(dict.fromkeys(channel_ids))
+
+@router.post("/channels/bulk")
+async def add_channels(request: BulkChannels, current_user: User = Depends(get_current_user)):
+    """Add many channels in one write; channels already present keep their offset.
+
+    With ``backfill`` a scrape job is queued for every added channel. The
+    jobs run in the user's fair share of the scrape slots, as many at once
+    as the user has Telegram accounts.
+    """
+    offsets = {}
+    for channel in request.channels:
+        offsets.setdefault(channel.channel_id, channel.last_message_id)
+    check_bulk_channel_ids(list(offsets))
+    
+    if request.backfill and not current_user.telegram_credentials:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Telegram credentials not set"
+        )
+    
+    added = {c: offset for c, offset in offsets.items() if c not in current_user.channels}
+    if request.backfill and added:
+        # 429 before anything is written
+        state.scrape_rate.check(current_user.id)
+        state.scrape_scheduler.admit(current_user.id, len(added))
+    if added:
+        await state.db.users.update_one(
+            {"id": current_user.id},
+            {
+                "$set": {
+                    **{f"channels.{channel_id}": offset for channel_id, offset in added.items()},
+                    "updated_at": datetime.utcnow()
+                }
+            }
+        )
+    
+    queued = []
+    if request.backfill and added:
+        import scraping
+        queued = await state.job_registry.create_many(current_user.id, added)
+        asyncio.create_task(scraping.backfill_channels(current_user.id, queued, current_user.scrape_media))
+    
+    return {
+        "added": list(added),
+        "already_present": [c for c in offsets if c not in added],
+        "job_ids": {job["channel_id"]: job["id"] for job in queued}
+    }
+
+@router.post("/channels/bulk-remove")
+async def remove_channels(request: ChannelIds, current_user: User = Depends(get_current_user)):
+    channel_ids = check_bulk_channel_ids(request.channel_ids)
+    removed = [c for c in channel_ids if c in current_user.channels]
+    if removed:
+        await state.db.users.update_one(
+            {"id": current_user.id},
+            {
+                "$unset": {f"channels.{channel_id}": "" for channel_id in removed},
+                "$set": {"updated_at": datetime.utcnow()}
+            }
+        )
+    
+    return {"removed": removed, "not_found": [c for c in channel_ids if c not in current_user.channels]}
+
+@router.post("/channels/bulk-reset")
+async def reset_channel_offsets(request: ChannelOffsets, current_user: User = Depends(get_current_user)):
+    """Set the scrape offset of many channels, e.g. back to 0 for a full rescan."""
+    channel_ids = check_bulk_channel_ids(request.channel_ids)
+    reset = [c for c in channel_ids if c in current_user.channels]
+    if reset:
+        await state.db.users.update_one(
+            {"id": current_user.id},
+            {
+                "$set": {
+                    **{f"channels.{channel_id}": request.last_message_id for channel_id in reset},
+                    "updated_at": datetime.utcnow()
+                }
+            }
+        )
+    
+    return {"reset": reset, "not_found": [c for c in channel_ids if c not in current_user.channels]}
+
+@router.post("/scrape/{channel_id}")
+async def scrape_channel(channel_id: str, current_user: User = Depends(get_current_user)):
+    if not current_user.telegram_credentials:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Telegram credentials not set"
+        )
+    
+    if channel_id not in current_user.channels:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Channel {channel_id} not found"
+        )
+    
+    # Queue the scrape in the user's fair share of the scrape slots;
+    # progress and cancellation go through the job registry. A scrape of
+    # the channel that is already queued or running absorbs this one
+    import scraping
+    state.scrape_rate.check(current_user.id)
+    state.scrape_scheduler.admit(current_user.id)
+    job, _, merged = await scraping.queue_scrape(
+        current_user.dict(),
+        channel_id,
+        current_user.channels[channel_id],
+        current_user.scrape_media,
+        limit=await scraping.account_limit(current_user.dict())
+    )
+    
+    if merged:
+        return {"message": f"Channel {channel_id} is already being scraped", "job_id": job["id"], "merged": True}
+    return {"message": f"Scraping started for channel {channel_id}", "job_id": job["id"], "merged": False}
+
+@router.get("/scrape-jobs")
+async def list_scrape_jobs(
+    job_state: Optional[str] = Query(None, alias="state"),
+    channel_id: Optional[str] = None,
+    limit: int = 50,
+    current_user: User = Depends(get_current_user)
+):
+    job_list = await state.job_registry.list(current_user.id, state=job_state, channel_id=channel_id, limit=min(max(limit, 1), 500))
+    return {"jobs": job_list}
+
+@router.get("/scrape-jobs/{job_id}")
+async def get_scrape_job(job_id: str, request: Request, current_user: User = Depends(get_current_user)):
+    job = await state.job_registry.get(job_id, current_user.id)
+    if not job:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Job {job_id} not found"
+        )
+    
+    if "text/event-stream" not in request.headers.get("accept", ""):
+        return job
+    
+    # Server-sent events: one "job" event per change until the job finishes
+    async def event_stream():
+        async for update in state.job_registry.watch(job_id, current_user.id):
+            if await request.is_disconnected():
+                break
+            if update is None:
+                yield ": keepalive\n\n"
+            else:
+                yield b"event: job\ndata: %b\n\n" % dumps(jsonable_encoder(update))
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.delete("/scrape-jobs/{job_id}")
+async def cancel_scrape_job(job_id: str, current_user: User = Depends(get_current_user)):
+    job = await state.job_registry.request_cancel(job_id, current_user.id)
+    if not job:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Job {job_id} not found"
+        )
+    
+    if job["state"] in (jobs.COMPLETED, jobs.FAILED):
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Job {job_id} already {job['state']}"
+        )
+    
+    return {"message": f"Cancellation requested for job {job_id}", "job": job}
+
+@router.post("/continuous-scrape/start")
+async def start_continuous_scrape(current_user: User = Depends(get_current_user)):
+    if not current_user.telegram_credentials:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Telegram credentials not set"
+        )
+    
+    if not current_user.channels:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="No channels to scrape"
+        )
+    
+    state.scrape_rate.check(current_user.id)
+    
+    # Store a flag in the database to indicate continuous scraping
+    result = await state.db.users.update_one(
+        {"id": current_user.id},
+        {"$set": {"continuous_scraping": True}}
+    )
+    
+    # Start the continuous scraping process in the background, unless
+    # scrape workers pick up flagged users
+    if CONTINUOUS_SCRAPE_RUNNER == "api":
+        import scraping
+        scraping.start_continuous_scraping(current_user.id)
+    
+    return {"message": "Continuous scraping started"}
+
+@router.post("/continuous-scrape/stop")
+async def stop_continuous_scrape(current_user: User = Depends(get_current_user)):
+    # Update the flag in the database
+    result = await state.db.users.update_one(
+        {"id": current_user.id},
+        {"$set": {"continuous_scraping": False}}
+    )
+    
+    return {"message": "Continuous scraping stopped"}
+
+@router.get("/channels-list")
+async def list_channels(
+    q: Optional[str] = None,
+    kind: Optional[str] = None,
+    offset: int = 0,
+    limit: Optional[int] = None,
+    refresh: Optional[str] = None,
+    current_user: User = Depends(get_current_user)
+):
+    """Dialogs of the user's Telegram account, served from the dialog cache.
+
+    ``refresh=true`` syncs incrementally before answering and
+    ``refresh=full`` re-reads every dialog. Without it a stale cache is
+    refreshed in the background and the cached page is returned at once.
+    Every dialog is returned unless ``limit`` is given; ``next_offset`` is
+    the offset of the next page, or None after the last one.
+    """
+    if refresh not in (None, "", "false", "true", "full"):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="refresh must be 'true' or 'full'"
+        )
+    
+    sync_state = await state.dialog_cache.state(current_user.id)
+    if not sync_state or refresh in ("true", "full"):
+        import scraping
+        open_client = partial(scraping.telegram_session, wait=DIALOG_SESSION_WAIT)
+        try:
+            await state.dialog_cache.refresh(current_user.id, open_client, full=refresh == "full")
+        except ValueError as e:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=str(e)
+            )
+        except scraping.SessionBusy:
+            # A scrape holds the session: answer from the cache, if there is
+            # one, while a sync waits for the session in the background
+            if not sync_state:
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="The Telegram session is in use by a scrape, try again later",
+                    headers={"Retry-After": str(DIALOG_BUSY_RETRY_AFTER)}
+                )
+            refresh_dialogs_in_background(current_user.id, full=refresh == "full")
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=f"Error listing channels: {str(e)}"
+            )
+        else:
+            sync_state = await state.dialog_cache.state(current_user.id)
+    elif state.dialog_cache.is_stale(sync_state):
+        refresh_dialogs_in_background(current_user.id)
+    
+    offset = max(offset, 0)
+    if limit is not None:
+        limit = min(max(limit, 1), 5000)
+    channels, total = await state.dialog_cache.page(current_user.id, q=q, kind=kind, offset=offset, limit=limit)
+    return {
+        "channels": channels,
+        "total": total,
+        "offset": offset,
+        "limit": limit,
+        "next_offset": offset + len(channels) if offset + len(channels) < total else None,
+        "synced_at": sync_state["synced_at"] if sync_state else None,
+        "refreshing": state.dialog_cache.is_refreshing(current_user.id)
+    }
+
+def refresh_dialogs_in_background(user_id, full=False):
+    """Sync the user's dialog cache in the background, unless a sync runs already."""
+    if state.dialog_cache.is_refreshing(user_id):
+        return
+    import scraping
+    
+    def log_failure(task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Background dialog refresh failed for user {user_id}: {str(task.exception())}")
+    
+    state.dialog_cache.start_refresh(user_id, scraping.telegram_session, full=full).add_done_callback(log_failure)
+
+async def resume_scrapes():
+    """Resume the scraping a shutdown interrupted, when the API starts.
+    
+    Only imports scraping if there is something to resume.
+    """
+    resume = await state.job_registry.has_interrupted()
+    users = []
+    if CONTINUOUS_SCRAPE_RUNNER == "api":
+        users = [user["id"] async for user in state.db.users.find({"continuous_scraping": True}, {"id": 1})]
+    if not resume and not users:
+        return
+    import scraping
+    if resume:
+        await scraping.resume_interrupted()
+    for user_id in users:
+        scraping.start_continuous_scraping(user_id)
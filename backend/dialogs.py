@@ -0,0 +1,171 @@
+"""Per-user cache of Telegram dialogs for /channels-list.
+
+Walking ``iter_dialogs()`` for an account with thousands of dialogs takes
+seconds and runs into flood limits, so the result is cached in MongoDB and
+served from there with search and pagination.
+
+Telegram returns dialogs pinned first, then by most recent message. An
+incremental sync therefore walks dialogs only until it meets the first
+unpinned one whose top message matches the cache: everything after it is
+older and unchanged. Renames of quiet dialogs and dialogs the account
+left are only picked up by a full sync, which runs at most every
+DIALOG_FULL_SYNC_INTERVAL seconds or on request.
+"""
+import asyncio
+import logging
+import os
+import re
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+SERVICE_NOTIFICATIONS_ID = 777000
+
+DIALOG_CACHE_TTL = int(os.environ.get("DIALOG_CACHE_TTL", 300))
+DIALOG_FULL_SYNC_INTERVAL = int(os.environ.get("DIALOG_FULL_SYNC_INTERVAL", 86400))
+# How long a sync requested by /channels-list waits for a session a scrape
+# holds, and when it tells the client to try again if the scrape keeps it
+DIALOG_SESSION_WAIT = float(os.environ.get("DIALOG_SESSION_WAIT", 5))
+DIALOG_BUSY_RETRY_AFTER = 30
+
+
+def dialog_kind(dialog):
+    if getattr(dialog, "is_channel", False) and not getattr(dialog, "is_group", False):
+        return "channel"
+    if getattr(dialog, "is_group", False):
+        return "group"
+    if getattr(dialog, "is_user", False):
+        return "user"
+    return "other"
+
+
+class DialogCache:
+    def __init__(self, dialogs, sync_state, ttl=DIALOG_CACHE_TTL, full_sync_interval=DIALOG_FULL_SYNC_INTERVAL):
+        self.dialogs = dialogs
+        self.sync_state = sync_state
+        self.ttl = timedelta(seconds=ttl)
+        self.full_sync_interval = timedelta(seconds=full_sync_interval)
+        self._refreshing: Dict[str, asyncio.Task] = {}
+
+    async def ensure_indexes(self):
+        await self.dialogs.create_index([("user_id", 1), ("dialog_id", 1)], unique=True)
+        await self.dialogs.create_index([("user_id", 1), ("pinned", -1), ("date", -1)])
+        await self.sync_state.create_index("user_id", unique=True)
+
+    async def state(self, user_id) -> Optional[dict]:
+        return await self.sync_state.find_one({"user_id": user_id}, {"_id": 0})
+
+    def is_stale(self, state) -> bool:
+        return not state or datetime.utcnow() - state["synced_at"] > self.ttl
+
+    def is_refreshing(self, user_id) -> bool:
+        task = self._refreshing.get(user_id)
+        return task is not None and not task.done()
+
+    def start_refresh(self, user_id, open_client, full=False) -> asyncio.Task:
+        """Start syncing the cache for a user unless a sync runs already; returns the running sync.
+
+        ``open_client(user_id)`` must return an async context manager
+        yielding a started Telegram client.
+        """
+        task = self._refreshing.get(user_id)
+        if task is None or task.done():
+            task = asyncio.ensure_future(self._sync(user_id, open_client, full))
+            self._refreshing[user_id] = task
+            task.add_done_callback(lambda done: self._forget(user_id, done))
+        return task
+
+    async def refresh(self, user_id, open_client, full=False) -> dict:
+        """Sync the cache for a user. Concurrent calls share one sync."""
+        return await asyncio.shield(self.start_refresh(user_id, open_client, full))
+
+    def _forget(self, user_id, task):
+        if self._refreshing.get(user_id) is task:
+            del self._refreshing[user_id]
+
+    @staticmethod
+    def _dialog_doc(user_id, dialog, now):
+        message = getattr(dialog, "message", None)
+        return {
+            "user_id": user_id,
+            "dialog_id": str(dialog.id),
+            "title": dialog.title,
+            "kind": dialog_kind(dialog),
+            "username": getattr(dialog.entity, "username", None),
+            "pinned": bool(getattr(dialog, "pinned", False)),
+            "top_message_id": getattr(message, "id", 0) or 0,
+            "date": dialog.date.replace(tzinfo=None) if dialog.date else None,
+            "synced_at": now,
+        }
+
+    async def _sync(self, user_id, open_client, full):
+        now = datetime.utcnow()
+        state = await self.state(user_id)
+        if not state or not state.get("full_synced_at") or now - state["full_synced_at"] > self.full_sync_interval:
+            full = True
+
+        cached = {}
+        if not full:
+            cursor = self.dialogs.find({"user_id": user_id}, {"dialog_id": 1, "top_message_id": 1})
+            cached = {doc["dialog_id"]: doc["top_message_id"] async for doc in cursor}
+
+        changed = []
+        async with open_client(user_id) as client:
+            async for dialog in client.iter_dialogs():
+                if dialog.id == SERVICE_NOTIFICATIONS_ID:
+                    continue
+                doc = self._dialog_doc(user_id, dialog, now)
+                if not full and not doc["pinned"] and cached.get(doc["dialog_id"]) == doc["top_message_id"]:
+                    break
+                changed.append(doc)
+
+        if changed:
+            await self.dialogs.bulk_write(
+                [UpdateOne({"user_id": user_id, "dialog_id": doc["dialog_id"]}, {"$set": doc}, upsert=True)
+                 for doc in changed],
+                ordered=False,
+            )
+        removed = 0
+        if full:
+            result = await self.dialogs.delete_many({"user_id": user_id, "synced_at": {"$lt": now}})
+            removed = result.deleted_count
+
+        update = {"synced_at": now}
+        if full:
+            update["full_synced_at"] = now
+        await self.sync_state.update_one({"user_id": user_id}, {"$set": update}, upsert=True)
+        logger.info(f"Dialog sync for user {user_id}: {'full' if full else 'incremental'}, "
+                    f"{len(changed)} updated, {removed} removed")
+        return {"full": full, "updated": len(changed), "removed": removed}
+
+    async def usernames(self, user_id) -> Dict[str, str]:
+        """Lower-cased username -> dialog_id for the cached dialogs that have one."""
+        cursor = self.dialogs.find({"user_id": user_id, "username": {"$ne": None}}, {"dialog_id": 1, "username": 1})
+        return {doc["username"].lower(): doc["dialog_id"] async for doc in cursor}
+
+    async def page(self, user_id, q=None, kind=None, offset=0, limit: Optional[int] = 100):
+        """(dialogs, total matching) from ``offset`` on; every remaining one if ``limit`` is None."""
+        query = {"user_id": user_id}
+        if q:
+            query["title"] = {"$regex": re.escape(q), "$options": "i"}
+        if kind:
+            query["kind"] = kind
+        total = await self.dialogs.count_documents(query)
+        cursor = (self.dialogs.find(query, {"_id": 0, "user_id": 0, "synced_at": 0})
+                  .sort([("pinned", -1), ("date", -1)]).skip(offset).limit(limit or 0))
+        items = [
+            {
+                "id": doc["dialog_id"],
+                "title": doc["title"],
+                "kind": doc["kind"],
+                "username": doc.get("username"),
+                "pinned": doc["pinned"],
+                "date": doc["date"],
+                "top_message_id": doc["top_message_id"],
+            }
+            async for doc in cursor
+        ]
+        return items, total
@@ -0,0 +1,223 @@
+"""Near-duplicate messages across all of a user's channels.
+
+Every message the scraper stores or changes gets a MinHash signature of
+its shingles, the pairs of consecutive casefolded words: 64 independent
+hash functions (the 64 words of a SHAKE-128 digest of each shingle), and
+for each the smallest value over the message's shingles. The share of
+positions at which two signatures agree estimates the Jaccard similarity
+of the two shingle sets; messages are near-duplicates when it is at least
+NEAR_DUPLICATE_SIMILARITY. A repost with a word added, dropped or
+changed keeps about 70% (a 12 word post) to 95% of its shingles.
+
+Finding those without comparing against every stored message is done by
+locality-sensitive hashing: the signature is cut into 16 bands of 4
+values, and the bands' keys are stored in a multikey index in
+``message_signatures``. Messages with similarity s share at least one band
+with probability 1 - (1 - s^4)^16: 0.64 at 0.5, 0.99 at 0.7, 0.002 at 0.1.
+A lookup fetches only the messages sharing a band, so its cost follows
+the number of similar messages rather than the size of the corpus. Past
+NEAR_DUPLICATE_CANDIDATES_PER_BAND per band it fetches only the newest
+of them per band, which keeps a post reposted thousands of times as
+cheap to match as one reposted a few dozen times: its copies are all
+alike, and the newest stand for the rest.
+
+Each message is tagged with a cluster id: the cluster of the most similar
+message seen before it, or a new cluster named after the message itself
+("<channel id>:<message id>"). A message whose cluster id is its own key
+is the first copy of its content, which is what downstream processing of
+unique content keeps. The message store keeps each message's cluster id
+in its ``cluster_id`` column, so message reads and exports carry it. Scrapes of two channels saving copies of a post at
+the same moment may each start a cluster. Messages with fewer than
+NEAR_DUPLICATE_MIN_WORDS words are not indexed; short replies are not
+reposts.
+"""
+import asyncio
+import os
+import re
+import struct
+from datetime import datetime
+from functools import lru_cache
+from hashlib import shake_128
+from operator import eq
+from typing import Dict, List, Optional, Sequence
+
+from pymongo import UpdateOne
+
+# Set NEAR_DUPLICATE_INDEX=0 to stop indexing scraped messages
+NEAR_DUPLICATE_INDEX = os.environ.get("NEAR_DUPLICATE_INDEX", "1") != "0"
+NEAR_DUPLICATE_SIMILARITY = float(os.environ.get("NEAR_DUPLICATE_SIMILARITY", 0.5))
+NEAR_DUPLICATE_MIN_WORDS = int(os.environ.get("NEAR_DUPLICATE_MIN_WORDS", 5))
+NEAR_DUPLICATE_CANDIDATES_PER_BAND = int(os.environ.get("NEAR_DUPLICATE_CANDIDATES_PER_BAND", 50))
+
+SIGNATURE_SIZE = 64
+BAND_ROWS = 4
+_SIGNATURE = struct.Struct(f">{SIGNATURE_SIZE}I")
+# A band's key is its 16 bytes reduced to 56 bits, tagged with the band
+_BAND_BYTES = BAND_ROWS * 4
+_BAND_MODULUS = (1 << 56) - 5
+_WORDS = re.compile(r"\w+")
+
+
+@lru_cache(maxsize=1 << 16)
+def _shingle_hashes(shingle: str) -> tuple:
+    return _SIGNATURE.unpack(shake_128(shingle.encode("utf-8", "surrogatepass")).digest(_SIGNATURE.size))
+
+
+def minhash(text, min_words=NEAR_DUPLICATE_MIN_WORDS) -> Optional[tuple]:
+    """MinHash signature of ``text``, or None if it has fewer than ``min_words`` words."""
+    words = _WORDS.findall(text.casefold()) if text else []
+    if len(words) < max(min_words, 2):
+        return None
+    shingles = {f"{first} {second}" for first, second in zip(words, words[1:])}
+    return tuple(map(min, zip(*map(_shingle_hashes, shingles))))
+
+
+def similarity(first: Sequence[int], second: Sequence[int]) -> float:
+    """Estimated Jaccard similarity of the shingles behind two signatures."""
+    return sum(map(eq, first, second)) / SIGNATURE_SIZE
+
+
+def bands(signature: Sequence[int]) -> List[int]:
+    packed = _SIGNATURE.pack(*signature)
+    return [(band << 56) | (int.from_bytes(packed[start:start + _BAND_BYTES], "big") % _BAND_MODULUS)
+            for band, start in enumerate(range(0, _SIGNATURE.size, _BAND_BYTES))]
+
+
+def cluster_key(channel_id, message_id) -> str:
+    return f"{channel_id}:{message_id}"
+
+
+class NearDuplicateIndex:
+    """MinHash signatures of the users' messages and their clusters, in MongoDB."""
+
+    def __init__(self, signatures, min_similarity=NEAR_DUPLICATE_SIMILARITY, min_words=NEAR_DUPLICATE_MIN_WORDS,
+                 candidates_per_band=NEAR_DUPLICATE_CANDIDATES_PER_BAND):
+        self.signatures = signatures
+        self.min_similarity = min_similarity
+        self.min_words = min_words
+        self.candidates_per_band = candidates_per_band
+
+    async def ensure_indexes(self):
+        await self.signatures.create_index([("user_id", 1), ("channel_id", 1), ("message_id", 1)], unique=True)
+        await self.signatures.create_index([("user_id", 1), ("bands", 1), ("date", -1)])
+        await self.signatures.create_index([("user_id", 1), ("cluster_id", 1), ("date", 1)])
+
+    def signatures_of(self, records: Sequence) -> List[tuple]:
+        """(message id, date, signature, band keys) of the records with enough text to index."""
+        signatures = []
+        for record in records:
+            signature = minhash(record.message, self.min_words)
+            if signature is not None:
+                signatures.append((record.message_id, record.date, signature, bands(signature)))
+        return signatures
+
+    async def _find(self, query, sort=None, limit=0) -> List[dict]:
+        cursor = self.signatures.find(
+            query, {"_id": 0, "channel_id": 1, "message_id": 1, "date": 1, "signature": 1, "cluster_id": 1}
+        )
+        if sort:
+            cursor = cursor.sort(sort)
+        found = await cursor.limit(limit).to_list(None)
+        for doc in found:
+            doc["signature"] = _SIGNATURE.unpack(doc["signature"])
+        return found
+
+    async def _candidates(self, user_id, keys) -> List[dict]:
+        """The messages sharing a band key with ``keys``: all of them, or the newest candidates_per_band per key.
+
+        One query finds them unless there are more than candidates_per_band
+        per key; then each key is looked up on its own, so the copies of a
+        mass-reposted post cannot crowd out the candidates of other bands.
+        """
+        keys = list(keys)
+        limit = self.candidates_per_band * len(keys)
+        found = await self._find({"user_id": user_id, "bands": {"$in": keys}}, [("date", -1)], limit)
+        if len(found) < limit:
+            return found
+        candidates = {}
+        for band in await asyncio.gather(*(
+            self._find({"user_id": user_id, "bands": key}, [("date", -1)], self.candidates_per_band) for key in keys
+        )):
+            for doc in band:
+                candidates.setdefault((doc["channel_id"], doc["message_id"]), doc)
+        return list(candidates.values())
+
+    async def add(self, user_id, channel_id, records: Sequence) -> Dict[int, str]:
+        """Index a batch of saved MessageRecords; returns their cluster ids by message id.
+
+        Near-duplicates within the batch join each other's cluster just as
+        they would if they had been scraped one by one.
+        """
+        signatures = await asyncio.to_thread(self.signatures_of, records)
+        if not signatures:
+            return {}
+        indexed = {message_id for message_id, *_ in signatures}
+
+        buckets: Dict[int, list] = {}
+        for candidate in await self._candidates(user_id, {key for *_, keys in signatures for key in keys}):
+            # An edited message is matched against everything but its old self
+            if candidate["channel_id"] == channel_id and candidate["message_id"] in indexed:
+                continue
+            entry = (candidate["signature"], candidate["cluster_id"])
+            for key in bands(candidate["signature"]):
+                buckets.setdefault(key, []).append(entry)
+
+        clusters, now = {}, datetime.utcnow()
+        for message_id, date, signature, keys in signatures:
+            nearest = None
+            for key in keys:
+                for other, cluster_id in buckets.get(key, ()):
+                    similar = similarity(signature, other)
+                    if similar >= self.min_similarity and (nearest is None or similar > nearest[0]):
+                        nearest = (similar, cluster_id)
+            cluster_id = nearest[1] if nearest else cluster_key(channel_id, message_id)
+            clusters[message_id] = cluster_id
+            for key in keys:
+                buckets.setdefault(key, []).append((signature, cluster_id))
+
+        await self.signatures.bulk_write([
+            UpdateOne(
+                {"user_id": user_id, "channel_id": channel_id, "message_id": message_id},
+                {"$set": {"signature": _SIGNATURE.pack(*signature), "bands": keys,
+                          "cluster_id": clusters[message_id], "date": date, "updated_at": now}},
+                upsert=True,
+            )
+            for message_id, date, signature, keys in signatures
+        ], ordered=False)
+        return clusters
+
+    async def duplicates(self, user_id, channel_id, message_id, channels=None, limit=100) -> Optional[dict]:
+        """The cluster of a message and its near-duplicates, most similar first.
+
+        These are the first ``limit`` other members of its cluster by date
+        plus the similar messages among its band candidates that ended up
+        in another cluster. None if the message is not indexed;
+        ``channels`` limits the duplicates to those channels.
+        """
+        found = await self._find({"user_id": user_id, "channel_id": channel_id, "message_id": message_id})
+        if not found:
+            return None
+        doc = found[0]
+        query = {"user_id": user_id, "cluster_id": doc["cluster_id"]}
+        if channels is not None:
+            query["channel_id"] = {"$in": list(channels)}
+        members = await self._find(query, [("date", 1)], limit + 1)
+        near = [candidate for candidate in await self._candidates(user_id, bands(doc["signature"]))
+                if similarity(doc["signature"], candidate["signature"]) >= self.min_similarity]
+
+        duplicates = {}
+        for other in members + near:
+            key = (other["channel_id"], other["message_id"])
+            if key == (channel_id, message_id) or key in duplicates:
+                continue
+            if channels is not None and other["channel_id"] not in channels:
+                continue
+            duplicates[key] = {
+                "channel_id": other["channel_id"],
+                "message_id": other["message_id"],
+                "date": other.get("date"),
+                "cluster_id": other["cluster_id"],
+                "similarity": similarity(doc["signature"], other["signature"]),
+            }
+        ranked = sorted(duplicates.values(), key=lambda d: (-d["similarity"], d["date"] or ""))
+        return {"cluster_id": doc["cluster_id"], "duplicates": ranked[:limit]}
@@ -0,0 +1,467 @@
+"""Reading scraped channels back: latest messages, live streams, statistics,
+reply threads, forward lineage, near-duplicates, archival and file exports.
+
+These endpoints only need channel storage, not Telegram.
+"""
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel
+
+import state
+from admission import EXPORT_QUEUE_TIMEOUT
+from auth import User, get_current_user
+from media import etag_matches
+from serialization import dumps
+from storage import ARCHIVE_AFTER_DAYS
+
+# How far /forwards follows a message back through forwarded channels
+MAX_FORWARD_HOPS = 20
+
+# Rendered /channel-data responses kept per process. A cached response is
+# served without asking storage whether the channel changed for
+# CHANNEL_DATA_REVALIDATE seconds; commits by a scraper in this process,
+# or on any node when the broker runs on Redis, drop it straight away.
+CHANNEL_DATA_LIMIT = 100
+CHANNEL_DATA_CACHE_SIZE = int(os.environ.get("CHANNEL_DATA_CACHE_SIZE", 256))
+CHANNEL_DATA_REVALIDATE = float(os.environ.get("CHANNEL_DATA_REVALIDATE", 1.0))
+# Reads of a channel that keeps changing while it is read before it is sent
+# once without an ETag
+CHANNEL_DATA_RENDER_ATTEMPTS = 3
+
+router = APIRouter()
+
+
+class JSONBytesResponse(Response):
+    """JSON response that passes already encoded bytes through as they are."""
+
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        if isinstance(content, (bytes, bytearray, memoryview)):
+            return bytes(content)
+        return dumps(content)
+
+
+class MessageOut(BaseModel):
+    """A stored message as returned by the API (MESSAGE_COLUMNS)."""
+    id: Optional[int] = None
+    message_id: int
+    date: Optional[str] = None
+    sender_id: Optional[int] = None
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+    username: Optional[str] = None
+    message: Optional[str] = None
+    media_type: Optional[str] = None
+    media_path: Optional[str] = None
+    reply_to: Optional[int] = None
+    edit_date: Optional[str] = None
+    fwd_from_id: Optional[int] = None
+    fwd_from_msg_id: Optional[int] = None
+    cluster_id: Optional[str] = None
+
+
+class ChannelMessages(BaseModel):
+    messages: List[MessageOut]
+
+
+class CachedResponse:
+    __slots__ = ('etag', 'body', 'checked')
+
+    def __init__(self, etag, body):
+        self.etag = etag
+        self.body = body
+        self.checked = time.monotonic()
+
+
+class ChannelDataCache:
+    """LRU of rendered /channel-data bodies by (user, channel), with their ETags."""
+
+    def __init__(self, size=CHANNEL_DATA_CACHE_SIZE):
+        self.size = size
+        self._entries: "OrderedDict[tuple, CachedResponse]" = OrderedDict()
+
+    def lookup(self, key) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def store(self, key, etag, body) -> CachedResponse:
+        entry = self._entries[key] = CachedResponse(etag, body)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, user_id, channel_id):
+        self._entries.pop((user_id, channel_id), None)
+
+@router.get("/channel-data/{channel_id}", response_model=ChannelMessages, response_class=JSONBytesResponse)
+async def get_channel_data(channel_id: str, request: Request, current_user: User = Depends(get_current_user)):
+    """The latest messages of a channel, with an ETag of the channel's version.
+
+    Pollers sending it back in If-None-Match get a 304 until the channel
+    changes; unchanged responses are also kept rendered in memory.
+    """
+    if channel_id not in current_user.channels:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Channel {channel_id} not found"
+        )
+
+    key = (current_user.id, channel_id)
+    entry = state.channel_cache.lookup(key)
+    if entry is None or time.monotonic() - entry.checked > CHANNEL_DATA_REVALIDATE:
+        etag = await channel_etag(*key)
+        if entry is not None and entry.etag == etag:
+            entry.checked = time.monotonic()
+        else:
+            entry = None
+    else:
+        etag = entry.etag
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None and etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    if entry is None:
+        for _ in range(CHANNEL_DATA_RENDER_ATTEMPTS):
+            # Rows are encoded by the store, off the event loop, and sent as they are
+            messages = await run_in_threadpool(state.message_store.latest_messages_json, *key, CHANNEL_DATA_LIMIT)
+            body = b'{"messages":' + messages + b'}'
+            # The body goes under the ETag only if nothing was committed while it was read
+            rendered = await channel_etag(*key)
+            if rendered == etag:
+                entry = state.channel_cache.store(key, etag, body)
+                break
+            etag = rendered
+        else:
+            return JSONBytesResponse(body, headers={"Cache-Control": "private, no-cache"})
+        headers["ETag"] = etag
+    return JSONBytesResponse(entry.body, headers=headers)
+
+async def channel_etag(user_id, channel_id) -> str:
+    version = await run_in_threadpool(state.message_store.channel_version, user_id, channel_id, CHANNEL_DATA_LIMIT)
+    return '"' + '-'.join(map(str, version)) + '"'
+
+@router.get("/channel-data/{channel_id}/stream")
+async def stream_channel_data(
+    channel_id: str,
+    request: Request,
+    since_id: Optional[int] = None,
+    current_user: User = Depends(get_current_user)
+):
+    """Server-sent events with every message committed for a channel.
+
+    Messages newer than ``since_id`` (or the standard Last-Event-ID header
+    on reconnect) are replayed from storage first, then new ones are pushed
+    as the scraper commits them. Without either, only new messages are sent.
+    """
+    if channel_id not in current_user.channels:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Channel {channel_id} not found"
+        )
+    
+    last_event_id = request.headers.get("last-event-id")
+    if since_id is None and last_event_id and last_event_id.isdigit():
+        since_id = int(last_event_id)
+    
+    def format_event(payload):
+        return b"id: %d\nevent: message\ndata: %b\n\n" % (payload['message_id'], dumps(payload))
+    
+    async def event_stream():
+        last_sent = since_id
+        async with state.broker.subscribe(current_user.id, channel_id) as subscription:
+            catch_up = since_id is not None
+            while not await request.is_disconnected():
+                if catch_up or subscription.overflowed:
+                    # Subscribed before reading, so nothing committed meanwhile is lost
+                    subscription.overflowed = False
+                    while True:
+                        rows = await run_in_threadpool(state.message_store.messages_since, current_user.id, channel_id, last_sent or 0)
+                        if not rows:
+                            break
+                        for row in rows:
+                            yield format_event(row)
+                        last_sent = rows[-1]['message_id']
+                    catch_up = False
+                try:
+                    payload = await asyncio.wait_for(subscription.queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if last_sent is not None and payload['message_id'] <= last_sent:
+                    continue
+                last_sent = payload['message_id']
+                yield format_event(payload)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.get("/channels/{channel_id}/stats")
+async def get_channel_stats(channel_id: str, current_user: User = Depends(get_current_user)):
+    """Totals, media breakdown and top senders, answered from the store's rollups."""
+    if channel_id not in current_user.channels:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Channel {channel_id} not found"
+        )
+    
+    totals = await run_in_threadpool(state.message_store.channel_stats, current_user.id, channel_id)
+    if totals is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="No data found for this channel"
+        )
+    
+    media = await run_in_threadpool(state.message_store.media_counts, current_user.id, channel_id)
+    senders = await run_in_threadpool(state.message_store.top_senders, current_user.id, channel_id, 10)
+    return {"channel_id": channel_id, **totals, "media": media, "top_senders": senders}
+
+@router.get("/channels/{channel_id}/stats/daily")
+async def get_channel_daily_stats(
+    channel_id: str,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    current_user: User = Depends(get_current_user)
+):
+    if channel_id not in current_user.channels:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Channel {channel_id} not found"
+        )
+    
+    days = await run_in_threadpool(
+        state.message_store.daily_counts, current_user.id, channel_id,
+        start.isoformat() if start else None, end.isoformat() if end else None
+    )
+    return {"channel_id": channel_id, "days": days}
+
+@router.get("/channels/{channel_id}/stats/senders")
+async def get_channel_sender_stats(
+    channel_id: str,
+    limit: int = 20,
+    current_user: User = Depends(get_current_user)
+):
+    if channel_id not in current_user.channels:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Channel {channel_id} not found"
+        )
+    
+    limit = min(max(limit, 1), 1000)
+    senders = await run_in_threadpool(state.message_store.top_senders, current_user.id, channel_id, limit)
+    return {"channel_id": channel_id, "senders": senders}
+
+@router.get("/channels/{channel_id}/stats/media")
+async def get_channel_media_stats(channel_id: str, current_user: User = Depends(get_current_user)):
+    if channel_id not in current_user.channels:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Channel {channel_id} not found"
+        )
+    
+    media = await run_in_threadpool(state.message_store.media_counts, current_user.id, channel_id)
+    return {"channel_id": channel_id, "media": media}
+
+@router.get("/channels/{channel_id}/messages/{message_id}/thread")
+async def get_message_thread(channel_id: str, message_id: int, current_user: User = Depends(get_current_user)):
+    """The root of the reply thread containing a message and every stored reply in it."""
+    if channel_id not in current_user.channels:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Channel {channel_id} not found"
+        )
+    
+    thread = await run_in_threadpool(state.message_store.thread, current_user.id, channel_id, message_id)
+    if thread is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Message {message_id} not found"
+        )
+    return {"channel_id": channel_id, **thread}
+
+async def channel_peer_ids(user):
+    """Map Telegram peer ids to the user's channel keys, which are marked ids or usernames."""
+    peers, usernames = {}, {}
+    for key in user.channels:
+        if key.lstrip('-').isdigit():
+            peers[int(key)] = key
+        else:
+            usernames[key.lstrip('@').lower()] = key
+    if usernames:
+        for username, dialog_id in (await state.dialog_cache.usernames(user.id)).items():
+            if username in usernames:
+                peers[int(dialog_id)] = usernames[username]
+    return peers
+
+@router.get("/channels/{channel_id}/messages/{message_id}/forwards")
+async def get_message_forwards(channel_id: str, message_id: int, current_user: User = Depends(get_current_user)):
+    """Forward lineage of a message across the user's scraped channels.
+
+    ``lineage`` follows the message back through the channels it was
+    forwarded from, as far as they have been scraped. ``forwarded_in``
+    lists the messages in the user's channels that forward the original.
+    """
+    if channel_id not in current_user.channels:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Channel {channel_id} not found"
+        )
+    
+    peers = await channel_peer_ids(current_user)
+    lineage = []
+    current, current_id = channel_id, message_id
+    while current is not None and len(lineage) < MAX_FORWARD_HOPS:
+        source = await run_in_threadpool(state.message_store.forward_source, current_user.id, current, current_id)
+        if source is None:
+            break
+        current, current_id = peers.get(source["fwd_from_id"]), source["fwd_from_msg_id"]
+        lineage.append({**source, "channel_id": current, "scraped": current is not None})
+    
+    origin = lineage[-1] if lineage else None
+    forwarded_in = []
+    if origin and origin["fwd_from_msg_id"] is not None:
+        forwarded_in = await run_in_threadpool(
+            state.message_store.forwards_of, current_user.id, list(current_user.channels),
+            origin["fwd_from_id"], origin["fwd_from_msg_id"]
+        )
+    return {"channel_id": channel_id, "message_id": message_id, "lineage": lineage, "forwarded_in": forwarded_in}
+
+@router.get("/channels/{channel_id}/messages/{message_id}/duplicates")
+async def get_message_duplicates(
+    channel_id: str,
+    message_id: int,
+    limit: int = 100,
+    current_user: User = Depends(get_current_user)
+):
+    """Near-duplicates of a message in the user's scraped channels, most similar first.
+
+    ``cluster_id`` names the first copy of the content that was scraped;
+    ``similarity`` estimates the share of word pairs a duplicate has in
+    common with the message (see duplicates).
+    """
+    if channel_id not in current_user.channels:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Channel {channel_id} not found"
+        )
+    
+    found = await state.near_duplicates.duplicates(
+        current_user.id, channel_id, message_id, channels=set(current_user.channels), limit=min(max(limit, 1), 1000)
+    )
+    if found is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Message {message_id} has no indexed text"
+        )
+    return {"channel_id": channel_id, "message_id": message_id, **found}
+
+@router.get("/channels/{channel_id}/archive")
+async def get_channel_archive(channel_id: str, current_user: User = Depends(get_current_user)):
+    if channel_id not in current_user.channels:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Channel {channel_id} not found"
+        )
+    
+    if not state.message_store.supports_archive:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Archival is only supported by the SQLite message store"
+        )
+    
+    stats = await run_in_threadpool(state.message_store.archive_stats, current_user.id, channel_id)
+    return {"channel_id": channel_id, "archive_after_days": ARCHIVE_AFTER_DAYS or None, **stats}
+
+@router.post("/channels/{channel_id}/archive")
+async def archive_channel(
+    channel_id: str,
+    older_than_days: Optional[int] = None,
+    current_user: User = Depends(get_current_user)
+):
+    """Move messages older than ``older_than_days`` (default ARCHIVE_AFTER_DAYS) into compressed segments."""
+    if channel_id not in current_user.channels:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Channel {channel_id} not found"
+        )
+    
+    if not state.message_store.supports_archive:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Archival is only supported by the SQLite message store"
+        )
+    
+    older_than_days = older_than_days if older_than_days is not None else ARCHIVE_AFTER_DAYS
+    if older_than_days <= 0:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="older_than_days must be a positive number of days"
+        )
+    
+    older_than = datetime.utcnow() - timedelta(days=older_than_days)
+    try:
+        result = await run_in_threadpool(state.message_store.archive, current_user.id, channel_id, older_than)
+    except RuntimeError as e:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=str(e)
+        )
+    return {"channel_id": channel_id, "older_than": older_than, **result}
+
+@router.get("/export-data/{channel_id}/{format}")
+async def export_data(
+    channel_id: str, 
+    format: str,
+    current_user: User = Depends(get_current_user)
+):
+    if channel_id not in current_user.channels:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Channel {channel_id} not found"
+        )
+    
+    if format not in ["csv", "json"]:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Format must be 'csv' or 'json'"
+        )
+    
+    if not await run_in_threadpool(state.message_store.has_channel, current_user.id, channel_id):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="No data found for this channel"
+        )
+    
+    # Exports run in the user's fair share of the export slots; 429 when
+    # the user has too many waiting or none frees up in time
+    state.export_rate.check(current_user.id)
+    state.export_scheduler.admit(current_user.id)
+    
+    channel_dir = state.message_store.data_dir(current_user.id, channel_id)
+    os.makedirs(channel_dir, exist_ok=True)
+    
+    async with state.export_scheduler.slot(current_user.id, current_user.weight, timeout=EXPORT_QUEUE_TIMEOUT):
+        if format == "csv":
+            output_file = os.path.join(channel_dir, f'{channel_id}.csv')
+            await run_in_threadpool(state.message_store.export_csv, current_user.id, channel_id, output_file)
+            return {"message": "CSV export completed", "path": output_file}
+        
+        elif format == "json":
+            output_file = os.path.join(channel_dir, f'{channel_id}.json')
+            await run_in_threadpool(state.message_store.export_json, current_user.id, channel_id, output_file)
+            return {"message": "JSON export completed", "path": output_file}
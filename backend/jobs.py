@@ -0,0 +1,320 @@
+"""Scrape job registry shared across API workers.
+
+Jobs are stored in a MongoDB collection so that every worker sees the same
+state: which channel a job scrapes, how far it got, its rate and ETA, and
+whether a client asked for it to be cancelled. Running jobs report through
+a JobTracker, which batches progress writes and picks up cancellation
+requests made on other workers in the same round-trip.
+"""
+import asyncio
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from pymongo import ReturnDocument, UpdateOne
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+CANCELLING = "cancelling"
+CANCELLED = "cancelled"
+# Stopped by a shutdown; the next process to start takes it up again
+INTERRUPTED = "interrupted"
+
+ACTIVE_STATES = (QUEUED, RUNNING, CANCELLING)
+FINISHED_STATES = (COMPLETED, FAILED, CANCELLED)
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+JOB_PROGRESS_INTERVAL = float(os.environ.get("JOB_PROGRESS_INTERVAL", 1.0))
+JOB_RETENTION_DAYS = int(os.environ.get("JOB_RETENTION_DAYS", 7))
+# An active job that has not written for this long is presumed lost with its worker
+JOB_STALE_AFTER = int(os.environ.get("JOB_STALE_AFTER", 900))
+# Queued jobs are touched this often by their process while they wait for a slot
+JOB_QUEUED_HEARTBEAT = JOB_STALE_AFTER / 3
+
+PUBLIC_PROJECTION = {"_id": 0}
+
+
+class JobCancelled(Exception):
+    """Raised inside a scrape when its job has been cancelled."""
+
+
+class JobTracker:
+    """Progress reporting handle for one running job.
+
+    ``update`` is cheap to call per message: it only writes to MongoDB once
+    every ``interval`` seconds. Each write also reads back the cancellation
+    flag, so cancelling from another worker takes effect within one
+    interval. Cancelling from this worker takes effect immediately.
+    """
+
+    def __init__(self, registry: "JobRegistry", job_id: str, interval: float = JOB_PROGRESS_INTERVAL):
+        self.registry = registry
+        self.job_id = job_id
+        self.interval = interval
+        self.total = 0
+        self.processed = 0
+        self.last_message_id = None
+        self.stages = None
+        self.started = time.monotonic()
+        self.cancelled = False
+        self._last_flush = 0.0
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise JobCancelled(self.job_id)
+
+    async def start(self, total):
+        self.total = total
+        self.started = time.monotonic()
+        now = datetime.utcnow()
+        await self._write({
+            "state": RUNNING,
+            "total": total,
+            "worker": WORKER_ID,
+            "started_at": now,
+            "updated_at": now,
+        })
+        self.check_cancelled()
+
+    def _progress_fields(self):
+        elapsed = time.monotonic() - self.started
+        rate = self.processed / elapsed if elapsed > 0 else 0.0
+        remaining = max(self.total - self.processed, 0)
+        fields = {
+            "processed": self.processed,
+            "last_message_id": self.last_message_id,
+            "rate": round(rate, 2),
+            "eta_seconds": round(remaining / rate, 1) if rate > 0 else None,
+            "updated_at": datetime.utcnow(),
+        }
+        if self.stages is not None:
+            fields["stages"] = self.stages
+        return fields
+
+    async def update(self, processed, last_message_id=None, force=False, stages=None):
+        """Record progress; ``stages`` is the scrape pipeline's per-stage occupancy."""
+        self.processed = processed
+        if last_message_id is not None:
+            self.last_message_id = last_message_id
+        if stages is not None:
+            self.stages = stages
+        now = time.monotonic()
+        if force or now - self._last_flush >= self.interval:
+            self._last_flush = now
+            await self._write(self._progress_fields())
+        self.check_cancelled()
+
+    async def finish(self, state, error=None):
+        fields = self._progress_fields()
+        fields.update({"state": state, "error": error, "finished_at": datetime.utcnow()})
+        if state == COMPLETED:
+            fields["eta_seconds"] = 0
+        await self.registry.collection.update_one({"id": self.job_id}, {"$set": fields})
+        self.registry._trackers.pop(self.job_id, None)
+
+    async def interrupt(self, offset_id, segments=None):
+        """Leave the job to resume from ``offset_id`` after a restart.
+
+        ``segments`` is the state of a backfill's segments (see
+        SegmentProgress.snapshot), so that a resumed backfill only fetches
+        what is left of each.
+        """
+        if self.cancelled:
+            await self.finish(CANCELLED)
+            return
+        fields = self._progress_fields()
+        fields.update({"state": INTERRUPTED, "offset_id": offset_id, "segments": segments, "eta_seconds": None})
+        await self.registry.collection.update_one({"id": self.job_id}, {"$set": fields})
+        self.registry._trackers.pop(self.job_id, None)
+
+    async def _write(self, fields):
+        job = await self.registry.collection.find_one_and_update(
+            {"id": self.job_id},
+            {"$set": fields},
+            projection={"cancel_requested": 1},
+            return_document=ReturnDocument.AFTER,
+        )
+        if job and job.get("cancel_requested"):
+            self.cancelled = True
+
+
+class JobRegistry:
+    def __init__(self, collection):
+        self.collection = collection
+        self._trackers: Dict[str, JobTracker] = {}
+
+    async def ensure_indexes(self):
+        await self.collection.create_index("id", unique=True)
+        await self.collection.create_index([("user_id", 1), ("created_at", -1)])
+        await self.collection.create_index([("user_id", 1), ("channel_id", 1), ("state", 1)])
+        await self.collection.create_index("state", partialFilterExpression={"state": INTERRUPTED})
+        await self.collection.create_index(
+            "finished_at", expireAfterSeconds=int(timedelta(days=JOB_RETENTION_DAYS).total_seconds())
+        )
+
+    @staticmethod
+    def _new_job(user_id, channel_id, offset_id, kind, now):
+        return {
+            "id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "channel_id": channel_id,
+            "kind": kind,
+            "state": QUEUED,
+            "offset_id": offset_id,
+            "processed": 0,
+            "total": None,
+            "last_message_id": None,
+            "rate": 0.0,
+            "eta_seconds": None,
+            "error": None,
+            "cancel_requested": False,
+            "worker": WORKER_ID,
+            "created_at": now,
+            "started_at": None,
+            "updated_at": now,
+            "finished_at": None,
+        }
+
+    async def create(self, user_id, channel_id, offset_id, kind="scrape"):
+        job = self._new_job(user_id, channel_id, offset_id, kind, datetime.utcnow())
+        await self.collection.insert_one(job)
+        job.pop("_id", None)
+        return job
+
+    async def create_many(self, user_id, offsets: Dict[str, int], kind="scrape"):
+        """Queue one job per channel of ``offsets`` (channel_id -> offset_id) in one write."""
+        now = datetime.utcnow()
+        created = [self._new_job(user_id, channel_id, offset_id, kind, now)
+                   for channel_id, offset_id in offsets.items()]
+        if created:
+            await self.collection.insert_many(created, ordered=False)
+        for job in created:
+            job.pop("_id", None)
+        return created
+
+    async def find_active(self, user_id, channel_id) -> Optional[dict]:
+        """A queued or running job of the channel that has written within JOB_STALE_AFTER seconds."""
+        return await self.collection.find_one({
+            "user_id": user_id,
+            "channel_id": channel_id,
+            "state": {"$in": [QUEUED, RUNNING]},
+            "updated_at": {"$gte": datetime.utcnow() - timedelta(seconds=JOB_STALE_AFTER)},
+        }, PUBLIC_PROJECTION)
+
+    async def touch_queued(self, job_ids):
+        """Mark queued jobs as alive, so that find_active keeps finding them while they wait."""
+        if not job_ids:
+            return
+        now = datetime.utcnow()
+        await self.collection.bulk_write([
+            UpdateOne({"id": job_id, "state": QUEUED}, {"$set": {"updated_at": now}}) for job_id in job_ids
+        ], ordered=False)
+
+    async def merge(self, job_id, into_id):
+        """Close a queued job as a duplicate of ``into_id``, which does its work."""
+        now = datetime.utcnow()
+        await self.collection.update_one(
+            {"id": job_id, "state": QUEUED},
+            {"$set": {"state": CANCELLED, "merged_into": into_id, "updated_at": now, "finished_at": now}},
+        )
+
+    async def interrupt(self, job_id):
+        """Leave a queued job that has not started to be taken up after a restart."""
+        await self.collection.update_one(
+            {"id": job_id, "state": QUEUED},
+            {"$set": {"state": INTERRUPTED, "updated_at": datetime.utcnow()}},
+        )
+
+    async def fail(self, job_id, error):
+        """Fail a job whose scrape crashed, unless it already finished."""
+        now = datetime.utcnow()
+        await self.collection.update_one(
+            {"id": job_id, "state": {"$in": [QUEUED, RUNNING, CANCELLING]}},
+            {"$set": {"state": FAILED, "error": error, "updated_at": now, "finished_at": now}},
+        )
+        self._trackers.pop(job_id, None)
+
+    async def claim_interrupted(self, limit=1000) -> list:
+        """Queue jobs interrupted by a shutdown again, under this worker.
+
+        Each job is claimed by one process, however many start at once.
+        """
+        claimed = []
+        while len(claimed) < limit:
+            job = await self.collection.find_one_and_update(
+                {"state": INTERRUPTED},
+                {"$set": {"state": QUEUED, "worker": WORKER_ID, "updated_at": datetime.utcnow()}},
+                projection=PUBLIC_PROJECTION,
+                return_document=ReturnDocument.AFTER,
+            )
+            if job is None:
+                break
+            claimed.append(job)
+        return claimed
+
+    async def has_interrupted(self) -> bool:
+        return await self.collection.find_one({"state": INTERRUPTED}, {"id": 1}) is not None
+
+    def tracker(self, job_id) -> JobTracker:
+        tracker = JobTracker(self, job_id)
+        self._trackers[job_id] = tracker
+        return tracker
+
+    async def get(self, job_id, user_id) -> Optional[dict]:
+        return await self.collection.find_one({"id": job_id, "user_id": user_id}, PUBLIC_PROJECTION)
+
+    async def list(self, user_id, state=None, channel_id=None, limit=50):
+        query = {"user_id": user_id}
+        if state:
+            query["state"] = state
+        if channel_id:
+            query["channel_id"] = channel_id
+        cursor = self.collection.find(query, PUBLIC_PROJECTION).sort("created_at", -1).limit(limit)
+        return await cursor.to_list(length=limit)
+
+    async def request_cancel(self, job_id, user_id) -> Optional[dict]:
+        """Ask a job to stop. Queued and interrupted jobs are cancelled outright."""
+        now = datetime.utcnow()
+        await self.collection.update_one(
+            {"id": job_id, "user_id": user_id, "state": {"$in": [QUEUED, INTERRUPTED]}},
+            {"$set": {"state": CANCELLED, "cancel_requested": True, "updated_at": now, "finished_at": now}},
+        )
+        await self.collection.update_one(
+            {"id": job_id, "user_id": user_id, "state": RUNNING},
+            {"$set": {"state": CANCELLING, "cancel_requested": True, "updated_at": now}},
+        )
+        tracker = self._trackers.get(job_id)
+        if tracker:
+            tracker.cancelled = True
+        return await self.get(job_id, user_id)
+
+    async def watch(self, job_id, user_id, poll_interval=1.0, keepalive=15.0):
+        """Yield the job document whenever it changes, until it finishes.
+
+        Yields ``None`` as a keepalive when nothing changed for
+        ``keepalive`` seconds.
+        """
+        last_seen = None
+        idle = 0.0
+        while True:
+            job = await self.get(job_id, user_id)
+            if job is None:
+                return
+            marker = (job.get("updated_at"), job.get("state"), job.get("processed"))
+            if marker != last_seen:
+                last_seen = marker
+                idle = 0.0
+                yield job
+                if job["state"] in FINISHED_STATES:
+                    return
+            elif idle >= keepalive:
+                idle = 0.0
+                yield None
+            await asyncio.sleep(poll_interval)
+            idle += poll_interval
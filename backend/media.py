@@ -0,0 +1,287 @@
+"""Serving downloaded media: byte ranges, conditional requests and previews.
+
+``GET /api/media/{channel_id}/{file_name}`` serves a file of the channel's
+media directory; ``file_name`` is the base name of a message's media_path.
+Responses carry an ETag (size and mtime), Last-Modified and a long
+Cache-Control max-age, and answer If-None-Match / If-Modified-Since with
+304. A single ``Range`` is answered with 206 so that video players can
+seek without fetching the whole file.
+
+The body is sent with sendfile through the ASGI zero-copy extension where
+the server offers it, and read in chunks off the event loop otherwise.
+With MEDIA_ACCEL_REDIRECT set to an internal nginx location mapped to the
+data directory, the API only checks access and nginx sends the file.
+
+Browsers cannot send the Authorization header for <img> and <video>
+sources. ``POST /api/media/{channel_id}/{file_name}/token`` returns a URL
+for them carrying a media token, which grants only that file and only
+for MEDIA_TOKEN_TTL to twice that, instead of the bearer token.
+
+``?preview=<px>`` serves a JPEG scaled to fit the size instead (images
+only, needs Pillow). Previews are rendered in a process pool and kept
+next to the media in ``.previews``.
+"""
+import asyncio
+import importlib.util
+import mimetypes
+import os
+from datetime import datetime
+from email.utils import formatdate, parsedate_to_datetime
+from functools import lru_cache
+from typing import Dict, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from fastapi.responses import Response
+
+import state
+from auth import User, create_media_token, get_current_user, get_media_user
+
+MEDIA_MAX_AGE = int(os.environ.get("MEDIA_MAX_AGE", 365 * 24 * 3600))
+MEDIA_CHUNK_SIZE = int(os.environ.get("MEDIA_CHUNK_SIZE", 256 * 1024))
+MEDIA_ACCEL_REDIRECT = os.environ.get("MEDIA_ACCEL_REDIRECT")
+PREVIEW_SIZES = tuple(sorted(int(size) for size in os.environ.get("MEDIA_PREVIEW_SIZES", "160,320,640,1280").split(",")))
+PREVIEW_QUALITY = int(os.environ.get("MEDIA_PREVIEW_QUALITY", 80))
+PREVIEW_WORKERS = int(os.environ.get("MEDIA_PREVIEW_WORKERS", 2))
+
+router = APIRouter()
+
+# Previews being rendered, by target path, so that concurrent requests share one
+_rendering: Dict[str, asyncio.Future] = {}
+
+
+class MediaFileResponse(Response):
+    """``count`` bytes of a file from ``offset``, sent without reading the file into memory."""
+
+    def __init__(self, path, offset, count, status_code=200, headers=None, media_type=None):
+        self.path = path
+        self.offset = offset
+        self.count = count
+        super().__init__(
+            status_code=status_code,
+            headers={**(headers or {}), "Content-Length": str(count)},
+            media_type=media_type,
+        )
+
+    async def __call__(self, scope, receive, send):
+        # Opened before the headers go out, so a missing file is still a clean error
+        with open(self.path, "rb") as f:
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            if scope.get("method") == "HEAD" or not self.count:
+                await send({"type": "http.response.body", "body": b""})
+                return
+            if "http.response.zerocopysend" in scope.get("extensions", {}):
+                await send({"type": "http.response.zerocopysend", "file": f,
+                            "offset": self.offset, "count": self.count})
+                return
+            offset, remaining = self.offset, self.count
+            while remaining:
+                chunk = await asyncio.to_thread(os.pread, f.fileno(), min(MEDIA_CHUNK_SIZE, remaining), offset)
+                if not chunk:
+                    break  # truncated since it was stat'ed
+                offset += len(chunk)
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": bool(remaining)})
+            if remaining:
+                await send({"type": "http.response.body", "body": b""})
+
+
+def media_file(user_id, channel_id, file_name):
+    """Path of a file in the channel's media directory; 404 for names that would leave it."""
+    if not file_name or file_name.startswith(".") or os.path.basename(file_name) != file_name:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Media not found")
+    return os.path.join(state.message_store.data_dir(user_id, channel_id), "media", file_name)
+
+
+def parse_range(header, size):
+    """(first, last) byte of a single ``bytes=`` range, or None to send the whole file.
+
+    Several ranges, other units and malformed ranges get the whole file,
+    which HTTP allows; a range that starts past the end is a 416.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, dash, last = spec.strip().partition("-")
+    if not dash:
+        return None
+    try:
+        if not first:
+            # The last ``last`` bytes
+            length = int(last)
+            start, end = size - length, size - 1
+            if length <= 0 or size == 0:
+                start = size
+        else:
+            start = int(first)
+            end = int(last) if last else size - 1
+            if last and start > end:
+                return None
+    except ValueError:
+        return None
+    if start >= size:
+        raise HTTPException(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            detail="Range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"},
+        )
+    return max(start, 0), min(end, size - 1)
+
+
+def _http_date(value) -> Optional[float]:
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def etag_matches(if_none_match, etag) -> bool:
+    """Whether an If-None-Match header names ``etag`` (weak comparison)."""
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return "*" in tags or etag in tags
+
+
+def not_modified(headers, etag, mtime) -> bool:
+    """Whether the client's cached copy is current (If-None-Match, else If-Modified-Since)."""
+    if_none_match = headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag)
+    since = _http_date(headers.get("if-modified-since"))
+    return since is not None and int(mtime) <= since
+
+
+def range_applies(headers, etag, mtime) -> bool:
+    """If-Range: the range only applies to the version of the file the client has."""
+    if_range = headers.get("if-range")
+    if if_range is None:
+        return True
+    if if_range.startswith(('"', 'W/')):
+        return if_range == etag
+    since = _http_date(if_range)
+    return since is not None and int(mtime) <= since
+
+
+@lru_cache(maxsize=None)
+def previews_available() -> bool:
+    return importlib.util.find_spec("PIL") is not None
+
+
+def render_preview(source, target, size):
+    """Write ``source`` scaled to fit ``size`` px as a JPEG to ``target``; runs in the preview pool."""
+    from PIL import Image, ImageOps
+    temporary = f"{target}.{os.getpid()}.tmp"
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size))
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        image.save(temporary, "JPEG", quality=PREVIEW_QUALITY, optimize=True)
+    os.replace(temporary, target)
+
+
+async def preview_file(source, size):
+    """Path of the cached preview of ``source``, rendering it first if it is missing or stale."""
+    if size not in PREVIEW_SIZES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Preview size must be one of {', '.join(map(str, PREVIEW_SIZES))}"
+        )
+    if not previews_available():
+        raise HTTPException(status_code=status.HTTP_501_NOT_IMPLEMENTED, detail="Previews are not available")
+    try:
+        source_mtime = os.stat(source).st_mtime_ns
+    except FileNotFoundError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Media not found")
+    directory, name = os.path.split(source)
+    target = os.path.join(directory, ".previews", f"{name}.{size}.jpg")
+    try:
+        if os.stat(target).st_mtime_ns >= source_mtime:
+            return target
+    except FileNotFoundError:
+        pass
+
+    rendering = _rendering.get(target)
+    if rendering is None:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        rendering = asyncio.wrap_future(state.preview_pool.submit(render_preview, source, target, size))
+        _rendering[target] = rendering
+        rendering.add_done_callback(lambda _: _rendering.pop(target, None))
+    try:
+        # Shielded: a client going away must not cancel it for the others
+        await asyncio.shield(rendering)
+    except Exception:
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail="No preview for this file"
+        )
+    return target
+
+
+@router.post("/media/{channel_id}/{file_name}/token")
+async def create_media_url(
+    channel_id: str,
+    file_name: str,
+    request: Request,
+    current_user: User = Depends(get_current_user)
+):
+    """URL of a media file that works without the Authorization header, for a limited time."""
+    if channel_id not in current_user.channels:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Channel {channel_id} not found"
+        )
+    media_file(current_user.id, channel_id, file_name)
+    token, expires = create_media_token(current_user.id, channel_id, file_name)
+    path = request.app.url_path_for("get_media", channel_id=channel_id, file_name=file_name)
+    return {
+        "url": f"{path}?media_token={token}",
+        "media_token": token,
+        "expires_at": datetime.utcfromtimestamp(expires),
+    }
+
+
+@router.api_route("/media/{channel_id}/{file_name}", methods=["GET", "HEAD"])
+async def get_media(
+    channel_id: str,
+    file_name: str,
+    request: Request,
+    preview: Optional[int] = None,
+    current_user: User = Depends(get_media_user)
+):
+    if channel_id not in current_user.channels:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Channel {channel_id} not found"
+        )
+    path = media_file(current_user.id, channel_id, file_name)
+    if preview is not None:
+        path = await preview_file(path, preview)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Media not found")
+
+    etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+        "Cache-Control": f"private, max-age={MEDIA_MAX_AGE}",
+        "Accept-Ranges": "bytes",
+    }
+    if not_modified(request.headers, etag, stat.st_mtime):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+    if MEDIA_ACCEL_REDIRECT:
+        # nginx answers ranges and conditional requests itself
+        relative = os.path.relpath(path, state.message_store.data_dir(current_user.id, channel_id))
+        headers["X-Accel-Redirect"] = "/".join((MEDIA_ACCEL_REDIRECT.rstrip("/"), current_user.id, channel_id, relative))
+        return Response(headers=headers, media_type=media_type)
+
+    byte_range = None
+    if "range" in request.headers and range_applies(request.headers, etag, stat.st_mtime):
+        byte_range = parse_range(request.headers["range"], stat.st_size)
+    if byte_range is None:
+        return MediaFileResponse(path, 0, stat.st_size, headers=headers, media_type=media_type)
+    first, last = byte_range
+    headers["Content-Range"] = f"bytes {first}-{last}/{stat.st_size}"
+    return MediaFileResponse(path, first, last - first + 1, status.HTTP_206_PARTIAL_CONTENT, headers, media_type)
@@ -0,0 +1,217 @@
+"""Prometheus metrics for the scraper and the API.
+
+All metrics live in the default registry. When the API runs with several
+worker processes, set PROMETHEUS_MULTIPROC_DIR so that /metrics aggregates
+the values of every worker.
+"""
+import logging
+import os
+import time
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+logger = logging.getLogger(__name__)
+
+MESSAGES_SCRAPED = Counter(
+    "scraper_messages_scraped_total",
+    "Messages written to channel storage by the scraper",
+)
+MEDIA_DOWNLOADED_BYTES = Counter(
+    "scraper_media_downloaded_bytes_total",
+    "Bytes of media downloaded from Telegram",
+)
+MEDIA_DOWNLOADS = Counter(
+    "scraper_media_downloads_total",
+    "Media download attempts by result",
+    ["result"],
+)
+SQLITE_COMMIT_SECONDS = Histogram(
+    "scraper_sqlite_commit_seconds",
+    "Time spent committing SQLite transactions",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+MONGO_CHECKPOINT_SECONDS = Histogram(
+    "scraper_mongo_checkpoint_seconds",
+    "Time spent writing channel offset checkpoints to MongoDB",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+FLOOD_WAIT_SECONDS = Counter(
+    "telegram_flood_wait_seconds_total",
+    "Seconds spent waiting on Telegram FloodWait errors",
+)
+FLOOD_WAITS = Counter(
+    "telegram_flood_waits_total",
+    "Number of Telegram FloodWait errors",
+)
+ACTIVE_CLIENTS = Gauge(
+    "telegram_active_clients",
+    "Telegram clients currently connected",
+    multiprocess_mode="livesum",
+)
+ACTIVE_SCRAPES = Gauge(
+    "scraper_active_tasks",
+    "Channel scrape tasks currently running",
+    multiprocess_mode="livesum",
+)
+PIPELINE_QUEUED = Gauge(
+    "scraper_stage_queued",
+    "Items waiting in the input queue of a scrape pipeline stage",
+    ["stage"],
+    multiprocess_mode="livesum",
+)
+PIPELINE_BUSY = Gauge(
+    "scraper_stage_busy_workers",
+    "Workers of a scrape pipeline stage currently handling items",
+    ["stage"],
+    multiprocess_mode="livesum",
+)
+PIPELINE_BUSY_SECONDS = Counter(
+    "scraper_stage_busy_seconds_total",
+    "Time workers of a scrape pipeline stage spent handling items",
+    ["stage"],
+)
+ADMISSION_REJECTIONS = Counter(
+    "admission_rejections_total",
+    "Requests for scrape or export work turned away with a 429",
+    ["scheduler", "reason"],
+)
+FAIR_QUEUE_WAITING = Gauge(
+    "admission_waiting",
+    "Units of work waiting for a slot of a fair-share scheduler",
+    ["scheduler"],
+    multiprocess_mode="livesum",
+)
+FAIR_QUEUE_RUNNING = Gauge(
+    "admission_running",
+    "Units of work holding a slot of a fair-share scheduler",
+    ["scheduler"],
+    multiprocess_mode="livesum",
+)
+WATCH_MATCHES = Counter(
+    "scraper_watch_matches_total",
+    "Watch rule hits on messages as they were scraped",
+)
+WATCH_REGEX_TIMEOUTS = Counter(
+    "scraper_watch_regex_timeouts_total",
+    "Watch rules skipped because a search of their regular expression timed out",
+)
+NEAR_DUPLICATES = Counter(
+    "scraper_near_duplicates_total",
+    "Scraped messages that joined the cluster of an earlier near-duplicate",
+)
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Time until the response starts, by route template",
+    ["method", "route", "status"],
+)
+
+
+def record_flood_wait(seconds):
+    FLOOD_WAITS.inc()
+    FLOOD_WAIT_SECONDS.inc(seconds)
+
+
+class FloodWaitLogHandler(logging.Handler):
+    """Counts the flood waits Telethon sleeps through on its own.
+
+    Waits shorter than ``flood_sleep_threshold`` never reach our code as
+    FloodWaitError; Telethon only logs them, so we pick them up here.
+    """
+
+    def emit(self, record):
+        if record.msg == 'Sleeping%s for %ds (%s) on %s flood wait':
+            try:
+                record_flood_wait(int(record.args[1]))
+            except (IndexError, TypeError, ValueError):
+                pass
+
+
+def install_telethon_flood_wait_hook():
+    telethon_logger = logging.getLogger("telethon.client.users")
+    if not any(isinstance(h, FloodWaitLogHandler) for h in telethon_logger.handlers):
+        telethon_logger.addHandler(FloodWaitLogHandler())
+
+
+def render_metrics():
+    """Return (body, content_type) for the /metrics endpoint."""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+class PrometheusMiddleware:
+    """ASGI middleware observing per-route request latency.
+
+    Latency is measured until the response starts so that streaming
+    responses are not counted for as long as the client stays connected.
+    Requests that match no route share one label to bound cardinality.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        observed = False
+
+        def observe(status_code):
+            nonlocal observed
+            if observed:
+                return
+            observed = True
+            route = scope.get("route")
+            REQUEST_SECONDS.labels(
+                scope["method"],
+                getattr(route, "path", "unmatched"),
+                str(status_code),
+            ).observe(time.perf_counter() - started)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                observe(message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception:
+            observe(500)
+            raise
+
+
+class ProgressLogger:
+    """Rate-limited progress events for long running scrapes.
+
+    Logs at most once every ``interval`` seconds, plus the final event,
+    instead of one line per message.
+    """
+
+    def __init__(self, label, total, interval=None):
+        self.label = label
+        self.total = total
+        self.interval = interval if interval is not None else float(os.environ.get("PROGRESS_LOG_INTERVAL", 10))
+        self.started = time.monotonic()
+        self._last_logged = self.started
+
+    def update(self, processed, force=False):
+        now = time.monotonic()
+        if not force and now - self._last_logged < self.interval:
+            return
+        self._last_logged = now
+        elapsed = now - self.started
+        rate = processed / elapsed if elapsed > 0 else 0.0
+        percent = (processed / self.total * 100) if self.total else 100.0
+        logger.info(f"{self.label} - Progress: {percent:.2f}% ({processed}/{self.total}, {rate:.1f} msg/s)")
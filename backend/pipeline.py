@@ -0,0 +1,185 @@
+"""Staged pipelines with bounded queues between the stages.
+
+A pipeline is a chain of stages fed from an async iterator. Each stage has
+its own input queue and a fixed number of workers; a worker takes up to
+``batch_size`` items from the queue, hands them to the stage's handler and
+puts whatever the handler returns on the next stage's queue. Queues are
+bounded, so a slow stage fills its queue and the stages before it wait on
+``put``: memory stays bounded by the queue sizes, whatever the source
+delivers, and the stage with the full input queue is the bottleneck.
+
+``Pipeline.occupancy()`` and the scraper_stage_* metrics show how full the
+queues are and how many workers of each stage are busy.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import AsyncIterable, Awaitable, Callable, Dict, Iterable, List, Optional
+
+from metrics import PIPELINE_BUSY, PIPELINE_BUSY_SECONDS, PIPELINE_QUEUED
+
+# Queued after the last item; every worker that takes it puts it back.
+_DONE = object()
+
+
+class Stage:
+    def __init__(self, name, handler: Callable[[List], Awaitable[Optional[Iterable]]],
+                 workers=1, queue_size=100, batch_size=1, batch_wait=0.0):
+        self.name = name
+        self.handler = handler
+        self.workers = max(workers, 1)
+        self.queue: asyncio.Queue = asyncio.Queue(max(queue_size, 1))
+        # asyncio.Queue lets a new put overtake the ones waiting for room,
+        # which can starve a worker holding the oldest item indefinitely
+        self._put_lock = asyncio.Lock()
+        self.batch_size = max(batch_size, 1)
+        self.batch_wait = batch_wait
+        self.queued = 0
+        self.busy = 0
+        self.processed = 0
+        self.running = self.workers
+
+    async def put(self, item):
+        async with self._put_lock:
+            await self.queue.put(item)
+        self.queued += 1
+        PIPELINE_QUEUED.labels(self.name).inc()
+
+    async def close(self):
+        await self.queue.put(_DONE)
+
+    async def take(self) -> List:
+        """The next batch; empty once the stage is closed and drained.
+
+        Waits up to ``batch_wait`` seconds for a batch to fill up.
+        """
+        batch = []
+        deadline = None
+        while len(batch) < self.batch_size:
+            if not self.queue.empty():
+                item = self.queue.get_nowait()
+            elif not batch:
+                item = await self.queue.get()
+            else:
+                if deadline is None:
+                    deadline = time.monotonic() + self.batch_wait
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            if item is _DONE:
+                # Nothing follows the marker; leave it for the other workers
+                self.queue.put_nowait(_DONE)
+                break
+            self.queued -= 1
+            PIPELINE_QUEUED.labels(self.name).dec()
+            batch.append(item)
+        return batch
+
+    def occupancy(self) -> dict:
+        return {
+            "queued": self.queued,
+            "capacity": self.queue.maxsize,
+            "busy": self.busy,
+            "workers": self.workers,
+            "processed": self.processed,
+        }
+
+
+class Pipeline:
+    def __init__(self, stages: List[Stage]):
+        self.stages = stages
+
+    def occupancy(self) -> Dict[str, dict]:
+        return {stage.name: stage.occupancy() for stage in self.stages}
+
+    async def run(self, source: AsyncIterable):
+        """Push every item of ``source`` through the stages.
+
+        If the source fails, the items already taken from it still go
+        through every stage before its exception is raised. An exception
+        in a stage handler cancels the whole pipeline.
+        """
+        source_error = None
+
+        async def feed():
+            nonlocal source_error
+            try:
+                async for item in source:
+                    await self.stages[0].put(item)
+            except Exception as e:
+                source_error = e
+            await self.stages[0].close()
+
+        tasks = [asyncio.ensure_future(feed())]
+        for index, stage in enumerate(self.stages):
+            following = self.stages[index + 1] if index + 1 < len(self.stages) else None
+            tasks.extend(asyncio.ensure_future(self._work(stage, following)) for _ in range(stage.workers))
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for stage in self.stages:
+                PIPELINE_QUEUED.labels(stage.name).dec(stage.queued)
+                stage.queued = 0
+        if source_error is not None:
+            raise source_error
+
+    async def _work(self, stage: Stage, following: Optional[Stage]):
+        while True:
+            batch = await stage.take()
+            if not batch:
+                break
+            stage.busy += 1
+            PIPELINE_BUSY.labels(stage.name).inc()
+            started = time.monotonic()
+            try:
+                results = await stage.handler(batch)
+            finally:
+                stage.busy -= 1
+                PIPELINE_BUSY.labels(stage.name).dec()
+                PIPELINE_BUSY_SECONDS.labels(stage.name).inc(time.monotonic() - started)
+            stage.processed += len(batch)
+            if following is not None:
+                for result in results or ():
+                    await following.put(result)
+        stage.running -= 1
+        if following is not None and not stage.running:
+            await following.close()
+
+
+class InFlight:
+    """Ids that entered a pipeline in increasing order, until they leave it.
+
+    Items may finish out of order; ``done`` reports how far every id has
+    finished, which is the point a scrape can safely resume from.
+    """
+
+    def __init__(self):
+        self._ids: "OrderedDict[int, bool]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, item_id):
+        self._ids[item_id] = False
+
+    def done(self, item_id) -> Optional[int]:
+        """Mark ``item_id`` finished; return the highest id up to which all are, if it moved."""
+        if item_id in self._ids:
+            self._ids[item_id] = True
+        mark = None
+        while self._ids:
+            first_id, finished = next(iter(self._ids.items()))
+            if not finished:
+                break
+            self._ids.popitem(last=False)
+            mark = first_id
+        return mark
@@ -0,0 +1,785 @@
+"""Scraping of Telegram channels into channel storage.
+
+Everything that talks to Telegram lives here: building clients on leased
+sessions, turning Telethon messages into records, and running scrapes as
+pipelines over the user's accounts. The module needs Telethon but none of
+the web stack, so scrape workers import it without FastAPI, and the API
+only imports it when it first starts a scrape.
+"""
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+
+from telethon import TelegramClient, utils as telegram_utils
+from telethon.errors import FloodWaitError
+from telethon.tl.types import MessageMediaDocument, MessageMediaPhoto, PeerChannel
+from telethon.tl.types import User as TelegramUser
+
+import jobs
+import state
+from accounts import (
+    PRIMARY_ACCOUNT,
+    NoAccountAvailable,
+    SegmentProgress,
+    resume_segments,
+    segment_count,
+    split_segments,
+)
+from duplicates import NEAR_DUPLICATE_INDEX, cluster_key
+from jobs import JobCancelled
+from metrics import (
+    ACTIVE_CLIENTS,
+    ACTIVE_SCRAPES,
+    MEDIA_DOWNLOADED_BYTES,
+    MEDIA_DOWNLOADS,
+    MESSAGES_SCRAPED,
+    MONGO_CHECKPOINT_SECONDS,
+    NEAR_DUPLICATES,
+    WATCH_MATCHES,
+    WATCH_REGEX_TIMEOUTS,
+    ProgressLogger,
+    install_telethon_flood_wait_hook,
+    record_flood_wait,
+)
+from pipeline import InFlight, Pipeline, Stage
+from sessions import SESSION_LEASE_WAIT, SessionBusy
+from storage import ARCHIVE_AFTER_DAYS, MessageRecord, StoredMessage
+
+logger = logging.getLogger(__name__)
+install_telethon_flood_wait_hook()
+
+# A scrape waits out a FloodWait on a different account; if every account
+# is flooded it sleeps up to this long before failing the job
+MAX_FLOOD_SLEEP = int(os.environ.get('MAX_FLOOD_SLEEP', 300))
+
+# A scrape runs as a pipeline of stages with bounded queues between them:
+# fetch -> parse -> persist -> media -> publish, with duplicates (unless
+# NEAR_DUPLICATE_INDEX=0) and watch (for users with watch rules) after
+# persist. SCRAPE_<STAGE>_WORKERS and SCRAPE_<STAGE>_QUEUE override the
+# workers and queue size of a stage; persist writes up to
+# SCRAPE_BATCH_SIZE messages per transaction
+SCRAPE_QUEUE_SIZE = int(os.environ.get('SCRAPE_QUEUE_SIZE', 100))
+SCRAPE_BATCH_SIZE = int(os.environ.get('SCRAPE_BATCH_SIZE', 100))
+SCRAPE_BATCH_WAIT = float(os.environ.get('SCRAPE_BATCH_WAIT', 0.05))
+
+# On shutdown, scrapes stop fetching and get this long to store what they
+# fetched and write their offsets before they are cancelled
+SCRAPE_DRAIN_TIMEOUT = float(os.environ.get('SCRAPE_DRAIN_TIMEOUT', 20))
+
+# Set while drain() runs: scrapes stop fetching and queued scrapes do not start
+draining = False
+
+class ScrapeInterrupted(Exception):
+    """A scrape stopped fetching because the process is shutting down."""
+
+def message_record(message, sender):
+    """Everything stored about a message, taken from the Telethon objects once."""
+    is_user = isinstance(sender, TelegramUser)
+    fwd_from = message.fwd_from
+    return MessageRecord(
+        message.id,
+        message.date.strftime('%Y-%m-%d %H:%M:%S'),
+        message.sender_id,
+        sender.first_name if is_user else None,
+        sender.last_name if is_user else None,
+        sender.username if is_user else None,
+        message.message,
+        message.media.__class__.__name__ if message.media else None,
+        None,
+        message.reply_to_msg_id if message.reply_to else None,
+        message.edit_date.strftime('%Y-%m-%d %H:%M:%S') if message.edit_date else None,
+        telegram_utils.get_peer_id(fwd_from.from_id) if fwd_from and fwd_from.from_id else None,
+        fwd_from.channel_post if fwd_from else None,
+    )
+
+def save_messages_to_db(user_id, channel, records):
+    """Upsert a batch of records; the id of each, None where nothing changed."""
+    return state.message_store.upsert_messages(user_id, channel, records)
+
+def channel_changed(user_id, channel):
+    """Drop this process's cached /channel-data response for a channel whose rows changed."""
+    if state.loaded('channel_cache'):
+        state.channel_cache.invalidate(user_id, channel)
+
+async def download_media(user_id, channel, message, scrape_media=True):
+    if not message.media or not scrape_media:
+        return None
+
+    media_folder = os.path.join(state.message_store.data_dir(user_id, channel), 'media')
+    os.makedirs(media_folder, exist_ok=True)    
+    media_file_name = None
+    
+    if isinstance(message.media, MessageMediaPhoto):
+        media_file_name = message.file.name or f"{message.id}.jpg"
+    elif isinstance(message.media, MessageMediaDocument):
+        media_file_name = message.file.name or f"{message.id}.{message.file.ext if message.file.ext else 'bin'}"
+    
+    if not media_file_name:
+        logger.warning(f"Unable to determine file name for message {message.id}. Skipping download.")
+        return None
+    
+    media_path = os.path.join(media_folder, media_file_name)
+    
+    if os.path.exists(media_path):
+        logger.debug(f"Media file already exists: {media_path}")
+        MEDIA_DOWNLOADS.labels("cached").inc()
+        return media_path
+
+    MAX_RETRIES = 5
+    retries = 0
+    while retries < MAX_RETRIES:
+        try:
+            if isinstance(message.media, MessageMediaPhoto):
+                media_path = await message.download_media(file=media_folder)
+            elif isinstance(message.media, MessageMediaDocument):
+                media_path = await message.download_media(file=media_folder)
+            if media_path:
+                logger.debug(f"Successfully downloaded media to: {media_path}")
+                MEDIA_DOWNLOADS.labels("ok").inc()
+                MEDIA_DOWNLOADED_BYTES.inc(os.path.getsize(media_path))
+            break
+        except FloodWaitError as e:
+            retries += 1
+            record_flood_wait(e.seconds)
+            logger.warning(f"Flood wait of {e.seconds}s while downloading media for message {message.id}")
+            await asyncio.sleep(e.seconds)
+        except Exception as e:
+            retries += 1
+            logger.warning(f"Retrying download for message {message.id}. Attempt {retries}... Error: {str(e)}")
+            await asyncio.sleep(2 ** retries)
+    else:
+        MEDIA_DOWNLOADS.labels("error").inc()
+    
+    return media_path
+
+async def get_telegram_client(user_id, account=None, wait=SESSION_LEASE_WAIT):
+    """Client for one of the user's accounts; the primary one by default."""
+    if account is None:
+        user = await state.db.users.find_one({"id": user_id})
+        if not user or not user.get("telegram_credentials"):
+            return None
+        account = {**user["telegram_credentials"], "account_id": PRIMARY_ACCOUNT}
+    
+    if not state.loaded('session_store'):
+        await state.ensure_indexes('session_store')
+    
+    # Held until the client disconnects; raises SessionBusy if another
+    # client keeps it for longer than ``wait`` seconds
+    session = await state.session_store.acquire(user_id, account["account_id"], wait=wait)
+    try:
+        client = TelegramClient(
+            session, 
+            account["api_id"], 
+            account["api_hash"]
+        )
+    except Exception:
+        session.close()
+        raise
+    
+    return client
+
+async def open_channel(client, channel_id):
+    await client.start()
+    if channel_id.startswith('-'):
+        return await client.get_entity(PeerChannel(int(channel_id)))
+    return await client.get_entity(channel_id)
+
+@asynccontextmanager
+async def telegram_session(user_id, wait=SESSION_LEASE_WAIT):
+    """Started Telegram client for a user, disconnected on exit.
+    
+    Raises SessionBusy if a scrape keeps the session for more than ``wait`` seconds.
+    """
+    client = await get_telegram_client(user_id, wait=wait)
+    if not client:
+        raise ValueError("Failed to initialize Telegram client")
+    
+    ACTIVE_CLIENTS.inc()
+    try:
+        await client.start()
+        yield client
+    finally:
+        ACTIVE_CLIENTS.dec()
+        await client.disconnect()
+
+async def scrape_channel_task(user_id, channel_id, offset_id, scrape_media, job_id=None, segments=None):
+    """Scrape a channel from offset_id on, spread over the user's Telegram accounts.
+
+    The account with the best flood history looks up the newest message. A
+    backfill of more than BACKFILL_SEGMENT_MIN messages per account is cut
+    into segments that run on separate accounts at once; a segment that
+    hits a FloodWait moves to another account and carries on where it was.
+
+    A scrape stopped by drain() leaves its job interrupted with its offset
+    and a snapshot of its segments, which the resumed scrape passes back in
+    as ``segments``.
+    """
+    tracker = state.job_registry.tracker(job_id) if job_id else None
+    user = await state.db.users.find_one({"id": user_id})
+    try:
+        accounts = await state.account_pool.assign(user, count=None) if user else []
+    except NoAccountAvailable as e:
+        logger.error(f"No Telegram account available for user {user_id}: {str(e)}")
+        accounts = []
+    client, error = None, "Failed to get Telegram client"
+    try:
+        client = await get_telegram_client(user_id, accounts[0]) if accounts else None
+    except SessionBusy as e:
+        error = str(e)
+    if not client:
+        logger.error(f"{error} for user {user_id}")
+        if tracker:
+            await tracker.finish(jobs.FAILED, error)
+        return
+    
+    ACTIVE_SCRAPES.inc()
+    ACTIVE_CLIENTS.inc()
+    job_state, job_error = jobs.COMPLETED, None
+    scrape = None
+    try:
+        async with state.account_pool.lease(accounts[0]):
+            entity = await open_channel(client, channel_id)
+            
+            # Channel message ids are sequential: the newest id bounds the backfill
+            newest = await client.get_messages(entity, limit=1)
+            last_id = newest[0].id if newest else offset_id
+            if segments:
+                segments = resume_segments(segments, last_id)
+            else:
+                segments = split_segments(offset_id, last_id, segment_count(last_id - offset_id, len(accounts)))
+            total_messages = sum(end - after for after, end in segments)
+            
+            if tracker:
+                await tracker.start(total_messages)
+            
+            if total_messages == 0:
+                logger.info(f"No messages found in channel {channel_id}")
+                return
+            
+            scrape = ChannelScrape(user, channel_id, scrape_media, segments, tracker, total_messages)
+            if len(segments) > 1:
+                logger.info(f"Scraping channel {channel_id} in {len(segments)} segments")
+            await scrape.run(accounts[0], client, entity)
+        
+        logger.info(f"Scraping completed for channel {channel_id}")
+        await archive_old_messages(user_id, channel_id)
+    except JobCancelled:
+        job_state = jobs.CANCELLED
+        logger.info(f"Scraping cancelled for channel {channel_id}")
+    except ScrapeInterrupted:
+        job_state = jobs.INTERRUPTED
+        logger.info(f"Scraping channel {channel_id} interrupted at message {scrape.offsets.checkpoint}")
+    except asyncio.CancelledError:
+        # Cancelled when drain() timed out: resumes from the last checkpoint
+        job_state = jobs.INTERRUPTED
+        raise
+    except FloodWaitError as e:
+        record_flood_wait(e.seconds)
+        await state.account_pool.record_flood_wait(user_id, accounts[0]["account_id"], e.seconds)
+        job_state, job_error = jobs.FAILED, f"Flood wait of {e.seconds}s"
+        logger.error(f"Flood wait of {e.seconds}s while scraping channel {channel_id}")
+    except NoAccountAvailable as e:
+        job_state, job_error = jobs.FAILED, str(e)
+        logger.error(f"Scraping channel {channel_id} stopped: {str(e)}")
+    except Exception as e:
+        job_state, job_error = jobs.FAILED, str(e)
+        logger.error(f"Error scraping channel {channel_id}: {str(e)}")
+    finally:
+        ACTIVE_CLIENTS.dec()
+        ACTIVE_SCRAPES.dec()
+        await client.disconnect()
+        if tracker and job_state == jobs.INTERRUPTED:
+            if scrape is not None:
+                await tracker.interrupt(scrape.offsets.checkpoint, scrape.offsets.snapshot())
+            else:
+                await tracker.interrupt(offset_id, segments)
+        elif tracker:
+            await tracker.finish(job_state, job_error)
+
+class ScrapedMessage:
+    """One message on its way through the scrape pipeline.
+    
+    The Telethon message is dropped once its record is extracted, unless
+    its media still has to be downloaded.
+    """
+    __slots__ = ('message_id', 'message', 'record', 'row_id', 'media_path', 'cluster_id', 'stored')
+    
+    def __init__(self, message):
+        self.message_id = message.id
+        self.message = message
+        self.record = None
+        self.row_id = None
+        self.media_path = None
+        self.cluster_id = None
+        self.stored = False
+    
+    def as_dict(self):
+        saved = StoredMessage(self.row_id, *self.record, self.cluster_id)._asdict()
+        if self.media_path:
+            saved['media_path'] = self.media_path
+        return saved
+
+def scrape_stage(name, handler, workers=1, **kwargs):
+    """Scrape pipeline stage, sized by SCRAPE_<NAME>_WORKERS and SCRAPE_<NAME>_QUEUE if set."""
+    prefix = f'SCRAPE_{name.upper()}'
+    return Stage(name, handler,
+                 workers=int(os.environ.get(f'{prefix}_WORKERS', workers)),
+                 queue_size=int(os.environ.get(f'{prefix}_QUEUE', SCRAPE_QUEUE_SIZE)),
+                 **kwargs)
+
+class ChannelScrape:
+    """One channel scrape, run as one or more segments on separate accounts."""
+    
+    def __init__(self, user, channel_id, scrape_media, segments, tracker, total_messages):
+        self.user = user
+        self.user_id = user["id"]
+        self.channel_id = channel_id
+        self.scrape_media = scrape_media
+        self.segments = segments
+        self.offsets = SegmentProgress(segments)
+        self.tracker = tracker
+        self.processed = 0
+        self.interrupted = False
+        # The user's watch rules, compiled; None if there are none
+        self.matcher = None
+        self.pipelines = {}
+        self.progress = ProgressLogger(f"Scraping channel: {channel_id}", total_messages)
+    
+    async def run(self, account, client, entity):
+        """Run every segment; the first one on the already connected client."""
+        try:
+            self.matcher = await state.watch_rules.matcher(self.user)
+        except Exception as e:
+            logger.error(f"Loading the watch rules of user {self.user_id} failed: {str(e)}")
+        busy = {account["account_id"]}
+        spare = []
+        if len(self.segments) > 1:
+            spare = [a for a in await state.account_pool.assign(self.user, count=None) if a["account_id"] not in busy]
+        tasks = [asyncio.ensure_future(self.run_segment(0, account, client, entity))]
+        for index in range(1, len(self.segments)):
+            tasks.append(asyncio.ensure_future(self.run_segment(index, spare[index - 1] if index <= len(spare) else None)))
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            self.progress.update(self.processed, force=True)
+        if self.interrupted:
+            raise ScrapeInterrupted(self.channel_id)
+    
+    async def run_segment(self, index, account, client=None, entity=None):
+        after_id, last_id = self.segments[index]
+        # The last segment also takes messages posted since the scrape started
+        max_id = last_id + 1 if index < len(self.segments) - 1 else 0
+        busy = set()
+        complete = False
+        while True:
+            if account is None:
+                account = await self.next_account(busy)
+            own_client = client is None
+            try:
+                async with state.account_pool.lease(account):
+                    if own_client:
+                        client = await get_telegram_client(self.user_id, account)
+                        ACTIVE_CLIENTS.inc()
+                        entity = await open_channel(client, self.channel_id)
+                    complete = await self.scrape_range(index, client, entity, self.offsets.positions[index], max_id)
+                break
+            except ScrapeInterrupted:
+                # What was fetched is stored and checkpointed; the rest resumes after a restart
+                self.interrupted = True
+                return
+            except FloodWaitError as e:
+                record_flood_wait(e.seconds)
+                await state.account_pool.record_flood_wait(self.user_id, account["account_id"], e.seconds)
+                logger.warning(f"Flood wait of {e.seconds}s on account {account['account_id']} "
+                               f"while scraping channel {self.channel_id}, switching accounts")
+                account = None
+            except SessionBusy:
+                logger.warning(f"Session of account {account['account_id']} is busy, switching accounts")
+                busy.add(account["account_id"])
+                account = None
+            finally:
+                if own_client and client is not None:
+                    ACTIVE_CLIENTS.dec()
+                    await client.disconnect()
+                client = None
+        
+        if not complete:
+            # The offset stays before the messages that were not saved, for the next scrape to retry
+            return
+        checkpoint = self.offsets.finish(index)
+        if checkpoint is not None:
+            await self.write_checkpoint(checkpoint)
+    
+    async def next_account(self, busy=()):
+        """Best account outside a flood wait; sleeps through waits up to MAX_FLOOD_SLEEP."""
+        while True:
+            try:
+                return (await state.account_pool.assign(self.user, exclude=busy))[0]
+            except NoAccountAvailable as e:
+                if busy and e.retry_after is None:
+                    raise SessionBusy("Every Telegram session of the user is in use")
+                if e.retry_after is None or e.retry_after > MAX_FLOOD_SLEEP:
+                    raise
+                await asyncio.sleep(max(e.retry_after, 0))
+    
+    def occupancy(self):
+        """Per-stage occupancy, summed over the segments running now."""
+        stages = {}
+        for pipeline in self.pipelines.values():
+            for name, counts in pipeline.occupancy().items():
+                total = stages.setdefault(name, dict.fromkeys(counts, 0))
+                for key, value in counts.items():
+                    total[key] += value
+        return stages
+    
+    async def scrape_range(self, index, client, entity, after_id, max_id) -> bool:
+        """Scrape a segment's messages after ``after_id``; False if some could not be saved.
+
+        Messages that were not saved never finish, so the offset stops
+        before the first of them.
+        """
+        user_id, channel_id = self.user_id, self.channel_id
+        # Messages finish out of order; the offset only passes finished ones
+        in_flight = InFlight()
+        failed = []
+        
+        async def fetch():
+            async for message in client.iter_messages(entity, offset_id=after_id, max_id=max_id, reverse=True):
+                if draining:
+                    raise ScrapeInterrupted(channel_id)
+                in_flight.add(message.id)
+                yield ScrapedMessage(message)
+        
+        async def parse(items):
+            for item in items:
+                message = item.message
+                try:
+                    item.record = message_record(message, await message.get_sender())
+                except Exception as e:
+                    logger.error(f"Error processing message {item.message_id}: {str(e)}")
+                if not (self.scrape_media and message.media):
+                    item.message = None
+            return items
+        
+        async def persist(items):
+            parsed = [item for item in items if item.record is not None]
+            if not parsed:
+                return items
+            try:
+                ids = await asyncio.to_thread(save_messages_to_db, user_id, channel_id, [item.record for item in parsed])
+            except Exception as e:
+                logger.error(f"Error saving {len(parsed)} messages: {str(e)}")
+                return items
+            for item, row_id in zip(parsed, ids):
+                item.row_id = row_id
+                item.stored = True
+            if any(row_id is not None for row_id in ids):
+                channel_changed(user_id, channel_id)
+            return items
+        
+        async def match_rules(items):
+            # Only new and changed messages; hits of the others are stored already
+            records = [item.record for item in items if item.row_id is not None]
+            if not records:
+                return items
+            try:
+                hits = await asyncio.to_thread(self.matcher.scan_records, channel_id, records)
+                if hits:
+                    await state.watch_rules.record(user_id, channel_id, hits)
+                    WATCH_MATCHES.inc(len(hits))
+                timed_out = self.matcher.take_timeouts()
+                if timed_out:
+                    logger.warning(f"Watch rules {', '.join(sorted(timed_out))} of user {user_id} timed out "
+                                   f"and are skipped until edited")
+                    await state.watch_rules.record_timeouts(user_id, timed_out)
+                    WATCH_REGEX_TIMEOUTS.inc(len(timed_out))
+            except Exception as e:
+                logger.error(f"Error matching watch rules on {len(records)} messages: {str(e)}")
+            return items
+        
+        async def index_duplicates(items):
+            records = [item.record for item in items if item.row_id is not None]
+            if not records:
+                return items
+            try:
+                clusters = await state.near_duplicates.add(user_id, channel_id, records)
+                NEAR_DUPLICATES.inc(sum(1 for message_id, cluster_id in clusters.items()
+                                        if cluster_id != cluster_key(channel_id, message_id)))
+                for item in items:
+                    item.cluster_id = clusters.get(item.message_id)
+                if clusters and await asyncio.to_thread(state.message_store.set_cluster_ids, user_id, channel_id, clusters):
+                    channel_changed(user_id, channel_id)
+            except Exception as e:
+                logger.error(f"Error indexing {len(records)} messages for near-duplicates: {str(e)}")
+            return items
+        
+        async def media(items):
+            for item in items:
+                message = item.message
+                if not item.stored or message is None:
+                    continue
+                try:
+                    media_path = await download_media(user_id, channel_id, message, self.scrape_media)
+                    if media_path:
+                        item.media_path = media_path
+                        await asyncio.to_thread(state.message_store.set_media_path, user_id, channel_id, message.id, media_path)
+                        channel_changed(user_id, channel_id)
+                except Exception as e:
+                    logger.error(f"Error processing message {message.id}: {str(e)}")
+                    item.stored = False
+                item.message = None
+            return items
+        
+        async def publish(items):
+            finished = None
+            for item in items:
+                if item.stored:
+                    # Unchanged messages seen again on a rescan are not re-published
+                    if item.row_id is not None and state.broker.has_subscribers(user_id, channel_id):
+                        try:
+                            await state.broker.publish(user_id, channel_id, item.as_dict())
+                        except Exception as e:
+                            logger.error(f"Error publishing message {item.message_id}: {str(e)}")
+                    self.processed += 1
+                    MESSAGES_SCRAPED.inc()
+                    finished = in_flight.done(item.message_id) or finished
+                else:
+                    failed.append(item.message_id)
+            self.progress.update(self.processed)
+            
+            # Update the last message ID in the database once every
+            # earlier message and segment is stored
+            if finished is not None:
+                checkpoint = self.offsets.advance(index, finished)
+                if checkpoint is not None:
+                    await self.write_checkpoint(checkpoint)
+            if self.tracker:
+                await self.tracker.update(self.processed, self.offsets.checkpoint, stages=self.occupancy())
+        
+        stages = [
+            scrape_stage("parse", parse, workers=4),
+            scrape_stage("persist", persist, workers=1, batch_size=SCRAPE_BATCH_SIZE, batch_wait=SCRAPE_BATCH_WAIT),
+            scrape_stage("media", media, workers=4),
+            scrape_stage("publish", publish, workers=1, batch_size=SCRAPE_BATCH_SIZE),
+        ]
+        if self.matcher is not None:
+            # Watch rules are matched as soon as messages are saved
+            stages.insert(2, scrape_stage("watch", match_rules, workers=1, batch_size=SCRAPE_BATCH_SIZE))
+        if NEAR_DUPLICATE_INDEX:
+            stages.insert(2, scrape_stage("duplicates", index_duplicates, workers=1, batch_size=SCRAPE_BATCH_SIZE))
+        pipeline = Pipeline(stages)
+        self.pipelines[index] = pipeline
+        try:
+            await pipeline.run(fetch())
+        finally:
+            del self.pipelines[index]
+        if failed:
+            logger.warning(f"{len(failed)} messages of channel {channel_id} were not saved, the first "
+                           f"{min(failed)}; the offset stays before it")
+        return not failed
+    
+    async def write_checkpoint(self, last_message_id):
+        with MONGO_CHECKPOINT_SECONDS.time():
+            await state.db.users.update_one(
+                {"id": self.user_id},
+                {"$set": {f"channels.{self.channel_id}": last_message_id}}
+            )
+
+async def archive_old_messages(user_id, channel_id):
+    """Archive messages older than ARCHIVE_AFTER_DAYS, if enabled. Never fails the scrape."""
+    if not ARCHIVE_AFTER_DAYS or not state.message_store.supports_archive:
+        return
+    older_than = datetime.utcnow() - timedelta(days=ARCHIVE_AFTER_DAYS)
+    try:
+        await asyncio.to_thread(state.message_store.archive, user_id, channel_id, older_than)
+    except Exception as e:
+        logger.warning(f"Archiving channel {channel_id} failed: {str(e)}")
+
+async def run_queued_job(user_id, job, scrape_media):
+    """Scrape for a queued job, unless it was cancelled while it waited for a slot.
+    
+    A scrape that crashes fails its job, so that later scrapes of the
+    channel are not merged into a job nothing runs.
+    """
+    try:
+        current = await state.job_registry.get(job["id"], user_id)
+        if not current or current["state"] != jobs.QUEUED:
+            return
+        if draining:
+            await state.job_registry.interrupt(job["id"])
+            return
+        await scrape_channel_task(user_id, job["channel_id"], current["offset_id"], scrape_media, job_id=job["id"],
+                                  segments=current.get("segments"))
+    except Exception as e:
+        logger.error(f"Scrape job {job['id']} of channel {job['channel_id']} crashed: {str(e)}")
+        await state.job_registry.fail(job["id"], str(e))
+
+async def account_limit(user):
+    """How many of the user's scrapes may run at once: one per Telegram account."""
+    return max(len(await state.account_pool.accounts(user)), 1)
+
+# Task touching this process's queued jobs, while there are any
+queued_heartbeat = None
+
+async def touch_queued_jobs():
+    """Keep the jobs of scrapes submitted here fresh until none are left.
+    
+    A job waiting for a slot writes nothing, and one that looks stale is
+    not merged into, so a long queue would otherwise start second scrapes.
+    """
+    while True:
+        await asyncio.sleep(jobs.JOB_QUEUED_HEARTBEAT)
+        submitted = state.scrape_scheduler.submitted()
+        if not submitted:
+            return
+        try:
+            await state.job_registry.touch_queued([job["id"] for _, job in submitted])
+        except Exception as e:
+            logger.error(f"Error touching {len(submitted)} queued jobs: {str(e)}")
+
+async def submit_job(user, job, scrape_media, limit=None):
+    """Queue a job's scrape in the user's fair share of the node's scrape slots.
+    
+    Returns (job, task). If a scrape of the channel got queued meanwhile,
+    ``job`` is merged into it and that scrape's job and task are returned.
+    """
+    user_id = user["id"]
+    key = (user_id, job["channel_id"])
+    task = state.scrape_scheduler.submit(
+        key, user_id, lambda: run_queued_job(user_id, job, scrape_media),
+        tag=job, weight=user.get("weight", 1.0), limit=limit
+    )
+    global queued_heartbeat
+    if queued_heartbeat is None or queued_heartbeat.done():
+        queued_heartbeat = asyncio.ensure_future(touch_queued_jobs())
+    current = state.scrape_scheduler.pending(key)
+    if current is not job:
+        await state.job_registry.merge(job["id"], current["id"])
+    return current, task
+
+async def queue_scrape(user, channel_id, offset_id, scrape_media, kind="scrape", limit=None):
+    """Queue a scrape of a channel from offset_id on; returns (job, task, merged).
+    
+    A scrape of the channel that is already queued or running, on this node
+    or on another one that reported recently, is returned instead of
+    starting a second one; its task is None if it runs elsewhere.
+    """
+    user_id = user["id"]
+    key = (user_id, channel_id)
+    job = state.scrape_scheduler.pending(key)
+    if job is not None:
+        return job, state.scrape_scheduler.task(key), True
+    job = await state.job_registry.find_active(user_id, channel_id)
+    if job is not None:
+        return job, None, True
+    
+    job = await state.job_registry.create(user_id, channel_id, offset_id, kind=kind)
+    current, task = await submit_job(user, job, scrape_media, limit)
+    return current, task, current is not job
+
+async def backfill_channels(user_id, queued_jobs, scrape_media):
+    """Queue scrapes for jobs created by a bulk add, as many at once as the user has accounts."""
+    user = await state.db.users.find_one({"id": user_id})
+    if not user:
+        return
+    limit = await account_limit(user)
+    for job in queued_jobs:
+        await submit_job(user, job, scrape_media, limit)
+
+async def resume_interrupted():
+    """Queue the scrapes interrupted by a shutdown again, from where they stopped.
+    
+    Every process that scrapes calls this when it starts; each job is
+    taken up by one of them. Returns the jobs queued.
+    """
+    resumed = []
+    for job in await state.job_registry.claim_interrupted():
+        user = await state.db.users.find_one({"id": job["user_id"]})
+        if not user or job["channel_id"] not in user.get("channels", {}):
+            await state.job_registry.request_cancel(job["id"], job["user_id"])
+            continue
+        await submit_job(user, job, user.get("scrape_media", True), await account_limit(user))
+        resumed.append(job)
+    if resumed:
+        logger.info(f"Resumed {len(resumed)} interrupted scrapes")
+    return resumed
+
+async def drain(timeout=SCRAPE_DRAIN_TIMEOUT):
+    """Stop scraping in this process for a shutdown, without losing progress.
+    
+    Continuous scraping loops stop and queued scrapes do not start. Running
+    scrapes stop fetching, store and publish what they fetched and write
+    their final offsets; scrapes still running after ``timeout`` seconds
+    are cancelled and keep their last checkpoint. Either way their jobs are
+    left interrupted for resume_interrupted() to pick up on the next start,
+    as are the jobs of scrapes that were still queued; continuous scraping
+    itself resumes from the users' flags.
+    """
+    global draining
+    draining = True
+    try:
+        loops = [task for task in continuous_tasks.values() if not task.done()]
+        for task in loops:
+            task.cancel()
+        submitted = state.scrape_scheduler.submitted() if state.loaded('scrape_scheduler') else []
+        scrapes = [task for task, _ in submitted]
+        if scrapes:
+            logger.info(f"Draining {len(scrapes)} scrapes")
+            _, pending = await asyncio.wait(scrapes, timeout=timeout)
+            for task in pending:
+                task.cancel()
+        await asyncio.gather(*loops, *scrapes, return_exceptions=True)
+        # Scrapes cancelled while they waited for a slot never started
+        for _, job in submitted:
+            await state.job_registry.interrupt(job["id"])
+    finally:
+        draining = False
+
+# Continuous scraping loops running in this process, by user
+continuous_tasks = {}
+
+def start_continuous_scraping(user_id):
+    """Start the user's continuous scraping loop here unless it already runs; False if it does."""
+    task = continuous_tasks.get(user_id)
+    if task is not None and not task.done():
+        return False
+    continuous_tasks[user_id] = asyncio.ensure_future(continuous_scraping_task(user_id))
+    return True
+
+async def continuous_scraping_task(user_id):
+    while True:
+        # Check if continuous scraping is still enabled
+        user = await state.db.users.find_one({"id": user_id})
+        if not user or not user.get("continuous_scraping", False):
+            logger.info(f"Continuous scraping stopped for user {user_id}")
+            break
+        
+        # Scrape all channels in the user's fair share of the scrape slots,
+        # as many at once as the user has accounts; each scrape leases the
+        # least loaded account
+        limit = await account_limit(user)
+        
+        async def scrape_one(channel_id, last_message_id):
+            try:
+                logger.info(f"Checking for new messages in channel: {channel_id}")
+                job, task, merged = await queue_scrape(user, channel_id, last_message_id, user.get("scrape_media", True),
+                                                       kind="continuous", limit=limit)
+                if merged:
+                    logger.info(f"Channel {channel_id} is already being scraped by job {job['id']}")
+                if task is not None:
+                    await asyncio.shield(task)
+            except Exception as e:
+                logger.error(f"Error in continuous scraping for channel {channel_id}: {str(e)}")
+        
+        await asyncio.gather(*(scrape_one(channel_id, last_message_id)
+                               for channel_id, last_message_id in user.get("channels", {}).items()))
+        
+        # Wait before checking again
+        await asyncio.sleep(60)
@@ -0,0 +1,46 @@
+"""JSON encoding of message payloads for the data, export and streaming endpoints.
+
+Message rows are encoded to JSON bytes without building a dict per row:
+the stores have the database render each row as a JSON object (SQLite's
+json_object, PostgreSQL's row_to_json), and rows that only exist as
+tuples, such as archived ones, are encoded field by field. Whole
+payloads are then joined from the encoded rows.
+
+orjson is used when it is installed, the standard library otherwise.
+"""
+import json
+from typing import Iterable, Iterator, Sequence
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+def dumps(value) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+    return _encoder.encode(value).encode("utf-8")
+
+
+def encode_rows(columns: Sequence[str], rows: Iterable[Sequence]) -> Iterator[bytes]:
+    """Each row tuple as a JSON object keyed by ``columns``."""
+    keys = [b'{"' + columns[0].encode() + b'":'] + [b',"' + column.encode() + b'":' for column in columns[1:]]
+    for row in rows:
+        yield b"".join(key + dumps(value) for key, value in zip(keys, row)) + b"}"
+
+
+def json_array(objects: Iterable[bytes]) -> bytes:
+    return b"[" + b",".join(objects) + b"]"
+
+
+def write_json_array(f, objects: Iterable[bytes]):
+    """Write encoded objects to a binary file as a JSON array, one object per line."""
+    separator = b"[\n"
+    for encoded in objects:
+        f.write(separator)
+        f.write(encoded)
+        separator = b",\n"
+    f.write(b"[]" if separator == b"[\n" else b"\n]")
@@ -0,0 +1,269 @@
+"""Telegram session storage with one client per session at a time.
+
+Telethon keeps an account's login (data center and auth key) and its
+entity cache in a session. Two clients using one session at once corrupt
+it, so every session is leased before a client is built on it and handed
+back when that client disconnects.
+
+SESSION_STORE=file (the default) keeps sessions as SQLite files under
+sessions/ and leases them within this process only, which ties an
+account's scrapes to the node holding its file.
+
+SESSION_STORE=mongo keeps sessions in the telegram_sessions collection,
+so any worker can run any account without logging in again. Leases are
+stored on the session document, expire after SESSION_LEASE_TTL seconds
+and are renewed while the client is connected; a worker that dies loses
+its leases within one TTL. A session is loaded into memory when its lease
+is taken and written back whenever Telethon saves it and on disconnect.
+Session files left from the file store are imported on first use.
+"""
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from pymongo import ReturnDocument
+from telethon.crypto import AuthKey
+from telethon.sessions import MemorySession, SQLiteSession
+
+from accounts import PRIMARY_ACCOUNT
+from jobs import WORKER_ID
+
+logger = logging.getLogger(__name__)
+
+SESSION_LEASE_TTL = int(os.environ.get("SESSION_LEASE_TTL", 60))
+SESSION_LEASE_WAIT = float(os.environ.get("SESSION_LEASE_WAIT", 60))
+SESSION_LEASE_POLL = 1.0
+
+NO_LEASE = datetime(1970, 1, 1)
+
+
+class SessionBusy(Exception):
+    """The session is leased by another client and did not free up in time."""
+
+
+def session_name(user_id, account_id):
+    return user_id if account_id == PRIMARY_ACCOUNT else f"{user_id}-{account_id}"
+
+
+class LockedSQLiteSession(SQLiteSession):
+    """SQLite session file that releases its in-process lease when closed."""
+
+    def __init__(self, path, lock: asyncio.Lock):
+        super().__init__(path)
+        self._lock = lock
+
+    def close(self):
+        super().close()
+        if self._lock is not None:
+            self._lock.release()
+            self._lock = None
+
+
+class FileSessionStore:
+    def __init__(self, sessions_dir=None):
+        self.sessions_dir = sessions_dir
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    async def ensure_indexes(self):
+        pass
+
+    def path(self, user_id, account_id):
+        sessions_dir = self.sessions_dir or os.path.join(os.getcwd(), "sessions")
+        return os.path.join(sessions_dir, session_name(user_id, account_id))
+
+    async def acquire(self, user_id, account_id, wait=SESSION_LEASE_WAIT):
+        path = self.path(user_id, account_id)
+        lock = self._locks.setdefault(path, asyncio.Lock())
+        try:
+            await asyncio.wait_for(lock.acquire(), wait)
+        except asyncio.TimeoutError:
+            raise SessionBusy(f"Telegram session {session_name(user_id, account_id)} is in use")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            return LockedSQLiteSession(path, lock)
+        except Exception:
+            lock.release()
+            raise
+
+    async def drain(self):
+        pass
+
+
+class LeasedSession(MemorySession):
+    """In-memory Telethon session backed by a leased Mongo document.
+
+    Writes go out one at a time: saves made while one is in flight are
+    folded into a single next write of the state as it is then, so an
+    older state never lands after a newer one.
+    """
+
+    def __init__(self, store: "MongoSessionStore", user_id, account_id, token):
+        super().__init__()
+        self.store = store
+        self.user_id = user_id
+        self.account_id = account_id
+        self.token = token
+        self.closed = False
+        self._heartbeat: Optional[asyncio.Task] = None
+        self._writer: Optional[asyncio.Task] = None
+        self._dirty = False
+
+    def load(self, doc):
+        if doc.get("dc_id"):
+            self.set_dc(doc["dc_id"], doc.get("server_address"), doc.get("port"))
+        if doc.get("auth_key"):
+            self._auth_key = AuthKey(data=bytes(doc["auth_key"]))
+        self._takeout_id = doc.get("takeout_id")
+        self._entities = {tuple(row) for row in doc.get("entities") or ()}
+
+    def state(self) -> dict:
+        return {
+            "dc_id": self._dc_id,
+            "server_address": self._server_address,
+            "port": self._port,
+            "auth_key": self._auth_key.key if self._auth_key else None,
+            "takeout_id": self._takeout_id,
+            "entities": [list(row) for row in self._entities],
+            "updated_at": datetime.utcnow(),
+        }
+
+    def save(self):
+        if self.closed:
+            return
+        self._dirty = True
+        if self._writer is None or self._writer.done():
+            self._writer = self.store.schedule(self._write())
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            if self._heartbeat:
+                self._heartbeat.cancel()
+            self.store.schedule(self._release())
+
+    async def _write(self):
+        while self._dirty and not self.closed:
+            self._dirty = False
+            await self.store.write(self)
+
+    async def _release(self):
+        # The release carries the final state; it must land after the last write
+        if self._writer is not None:
+            await asyncio.wait([self._writer])
+        await self.store.release(self)
+
+    def delete(self):
+        self._auth_key = None
+        self._entities = set()
+        self.save()
+
+
+class MongoSessionStore:
+    def __init__(self, collection, file_store: Optional[FileSessionStore] = None, ttl=SESSION_LEASE_TTL):
+        self.collection = collection
+        self.file_store = file_store or FileSessionStore()
+        self.ttl = timedelta(seconds=ttl)
+        self._pending = set()
+
+    async def ensure_indexes(self):
+        await self.collection.create_index([("user_id", 1), ("account_id", 1)], unique=True)
+
+    def _key(self, user_id, account_id):
+        return {"user_id": user_id, "account_id": account_id}
+
+    async def acquire(self, user_id, account_id, wait=SESSION_LEASE_WAIT) -> LeasedSession:
+        key = self._key(user_id, account_id)
+        await self.collection.update_one(key, {"$setOnInsert": {"lease_until": NO_LEASE, "holder": None}},
+                                         upsert=True)
+        token = f"{WORKER_ID}:{uuid.uuid4().hex}"
+        deadline = time.monotonic() + wait
+        while True:
+            now = datetime.utcnow()
+            doc = await self.collection.find_one_and_update(
+                {**key, "lease_until": {"$lt": now}},
+                {"$set": {"holder": token, "lease_until": now + self.ttl}},
+                return_document=ReturnDocument.AFTER,
+            )
+            if doc is not None:
+                break
+            if time.monotonic() >= deadline:
+                raise SessionBusy(f"Telegram session {session_name(user_id, account_id)} is in use by another worker")
+            await asyncio.sleep(min(SESSION_LEASE_POLL, max(deadline - time.monotonic(), 0)))
+
+        session = LeasedSession(self, user_id, account_id, token)
+        if doc.get("auth_key"):
+            session.load(doc)
+        else:
+            self._import_file(session)
+            if session.auth_key:
+                await self.write(session)
+        session._heartbeat = asyncio.ensure_future(self._renew(session))
+        return session
+
+    def _import_file(self, session):
+        """Copy a session file of the file store, if there is one, into ``session``."""
+        path = self.file_store.path(session.user_id, session.account_id)
+        if not os.path.exists(f"{path}.session"):
+            return
+        legacy = SQLiteSession(path)
+        try:
+            session.set_dc(legacy.dc_id, legacy.server_address, legacy.port)
+            session.auth_key = legacy.auth_key
+        finally:
+            legacy.close()
+        conn = sqlite3.connect(f"{path}.session")
+        try:
+            session._entities = set(conn.execute("SELECT id, hash, username, phone, name FROM entities"))
+        finally:
+            conn.close()
+        logger.info(f"Imported Telegram session file {path}.session")
+
+    async def _renew(self, session):
+        while not session.closed:
+            await asyncio.sleep(self.ttl.total_seconds() / 3)
+            result = await self.collection.update_one(
+                {**self._key(session.user_id, session.account_id), "holder": session.token},
+                {"$set": {"lease_until": datetime.utcnow() + self.ttl}},
+            )
+            if not result.matched_count:
+                logger.warning(f"Lost the lease on Telegram session "
+                               f"{session_name(session.user_id, session.account_id)}")
+                return
+
+    async def write(self, session):
+        await self.collection.update_one(
+            {**self._key(session.user_id, session.account_id), "holder": session.token},
+            {"$set": session.state()},
+        )
+
+    async def release(self, session):
+        await self.collection.update_one(
+            {**self._key(session.user_id, session.account_id), "holder": session.token},
+            {"$set": {**session.state(), "holder": None, "lease_until": NO_LEASE}},
+        )
+
+    def schedule(self, coro) -> asyncio.Task:
+        """Run a session write from Telethon's synchronous save/close hooks."""
+        task = asyncio.ensure_future(coro)
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+        return task
+
+    async def drain(self):
+        """Wait for scheduled session writes, e.g. before shutting down."""
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+
+
+def create_session_store(db, backend: Optional[str] = None):
+    backend = (backend or os.environ.get("SESSION_STORE", "file")).lower()
+    if backend == "file":
+        return FileSessionStore()
+    if backend == "mongo":
+        return MongoSessionStore(db.telegram_sessions)
+    raise ValueError(f"Unknown SESSION_STORE {backend!r}")
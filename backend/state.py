@@ -0,0 +1,156 @@
+"""Process-wide services, built the first time they are used.
+
+``state.db``, ``state.job_registry`` and the other services below are
+created on first attribute access, so importing this module connects to
+nothing and pulls in none of their dependencies: an API process that
+never scrapes never imports Telethon for the session store. Tests and
+benchmarks swap a service by assignment, e.g. ``state.db = FakeDatabase()``.
+"""
+import os
+import sys
+
+# Module attribute access goes through __getattr__, bare global names do not
+_this = sys.modules[__name__]
+
+
+def _mongo_client():
+    from motor.motor_asyncio import AsyncIOMotorClient
+    return AsyncIOMotorClient(os.environ.get('MONGO_URL'))
+
+
+def _db():
+    return _this.mongo_client[os.environ.get('DB_NAME', 'telegram_scraper')]
+
+
+def _job_registry():
+    from jobs import JobRegistry
+    return JobRegistry(_this.db.scrape_jobs)
+
+
+def _account_pool():
+    # Telegram accounts per user; scrapes are spread over them by flood history
+    from accounts import AccountPool
+    return AccountPool(_this.db.telegram_accounts)
+
+
+def _session_store():
+    # Telethon sessions, leased so that only one client uses each at a time
+    # (session files by default, MongoDB with SESSION_STORE=mongo)
+    from sessions import create_session_store
+    return create_session_store(_this.db)
+
+
+def _dialog_cache():
+    # Cached Telegram dialog listings for /channels-list
+    from dialogs import DialogCache
+    return DialogCache(_this.db.dialog_cache, _this.db.dialog_sync_state)
+
+
+def _message_store():
+    # Channel message storage (per-channel SQLite files or central PostgreSQL)
+    from storage import create_message_store
+    return create_message_store()
+
+
+def _broker():
+    # Fan-out of newly scraped messages to streaming clients
+    from broker import MessageBroker
+    return MessageBroker(os.environ.get('REDIS_URL'))
+
+
+def _scrape_scheduler():
+    # Fair share of the node's scrape slots among users
+    from admission import SCRAPE_SLOTS, SCRAPE_USER_CONCURRENCY, SCRAPE_USER_QUEUE, FairScheduler
+    return FairScheduler("scrape", SCRAPE_SLOTS, SCRAPE_USER_CONCURRENCY, SCRAPE_USER_QUEUE)
+
+
+def _scrape_rate():
+    from admission import SCRAPE_RATE_BURST, SCRAPE_RATE_PER_MINUTE, RateLimiter
+    return RateLimiter("scrape", SCRAPE_RATE_PER_MINUTE, SCRAPE_RATE_BURST)
+
+
+def _export_scheduler():
+    from admission import EXPORT_SLOTS, EXPORT_USER_CONCURRENCY, EXPORT_USER_QUEUE, FairScheduler
+    return FairScheduler("export", EXPORT_SLOTS, EXPORT_USER_CONCURRENCY, EXPORT_USER_QUEUE)
+
+
+def _export_rate():
+    from admission import EXPORT_RATE_BURST, EXPORT_RATE_PER_MINUTE, RateLimiter
+    return RateLimiter("export", EXPORT_RATE_PER_MINUTE, EXPORT_RATE_BURST)
+
+
+def _channel_cache():
+    # Rendered /channel-data responses, dropped when a channel changes
+    from export import ChannelDataCache
+    return ChannelDataCache()
+
+
+def _watch_rules():
+    from watch import WatchRules
+    return WatchRules(_this.db.watch_rules, _this.db.watch_matches, _this.db.users)
+
+
+def _near_duplicates():
+    # SimHash index of every user's messages across their channels
+    from duplicates import NearDuplicateIndex
+    return NearDuplicateIndex(_this.db.message_signatures)
+
+
+def _preview_pool():
+    # Processes rendering media previews, off the event loop and the GIL
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from media import PREVIEW_WORKERS
+    return ProcessPoolExecutor(PREVIEW_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+
+_FACTORIES = {
+    'mongo_client': _mongo_client,
+    'db': _db,
+    'job_registry': _job_registry,
+    'account_pool': _account_pool,
+    'session_store': _session_store,
+    'dialog_cache': _dialog_cache,
+    'message_store': _message_store,
+    'broker': _broker,
+    'scrape_scheduler': _scrape_scheduler,
+    'scrape_rate': _scrape_rate,
+    'export_scheduler': _export_scheduler,
+    'export_rate': _export_rate,
+    'channel_cache': _channel_cache,
+    'preview_pool': _preview_pool,
+    'watch_rules': _watch_rules,
+    'near_duplicates': _near_duplicates,
+}
+
+
+def __getattr__(name):
+    factory = _FACTORIES.get(name)
+    if factory is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = factory()
+    globals()[name] = value
+    return value
+
+
+def loaded(name) -> bool:
+    """Whether the service ``name`` has been built (or assigned) yet."""
+    return name in globals()
+
+
+async def ensure_indexes(*names):
+    """Create the MongoDB indexes of the named services, building them if needed."""
+    for name in names:
+        await getattr(_this, name).ensure_indexes()
+
+
+async def close():
+    """Release the services this process has built; the others are left alone."""
+    if loaded('broker'):
+        await _this.broker.close()
+    if loaded('session_store'):
+        await _this.session_store.drain()
+    if loaded('preview_pool'):
+        _this.preview_pool.shutdown(wait=False, cancel_futures=True)
+    if loaded('mongo_client'):
+        _this.mongo_client.close()
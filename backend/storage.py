@@ -0,0 +1,1519 @@
+"""Channel message storage.
+
+``MessageStore`` is the interface the scraper and the data/export
+endpoints use. Two implementations are provided:
+
+* ``SQLiteMessageStore`` keeps the original layout, one database per
+  channel at ``data/<user_id>/<channel_id>/<channel_id>.db``.
+* ``PostgresMessageStore`` keeps every channel in one central PostgreSQL
+  table, hash-partitioned by (user_id, channel_id), so API nodes and
+  scrape workers on different machines share the same data.
+
+Select the backend with MESSAGE_STORE=sqlite|postgres; the PostgreSQL
+connection string comes from POSTGRES_DSN.
+
+Methods are blocking; async callers should run them in a threadpool.
+
+Existing SQLite data can be bulk-loaded into PostgreSQL with:
+
+    python storage.py import-sqlite data/
+
+SQLite files are migrated to the current schema when first opened; to
+migrate them all up front, e.g. during a deploy, run:
+
+    python storage.py migrate data/
+
+and old SQLite messages moved into compressed archive segments with:
+
+    python storage.py archive data/ --older-than-days 90
+"""
+import argparse
+import csv
+import hashlib
+import io
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Iterable, List, Optional, Sequence
+
+from archive import ARCHIVE_SEGMENT_ROWS, SegmentCache, write_segment
+from metrics import SQLITE_COMMIT_SECONDS
+from serialization import dumps, encode_rows, json_array, write_json_array
+
+logger = logging.getLogger(__name__)
+
+# Age in days after which scraped messages are archived; 0 disables archival
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', 0))
+# Seconds a SQLite connection waits for another one's write lock before giving up
+SQLITE_BUSY_TIMEOUT = float(os.environ.get('SQLITE_BUSY_TIMEOUT', 30))
+# Copies of the messages to archive made before giving up on a channel that keeps changing
+ARCHIVE_ATTEMPTS = int(os.environ.get('ARCHIVE_ATTEMPTS', 3))
+
+# Column order of stored messages, as returned by the read API and exports
+MESSAGE_COLUMNS = ('id', 'message_id', 'date', 'sender_id', 'first_name', 'last_name', 'username',
+                   'message', 'media_type', 'media_path', 'reply_to', 'edit_date', 'fwd_from_id', 'fwd_from_msg_id',
+                   'cluster_id')
+# Columns supplied by the scraper; ``id`` is assigned by the store and ``cluster_id``
+# by the near-duplicate index
+INSERT_COLUMNS = MESSAGE_COLUMNS[1:-1]
+# Columns covered by a message's content hash; media_path is filled in later
+HASHED_COLUMNS = ('date', 'sender_id', 'message', 'media_type', 'reply_to', 'edit_date', 'fwd_from_id', 'fwd_from_msg_id')
+_HASHED_INDEXES = tuple(INSERT_COLUMNS.index(column) for column in HASHED_COLUMNS)
+# Content hashes are summed modulo this for channel_version, so the sum cannot overflow
+FINGERPRINT_MODULUS = 1000000007
+
+
+class MessageRecord(namedtuple('MessageRecord', INSERT_COLUMNS)):
+    """A scraped message, extracted once from Telegram, in INSERT_COLUMNS order.
+
+    Plain tuples are accepted wherever a record is; a record costs about as
+    much as a tuple and far less than a dict or the Telethon message.
+    """
+    __slots__ = ()
+
+
+class StoredMessage(namedtuple('StoredMessage', MESSAGE_COLUMNS)):
+    """A stored message in MESSAGE_COLUMNS order; ``_asdict()`` gives the API shape."""
+    __slots__ = ()
+
+
+def content_hash(row: Sequence) -> int:
+    """Signed 64-bit hash of the content of an INSERT_COLUMNS row."""
+    return hash_content(*(row[i] for i in _HASHED_INDEXES))
+
+
+def hash_content(*values) -> int:
+    """content_hash of a row from its HASHED_COLUMNS values, in that order."""
+    content = json.dumps(values, ensure_ascii=False, default=str)
+    return int.from_bytes(hashlib.blake2b(content.encode('utf-8'), digest_size=8).digest(), 'big', signed=True)
+
+
+class MessageStore:
+    """Interface for per-channel message storage.
+
+    Rows passed to the save methods are tuples in INSERT_COLUMNS order,
+    usually MessageRecords. Rows returned are dicts keyed by
+    MESSAGE_COLUMNS; the ``_json`` reads and exports have the database
+    encode rows to JSON instead.
+
+    Saving is an upsert on message_id: a message seen again is rewritten
+    only if its content hash changed (it was edited), and unchanged
+    messages cost no write. Save methods report inserted and changed rows.
+    """
+
+    supports_archive = False
+
+    def data_dir(self, user_id, channel_id):
+        """Local directory for a channel's media and export files."""
+        return os.path.join(os.getcwd(), 'data', user_id, channel_id)
+
+    def has_channel(self, user_id, channel_id) -> bool:
+        raise NotImplementedError
+
+    def save_message(self, user_id, channel_id, row: Sequence) -> dict:
+        """Upsert one message; the returned ``id`` is None if nothing changed."""
+        raise NotImplementedError
+
+    def save_messages(self, user_id, channel_id, rows: Iterable[Sequence]) -> int:
+        return sum(row_id is not None for row_id in self.upsert_messages(user_id, channel_id, rows))
+
+    def upsert_messages(self, user_id, channel_id, rows: Iterable[Sequence]) -> List[Optional[int]]:
+        """Upsert a batch in one transaction; the id of each row, None where nothing changed."""
+        raise NotImplementedError
+
+    def set_media_path(self, user_id, channel_id, message_id, media_path):
+        raise NotImplementedError
+
+    def set_cluster_ids(self, user_id, channel_id, clusters: dict) -> int:
+        """Tag messages with near-duplicate cluster ids given by message_id; the number of rows changed."""
+        raise NotImplementedError
+
+    def latest_messages(self, user_id, channel_id, limit=100) -> List[dict]:
+        raise NotImplementedError
+
+    def latest_messages_json(self, user_id, channel_id, limit=100) -> bytes:
+        """``latest_messages`` as an encoded JSON array."""
+        return json_array(dumps(row) for row in self.latest_messages(user_id, channel_id, limit))
+
+    def messages_since(self, user_id, channel_id, since_id, limit=500) -> List[dict]:
+        """Messages with message_id > since_id in message_id order."""
+        raise NotImplementedError
+
+    def channel_version(self, user_id, channel_id, limit=100) -> tuple:
+        """(high-water message_id, message count, fingerprint of the latest ``limit`` rows).
+
+        Changes whenever ``latest_messages`` with the same limit would: new
+        messages move the first two, edits, media paths, cluster ids and
+        sender renames the fingerprint.
+        Cheap enough to ask on every poll.
+        """
+        raise NotImplementedError
+
+    def export_csv(self, user_id, channel_id, path):
+        raise NotImplementedError
+
+    def export_json(self, user_id, channel_id, path):
+        raise NotImplementedError
+
+    # Rollups, maintained by the store on every inserted message
+
+    def channel_stats(self, user_id, channel_id) -> Optional[dict]:
+        """Totals for a channel, or None if nothing was stored yet."""
+        raise NotImplementedError
+
+    def daily_counts(self, user_id, channel_id, start=None, end=None) -> List[dict]:
+        """Messages and media messages per day, oldest first. Bounds are inclusive YYYY-MM-DD."""
+        raise NotImplementedError
+
+    def top_senders(self, user_id, channel_id, limit=20) -> List[dict]:
+        raise NotImplementedError
+
+    def media_counts(self, user_id, channel_id) -> List[dict]:
+        """Messages per media type; messages without media count as 'text'."""
+        raise NotImplementedError
+
+    # Reply/forward graph, maintained by the store on every saved message
+
+    def thread(self, user_id, channel_id, message_id) -> Optional[dict]:
+        """``{"thread_root", "messages"}`` for the thread containing a message, or None."""
+        raise NotImplementedError
+
+    def forward_source(self, user_id, channel_id, message_id) -> Optional[dict]:
+        """``{"fwd_from_id", "fwd_from_msg_id"}`` of a forwarded message, or None."""
+        raise NotImplementedError
+
+    def forwards_of(self, user_id, channel_ids, fwd_from_id, fwd_from_msg_id) -> List[dict]:
+        """``{"channel_id", "message_id"}`` of messages in channel_ids forwarded from a source."""
+        raise NotImplementedError
+
+    def archive(self, user_id, channel_id, older_than: datetime, vacuum=True) -> dict:
+        """Move messages dated before ``older_than`` out of the hot store."""
+        raise NotImplementedError(f"{type(self).__name__} does not support archival")
+
+
+class SQLiteMessageStore(MessageStore):
+    """One SQLite database per channel.
+
+    Messages are unique by message_id and reference a ``senders`` table
+    instead of repeating sender names; the ``message_rows`` view joins
+    them back into MESSAGE_COLUMNS rows. Files are in WAL mode, so API
+    reads go on while a scrape commits; writers wait up to
+    SQLITE_BUSY_TIMEOUT seconds for each other.
+
+    Old messages can be archived: a prefix of the channel, up to the
+    newest message older than a cutoff, is written to compressed segment
+    files under ``archive/`` and deleted from the database. Reads fall
+    through to the segments, so callers see one continuous channel.
+    Archived message ids are immutable; re-inserting one is ignored.
+    """
+
+    supports_archive = True
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS messages
+            (id INTEGER PRIMARY KEY, message_id INTEGER, date TEXT, sender_id INTEGER, first_name TEXT, last_name TEXT, username TEXT, message TEXT, media_type TEXT, media_path TEXT, reply_to INTEGER);
+        CREATE INDEX IF NOT EXISTS idx_messages_message_id ON messages (message_id);
+        CREATE INDEX IF NOT EXISTS idx_messages_date ON messages (date);
+    '''
+
+    # Schema changes applied on top of SCHEMA; PRAGMA user_version records
+    # how many have run. Pending ones run in one IMMEDIATE transaction after
+    # re-checking the version under the write lock, so each runs once.
+    # Statements must end at the end of a line.
+    MIGRATIONS = (
+        # 1: rollup tables kept current by a trigger, backfilled from messages
+        '''
+        CREATE TABLE IF NOT EXISTS daily_counts
+            (day TEXT PRIMARY KEY, messages INTEGER NOT NULL, media INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS sender_counts
+            (sender_id INTEGER PRIMARY KEY, first_name TEXT, last_name TEXT, username TEXT, messages INTEGER NOT NULL);
+        CREATE INDEX IF NOT EXISTS idx_sender_counts_messages ON sender_counts (messages DESC);
+        CREATE TABLE IF NOT EXISTS media_counts
+            (media_type TEXT PRIMARY KEY, messages INTEGER NOT NULL);
+
+        CREATE TRIGGER IF NOT EXISTS messages_rollup AFTER INSERT ON messages
+        BEGIN
+            INSERT INTO daily_counts (day, messages, media)
+                SELECT substr(NEW.date, 1, 10), 1, NEW.media_type IS NOT NULL WHERE NEW.date IS NOT NULL
+                ON CONFLICT (day) DO UPDATE SET messages = messages + 1, media = media + excluded.media;
+            INSERT INTO sender_counts (sender_id, first_name, last_name, username, messages)
+                VALUES (coalesce(NEW.sender_id, 0), NEW.first_name, NEW.last_name, NEW.username, 1)
+                ON CONFLICT (sender_id) DO UPDATE SET messages = messages + 1,
+                    first_name = coalesce(excluded.first_name, first_name),
+                    last_name = coalesce(excluded.last_name, last_name),
+                    username = coalesce(excluded.username, username);
+            INSERT INTO media_counts (media_type, messages) VALUES (coalesce(NEW.media_type, 'text'), 1)
+                ON CONFLICT (media_type) DO UPDATE SET messages = messages + 1;
+        END;
+
+        DELETE FROM daily_counts;
+        INSERT INTO daily_counts (day, messages, media)
+            SELECT substr(date, 1, 10), count(*), count(media_type) FROM messages
+            WHERE date IS NOT NULL GROUP BY 1;
+        DELETE FROM sender_counts;
+        INSERT INTO sender_counts (sender_id, first_name, last_name, username, messages)
+            SELECT sender_id, first_name, last_name, username, messages FROM (
+                -- bare columns come from the row holding max(id), i.e. the latest name
+                SELECT coalesce(sender_id, 0) AS sender_id, first_name, last_name, username,
+                       count(*) AS messages, max(id)
+                FROM messages GROUP BY 1
+            );
+        DELETE FROM media_counts;
+        INSERT INTO media_counts (media_type, messages)
+            SELECT coalesce(media_type, 'text'), count(*) FROM messages GROUP BY 1;
+        ''',
+        # 2: index of archive segments
+        '''
+        CREATE TABLE IF NOT EXISTS archive_segments
+            (id INTEGER PRIMARY KEY, path TEXT NOT NULL UNIQUE, codec TEXT NOT NULL,
+             first_message_id INTEGER NOT NULL, last_message_id INTEGER NOT NULL,
+             first_date TEXT, last_date TEXT, rows INTEGER NOT NULL, bytes INTEGER NOT NULL,
+             raw_bytes INTEGER NOT NULL, created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP);
+        CREATE INDEX IF NOT EXISTS idx_archive_segments_last ON archive_segments (last_message_id);
+
+        CREATE TRIGGER IF NOT EXISTS messages_archived BEFORE INSERT ON messages
+        WHEN NEW.message_id <= (SELECT max(last_message_id) FROM archive_segments)
+        BEGIN
+            SELECT RAISE(IGNORE);
+        END;
+        ''',
+        # 3: normalized messages: unique message_id, senders table, edit_date and content hash
+        '''
+        DROP TRIGGER messages_rollup;
+        DROP TRIGGER messages_archived;
+        CREATE TABLE senders
+            (sender_id INTEGER PRIMARY KEY, first_name TEXT, last_name TEXT, username TEXT);
+        -- bare columns come from the row holding max(id), i.e. the latest name
+        INSERT INTO senders (sender_id, first_name, last_name, username)
+            SELECT sender_id, first_name, last_name, username FROM (
+                SELECT sender_id, first_name, last_name, username, max(id) FROM messages
+                WHERE sender_id IS NOT NULL GROUP BY sender_id
+            );
+
+        -- Keep the most recently scraped copy of each message. Rollups counted every copy.
+        CREATE TEMP TABLE duplicate_messages AS
+            SELECT * FROM messages WHERE id NOT IN (SELECT max(id) FROM messages GROUP BY message_id);
+        UPDATE daily_counts SET
+            messages = messages - (SELECT count(*) FROM duplicate_messages d WHERE substr(d.date, 1, 10) = day),
+            media = media - (SELECT count(d.media_type) FROM duplicate_messages d WHERE substr(d.date, 1, 10) = day);
+        UPDATE sender_counts SET messages = messages -
+            (SELECT count(*) FROM duplicate_messages d WHERE coalesce(d.sender_id, 0) = sender_counts.sender_id);
+        UPDATE media_counts SET messages = messages -
+            (SELECT count(*) FROM duplicate_messages d WHERE coalesce(d.media_type, 'text') = media_counts.media_type);
+        DELETE FROM daily_counts WHERE messages <= 0;
+        DELETE FROM sender_counts WHERE messages <= 0;
+        DELETE FROM media_counts WHERE messages <= 0;
+        ALTER TABLE sender_counts DROP COLUMN first_name;
+        ALTER TABLE sender_counts DROP COLUMN last_name;
+        ALTER TABLE sender_counts DROP COLUMN username;
+
+        CREATE TABLE messages_normalized
+            (id INTEGER PRIMARY KEY, message_id INTEGER NOT NULL, date TEXT, edit_date TEXT, sender_id INTEGER,
+             message TEXT, media_type TEXT, media_path TEXT, reply_to INTEGER, content_hash INTEGER);
+        INSERT INTO messages_normalized (id, message_id, date, sender_id, message, media_type, media_path, reply_to)
+            SELECT m.id, m.message_id, m.date, m.sender_id, m.message, m.media_type,
+                   coalesce(m.media_path, (SELECT max(d.media_path) FROM duplicate_messages d
+                                           WHERE d.message_id = m.message_id)),
+                   m.reply_to
+            FROM messages m WHERE m.id NOT IN (SELECT id FROM duplicate_messages);
+        DROP TABLE duplicate_messages;
+        DROP TABLE messages;
+        ALTER TABLE messages_normalized RENAME TO messages;
+        CREATE UNIQUE INDEX idx_messages_message_id ON messages (message_id);
+        CREATE INDEX idx_messages_date ON messages (date);
+
+        CREATE VIEW message_rows AS
+            SELECT m.id, m.message_id, m.date, m.sender_id, s.first_name, s.last_name, s.username,
+                   m.message, m.media_type, m.media_path, m.reply_to, m.edit_date
+            FROM messages m LEFT JOIN senders s ON s.sender_id = m.sender_id;
+
+        CREATE TRIGGER messages_archived BEFORE INSERT ON messages
+        WHEN NEW.message_id <= (SELECT max(last_message_id) FROM archive_segments)
+        BEGIN
+            SELECT RAISE(IGNORE);
+        END;
+        -- Fires for new messages only; edits arrive as upsert updates
+        CREATE TRIGGER messages_rollup AFTER INSERT ON messages
+        BEGIN
+            INSERT INTO daily_counts (day, messages, media)
+                SELECT substr(NEW.date, 1, 10), 1, NEW.media_type IS NOT NULL WHERE NEW.date IS NOT NULL
+                ON CONFLICT (day) DO UPDATE SET messages = messages + 1, media = media + excluded.media;
+            INSERT INTO sender_counts (sender_id, messages) VALUES (coalesce(NEW.sender_id, 0), 1)
+                ON CONFLICT (sender_id) DO UPDATE SET messages = messages + 1;
+            INSERT INTO media_counts (media_type, messages) VALUES (coalesce(NEW.media_type, 'text'), 1)
+                ON CONFLICT (media_type) DO UPDATE SET messages = messages + 1;
+        END;
+        ''',
+        # 4: forward source columns and the reply/forward graph
+        '''
+        ALTER TABLE messages ADD COLUMN fwd_from_id INTEGER;
+        ALTER TABLE messages ADD COLUMN fwd_from_msg_id INTEGER;
+        DROP VIEW message_rows;
+        CREATE VIEW message_rows AS
+            SELECT m.id, m.message_id, m.date, m.sender_id, s.first_name, s.last_name, s.username,
+                   m.message, m.media_type, m.media_path, m.reply_to, m.edit_date, m.fwd_from_id, m.fwd_from_msg_id
+            FROM messages m LEFT JOIN senders s ON s.sender_id = m.sender_id;
+
+        -- One row per reply or forward. Kept when messages are archived.
+        CREATE TABLE message_links
+            (message_id INTEGER PRIMARY KEY, reply_to INTEGER, thread_root INTEGER NOT NULL,
+             fwd_from_id INTEGER, fwd_from_msg_id INTEGER);
+        CREATE INDEX idx_message_links_thread ON message_links (thread_root);
+        CREATE INDEX idx_message_links_reply ON message_links (reply_to);
+        CREATE INDEX idx_message_links_forward ON message_links (fwd_from_id, fwd_from_msg_id)
+            WHERE fwd_from_id IS NOT NULL;
+
+        CREATE INDEX temp_messages_reply_to ON messages (reply_to);
+        WITH RECURSIVE roots (message_id, thread_root) AS (
+            SELECT message_id, coalesce(reply_to, message_id) FROM messages m
+            WHERE reply_to IS NULL OR NOT EXISTS (SELECT 1 FROM messages p WHERE p.message_id = m.reply_to)
+            UNION ALL
+            SELECT m.message_id, r.thread_root FROM messages m JOIN roots r ON m.reply_to = r.message_id
+        )
+        INSERT INTO message_links (message_id, reply_to, thread_root)
+            SELECT m.message_id, m.reply_to, r.thread_root FROM roots r JOIN messages m ON m.message_id = r.message_id
+            WHERE m.reply_to IS NOT NULL;
+        DROP INDEX temp_messages_reply_to;
+
+        -- A reply joins the thread of its parent; a reply to an unknown message starts one there
+        CREATE TRIGGER messages_links AFTER INSERT ON messages
+        WHEN NEW.reply_to IS NOT NULL OR NEW.fwd_from_id IS NOT NULL
+        BEGIN
+            INSERT OR REPLACE INTO message_links (message_id, reply_to, thread_root, fwd_from_id, fwd_from_msg_id)
+            VALUES (NEW.message_id, NEW.reply_to,
+                    coalesce((SELECT thread_root FROM message_links WHERE message_id = NEW.reply_to),
+                             NEW.reply_to, NEW.message_id),
+                    NEW.fwd_from_id, NEW.fwd_from_msg_id);
+            UPDATE message_links SET thread_root = (SELECT thread_root FROM message_links WHERE message_id = NEW.message_id)
+            WHERE thread_root = NEW.message_id AND message_id != NEW.message_id;
+        END;
+        CREATE TRIGGER messages_links_update AFTER UPDATE OF reply_to, fwd_from_id, fwd_from_msg_id ON messages
+        WHEN NEW.reply_to IS NOT NULL OR NEW.fwd_from_id IS NOT NULL
+        BEGIN
+            INSERT OR REPLACE INTO message_links (message_id, reply_to, thread_root, fwd_from_id, fwd_from_msg_id)
+            VALUES (NEW.message_id, NEW.reply_to,
+                    coalesce((SELECT thread_root FROM message_links WHERE message_id = NEW.reply_to),
+                             NEW.reply_to, NEW.message_id),
+                    NEW.fwd_from_id, NEW.fwd_from_msg_id);
+        END;
+        ''',
+        # 5: content hashes of the messages carried over by 3, which left them NULL and so
+        # made every one of them look edited on the next rescan
+        f'''
+        UPDATE messages SET content_hash = hash_content({', '.join(HASHED_COLUMNS)})
+        WHERE content_hash IS NULL;
+        ''',
+        # 6: a version per sender, bumped on every rename, so that channel_version moves
+        # when names shown on messages change without the messages themselves changing
+        '''
+        ALTER TABLE senders ADD COLUMN version INTEGER NOT NULL DEFAULT 0;
+        ''',
+        # 7: the near-duplicate cluster of each message
+        '''
+        ALTER TABLE messages ADD COLUMN cluster_id TEXT;
+        DROP VIEW message_rows;
+        CREATE VIEW message_rows AS
+            SELECT m.id, m.message_id, m.date, m.sender_id, s.first_name, s.last_name, s.username,
+                   m.message, m.media_type, m.media_path, m.reply_to, m.edit_date, m.fwd_from_id, m.fwd_from_msg_id,
+                   m.cluster_id
+            FROM messages m LEFT JOIN senders s ON s.sender_id = m.sender_id;
+        ''',
+    )
+
+    UPSERT_MESSAGE = '''
+        INSERT INTO messages (message_id, date, edit_date, sender_id, message, media_type, media_path, reply_to,
+                              fwd_from_id, fwd_from_msg_id, content_hash)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (message_id) DO UPDATE SET
+            date = excluded.date, edit_date = excluded.edit_date, sender_id = excluded.sender_id,
+            message = excluded.message, media_type = excluded.media_type,
+            media_path = coalesce(excluded.media_path, media_path), reply_to = excluded.reply_to,
+            fwd_from_id = excluded.fwd_from_id, fwd_from_msg_id = excluded.fwd_from_msg_id,
+            content_hash = excluded.content_hash
+        WHERE content_hash IS NOT excluded.content_hash
+    '''
+    UPSERT_SENDER = '''
+        INSERT INTO senders (sender_id, first_name, last_name, username, version) VALUES (?, ?, ?, ?, 1)
+        ON CONFLICT (sender_id) DO UPDATE SET
+            first_name = excluded.first_name, last_name = excluded.last_name, username = excluded.username,
+            version = version + 1
+        WHERE first_name IS NOT excluded.first_name OR last_name IS NOT excluded.last_name
+            OR username IS NOT excluded.username
+        RETURNING sender_id
+    '''
+
+    # What archival compares before deleting the rows it copied: messages
+    # up to ?, their edits, media paths and clusters, and sender renames
+    ARCHIVE_FINGERPRINT = f'''
+        SELECT count(*), max(id), coalesce(sum(content_hash % {FINGERPRINT_MODULUS}), 0), count(media_path),
+               count(cluster_id), (SELECT coalesce(sum(version), 0) FROM senders)
+        FROM messages WHERE message_id <= ?
+    '''
+
+    # A message_rows row as a JSON object
+    JSON_ROW = 'json_object(' + ', '.join(f"'{column}', {column}" for column in MESSAGE_COLUMNS) + ')'
+
+    def __init__(self, base_dir=None):
+        self.base_dir = base_dir
+        self._initialized = set()
+        self._segments = SegmentCache(MESSAGE_COLUMNS, StoredMessage._make)
+
+    def data_dir(self, user_id, channel_id):
+        base_dir = self.base_dir or os.path.join(os.getcwd(), 'data')
+        return os.path.join(base_dir, user_id, channel_id)
+
+    def db_path(self, user_id, channel_id):
+        return os.path.join(self.data_dir(user_id, channel_id), f'{channel_id}.db')
+
+    def archive_dir(self, user_id, channel_id):
+        return os.path.join(self.data_dir(user_id, channel_id), 'archive')
+
+    def connect(self, user_id, channel_id, create=False):
+        db_file = self.db_path(user_id, channel_id)
+        existed = os.path.exists(db_file)
+        if not existed and create:
+            os.makedirs(os.path.dirname(db_file), exist_ok=True)
+        conn = sqlite3.connect(db_file, timeout=SQLITE_BUSY_TIMEOUT)
+        conn.create_function('hash_content', -1, hash_content, deterministic=True)
+        if not existed or db_file not in self._initialized:
+            # Persistent in the file; set once per file and process like the schema
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(self.SCHEMA)
+            self._migrate(conn)
+            self._initialized.add(db_file)
+        return conn
+
+    def _migrate(self, conn):
+        if conn.execute('PRAGMA user_version').fetchone()[0] >= len(self.MIGRATIONS):
+            return
+        conn.isolation_level = None
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            for number, script in enumerate(self.MIGRATIONS[version:], start=version + 1):
+                for statement in _sql_statements(script):
+                    conn.execute(statement)
+                conn.execute(f'PRAGMA user_version = {number}')
+                logger.info(f"Migrated {conn.execute('PRAGMA database_list').fetchone()[2]} to schema version {number}")
+            conn.execute('COMMIT')
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.isolation_level = ''
+
+    def schema_version(self, user_id, channel_id):
+        conn = self.connect(user_id, channel_id)
+        try:
+            return conn.execute('PRAGMA user_version').fetchone()[0]
+        finally:
+            conn.close()
+
+    def _upsert(self, conn, rows):
+        """Upsert INSERT_COLUMNS rows; return the id of each row, None where nothing changed."""
+        ids = []
+        for row in rows:
+            (message_id, date, sender_id, first_name, last_name, username,
+             message, media_type, media_path, reply_to, edit_date, fwd_from_id, fwd_from_msg_id) = row
+            renamed = None
+            if sender_id is not None and (first_name or last_name or username):
+                renamed = conn.execute(self.UPSERT_SENDER, (sender_id, first_name, last_name, username)).fetchone()
+            c = conn.execute(
+                self.UPSERT_MESSAGE + ' RETURNING id',
+                (message_id, date, edit_date, sender_id, message, media_type, media_path, reply_to,
+                 fwd_from_id, fwd_from_msg_id, content_hash(row))
+            )
+            returned = c.fetchone()
+            if returned is None and renamed:
+                # Same content under a new sender name: the row still reads differently
+                returned = conn.execute('SELECT id FROM messages WHERE message_id = ?', (message_id,)).fetchone()
+            ids.append(returned[0] if returned else None)
+        return ids
+
+    def has_channel(self, user_id, channel_id):
+        return os.path.exists(self.db_path(user_id, channel_id))
+
+    def save_message(self, user_id, channel_id, row):
+        conn = self.connect(user_id, channel_id, create=True)
+        try:
+            row_id, = self._upsert(conn, [tuple(row)])
+            with SQLITE_COMMIT_SECONDS.time():
+                conn.commit()
+        finally:
+            conn.close()
+        return dict(zip(MESSAGE_COLUMNS, (row_id,) + tuple(row)))
+
+    def upsert_messages(self, user_id, channel_id, rows):
+        conn = self.connect(user_id, channel_id, create=True)
+        try:
+            ids = self._upsert(conn, rows)
+            with SQLITE_COMMIT_SECONDS.time():
+                conn.commit()
+        finally:
+            conn.close()
+        return ids
+
+    def set_media_path(self, user_id, channel_id, message_id, media_path):
+        conn = self.connect(user_id, channel_id, create=True)
+        try:
+            conn.execute('UPDATE messages SET media_path = ? WHERE message_id = ?', (media_path, message_id))
+            with SQLITE_COMMIT_SECONDS.time():
+                conn.commit()
+        finally:
+            conn.close()
+
+    def set_cluster_ids(self, user_id, channel_id, clusters):
+        conn = self.connect(user_id, channel_id, create=True)
+        try:
+            before = conn.total_changes
+            conn.executemany(
+                'UPDATE messages SET cluster_id = ?1 WHERE message_id = ?2 AND cluster_id IS NOT ?1',
+                [(cluster_id, message_id) for message_id, cluster_id in clusters.items()]
+            )
+            with SQLITE_COMMIT_SECONDS.time():
+                conn.commit()
+            return conn.total_changes - before
+        finally:
+            conn.close()
+
+    def _select(self, user_id, channel_id, query, params):
+        if not self.has_channel(user_id, channel_id):
+            return []
+        conn = self.connect(user_id, channel_id)
+        conn.row_factory = sqlite3.Row
+        try:
+            return [dict(row) for row in conn.execute(query, params).fetchall()]
+        finally:
+            conn.close()
+
+    def _archived(self, user_id, channel_id, after_id=None, newest_first=False):
+        """Yield archived rows segment by segment, in message_id order within each segment."""
+        segments = self._select(
+            user_id, channel_id,
+            f'''SELECT path, codec FROM archive_segments WHERE ?1 IS NULL OR last_message_id > ?1
+                ORDER BY first_message_id {"DESC" if newest_first else "ASC"}''',
+            (after_id,)
+        )
+        archive_dir = self.archive_dir(user_id, channel_id)
+        for segment in segments:
+            yield self._segments.rows(os.path.join(archive_dir, segment['path']), segment['codec'])
+
+    def latest_messages(self, user_id, channel_id, limit=100):
+        messages = self._select(user_id, channel_id, 'SELECT * FROM message_rows ORDER BY date DESC LIMIT ?', (limit,))
+        if len(messages) < limit:
+            for rows in self._archived(user_id, channel_id, newest_first=True):
+                messages.extend(row._asdict() for row in sorted(rows, key=lambda row: row.date or '', reverse=True))
+                if len(messages) >= limit:
+                    break
+        return messages[:limit]
+
+    def latest_messages_json(self, user_id, channel_id, limit=100):
+        if not self.has_channel(user_id, channel_id):
+            return b'[]'
+        conn = self.connect(user_id, channel_id)
+        try:
+            messages = [row[0].encode() for row in conn.execute(
+                f'SELECT {self.JSON_ROW} FROM message_rows ORDER BY date DESC LIMIT ?', (limit,)
+            )]
+        finally:
+            conn.close()
+        if len(messages) < limit:
+            for rows in self._archived(user_id, channel_id, newest_first=True):
+                newest = sorted(rows, key=lambda row: row.date or '', reverse=True)[:limit - len(messages)]
+                messages.extend(encode_rows(MESSAGE_COLUMNS, newest))
+                if len(messages) >= limit:
+                    break
+        return json_array(messages)
+
+    def messages_since(self, user_id, channel_id, since_id, limit=500):
+        messages = []
+        for rows in self._archived(user_id, channel_id, after_id=since_id):
+            messages.extend(row._asdict() for row in rows if row.message_id > since_id)
+            if len(messages) >= limit:
+                return messages[:limit]
+        return messages + self._select(
+            user_id, channel_id,
+            'SELECT * FROM message_rows WHERE message_id > ? ORDER BY message_id LIMIT ?',
+            (since_id, limit - len(messages))
+        )
+
+    def channel_version(self, user_id, channel_id, limit=100):
+        if not self.has_channel(user_id, channel_id):
+            return (None, 0, 0)
+        conn = self.connect(user_id, channel_id)
+        try:
+            # Archived messages are immutable; the window only needs the hot rows
+            return tuple(conn.execute(
+                f'''SELECT coalesce((SELECT max(message_id) FROM messages),
+                                   (SELECT max(last_message_id) FROM archive_segments)),
+                          (SELECT coalesce(sum(messages), 0) FROM daily_counts),
+                          (SELECT coalesce(sum(content_hash % {FINGERPRINT_MODULUS}), 0) + count(media_path)
+                                  + coalesce(sum(CASE WHEN cluster_id IS NOT NULL
+                                                      THEN hash_content(cluster_id) % {FINGERPRINT_MODULUS} END), 0)
+                           FROM (SELECT content_hash, media_path, cluster_id FROM messages ORDER BY date DESC LIMIT ?))
+                          + (SELECT coalesce(sum(version), 0) FROM senders)''',
+                (limit,)
+            ).fetchone())
+        finally:
+            conn.close()
+
+    def export_csv(self, user_id, channel_id, path):
+        archived = self._archived(user_id, channel_id)
+        conn = self.connect(user_id, channel_id)
+        try:
+            c = conn.cursor()
+            c.execute('SELECT * FROM message_rows')
+            with open(path, 'w', newline='', encoding='utf-8') as f:
+                writer = csv.writer(f)
+                writer.writerow([description[0] for description in c.description])
+                for rows in archived:
+                    writer.writerows(rows)
+                writer.writerows(c)
+        finally:
+            conn.close()
+
+    def export_json(self, user_id, channel_id, path):
+        conn = self.connect(user_id, channel_id)
+        try:
+            archived = itertools.chain.from_iterable(self._archived(user_id, channel_id))
+            hot = (row[0].encode() for row in conn.execute(f'SELECT {self.JSON_ROW} FROM message_rows'))
+            with open(path, 'wb') as f:
+                write_json_array(f, itertools.chain(encode_rows(MESSAGE_COLUMNS, archived), hot))
+        finally:
+            conn.close()
+
+    def thread(self, user_id, channel_id, message_id):
+        if not self.has_channel(user_id, channel_id):
+            return None
+        conn = self.connect(user_id, channel_id)
+        conn.row_factory = sqlite3.Row
+        try:
+            root = conn.execute(
+                'SELECT coalesce((SELECT thread_root FROM message_links WHERE message_id = ?1), ?1)', (message_id,)
+            ).fetchone()[0]
+            ids = [root] + [row[0] for row in conn.execute(
+                'SELECT message_id FROM message_links WHERE thread_root = ?1 AND message_id != ?1 ORDER BY message_id',
+                (root,)
+            )]
+            messages = {row['message_id']: dict(row) for row in conn.execute(
+                '''SELECT * FROM message_rows WHERE message_id = ?1
+                   OR message_id IN (SELECT message_id FROM message_links WHERE thread_root = ?1)''',
+                (root,)
+            )}
+        finally:
+            conn.close()
+        missing = set(ids) - set(messages)
+        if missing and min(missing) <= (self.archive_stats(user_id, channel_id)['last_message_id'] or 0):
+            for rows in self._archived(user_id, channel_id, after_id=min(missing) - 1):
+                messages.update((row.message_id, row._asdict()) for row in rows if row.message_id in missing)
+                if max(missing) <= rows[-1].message_id:
+                    break
+        if message_id not in messages:
+            return None
+        return {'thread_root': root, 'messages': [messages[i] for i in ids if i in messages]}
+
+    def forward_source(self, user_id, channel_id, message_id):
+        links = self._select(
+            user_id, channel_id,
+            '''SELECT fwd_from_id, fwd_from_msg_id FROM message_links
+               WHERE message_id = ? AND fwd_from_id IS NOT NULL''',
+            (message_id,)
+        )
+        return links[0] if links else None
+
+    def forwards_of(self, user_id, channel_ids, fwd_from_id, fwd_from_msg_id):
+        forwards = []
+        for channel_id in channel_ids:
+            forwards.extend(
+                {'channel_id': channel_id, 'message_id': row['message_id']}
+                for row in self._select(
+                    user_id, channel_id,
+                    '''SELECT message_id FROM message_links
+                       WHERE fwd_from_id = ? AND fwd_from_msg_id = ? ORDER BY message_id''',
+                    (fwd_from_id, fwd_from_msg_id)
+                )
+            )
+        return forwards
+
+    def archive(self, user_id, channel_id, older_than, vacuum=True, segment_rows=ARCHIVE_SEGMENT_ROWS):
+        """Move messages up to the newest one dated before ``older_than`` into segments.
+
+        Segments are written without holding the write lock; the lock is
+        only taken to check nothing changed, record them and delete the
+        archived rows. Rows changed meanwhile are copied again, up to
+        ARCHIVE_ATTEMPTS times. Returns counts of what was archived.
+        """
+        result = {'segments': 0, 'messages': 0, 'bytes': 0, 'raw_bytes': 0}
+        if not self.has_channel(user_id, channel_id):
+            return result
+        cutoff = older_than.strftime('%Y-%m-%d %H:%M:%S')
+        archive_dir = self.archive_dir(user_id, channel_id)
+        segments = []
+        conn = self.connect(user_id, channel_id)
+        try:
+            through = conn.execute('SELECT max(message_id) FROM messages WHERE date < ?', (cutoff,)).fetchone()[0]
+            if through is None:
+                return result
+            for attempt in range(ARCHIVE_ATTEMPTS):
+                # The rows and their fingerprint come from one snapshot
+                conn.execute('BEGIN')
+                fingerprint = conn.execute(self.ARCHIVE_FINGERPRINT, (through,)).fetchone()
+                c = conn.execute(
+                    f'SELECT {", ".join(MESSAGE_COLUMNS)} FROM message_rows WHERE message_id <= ? ORDER BY message_id',
+                    (through,)
+                )
+                while True:
+                    rows = c.fetchmany(segment_rows)
+                    if not rows:
+                        break
+                    segments.append(write_segment(archive_dir, MESSAGE_COLUMNS, rows))
+                conn.commit()
+
+                conn.execute('BEGIN IMMEDIATE')
+                if conn.execute(self.ARCHIVE_FINGERPRINT, (through,)).fetchone() == fingerprint:
+                    break
+                conn.rollback()
+                _remove_segments(archive_dir, segments)
+                segments = []
+                logger.info(f"Messages up to {through} of {user_id}/{channel_id} changed while archiving; copying again")
+            else:
+                raise RuntimeError(f"Messages up to {through} kept changing while archiving; try again")
+            conn.executemany(
+                '''INSERT INTO archive_segments (path, codec, first_message_id, last_message_id, first_date, last_date, rows, bytes, raw_bytes)
+                   VALUES (:path, :codec, :first_message_id, :last_message_id, :first_date, :last_date, :rows, :bytes, :raw_bytes)''',
+                segments
+            )
+            conn.execute('DELETE FROM messages WHERE message_id <= ?', (through,))
+            with SQLITE_COMMIT_SECONDS.time():
+                conn.commit()
+        except Exception:
+            conn.rollback()
+            _remove_segments(archive_dir, segments)
+            raise
+        finally:
+            conn.close()
+
+        if vacuum:
+            conn = sqlite3.connect(self.db_path(user_id, channel_id), timeout=SQLITE_BUSY_TIMEOUT, isolation_level=None)
+            try:
+                conn.execute('VACUUM')
+            finally:
+                conn.close()
+        result.update(
+            segments=len(segments),
+            messages=sum(segment['rows'] for segment in segments),
+            bytes=sum(segment['bytes'] for segment in segments),
+            raw_bytes=sum(segment['raw_bytes'] for segment in segments),
+        )
+        logger.info(f"Archived {result['messages']} messages of {user_id}/{channel_id} "
+                    f"into {result['segments']} segments ({result['raw_bytes']} -> {result['bytes']} bytes)")
+        return result
+
+    def archive_stats(self, user_id, channel_id):
+        stats = self._select(
+            user_id, channel_id,
+            '''SELECT count(*) AS segments, coalesce(sum(rows), 0) AS messages, coalesce(sum(bytes), 0) AS bytes,
+                      coalesce(sum(raw_bytes), 0) AS raw_bytes, max(last_message_id) AS last_message_id
+               FROM archive_segments''',
+            ()
+        )
+        stats = stats[0] if stats else {'segments': 0, 'messages': 0, 'bytes': 0, 'raw_bytes': 0, 'last_message_id': None}
+        db_file = self.db_path(user_id, channel_id)
+        stats['hot_db_bytes'] = sum(os.path.getsize(path) for path in (db_file, db_file + '-wal') if os.path.exists(path))
+        return stats
+
+    def channel_stats(self, user_id, channel_id):
+        totals = self._select(
+            user_id, channel_id,
+            '''SELECT coalesce(sum(messages), 0) AS messages, coalesce(sum(media), 0) AS media_messages,
+                      count(*) AS days, min(day) AS first_day, max(day) AS last_day,
+                      (SELECT count(*) FROM sender_counts) AS senders,
+                      coalesce((SELECT max(message_id) FROM messages),
+                               (SELECT max(last_message_id) FROM archive_segments)) AS last_message_id
+               FROM daily_counts''',
+            ()
+        )
+        return totals[0] if totals else None
+
+    def daily_counts(self, user_id, channel_id, start=None, end=None):
+        return self._select(
+            user_id, channel_id,
+            '''SELECT day, messages, media FROM daily_counts
+               WHERE (?1 IS NULL OR day >= ?1) AND (?2 IS NULL OR day <= ?2) ORDER BY day''',
+            (start, end)
+        )
+
+    def top_senders(self, user_id, channel_id, limit=20):
+        return self._select(
+            user_id, channel_id,
+            '''SELECT nullif(c.sender_id, 0) AS sender_id, s.first_name, s.last_name, s.username, c.messages
+               FROM sender_counts c LEFT JOIN senders s ON s.sender_id = c.sender_id
+               ORDER BY c.messages DESC LIMIT ?''',
+            (limit,)
+        )
+
+    def media_counts(self, user_id, channel_id):
+        return self._select(
+            user_id, channel_id, 'SELECT media_type, messages FROM media_counts ORDER BY messages DESC', ()
+        )
+
+    def iter_channels(self):
+        """Yield (user_id, channel_id) for every channel database on disk."""
+        base_dir = self.base_dir or os.path.join(os.getcwd(), 'data')
+        if not os.path.isdir(base_dir):
+            return
+        for user_id in sorted(os.listdir(base_dir)):
+            user_dir = os.path.join(base_dir, user_id)
+            if not os.path.isdir(user_dir):
+                continue
+            for channel_id in sorted(os.listdir(user_dir)):
+                if os.path.exists(os.path.join(user_dir, channel_id, f'{channel_id}.db')):
+                    yield user_id, channel_id
+
+    def iter_rows(self, user_id, channel_id, chunk_size=5000):
+        """Yield chunks of INSERT_COLUMNS tuples in message_id order, archived ones first."""
+        for rows in self._archived(user_id, channel_id):
+            for start in range(0, len(rows), chunk_size):
+                yield [row[1:-1] for row in rows[start:start + chunk_size]]
+        conn = self.connect(user_id, channel_id)
+        try:
+            c = conn.execute(f'SELECT {", ".join(INSERT_COLUMNS)} FROM message_rows ORDER BY message_id')
+            while True:
+                rows = c.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            conn.close()
+
+
+def _remove_segments(archive_dir, segments):
+    for segment in segments:
+        try:
+            os.remove(os.path.join(archive_dir, segment['path']))
+        except OSError:
+            pass
+
+
+def _sql_statements(script):
+    """Split a migration script into statements, keeping trigger bodies whole."""
+    statement = ''
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            yield statement.strip()
+            statement = ''
+    if statement.strip() and not statement.strip().startswith('--'):
+        raise ValueError(f"Incomplete SQL statement in migration: {statement.strip()[:80]}")
+
+
+def _thread_anchors(rows):
+    """For each row of a batch, the message whose thread it joins.
+
+    That is the first ancestor outside the batch, or the top of the chain
+    if it starts inside the batch; None for rows that are not replies.
+    """
+    message_id, reply_to = INSERT_COLUMNS.index('message_id'), INSERT_COLUMNS.index('reply_to')
+    parents = {row[message_id]: row[reply_to] for row in rows}
+    anchors = []
+    for row in rows:
+        node, parent, hops = row[message_id], row[reply_to], 0
+        while parent is not None and parent in parents and hops < len(parents):
+            node, parent, hops = parent, parents[parent], hops + 1
+        anchors.append(parent if parent is not None else (node if hops else None))
+    return anchors
+
+
+def _copy_text(value):
+    """Encode one value for COPY ... FROM STDIN in text format."""
+    if value is None:
+        return '\\N'
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+class PostgresMessageStore(MessageStore):
+    """All channels in one hash-partitioned PostgreSQL table.
+
+    Partitioning by (user_id, channel_id) keeps each channel's rows and
+    index entries together in one of POSTGRES_PARTITIONS partitions, so
+    per-channel reads touch a single partition. Bulk writes go through
+    COPY into a temporary staging table followed by one upsert on
+    (user_id, channel_id, message_id) that skips rows whose content hash
+    is unchanged. The same statement folds the rows it newly inserted
+    into the per-channel rollup tables, so the stats endpoints never scan
+    ``messages``. Sender names stay on the rows here: they compress well
+    in TOAST and keep every read a single-partition scan.
+    """
+
+    # Data-modifying CTEs that fold the rows returned by an ``inserted`` CTE
+    # into the rollup tables, in the same statement as the insert itself
+    ROLLUP_CTES = '''
+        daily AS (
+            INSERT INTO channel_daily_counts AS t (user_id, channel_id, day, messages, media)
+            SELECT user_id, channel_id, date::date, count(*), count(media_type) FROM inserted
+            WHERE date IS NOT NULL GROUP BY 1, 2, 3
+            ON CONFLICT (user_id, channel_id, day) DO UPDATE
+            SET messages = t.messages + excluded.messages, media = t.media + excluded.media
+        ),
+        senders AS (
+            INSERT INTO channel_sender_counts AS t (user_id, channel_id, sender_id, first_name, last_name, username, messages)
+            SELECT user_id, channel_id, coalesce(sender_id, 0), max(first_name), max(last_name), max(username), count(*)
+            FROM inserted GROUP BY 1, 2, 3
+            ON CONFLICT (user_id, channel_id, sender_id) DO UPDATE
+            SET messages = t.messages + excluded.messages,
+                first_name = coalesce(excluded.first_name, t.first_name),
+                last_name = coalesce(excluded.last_name, t.last_name),
+                username = coalesce(excluded.username, t.username)
+        ),
+        media AS (
+            INSERT INTO channel_media_counts AS t (user_id, channel_id, media_type, messages)
+            SELECT user_id, channel_id, coalesce(media_type, 'text'), count(*) FROM inserted GROUP BY 1, 2, 3
+            ON CONFLICT (user_id, channel_id, media_type) DO UPDATE SET messages = t.messages + excluded.messages
+        )
+    '''
+    INSERTED_COLUMNS = '''id, user_id, channel_id, date, sender_id, first_name, last_name, username, media_type,
+        reply_to, fwd_from_id, fwd_from_msg_id'''
+
+    # Rewrites a stored message only when its content hash changed. Rows
+    # returned by an upsert are new if the statement's snapshot of
+    # ``messages``, which predates the upsert, does not have them yet.
+    UPSERT = f'''
+        ON CONFLICT (user_id, channel_id, message_id) DO UPDATE SET
+            date = excluded.date, edit_date = excluded.edit_date, sender_id = excluded.sender_id,
+            first_name = excluded.first_name, last_name = excluded.last_name, username = excluded.username,
+            message = excluded.message, media_type = excluded.media_type,
+            media_path = coalesce(excluded.media_path, messages.media_path), reply_to = excluded.reply_to,
+            fwd_from_id = excluded.fwd_from_id, fwd_from_msg_id = excluded.fwd_from_msg_id,
+            content_hash = excluded.content_hash
+        WHERE messages.content_hash IS DISTINCT FROM excluded.content_hash
+            OR messages.first_name IS DISTINCT FROM excluded.first_name
+            OR messages.last_name IS DISTINCT FROM excluded.last_name
+            OR messages.username IS DISTINCT FROM excluded.username
+        RETURNING {INSERTED_COLUMNS}, message_id
+    '''
+    UPSERT_INSERTED = '''
+        inserted AS (
+            SELECT * FROM upserted u WHERE NOT EXISTS (
+                SELECT 1 FROM messages m
+                WHERE m.user_id = u.user_id AND m.channel_id = u.channel_id AND m.message_id = u.message_id
+            )
+        )
+    '''
+
+    # Records replies and forwards of upserted rows. ``{anchor}`` is the
+    # message whose thread a row joins: its parent, or for replies to
+    # messages in the same batch, the batch chain's first ancestor outside
+    # it (see _thread_anchors), since rows of the same statement cannot see
+    # each other's links. Replies stored before their parent arrived are
+    # moved into the parent's thread.
+    LINKS_CTE = '''
+        links AS (
+            INSERT INTO message_links (user_id, channel_id, message_id, reply_to, thread_root, fwd_from_id, fwd_from_msg_id)
+            SELECT u.user_id, u.channel_id, u.message_id, u.reply_to,
+                   coalesce((SELECT p.thread_root FROM message_links p
+                             WHERE p.user_id = u.user_id AND p.channel_id = u.channel_id AND p.message_id = {anchor}),
+                            {anchor}, u.message_id),
+                   u.fwd_from_id, u.fwd_from_msg_id
+            FROM upserted u WHERE u.reply_to IS NOT NULL OR u.fwd_from_id IS NOT NULL
+            ON CONFLICT (user_id, channel_id, message_id) DO UPDATE SET
+                reply_to = excluded.reply_to, thread_root = excluded.thread_root,
+                fwd_from_id = excluded.fwd_from_id, fwd_from_msg_id = excluded.fwd_from_msg_id
+            RETURNING user_id, channel_id, message_id, thread_root
+        ),
+        rerooted AS (
+            UPDATE message_links l SET thread_root = n.thread_root FROM links n
+            WHERE l.user_id = n.user_id AND l.channel_id = n.channel_id
+              AND l.thread_root = n.message_id AND l.message_id != n.message_id
+        )
+    '''
+
+    SELECT_COLUMNS = '''id, message_id, to_char(date, 'YYYY-MM-DD HH24:MI:SS') AS date, sender_id,
+        first_name, last_name, username, message, media_type, media_path, reply_to,
+        to_char(edit_date, 'YYYY-MM-DD HH24:MI:SS') AS edit_date, fwd_from_id, fwd_from_msg_id, cluster_id'''
+
+    def __init__(self, dsn, partitions=16, min_connections=1, max_connections=10):
+        import psycopg2.extras
+        import psycopg2.pool
+
+        self._extras = psycopg2.extras
+        self.pool = psycopg2.pool.ThreadedConnectionPool(min_connections, max_connections, dsn)
+        self.partitions = partitions
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+
+    @contextmanager
+    def cursor(self, dict_rows=False):
+        conn = self.pool.getconn()
+        try:
+            cursor_factory = self._extras.RealDictCursor if dict_rows else None
+            with conn.cursor(cursor_factory=cursor_factory) as cur:
+                yield cur
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.pool.putconn(conn)
+
+    def ensure_schema(self):
+        if self._schema_ready:
+            return
+        with self._schema_lock:
+            if self._schema_ready:
+                return
+            with self.cursor() as cur:
+                cur.execute('''
+                    CREATE TABLE IF NOT EXISTS messages (
+                        id BIGSERIAL,
+                        user_id TEXT NOT NULL,
+                        channel_id TEXT NOT NULL,
+                        message_id BIGINT NOT NULL,
+                        date TIMESTAMP,
+                        sender_id BIGINT,
+                        first_name TEXT,
+                        last_name TEXT,
+                        username TEXT,
+                        message TEXT,
+                        media_type TEXT,
+                        media_path TEXT,
+                        reply_to BIGINT,
+                        edit_date TIMESTAMP,
+                        content_hash BIGINT,
+                        fwd_from_id BIGINT,
+                        fwd_from_msg_id BIGINT,
+                        cluster_id TEXT,
+                        PRIMARY KEY (user_id, channel_id, message_id)
+                    ) PARTITION BY HASH (user_id, channel_id)
+                ''')
+                cur.execute('''ALTER TABLE messages ADD COLUMN IF NOT EXISTS edit_date TIMESTAMP,
+                                                 ADD COLUMN IF NOT EXISTS content_hash BIGINT,
+                                                 ADD COLUMN IF NOT EXISTS fwd_from_id BIGINT,
+                                                 ADD COLUMN IF NOT EXISTS fwd_from_msg_id BIGINT,
+                                                 ADD COLUMN IF NOT EXISTS cluster_id TEXT''')
+                for remainder in range(self.partitions):
+                    cur.execute(
+                        f'''CREATE TABLE IF NOT EXISTS messages_p{remainder} PARTITION OF messages
+                            FOR VALUES WITH (MODULUS {self.partitions}, REMAINDER {remainder})'''
+                    )
+                cur.execute('CREATE INDEX IF NOT EXISTS messages_channel_date_idx ON messages (user_id, channel_id, date DESC)')
+                self._backfill_content_hashes(cur)
+                self._ensure_rollups(cur)
+                self._ensure_links(cur)
+            self._schema_ready = True
+
+    def _backfill_content_hashes(self, cur):
+        """Hash the rows stored before content_hash existed, so a rescan does not see them all as edited."""
+        cur.execute('CREATE INDEX IF NOT EXISTS messages_unhashed_idx ON messages (user_id) WHERE content_hash IS NULL')
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext('messages_content_hash'))")
+        # Dates are hashed as the scraper passes them
+        columns = ', '.join(f"to_char({column}, 'YYYY-MM-DD HH24:MI:SS')" if column in ('date', 'edit_date')
+                            else column for column in HASHED_COLUMNS)
+        with cur.connection.cursor(name='messages_unhashed') as unhashed:
+            unhashed.execute(f'SELECT user_id, channel_id, message_id, {columns} FROM messages WHERE content_hash IS NULL')
+            while True:
+                rows = unhashed.fetchmany(5000)
+                if not rows:
+                    break
+                self._extras.execute_values(
+                    cur,
+                    '''UPDATE messages m SET content_hash = v.content_hash
+                       FROM (VALUES %s) AS v (user_id, channel_id, message_id, content_hash)
+                       WHERE m.user_id = v.user_id AND m.channel_id = v.channel_id AND m.message_id = v.message_id''',
+                    [(user_id, channel_id, message_id, hash_content(*values))
+                     for user_id, channel_id, message_id, *values in rows],
+                    page_size=len(rows),
+                )
+                logger.info(f"Hashed {len(rows)} messages stored without a content hash")
+
+    def _ensure_rollups(self, cur):
+        # Serialise concurrent first starts so only one node backfills
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext('channel_rollups'))")
+        cur.execute("SELECT to_regclass('channel_daily_counts') IS NULL")
+        if not cur.fetchone()[0]:
+            return
+        cur.execute('''
+            CREATE TABLE channel_daily_counts (
+                user_id TEXT NOT NULL,
+                channel_id TEXT NOT NULL,
+                day DATE NOT NULL,
+                messages BIGINT NOT NULL,
+                media BIGINT NOT NULL,
+                PRIMARY KEY (user_id, channel_id, day)
+            );
+            CREATE TABLE channel_sender_counts (
+                user_id TEXT NOT NULL,
+                channel_id TEXT NOT NULL,
+                sender_id BIGINT NOT NULL,
+                first_name TEXT,
+                last_name TEXT,
+                username TEXT,
+                messages BIGINT NOT NULL,
+                PRIMARY KEY (user_id, channel_id, sender_id)
+            );
+            CREATE INDEX channel_sender_counts_top_idx ON channel_sender_counts (user_id, channel_id, messages DESC);
+            CREATE TABLE channel_media_counts (
+                user_id TEXT NOT NULL,
+                channel_id TEXT NOT NULL,
+                media_type TEXT NOT NULL,
+                messages BIGINT NOT NULL,
+                PRIMARY KEY (user_id, channel_id, media_type)
+            );
+        ''')
+        # Block writers while backfilling rows stored before rollups existed
+        cur.execute('LOCK TABLE messages IN SHARE MODE')
+        cur.execute(f'''
+            WITH inserted AS (SELECT {self.INSERTED_COLUMNS} FROM messages), {self.ROLLUP_CTES}
+            SELECT 1
+        ''')
+
+    def _ensure_links(self, cur):
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext('message_links'))")
+        cur.execute("SELECT to_regclass('message_links') IS NULL")
+        if not cur.fetchone()[0]:
+            return
+        cur.execute('''
+            CREATE TABLE message_links (
+                user_id TEXT NOT NULL,
+                channel_id TEXT NOT NULL,
+                message_id BIGINT NOT NULL,
+                reply_to BIGINT,
+                thread_root BIGINT NOT NULL,
+                fwd_from_id BIGINT,
+                fwd_from_msg_id BIGINT,
+                PRIMARY KEY (user_id, channel_id, message_id)
+            );
+            CREATE INDEX message_links_thread_idx ON message_links (user_id, channel_id, thread_root);
+            CREATE INDEX message_links_forward_idx ON message_links (user_id, fwd_from_id, fwd_from_msg_id)
+                WHERE fwd_from_id IS NOT NULL;
+        ''')
+        cur.execute('LOCK TABLE messages IN SHARE MODE')
+        cur.execute('''
+            WITH RECURSIVE roots (user_id, channel_id, message_id, thread_root) AS (
+                SELECT user_id, channel_id, message_id, coalesce(reply_to, message_id) FROM messages m
+                WHERE reply_to IS NULL OR NOT EXISTS (
+                    SELECT 1 FROM messages p
+                    WHERE p.user_id = m.user_id AND p.channel_id = m.channel_id AND p.message_id = m.reply_to
+                )
+                UNION ALL
+                SELECT m.user_id, m.channel_id, m.message_id, r.thread_root FROM messages m
+                JOIN roots r ON m.user_id = r.user_id AND m.channel_id = r.channel_id AND m.reply_to = r.message_id
+            )
+            INSERT INTO message_links (user_id, channel_id, message_id, reply_to, thread_root, fwd_from_id, fwd_from_msg_id)
+            SELECT m.user_id, m.channel_id, m.message_id, m.reply_to, r.thread_root, m.fwd_from_id, m.fwd_from_msg_id
+            FROM roots r JOIN messages m USING (user_id, channel_id, message_id)
+            WHERE m.reply_to IS NOT NULL OR m.fwd_from_id IS NOT NULL
+        ''')
+
+    def has_channel(self, user_id, channel_id):
+        self.ensure_schema()
+        with self.cursor() as cur:
+            cur.execute('SELECT 1 FROM messages WHERE user_id = %s AND channel_id = %s LIMIT 1', (user_id, channel_id))
+            return cur.fetchone() is not None
+
+    def save_message(self, user_id, channel_id, row):
+        self.ensure_schema()
+        with self.cursor() as cur:
+            cur.execute(
+                f'''WITH upserted AS (
+                        INSERT INTO messages (user_id, channel_id, {", ".join(INSERT_COLUMNS)}, content_hash)
+                        VALUES ({', '.join(['%s'] * (len(INSERT_COLUMNS) + 3))})
+                        {self.UPSERT}
+                    ),
+                    {self.UPSERT_INSERTED}, {self.ROLLUP_CTES}, {self.LINKS_CTE.format(anchor='u.reply_to')}
+                    SELECT id FROM upserted''',
+                (user_id, channel_id) + tuple(row) + (content_hash(row),)
+            )
+            upserted = cur.fetchone()
+        return dict(zip(MESSAGE_COLUMNS, (upserted[0] if upserted else None,) + tuple(row)))
+
+    def upsert_messages(self, user_id, channel_id, rows):
+        self.ensure_schema()
+        rows = [tuple(row) for row in rows]
+        if not rows:
+            return []
+        buffer = io.StringIO()
+        prefix = f'{_copy_text(user_id)}\t{_copy_text(channel_id)}\t'
+        for row, anchor in zip(rows, _thread_anchors(rows)):
+            buffer.write(prefix + '\t'.join(_copy_text(value) for value in row)
+                         + f'\t{content_hash(row)}\t{_copy_text(anchor)}\n')
+        buffer.seek(0)
+        columns = ', '.join(('user_id', 'channel_id') + INSERT_COLUMNS + ('content_hash',))
+        anchor = '(SELECT s.thread_anchor FROM messages_staging s WHERE s.message_id = u.message_id LIMIT 1)'
+        with self.cursor() as cur:
+            cur.execute(
+                f'''CREATE TEMP TABLE IF NOT EXISTS messages_staging ON COMMIT DELETE ROWS
+                    AS SELECT {columns}, NULL::bigint AS thread_anchor FROM messages WITH NO DATA'''
+            )
+            cur.copy_expert(f'COPY messages_staging ({columns}, thread_anchor) FROM STDIN', buffer)
+            # One row per message_id: an upsert cannot touch the same row twice
+            cur.execute(
+                f'''WITH upserted AS (
+                        INSERT INTO messages ({columns})
+                        SELECT DISTINCT ON (message_id) {columns} FROM messages_staging
+                        {self.UPSERT}
+                    ),
+                    {self.UPSERT_INSERTED}, {self.ROLLUP_CTES}, {self.LINKS_CTE.format(anchor=anchor)}
+                    SELECT message_id, id FROM upserted'''
+            )
+            upserted = dict(cur.fetchall())
+        # A message_id repeated in the batch was written once; report it once
+        return [upserted.pop(row[0], None) for row in rows]
+
+    def set_media_path(self, user_id, channel_id, message_id, media_path):
+        self.ensure_schema()
+        with self.cursor() as cur:
+            cur.execute(
+                'UPDATE messages SET media_path = %s WHERE user_id = %s AND channel_id = %s AND message_id = %s',
+                (media_path, user_id, channel_id, message_id)
+            )
+
+    def set_cluster_ids(self, user_id, channel_id, clusters):
+        self.ensure_schema()
+        with self.cursor() as cur:
+            cur.execute(
+                '''UPDATE messages m SET cluster_id = v.cluster_id
+                   FROM unnest(%s::bigint[], %s::text[]) AS v (message_id, cluster_id)
+                   WHERE m.user_id = %s AND m.channel_id = %s AND m.message_id = v.message_id
+                     AND m.cluster_id IS DISTINCT FROM v.cluster_id''',
+                (list(clusters), list(clusters.values()), user_id, channel_id)
+            )
+            return cur.rowcount
+
+    def latest_messages(self, user_id, channel_id, limit=100):
+        self.ensure_schema()
+        with self.cursor(dict_rows=True) as cur:
+            cur.execute(
+                f'''SELECT {self.SELECT_COLUMNS} FROM messages
+                    WHERE user_id = %s AND channel_id = %s ORDER BY date DESC LIMIT %s''',
+                (user_id, channel_id, limit)
+            )
+            return [dict(row) for row in cur.fetchall()]
+
+    def latest_messages_json(self, user_id, channel_id, limit=100):
+        self.ensure_schema()
+        with self.cursor() as cur:
+            cur.execute(
+                f'''SELECT row_to_json(m)::text FROM (
+                        SELECT {self.SELECT_COLUMNS} FROM messages
+                        WHERE user_id = %s AND channel_id = %s ORDER BY date DESC LIMIT %s
+                    ) m''',
+                (user_id, channel_id, limit)
+            )
+            return json_array(row[0].encode() for row in cur)
+
+    def messages_since(self, user_id, channel_id, since_id, limit=500):
+        self.ensure_schema()
+        with self.cursor(dict_rows=True) as cur:
+            cur.execute(
+                f'''SELECT {self.SELECT_COLUMNS} FROM messages
+                    WHERE user_id = %s AND channel_id = %s AND message_id > %s
+                    ORDER BY message_id LIMIT %s''',
+                (user_id, channel_id, since_id, limit)
+            )
+            return [dict(row) for row in cur.fetchall()]
+
+    def channel_version(self, user_id, channel_id, limit=100):
+        self.ensure_schema()
+        with self.cursor() as cur:
+            cur.execute(
+                f'''SELECT (SELECT max(message_id) FROM messages WHERE user_id = %(user)s AND channel_id = %(channel)s),
+                          (SELECT coalesce(sum(messages), 0) FROM channel_daily_counts
+                           WHERE user_id = %(user)s AND channel_id = %(channel)s),
+                          (SELECT coalesce(sum(content_hash %% {FINGERPRINT_MODULUS}
+                                               + hashtext(concat_ws(' ', first_name, last_name, username))), 0)
+                                  + count(media_path) + coalesce(sum(hashtext(cluster_id)), 0) FROM (
+                               SELECT content_hash, media_path, first_name, last_name, username, cluster_id FROM messages
+                               WHERE user_id = %(user)s AND channel_id = %(channel)s
+                               ORDER BY date DESC LIMIT %(limit)s) w)''',
+                {"user": user_id, "channel": channel_id, "limit": limit}
+            )
+            return tuple(cur.fetchone())
+
+    def export_csv(self, user_id, channel_id, path):
+        self.ensure_schema()
+        with self.cursor() as cur:
+            query = cur.mogrify(
+                f'''SELECT {self.SELECT_COLUMNS} FROM messages
+                    WHERE user_id = %s AND channel_id = %s ORDER BY message_id''',
+                (user_id, channel_id)
+            ).decode()
+            with open(path, 'w', newline='', encoding='utf-8') as f:
+                cur.copy_expert(f'COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER true)', f)
+
+    def export_json(self, user_id, channel_id, path):
+        self.ensure_schema()
+        with self.cursor() as cur:
+            cur.execute(
+                f'''SELECT row_to_json(m)::text FROM (
+                        SELECT {self.SELECT_COLUMNS} FROM messages
+                        WHERE user_id = %s AND channel_id = %s ORDER BY message_id
+                    ) m''',
+                (user_id, channel_id)
+            )
+            with open(path, 'wb') as f:
+                write_json_array(f, (row[0].encode() for row in cur))
+
+    def _select(self, query, params):
+        self.ensure_schema()
+        with self.cursor(dict_rows=True) as cur:
+            cur.execute(query, params)
+            return [dict(row) for row in cur.fetchall()]
+
+    def channel_stats(self, user_id, channel_id):
+        totals = self._select(
+            '''SELECT coalesce(sum(messages), 0)::bigint AS messages, coalesce(sum(media), 0)::bigint AS media_messages,
+                      count(*) AS days, to_char(min(day), 'YYYY-MM-DD') AS first_day,
+                      to_char(max(day), 'YYYY-MM-DD') AS last_day,
+                      (SELECT count(*) FROM channel_sender_counts
+                       WHERE user_id = %(user_id)s AND channel_id = %(channel_id)s) AS senders,
+                      (SELECT max(message_id) FROM messages
+                       WHERE user_id = %(user_id)s AND channel_id = %(channel_id)s) AS last_message_id
+               FROM channel_daily_counts WHERE user_id = %(user_id)s AND channel_id = %(channel_id)s''',
+            {'user_id': user_id, 'channel_id': channel_id}
+        )[0]
+        if not totals['days'] and totals['last_message_id'] is None:
+            return None
+        return totals
+
+    def daily_counts(self, user_id, channel_id, start=None, end=None):
+        return self._select(
+            '''SELECT to_char(day, 'YYYY-MM-DD') AS day, messages, media FROM channel_daily_counts
+               WHERE user_id = %(user_id)s AND channel_id = %(channel_id)s
+                 AND (%(start)s::date IS NULL OR day >= %(start)s::date)
+                 AND (%(end)s::date IS NULL OR day <= %(end)s::date)
+               ORDER BY day''',
+            {'user_id': user_id, 'channel_id': channel_id, 'start': start, 'end': end}
+        )
+
+    def top_senders(self, user_id, channel_id, limit=20):
+        return self._select(
+            '''SELECT nullif(sender_id, 0) AS sender_id, first_name, last_name, username, messages
+               FROM channel_sender_counts WHERE user_id = %s AND channel_id = %s
+               ORDER BY messages DESC LIMIT %s''',
+            (user_id, channel_id, limit)
+        )
+
+    def media_counts(self, user_id, channel_id):
+        return self._select(
+            '''SELECT media_type, messages FROM channel_media_counts
+               WHERE user_id = %s AND channel_id = %s ORDER BY messages DESC''',
+            (user_id, channel_id)
+        )
+
+    def thread(self, user_id, channel_id, message_id):
+        self.ensure_schema()
+        params = {'user_id': user_id, 'channel_id': channel_id, 'message_id': message_id}
+        with self.cursor(dict_rows=True) as cur:
+            cur.execute(
+                f'''WITH root AS (
+                        SELECT coalesce((SELECT thread_root FROM message_links
+                                         WHERE user_id = %(user_id)s AND channel_id = %(channel_id)s
+                                           AND message_id = %(message_id)s), %(message_id)s) AS thread_root
+                    )
+                    SELECT root.thread_root, {self.SELECT_COLUMNS} FROM messages, root
+                    WHERE user_id = %(user_id)s AND channel_id = %(channel_id)s
+                      AND (message_id = root.thread_root OR message_id IN (
+                          SELECT message_id FROM message_links l
+                          WHERE l.user_id = %(user_id)s AND l.channel_id = %(channel_id)s
+                            AND l.thread_root = root.thread_root))
+                    ORDER BY message_id != root.thread_root, message_id''',
+                params
+            )
+            messages = [dict(row) for row in cur.fetchall()]
+        if not any(row['message_id'] == message_id for row in messages):
+            return None
+        root = messages[0].pop('thread_root')
+        for row in messages[1:]:
+            del row['thread_root']
+        return {'thread_root': root, 'messages': messages}
+
+    def forward_source(self, user_id, channel_id, message_id):
+        links = self._select(
+            '''SELECT fwd_from_id, fwd_from_msg_id FROM message_links
+               WHERE user_id = %s AND channel_id = %s AND message_id = %s AND fwd_from_id IS NOT NULL''',
+            (user_id, channel_id, message_id)
+        )
+        return links[0] if links else None
+
+    def forwards_of(self, user_id, channel_ids, fwd_from_id, fwd_from_msg_id):
+        return self._select(
+            '''SELECT channel_id, message_id FROM message_links
+               WHERE user_id = %s AND fwd_from_id = %s AND fwd_from_msg_id = %s AND channel_id = ANY(%s)
+               ORDER BY channel_id, message_id''',
+            (user_id, fwd_from_id, fwd_from_msg_id, list(channel_ids))
+        )
+
+
+def create_message_store(backend: Optional[str] = None) -> MessageStore:
+    backend = (backend or os.environ.get('MESSAGE_STORE', 'sqlite')).lower()
+    if backend == 'sqlite':
+        return SQLiteMessageStore()
+    if backend == 'postgres':
+        dsn = os.environ.get('POSTGRES_DSN')
+        if not dsn:
+            raise RuntimeError("POSTGRES_DSN must be set when MESSAGE_STORE=postgres")
+        return PostgresMessageStore(
+            dsn,
+            partitions=int(os.environ.get('POSTGRES_PARTITIONS', 16)),
+            max_connections=int(os.environ.get('POSTGRES_POOL_SIZE', 10)),
+        )
+    raise RuntimeError(f"Unknown MESSAGE_STORE {backend!r}, expected 'sqlite' or 'postgres'")
+
+
+def import_sqlite(source_dir, target: MessageStore):
+    """Copy every per-channel SQLite database under source_dir into target."""
+    source = SQLiteMessageStore(base_dir=source_dir)
+    for user_id, channel_id in source.iter_channels():
+        copied = 0
+        for rows in source.iter_rows(user_id, channel_id):
+            copied += target.save_messages(user_id, channel_id, rows)
+        logger.info(f"Imported {copied} messages for {user_id}/{channel_id}")
+
+
+def migrate_all(base_dir):
+    """Bring every per-channel SQLite database under base_dir to the current schema."""
+    store = SQLiteMessageStore(base_dir=base_dir)
+    for user_id, channel_id in store.iter_channels():
+        version = store.schema_version(user_id, channel_id)
+        logger.info(f"{user_id}/{channel_id} is at schema version {version}")
+
+
+def archive_all(base_dir, older_than_days, vacuum=True):
+    """Archive old messages of every per-channel SQLite database under base_dir."""
+    store = SQLiteMessageStore(base_dir=base_dir)
+    older_than = datetime.utcnow() - timedelta(days=older_than_days)
+    for user_id, channel_id in store.iter_channels():
+        store.archive(user_id, channel_id, older_than, vacuum=vacuum)
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Message store maintenance")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    import_parser = subcommands.add_parser("import-sqlite", help="Load per-channel SQLite files into PostgreSQL")
+    import_parser.add_argument("source_dir", help="Directory laid out as <user_id>/<channel_id>/<channel_id>.db")
+    migrate_parser = subcommands.add_parser("migrate", help="Upgrade per-channel SQLite files to the current schema")
+    migrate_parser.add_argument("data_dir", help="Directory laid out as <user_id>/<channel_id>/<channel_id>.db")
+    archive_parser = subcommands.add_parser("archive", help="Move old SQLite messages into compressed segments")
+    archive_parser.add_argument("data_dir", help="Directory laid out as <user_id>/<channel_id>/<channel_id>.db")
+    archive_parser.add_argument("--older-than-days", type=int, default=ARCHIVE_AFTER_DAYS or 90)
+    archive_parser.add_argument("--no-vacuum", action="store_true", help="Skip VACUUM of the hot databases")
+    args = parser.parse_args()
+
+    if args.command == "import-sqlite":
+        import_sqlite(args.source_dir, create_message_store('postgres'))
+    elif args.command == "migrate":
+        migrate_all(args.data_dir)
+    elif args.command == "archive":
+        archive_all(args.data_dir, args.older_than_days, vacuum=not args.no_vacuum)
@@ -0,0 +1,87 @@
+import os
+import sys
+
+# Make the backend modules (server, benchmarks, ...) importable from tests.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio  # noqa: E402
+
+import pytest  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+import auth  # noqa: E402
+import scraping  # noqa: E402
+import server  # noqa: E402
+import state  # noqa: E402
+from accounts import AccountPool  # noqa: E402
+from admission import FairScheduler  # noqa: E402
+from benchmarks.fakes import FakeDatabase, FakeTelegramClient  # noqa: E402
+from jobs import JobRegistry  # noqa: E402
+from storage import SQLiteMessageStore  # noqa: E402
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """In-memory MongoDB standing in for state.db."""
+    db = FakeDatabase()
+    monkeypatch.setattr(state, "db", db, raising=False)
+    return db
+
+
+@pytest.fixture
+def user_channels():
+    """Channels of the test user; override in a module to give it others."""
+    return {"c1": 0}
+
+
+@pytest.fixture
+def user(db, user_channels):
+    """The test user u1, with Telegram credentials and user_channels."""
+    doc = {
+        "id": "u1", "email": "u1@example.com", "hashed_password": "x", "channels": dict(user_channels),
+        "scrape_media": False, "telegram_credentials": {"api_id": 1, "api_hash": "hash", "phone": "+100"},
+    }
+    asyncio.run(db.users.insert_one(dict(doc)))
+    return doc
+
+
+@pytest.fixture
+def message_store(monkeypatch, tmp_path):
+    store = SQLiteMessageStore(base_dir=str(tmp_path / "data"))
+    monkeypatch.setattr(state, "message_store", store, raising=False)
+    return store
+
+
+@pytest.fixture
+def client(monkeypatch, db, user, message_store):
+    """API test client signed in as the test user; ``client.token`` is its access token."""
+    monkeypatch.setattr(auth, "SECRET_KEY", "test-secret")
+    token = auth.create_access_token({"sub": user["email"]})
+    with TestClient(server.app, headers={"Authorization": f"Bearer {token}"}) as client:
+        client.db = db
+        client.token = token
+        yield client
+
+
+@pytest.fixture
+def scrape_backend(monkeypatch, db, user, message_store):
+    """Runs real scrapes of the test user against a FakeTelegramClient.
+
+    Call it with the ChannelSpecs by channel id; it returns the client
+    every scrape gets.
+    """
+    def install(specs):
+        telegram = FakeTelegramClient(specs)
+
+        async def get_client(user_id, account=None):
+            return telegram
+
+        monkeypatch.setattr(state, "job_registry", JobRegistry(db.scrape_jobs), raising=False)
+        monkeypatch.setattr(state, "account_pool", AccountPool(db.telegram_accounts), raising=False)
+        monkeypatch.setattr(state, "scrape_scheduler", FairScheduler("scrape", 4, 4, 100), raising=False)
+        monkeypatch.setattr(scraping, "get_telegram_client", get_client)
+        monkeypatch.setattr(scraping, "draining", False)
+        monkeypatch.setattr(scraping, "continuous_tasks", {})
+        return telegram
+
+    return install
@@ -0,0 +1,76 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from accounts import (
+    PRIMARY_ACCOUNT,
+    AccountPool,
+    NoAccountAvailable,
+    SegmentProgress,
+    resume_segments,
+    split_segments,
+)
+from benchmarks.fakes import FakeDatabase
+
+USER = {"id": "u1", "telegram_credentials": {"api_id": 1, "api_hash": "hash", "phone": "+100"}}
+
+
+class TestAccountPool:
+    def setup_method(self):
+        self.pool = AccountPool(FakeDatabase().telegram_accounts)
+
+    def test_spreads_leases_and_avoids_flooded_accounts(self):
+        """Work goes to the least loaded account and skips ones in a flood wait"""
+        async def scenario():
+            second = await self.pool.add("u1", {"api_id": 2, "api_hash": "other", "phone": "+200"})
+            accounts = await self.pool.accounts(USER)
+            assert [a["account_id"] for a in accounts] == [PRIMARY_ACCOUNT, second["account_id"]]
+
+            first = (await self.pool.assign(USER))[0]
+            async with self.pool.lease(first):
+                assert (await self.pool.assign(USER))[0]["account_id"] != first["account_id"]
+
+            await self.pool.record_flood_wait("u1", PRIMARY_ACCOUNT, 120)
+            assert [a["account_id"] for a in await self.pool.assign(USER, count=None)] == [second["account_id"]]
+            await self.pool.record_flood_wait("u1", second["account_id"], 30)
+            with pytest.raises(NoAccountAvailable) as excinfo:
+                await self.pool.assign(USER)
+            assert 0 < excinfo.value.retry_after <= 30
+
+        asyncio.run(scenario())
+
+    def test_recent_flood_waits_lower_the_rank(self):
+        """An account that flooded recently is picked after one that did not"""
+        now = datetime.utcnow()
+        accounts = [
+            {"user_id": "u1", "account_id": "a", "flood_waits": [{"at": now - timedelta(minutes=5), "seconds": 600}]},
+            {"user_id": "u1", "account_id": "b", "flood_waits": [{"at": now - timedelta(hours=2), "seconds": 600}]},
+            {"user_id": "u1", "account_id": "c", "flood_until": now + timedelta(minutes=1)},
+        ]
+        assert [a["account_id"] for a in self.pool.rank(accounts, now)] == ["b", "a"]
+
+
+class TestSegments:
+    def test_split_and_checkpoint(self):
+        """Segments cover the backfill and the offset never passes an unsaved message"""
+        segments = split_segments(100, 3500, 2)
+        assert segments == [(100, 1800), (1800, 3500)]
+        assert split_segments(100, 100, 4) == [] and len(split_segments(0, 3, 8)) == 3
+
+        progress = SegmentProgress(segments)
+        assert progress.advance(1, 3000) is None
+        assert progress.advance(0, 1500) == 1500
+        assert progress.finish(1) is None
+        assert progress.finish(0) == 3500
+
+    def test_resume(self):
+        """An interrupted backfill resumes each segment where it stopped, up to the new newest id"""
+        progress = SegmentProgress([(0, 1000), (1000, 2000), (2000, 3000)])
+        progress.advance(0, 400)
+        progress.finish(1)
+        progress.advance(2, 2500)
+        snapshot = progress.snapshot()
+        assert snapshot == [[400, 1000, False], [2000, 2000, True], [2500, 3000, False]]
+        assert resume_segments(snapshot, 3200) == [(400, 1000), (2500, 3200)]
+        assert resume_segments([[500, 500, True]], 500) == []
@@ -0,0 +1,145 @@
+import asyncio
+import time
+
+import pytest
+
+import scraping
+import state
+from admission import AdmissionRejected, FairScheduler, RateLimiter
+from jobs import JobRegistry
+
+
+class TestRateLimiter:
+    def test_burst_then_retry_after(self):
+        """A user may spend the burst at once, then waits for the bucket to refill"""
+        limiter = RateLimiter("scrape", per_minute=6, burst=2)
+        limiter.check("u1")
+        limiter.check("u1")
+        with pytest.raises(AdmissionRejected) as excinfo:
+            limiter.check("u1")
+        assert 9 <= excinfo.value.retry_after <= 10
+        assert excinfo.value.headers == {"Retry-After": str(excinfo.value.retry_after)}
+        limiter.check("u2")
+
+
+class TestFairScheduler:
+    def test_slots_are_shared_by_weight(self):
+        """A heavy user with a long queue does not hold back a lighter one beyond its weight"""
+        async def scenario():
+            scheduler = FairScheduler("scrape", slots=1, per_user=1, max_waiting=100)
+            order = []
+            release = asyncio.Event()
+
+            async def unit(user_id, weight):
+                async with scheduler.slot(user_id, weight):
+                    order.append(user_id)
+                    await release.wait()
+
+            tasks = [asyncio.ensure_future(unit("heavy", 1.0)) for _ in range(6)]
+            await asyncio.sleep(0)
+            tasks += [asyncio.ensure_future(unit("light", 2.0)) for _ in range(4)]
+            while len(order) < 10:
+                await asyncio.sleep(0)
+                release.set()
+                release.clear()
+            await asyncio.gather(*tasks)
+            # The light user gets two slots for every one of the heavy user's
+            assert order[:7] == ["heavy", "light", "light", "heavy", "light", "light", "heavy"]
+
+        asyncio.run(scenario())
+
+    def test_queue_limit_timeout_and_merge(self):
+        """Full queues and slot timeouts are rejected; work under a busy key is merged"""
+        async def scenario():
+            scheduler = FairScheduler("export", slots=1, per_user=1, max_waiting=1)
+            runs = []
+            gate = asyncio.Event()
+
+            async def work():
+                runs.append(1)
+                await gate.wait()
+
+            first = scheduler.submit(("u1", "c1"), "u1", work, tag="job-1")
+            assert scheduler.submit(("u1", "c1"), "u1", work, tag="job-2") is first
+            assert scheduler.pending(("u1", "c1")) == "job-1"
+            await asyncio.sleep(0)
+
+            with pytest.raises(AdmissionRejected):
+                async with scheduler.slot("u1", timeout=0.01):
+                    pass
+            waiting = asyncio.ensure_future(scheduler.slot("u1").__aenter__())
+            await asyncio.sleep(0)
+            with pytest.raises(AdmissionRejected):
+                scheduler.admit("u1")
+            scheduler.admit("u2")
+
+            gate.set()
+            await first
+            await waiting
+            assert runs == [1] and scheduler.pending(("u1", "c1")) is None
+
+        asyncio.run(scenario())
+
+    def test_submitted_work_is_queued_before_it_starts(self):
+        """A burst of submissions counts against the queue before its tasks first run"""
+        async def scenario():
+            scheduler = FairScheduler("scrape", slots=1, per_user=1, max_waiting=3)
+            gate = asyncio.Event()
+            tasks = [scheduler.submit(("u1", f"c{i}"), "u1", gate.wait) for i in range(3)]
+            assert scheduler.waiting("u1") == 3
+            with pytest.raises(AdmissionRejected):
+                scheduler.admit("u1")
+            await asyncio.sleep(0)
+            assert scheduler.waiting("u1") == 2
+
+            late = scheduler.submit(("u1", "c3"), "u1", gate.wait)
+            late.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await late
+            assert scheduler.waiting("u1") == 2 and scheduler.pending(("u1", "c3")) is None
+            gate.set()
+            await asyncio.gather(*tasks)
+            assert scheduler.waiting("u1") == 0
+
+        asyncio.run(scenario())
+
+
+class TestScrapeAdmission:
+    @pytest.fixture
+    def user_channels(self):
+        return {"c1": 0, "c2": 0}
+
+    @pytest.fixture(autouse=True)
+    def admission(self, monkeypatch, db):
+        monkeypatch.setattr(state, "job_registry", JobRegistry(db.scrape_jobs), raising=False)
+        monkeypatch.setattr(state, "scrape_rate", RateLimiter("scrape", per_minute=1, burst=3), raising=False)
+        monkeypatch.setattr(state, "scrape_scheduler", FairScheduler("scrape", 4, 2, 100), raising=False)
+
+    def test_duplicate_scrapes_merge_and_excess_is_429(self, monkeypatch, client):
+        """A second scrape of a busy channel joins the first; past the rate quota the API answers 429"""
+        started = []
+
+        async def slow_scrape(user_id, channel_id, offset_id, scrape_media, job_id=None, segments=None):
+            started.append(channel_id)
+            await asyncio.sleep(0.5)
+
+        monkeypatch.setattr(scraping, "scrape_channel_task", slow_scrape)
+        first = client.post("/api/scrape/c1").json()
+        second = client.post("/api/scrape/c1").json()
+        assert first["merged"] is False and second["merged"] is True
+        assert second["job_id"] == first["job_id"]
+        assert client.post("/api/scrape/c2").json()["merged"] is False
+
+        rejected = client.post("/api/scrape/c2")
+        assert rejected.status_code == 429
+        assert int(rejected.headers["Retry-After"]) >= 1
+
+        # One scrape per channel ran, the merged request started none
+        deadline = time.monotonic() + 5
+        while len(started) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert started == ["c1", "c2"]
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,36 @@
+import asyncio
+
+import pytest
+
+from broker import MessageBroker
+
+
+class TestMessageBroker:
+    def test_publish_reaches_channel_subscribers_only(self):
+        """Messages fan out to subscribers of the same user and channel"""
+        async def scenario():
+            broker = MessageBroker()
+            async with broker.subscribe("u1", "c1") as first, broker.subscribe("u1", "c1") as second, \
+                    broker.subscribe("u1", "c2") as other:
+                await broker.publish("u1", "c1", {"message_id": 1})
+                assert first.queue.get_nowait() == {"message_id": 1}
+                assert second.queue.get_nowait() == {"message_id": 1}
+                assert other.queue.empty()
+            assert not broker.has_subscribers("u1", "c1")
+
+        asyncio.run(scenario())
+
+    def test_slow_subscriber_overflows(self):
+        """A full queue marks the subscriber for catch-up instead of blocking"""
+        async def scenario():
+            broker = MessageBroker(queue_size=2)
+            async with broker.subscribe("u1", "c1") as subscription:
+                for message_id in range(3):
+                    await broker.publish("u1", "c1", {"message_id": message_id})
+                assert subscription.overflowed
+                assert subscription.queue.empty()
+
+        asyncio.run(scenario())
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,106 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+
+import scraping
+import state
+from benchmarks.fakes import ChannelSpec, FakeDatabase, FakeTelegramClient
+from dialogs import DialogCache
+from sessions import SessionBusy
+
+
+class TestDialogCache:
+    def setup_method(self):
+        db = FakeDatabase()
+        self.cache = DialogCache(db.dialog_cache, db.dialog_sync_state)
+        self.client = FakeTelegramClient({f"chan{i}": ChannelSpec(messages=5, seed=i) for i in range(50)})
+        self.client.titles["chan7"] = "Crypto Alerts"
+        self.opened = 0
+
+    @asynccontextmanager
+    async def open_client(self, user_id):
+        self.opened += 1
+        await self.client.start()
+        yield self.client
+
+    def test_incremental_sync_stops_at_unchanged_dialogs(self):
+        """Only dialogs with new messages are walked after the first sync"""
+        async def scenario():
+            first = await self.cache.refresh("u1", self.open_client)
+            assert first == {"full": True, "updated": 50, "removed": 0}
+            self.client.add_messages("chan3", 2)
+            self.client.dialogs_served = 0
+            second = await self.cache.refresh("u1", self.open_client)
+            assert second == {"full": False, "updated": 1, "removed": 0}
+            assert self.client.dialogs_served == 2
+            items, total = await self.cache.page("u1", limit=1)
+            assert total == 50 and items[0]["id"] == "chan3"
+
+        asyncio.run(scenario())
+
+    def test_search_and_pagination(self):
+        """Pages come from the cache and can be filtered by title"""
+        async def scenario():
+            await self.cache.refresh("u1", self.open_client)
+            found, total = await self.cache.page("u1", q="crypto")
+            assert total == 1 and found[0]["title"] == "Crypto Alerts"
+            page, total = await self.cache.page("u1", offset=45, limit=10)
+            assert total == 50 and len(page) == 5
+            everything, total = await self.cache.page("u1", limit=None)
+            assert total == 50 and len(everything) == 50
+            assert await self.cache.page("u2") == ([], 0)
+
+        asyncio.run(scenario())
+
+    def test_concurrent_refreshes_share_one_sync(self):
+        """Parallel refreshes for one user open a single Telegram session"""
+        async def scenario():
+            await asyncio.gather(*(self.cache.refresh("u1", self.open_client) for _ in range(5)))
+            assert self.opened == 1
+            # Finished syncs are not kept around
+            await asyncio.sleep(0)
+            assert self.cache._refreshing == {} and not self.cache.is_refreshing("u1")
+
+        asyncio.run(scenario())
+
+class TestChannelsList:
+    @pytest.fixture
+    def telegram(self, monkeypatch, db):
+        monkeypatch.setattr(state, "dialog_cache", DialogCache(db.dialog_cache, db.dialog_sync_state), raising=False)
+        telegram = FakeTelegramClient({f"chan{i}": ChannelSpec(messages=5, seed=i) for i in range(30)})
+        telegram.busy = False
+
+        @asynccontextmanager
+        async def telegram_session(user_id, wait=None):
+            if telegram.busy:
+                raise SessionBusy("Telegram session u1 is in use")
+            await telegram.start()
+            yield telegram
+
+        monkeypatch.setattr(scraping, "telegram_session", telegram_session)
+        return telegram
+
+    def test_pages_and_everything(self, telegram, client):
+        """Without a limit every dialog is listed; with one, next_offset leads to the next page"""
+        everything = client.get("/api/channels-list").json()
+        assert len(everything["channels"]) == everything["total"] == 30 and everything["next_offset"] is None
+        page = client.get("/api/channels-list", params={"offset": 20, "limit": 8}).json()
+        assert len(page["channels"]) == 8 and page["next_offset"] == 28
+
+    def test_session_held_by_a_scrape(self, telegram, client):
+        """A busy session is a 503 with Retry-After, or the cached list while a sync waits for it"""
+        telegram.busy = True
+        busy = client.get("/api/channels-list")
+        assert busy.status_code == 503 and int(busy.headers["Retry-After"]) > 0
+
+        telegram.busy = False
+        assert client.get("/api/channels-list").json()["total"] == 30
+        telegram.busy = True
+        cached = client.get("/api/channels-list", params={"refresh": "true"})
+        assert cached.status_code == 200
+        assert cached.json()["total"] == 30 and cached.json()["refreshing"] is True
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,159 @@
+import asyncio
+import json
+
+import pytest
+
+import scraping
+import state
+from benchmarks.fakes import ChannelSpec, FakeDatabase
+from duplicates import NearDuplicateIndex, bands, minhash, similarity
+from storage import MessageRecord
+
+POST = ("Bitcoin jumps five percent as ETF inflows hit a record high on Tuesday while "
+        "analysts expect further gains this week and miners report strong revenue")
+OTHER = ("The city council approved the new budget for public transport after a long "
+         "debate on Monday evening and work on the tram line starts in spring")
+
+
+def record(message_id, text, date=...):
+    fields = dict.fromkeys(MessageRecord._fields)
+    if date is ...:
+        date = f"2024-01-01 00:{message_id % 60:02d}:00"
+    fields.update(message_id=message_id, message=text, date=date)
+    return MessageRecord(**fields)
+
+
+class TestMinHash:
+    def test_similarity(self):
+        """Small edits keep a post similar; unrelated and short texts are told apart"""
+        signature = minhash(POST)
+        for repost in ("BREAKING: " + POST, POST + " via @cryptonews", POST.replace("Tuesday", "Wednesday"),
+                       POST.upper()):
+            assert similarity(signature, minhash(repost)) >= 0.5, repost
+        assert similarity(signature, minhash(OTHER)) < 0.2
+        assert minhash(POST) == signature and bands(minhash(POST)) == bands(signature)
+        assert len(set(bands(signature)) & set(bands(minhash(OTHER)))) == 0
+        assert minhash("thanks a lot") is None
+        assert minhash("") is None
+
+
+class TestNearDuplicateIndex:
+    def test_clusters_across_channels(self):
+        """Reposts in other channels, or later in the same batch, join the first copy's cluster"""
+        index = NearDuplicateIndex(FakeDatabase().message_signatures)
+
+        async def scenario():
+            first = await index.add("u1", "c1", [record(1, POST), record(2, OTHER), record(3, "ok")])
+            assert first == {1: "c1:1", 2: "c1:2"}
+            second = await index.add("u1", "c2", [
+                record(7, "BREAKING: " + POST), record(8, OTHER + " more at the link below"),
+                record(9, "A completely new post about the weather in the north of the country"),
+                record(10, "A completely new post about the weather in the north of the country today"),
+            ])
+            assert second == {7: "c1:1", 8: "c1:2", 9: "c2:9", 10: "c2:9"}
+            # Other users' messages are never compared
+            assert await index.add("u2", "c1", [record(1, POST)]) == {1: "c1:1"}
+            assert await index.add("u2", "c2", [record(5, POST)]) == {5: "c1:1"}
+
+            found = await index.duplicates("u1", "c1", 1)
+            assert found["cluster_id"] == "c1:1"
+            assert [(d["channel_id"], d["message_id"]) for d in found["duplicates"]] == [("c2", 7)]
+            assert 0.5 <= found["duplicates"][0]["similarity"] < 1
+            assert (await index.duplicates("u1", "c1", 1, channels={"c1"}))["duplicates"] == []
+            assert await index.duplicates("u1", "c1", 3) is None
+
+            # An edit that makes a message unique again gives it its own cluster
+            assert await index.add("u1", "c2", [record(7, OTHER.replace("budget", "plan"))]) == {7: "c1:2"}
+            assert await index.add("u1", "c2", [record(8, "Nothing like the other posts at all, a fresh one")]) \
+                == {8: "c2:8"}
+
+        asyncio.run(scenario())
+
+    def test_undated_duplicates(self):
+        """Copies without a date rank after equally similar dated ones"""
+        index = NearDuplicateIndex(FakeDatabase().message_signatures)
+
+        async def scenario():
+            await index.add("u1", "c1", [record(1, POST)])
+            await index.add("u1", "c2", [record(2, POST, date=None)])
+            await index.add("u1", "c3", [record(3, POST)])
+            found = await index.duplicates("u1", "c1", 1)
+            assert [(d["channel_id"], d["date"]) for d in found["duplicates"]] == [("c2", None), ("c3", record(3, POST).date)]
+
+        asyncio.run(scenario())
+
+    def test_mass_reposts_are_capped(self):
+        """Lookups fetch a bounded number of a post's copies however often it was reposted"""
+        index = NearDuplicateIndex(FakeDatabase().message_signatures, candidates_per_band=3)
+
+        async def scenario():
+            for channel in range(60):
+                assert await index.add("u1", f"c{channel}", [record(1, f"{POST} via channel {channel}")]) \
+                    == {1: "c0:1"}
+            candidates = await index._candidates("u1", bands(minhash(POST)))
+            assert 3 <= len(candidates) <= 16 * 3
+            found = await index.duplicates("u1", "c0", 1, limit=5)
+            assert len(found["duplicates"]) == 5
+            assert await index.add("u1", "c60", [record(1, "BREAKING: " + POST)]) == {1: "c0:1"}
+            assert (await index.duplicates("u1", "c0", 1, channels={"c5", "c6"}))["duplicates"][0]["channel_id"] \
+                in ("c5", "c6")
+
+        asyncio.run(scenario())
+
+
+@pytest.fixture
+def user_channels():
+    return {"c1": 0, "c2": 0}
+
+
+@pytest.fixture
+def index(monkeypatch, db):
+    index = NearDuplicateIndex(db.message_signatures)
+    monkeypatch.setattr(state, "near_duplicates", index, raising=False)
+    return index
+
+
+class TestDuplicatesApi:
+    def test_duplicates(self, index, client):
+        """Duplicates come from the user's current channels only"""
+        async def seed():
+            await index.add("u1", "c1", [record(1, POST)])
+            await index.add("u1", "c2", [record(4, POST + " (repost)")])
+            await index.add("u1", "c3", [record(5, POST)])
+
+        asyncio.run(seed())
+        response = client.get("/api/channels/c1/messages/1/duplicates")
+        assert response.status_code == 200
+        body = response.json()
+        assert body["cluster_id"] == "c1:1"
+        assert [(d["channel_id"], d["message_id"]) for d in body["duplicates"]] == [("c2", 4)]
+        assert client.get("/api/channels/c2/messages/4/duplicates").json()["cluster_id"] == "c1:1"
+        assert client.get("/api/channels/c1/messages/2/duplicates").status_code == 404
+        assert client.get("/api/channels/c3/messages/5/duplicates").status_code == 404
+
+
+class TestScrapeIndexing:
+    def test_scraped_reposts_are_clustered(self, index, db, scrape_backend):
+        """A channel reposting another's messages, edited, is clustered with it as it is scraped"""
+        client = scrape_backend({"c1": ChannelSpec(messages=200), "c2": ChannelSpec(messages=200)})
+        for message in client.messages_for("c2"):
+            message.message = f"Repost: {message.message}"
+
+        async def scenario():
+            await scraping.scrape_channel_task("u1", "c1", 0, False)
+            await scraping.scrape_channel_task("u1", "c2", 0, False)
+            docs = db.message_signatures.docs
+            assert len(docs) == 400
+            clusters = {(doc["channel_id"], doc["message_id"]): doc["cluster_id"] for doc in docs}
+            assert all(clusters[("c2", message_id)] == f"c1:{message_id}" for message_id in range(1, 201))
+            assert all(clusters[("c1", message_id)] == f"c1:{message_id}" for message_id in range(1, 201))
+            # Stored rows and the /channel-data body carry the cluster too
+            rows = state.message_store.messages_since("u1", "c2", 0)
+            assert [row["cluster_id"] for row in rows] == [f"c1:{row['message_id']}" for row in rows]
+            latest = json.loads(state.message_store.latest_messages_json("u1", "c2", 5))
+            assert [row["cluster_id"] for row in latest] == [f"c1:{row['message_id']}" for row in latest]
+
+        asyncio.run(scenario())
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
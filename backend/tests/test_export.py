@@ -0,0 +1,98 @@
+import asyncio
+
+import pytest
+
+import scraping
+import state
+from broker import MessageBroker
+from export import ChannelDataCache
+from storage import SQLiteMessageStore
+
+
+def make_row(message_id):
+    return (message_id, f"2024-01-01 00:00:{message_id:02d}", 42, "First", None, "user",
+            "hello", None, None, None, None, None, None)
+
+
+class CountingStore(SQLiteMessageStore):
+    def __init__(self, base_dir):
+        super().__init__(base_dir)
+        self.calls = {"channel_version": 0, "latest_messages_json": 0}
+        self.on_read = None
+
+    def channel_version(self, *args):
+        self.calls["channel_version"] += 1
+        return super().channel_version(*args)
+
+    def latest_messages_json(self, *args):
+        self.calls["latest_messages_json"] += 1
+        messages = super().latest_messages_json(*args)
+        if self.on_read is not None:
+            self.on_read()
+        return messages
+
+
+@pytest.fixture
+def message_store(monkeypatch, tmp_path):
+    store = CountingStore(str(tmp_path / "data"))
+    monkeypatch.setattr(state, "message_store", store, raising=False)
+    monkeypatch.setattr(state, "broker", MessageBroker(), raising=False)
+    monkeypatch.setattr(state, "channel_cache", ChannelDataCache(), raising=False)
+    store.save_messages("u1", "c1", [make_row(i) for i in range(1, 4)])
+    return store
+
+
+class TestChannelData:
+    def test_unchanged_channel_is_304(self, client, message_store, monkeypatch):
+        """Pollers get 304 while nothing changed and the new rows once something did"""
+        monkeypatch.setattr("export.CHANNEL_DATA_REVALIDATE", 0)
+        first = client.get("/api/channel-data/c1")
+        etag = first.headers["etag"]
+        assert [m["message_id"] for m in first.json()["messages"]] == [3, 2, 1]
+
+        assert client.get("/api/channel-data/c1", headers={"If-None-Match": etag}).status_code == 304
+        assert client.get("/api/channel-data/c1").content == first.content
+        assert message_store.calls == {"channel_version": 4, "latest_messages_json": 1}
+
+        # Written by a scraper in another process: caught by revalidation
+        message_store.save_message("u1", "c1", make_row(4))
+        changed = client.get("/api/channel-data/c1", headers={"If-None-Match": etag})
+        assert changed.status_code == 200 and changed.headers["etag"] != etag
+        assert changed.json()["messages"][0]["message_id"] == 4
+
+    def test_cached_until_invalidated(self, client, message_store):
+        """Within the revalidation window storage is not read until a commit drops the entry"""
+        etag = client.get("/api/channel-data/c1").headers["etag"]
+        for _ in range(3):
+            assert client.get("/api/channel-data/c1", headers={"If-None-Match": etag}).status_code == 304
+        assert message_store.calls == {"channel_version": 2, "latest_messages_json": 1}
+
+        message_store.save_message("u1", "c1", make_row(4))
+        scraping.channel_changed("u1", "c1")
+        assert client.get("/api/channel-data/c1", headers={"If-None-Match": etag}).status_code == 200
+
+        message_store.save_message("u1", "c1", make_row(5))
+        asyncio.run(state.broker.publish("u1", "c1", {"message_id": 5}))
+        assert client.get("/api/channel-data/c1").json()["messages"][0]["message_id"] == 5
+
+    def test_commit_while_rendering(self, client, message_store):
+        """A body read while a scrape commits is never cached or sent under the ETag read before it"""
+        commits = iter(range(4, 6))
+        message_store.on_read = lambda: message_store.save_message("u1", "c1", make_row(next(commits, 5)))
+        response = client.get("/api/channel-data/c1")
+        message_store.on_read = None
+        assert response.json()["messages"][0]["message_id"] == 5
+        current = client.get("/api/channel-data/c1")
+        assert current.headers["etag"] == response.headers["etag"] and current.content == response.content
+
+    def test_lru(self):
+        """The least recently used response goes first"""
+        cache = ChannelDataCache(size=2)
+        for channel in ("a", "b"):
+            cache.store(("u", channel), '"1"', b"{}")
+        cache.lookup(("u", "a"))
+        cache.store(("u", "c"), '"1"', b"{}")
+        assert cache.lookup(("u", "b")) is None and cache.lookup(("u", "a")) is not None
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+
+import jobs
+from benchmarks.fakes import FakeDatabase
+from jobs import JobCancelled, JobRegistry
+
+
+class TestJobRegistry:
+    def setup_method(self):
+        self.registry = JobRegistry(FakeDatabase().scrape_jobs)
+
+    def test_progress_and_completion(self):
+        """A tracked job reports counts, rate and ETA and finishes completed"""
+        async def scenario():
+            job = await self.registry.create("user-1", "channel", 0)
+            assert job["state"] == jobs.QUEUED
+            tracker = self.registry.tracker(job["id"])
+            await tracker.start(10)
+            await tracker.update(4, last_message_id=4, force=True)
+            running = await self.registry.get(job["id"], "user-1")
+            assert running["state"] == jobs.RUNNING
+            assert (running["processed"], running["total"], running["last_message_id"]) == (4, 10, 4)
+            assert running["eta_seconds"] is not None
+            await tracker.finish(jobs.COMPLETED)
+            return await self.registry.get(job["id"], "user-1")
+
+        job = asyncio.run(scenario())
+        assert job["state"] == jobs.COMPLETED
+        assert job["eta_seconds"] == 0
+
+    def test_cancel_from_another_worker(self):
+        """Cancellation stored in Mongo is picked up on the next progress flush"""
+        async def scenario():
+            job = await self.registry.create("user-1", "channel", 0)
+            tracker = self.registry.tracker(job["id"])
+            await tracker.start(10)
+            other_worker = JobRegistry(self.registry.collection)
+            cancelling = await other_worker.request_cancel(job["id"], "user-1")
+            assert cancelling["state"] == jobs.CANCELLING
+            with pytest.raises(JobCancelled):
+                await tracker.update(1, force=True)
+
+        asyncio.run(scenario())
+
+    def test_cancel_queued_and_list(self):
+        """Queued jobs are cancelled outright and other users can't see them"""
+        async def scenario():
+            job = await self.registry.create("user-1", "channel", 0)
+            cancelled = await self.registry.request_cancel(job["id"], "user-1")
+            assert cancelled["state"] == jobs.CANCELLED
+            assert await self.registry.request_cancel(job["id"], "user-2") is None
+            assert [j["id"] for j in await self.registry.list("user-1")] == [job["id"]]
+            assert await self.registry.list("user-2") == []
+            updates = [u async for u in self.registry.watch(job["id"], "user-1", poll_interval=0)]
+            assert updates[-1]["state"] == jobs.CANCELLED
+
+        asyncio.run(scenario())
+
+    def test_create_many(self):
+        """Bulk-created jobs are queued in a single write"""
+        async def scenario():
+            created = await self.registry.create_many("user-1", {"a": 0, "b": 10}, kind="backfill")
+            assert [(j["channel_id"], j["offset_id"], j["state"]) for j in created] == [
+                ("a", 0, jobs.QUEUED), ("b", 10, jobs.QUEUED)]
+            assert self.registry.collection.op_counts.get("insert_many") == 1
+            assert len(await self.registry.list("user-1")) == 2
+
+        asyncio.run(scenario())
+
+    def test_interrupt_and_claim(self):
+        """Interrupted jobs keep their offset and are claimed by exactly one worker"""
+        async def scenario():
+            running = await self.registry.create("user-1", "a", 0)
+            tracker = self.registry.tracker(running["id"])
+            await tracker.start(100)
+            await tracker.interrupt(40, [[40, 100, False]])
+            queued = await self.registry.create("user-1", "b", 0)
+            await self.registry.interrupt(queued["id"])
+            assert await self.registry.has_interrupted()
+
+            other_worker = JobRegistry(self.registry.collection)
+            claims = await asyncio.gather(self.registry.claim_interrupted(), other_worker.claim_interrupted())
+            claimed = {job["id"]: job for claim in claims for job in claim}
+            assert sorted(claimed) == sorted([running["id"], queued["id"]])
+            assert sum(map(len, claims)) == 2
+            assert claimed[running["id"]]["state"] == jobs.QUEUED
+            assert (claimed[running["id"]]["offset_id"], claimed[running["id"]]["segments"]) == (40, [[40, 100, False]])
+            assert not await self.registry.has_interrupted()
+
+            cancelled = await self.registry.create("user-1", "c", 0)
+            await self.registry.interrupt(cancelled["id"])
+            assert (await self.registry.request_cancel(cancelled["id"], "user-1"))["state"] == jobs.CANCELLED
+
+        asyncio.run(scenario())
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,131 @@
+import asyncio
+import os
+import time
+
+import pytest
+from fastapi import HTTPException
+
+import auth
+import media
+
+CONTENT = bytes(range(256)) * 40
+
+
+@pytest.fixture(autouse=True)
+def clip(message_store):
+    media_dir = os.path.join(message_store.data_dir("u1", "c1"), "media")
+    os.makedirs(media_dir)
+    with open(os.path.join(media_dir, "clip.mp4"), "wb") as f:
+        f.write(CONTENT)
+
+
+class TestMedia:
+    def test_whole_file_and_conditional_requests(self, client):
+        """Files come with validators and cache headers; a current copy gets 304"""
+        response = client.get("/api/media/c1/clip.mp4")
+        assert response.status_code == 200 and response.content == CONTENT
+        assert response.headers["content-type"] == "video/mp4"
+        assert response.headers["accept-ranges"] == "bytes"
+        assert "max-age=" in response.headers["cache-control"]
+        etag, modified = response.headers["etag"], response.headers["last-modified"]
+
+        assert client.get("/api/media/c1/clip.mp4", headers={"If-None-Match": etag}).status_code == 304
+        assert client.get("/api/media/c1/clip.mp4", headers={"If-Modified-Since": modified}).status_code == 304
+        assert client.get("/api/media/c1/clip.mp4", headers={"If-None-Match": '"other"'}).status_code == 200
+        head = client.head("/api/media/c1/clip.mp4")
+        assert head.headers["content-length"] == str(len(CONTENT)) and head.content == b""
+
+    def test_ranges(self, client):
+        """Single ranges get 206 with Content-Range; a stale If-Range gets the whole file"""
+        response = client.get("/api/media/c1/clip.mp4", headers={"Range": "bytes=100-199"})
+        assert response.status_code == 206 and response.content == CONTENT[100:200]
+        assert response.headers["content-range"] == f"bytes 100-199/{len(CONTENT)}"
+        assert client.get("/api/media/c1/clip.mp4", headers={"Range": "bytes=-10"}).content == CONTENT[-10:]
+        assert client.get("/api/media/c1/clip.mp4", headers={"Range": "bytes=10000-"}).content == CONTENT[10000:]
+
+        unsatisfiable = client.get("/api/media/c1/clip.mp4", headers={"Range": f"bytes={len(CONTENT)}-"})
+        assert unsatisfiable.status_code == 416
+        assert unsatisfiable.headers["content-range"] == f"bytes */{len(CONTENT)}"
+        stale = client.get("/api/media/c1/clip.mp4", headers={"Range": "bytes=0-9", "If-Range": '"stale"'})
+        assert stale.status_code == 200 and len(stale.content) == len(CONTENT)
+
+    def test_access(self, client):
+        """Only the owner's channels are served, never files outside their media directory"""
+        assert client.get("/api/media/c2/clip.mp4").status_code == 404
+        assert client.get("/api/media/c1/.previews").status_code == 404
+        assert client.get("/api/media/c1/missing.jpg").status_code == 404
+        assert client.get("/api/media/c1/clip.mp4", headers={"Authorization": ""}).status_code == 401
+        # The bearer token is not taken from the URL
+        query = client.get(f"/api/media/c1/clip.mp4?access_token={client.token}", headers={"Authorization": ""})
+        assert query.status_code == 401
+        with pytest.raises(HTTPException):
+            media.media_file("u1", "c1", "../c1.db")
+
+    def test_media_tokens(self, client, monkeypatch):
+        """Media URLs work without the Authorization header for their one file, until they expire"""
+        minted = client.post("/api/media/c1/clip.mp4/token").json()
+        assert minted["url"].startswith("/api/media/c1/clip.mp4?media_token=")
+        assert client.get(minted["url"], headers={"Authorization": ""}).content == CONTENT
+        # Minted again within the window, the URL stays the same and cached copies stay valid
+        assert client.post("/api/media/c1/clip.mp4/token").json()["url"] == minted["url"]
+
+        token = minted["media_token"]
+        for url in (f"/api/media/c1/other.mp4?media_token={token}", f"/api/media/c1/clip.mp4?media_token={token}x",
+                    f"/api/media/c1/clip.mp4?media_token={client.token}"):
+            assert client.get(url, headers={"Authorization": ""}).status_code == 401
+        expired, _ = auth.create_media_token("u1", "c1", "clip.mp4", now=time.time() - 3 * auth.MEDIA_TOKEN_TTL)
+        assert client.get(f"/api/media/c1/clip.mp4?media_token={expired}",
+                          headers={"Authorization": ""}).status_code == 401
+        assert client.post("/api/media/c2/clip.mp4/token").status_code == 404
+        assert client.post("/api/media/c1/clip.mp4/token", headers={"Authorization": ""}).status_code == 401
+
+    def test_parse_range(self):
+        """Malformed and multiple ranges fall back to the whole file"""
+        assert media.parse_range("bytes=0-0", 10) == (0, 0)
+        assert media.parse_range("bytes=5-100", 10) == (5, 9)
+        assert media.parse_range("bytes=-100", 10) == (0, 9)
+        for header in ("bytes=0-1,4-5", "items=0-1", "bytes=5-2", "bytes=x-", "bytes=-"):
+            assert media.parse_range(header, 10) is None
+        with pytest.raises(HTTPException):
+            media.parse_range("bytes=-0", 10)
+
+    def test_zero_copy_send(self, tmp_path):
+        """Servers with the zero-copy extension get the open file and the range to send"""
+        path = tmp_path / "file.bin"
+        path.write_bytes(CONTENT)
+        messages = []
+
+        async def send(message):
+            if message["type"] == "http.response.zerocopysend":
+                message = {**message, "file": message["file"].name}
+            messages.append(message)
+
+        scope = {"type": "http", "method": "GET", "extensions": {"http.response.zerocopysend": {}}}
+        asyncio.run(media.MediaFileResponse(str(path), 10, 20, 206)(scope, None, send))
+        assert messages[0]["status"] == 206 and (b"content-length", b"20") in messages[0]["headers"]
+        assert messages[1] == {"type": "http.response.zerocopysend", "file": str(path), "offset": 10, "count": 20}
+
+    def test_previews(self, client, monkeypatch):
+        """Previews are rendered once and served from the cache after that"""
+        available = media.previews_available
+        monkeypatch.setattr(media, "previews_available", lambda: False)
+        assert client.get("/api/media/c1/clip.mp4?preview=320").status_code == 501
+        monkeypatch.setattr(media, "previews_available", available)
+        pytest.importorskip("PIL")
+        from PIL import Image
+
+        media_dir = os.path.dirname(media.media_file("u1", "c1", "clip.mp4"))
+        Image.new("RGB", (1000, 500), "red").save(os.path.join(media_dir, "photo.jpg"))
+        assert client.get("/api/media/c1/photo.jpg?preview=333").status_code == 400
+        response = client.get("/api/media/c1/photo.jpg?preview=320")
+        assert response.status_code == 200 and response.headers["content-type"] == "image/jpeg"
+        preview = os.path.join(media_dir, ".previews", "photo.jpg.320.jpg")
+        with Image.open(preview) as image:
+            assert image.size == (320, 160)
+        rendered = os.stat(preview).st_mtime_ns
+        assert client.get("/api/media/c1/photo.jpg?preview=320").content == response.content
+        assert os.stat(preview).st_mtime_ns == rendered
+        assert client.get("/api/media/c1/clip.mp4?preview=320").status_code == 415
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
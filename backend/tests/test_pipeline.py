@@ -0,0 +1,66 @@
+import asyncio
+
+import pytest
+
+from pipeline import InFlight, Pipeline, Stage
+
+
+class TestPipeline:
+    def test_items_flow_through_bounded_stages(self):
+        """Every item passes each stage once and no queue grows past its size"""
+        async def scenario():
+            seen, peaks = [], {}
+
+            async def source():
+                for number in range(50):
+                    yield number
+
+            async def double(items):
+                await asyncio.sleep(0)
+                return [item * 2 for item in items]
+
+            async def collect(items):
+                for stage in pipeline.stages:
+                    peaks[stage.name] = max(peaks.get(stage.name, 0), stage.queued)
+                seen.extend(items)
+                await asyncio.sleep(0.001)
+
+            pipeline = Pipeline([
+                Stage("double", double, workers=3, queue_size=4),
+                Stage("collect", collect, queue_size=8, batch_size=5, batch_wait=0.01),
+            ])
+            await pipeline.run(source())
+            assert sorted(seen) == [number * 2 for number in range(50)]
+            assert peaks["double"] <= 4 and peaks["collect"] <= 8
+            occupancy = pipeline.occupancy()
+            assert occupancy["collect"] == {"queued": 0, "capacity": 8, "busy": 0, "workers": 1, "processed": 50}
+
+        asyncio.run(scenario())
+
+    def test_source_error_after_draining(self):
+        """Items taken before the source failed still finish; then the error surfaces"""
+        async def scenario():
+            seen = []
+
+            async def source():
+                yield 1
+                yield 2
+                raise RuntimeError("flood")
+
+            async def collect(items):
+                seen.extend(items)
+
+            with pytest.raises(RuntimeError):
+                await Pipeline([Stage("collect", collect)]).run(source())
+            assert seen == [1, 2]
+
+        asyncio.run(scenario())
+
+    def test_in_flight_low_water(self):
+        """The resume point only passes ids once every earlier id finished"""
+        in_flight = InFlight()
+        for message_id in (3, 4, 7):
+            in_flight.add(message_id)
+        assert in_flight.done(4) is None
+        assert in_flight.done(3) == 4
+        assert in_flight.done(7) == 7 and not len(in_flight)
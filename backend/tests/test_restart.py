@@ -0,0 +1,139 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import jobs
+import scraping
+import state
+from admission import FairScheduler
+from benchmarks.fakes import ChannelSpec
+
+MESSAGES = 600
+
+
+@pytest.fixture
+def backend(db, scrape_backend):
+    client = scrape_backend({"c1": ChannelSpec(messages=MESSAGES, batch_size=50, fetch_latency=0.01)})
+    return db, client
+
+
+class TestWarmRestart:
+    def test_drain_and_resume(self, backend):
+        """A drained scrape stops at a checkpoint and resumes from it without refetching"""
+        db, client = backend
+
+        async def scenario():
+            user = await db.users.find_one({"id": "u1"})
+            job = await state.job_registry.create("u1", "c1", 0)
+            _, task = await scraping.submit_job(user, job, False)
+            while len(client.yield_times["c1"]) < 200:
+                await asyncio.sleep(0.005)
+            await scraping.drain(timeout=5)
+            assert task.done()
+
+            interrupted = await state.job_registry.get(job["id"], "u1")
+            checkpoint = (await db.users.find_one({"id": "u1"}))["channels"]["c1"]
+            assert interrupted["state"] == jobs.INTERRUPTED
+            assert 0 < checkpoint < MESSAGES
+            assert interrupted["offset_id"] == interrupted["last_message_id"] == checkpoint
+            assert state.message_store.latest_messages("u1", "c1", limit=1)[0]["message_id"] == checkpoint
+
+            # The next process to start
+            client.yield_times["c1"].clear()
+            resumed = await scraping.resume_interrupted()
+            assert [j["id"] for j in resumed] == [job["id"]]
+            await asyncio.gather(*(task for task, _ in state.scrape_scheduler.submitted()))
+            assert min(client.yield_times["c1"]) > checkpoint
+            finished = await state.job_registry.get(job["id"], "u1")
+            assert finished["state"] == jobs.COMPLETED
+            assert (await db.users.find_one({"id": "u1"}))["channels"]["c1"] == MESSAGES
+
+        asyncio.run(scenario())
+
+    def test_queued_scrapes_do_not_start_while_draining(self, backend):
+        """Scrapes still waiting for a slot are left interrupted, untouched"""
+        db, client = backend
+
+        async def scenario():
+            user = await db.users.find_one({"id": "u1"})
+            job = await state.job_registry.create("u1", "c1", 0)
+            scraping.draining = True
+            await scraping.run_queued_job("u1", job, False)
+            assert (await state.job_registry.get(job["id"], "u1"))["state"] == jobs.INTERRUPTED
+            assert client.yield_times["c1"] == {}
+
+            await db.users.update_one({"id": "u1"}, {"$set": {"channels": {}}})
+            assert await scraping.resume_interrupted() == []
+            assert (await state.job_registry.get(job["id"], "u1"))["state"] == jobs.CANCELLED
+
+        asyncio.run(scenario())
+    def test_crashed_scrape_fails_its_job(self, backend, monkeypatch):
+        """A scrape that crashes before it starts does not leave an active-looking job"""
+        db, client = backend
+
+        async def broken(*args, **kwargs):
+            raise RuntimeError("account pool unavailable")
+
+        monkeypatch.setattr(state.account_pool, "assign", broken)
+
+        async def scenario():
+            job = await state.job_registry.create("u1", "c1", 0)
+            await scraping.run_queued_job("u1", job, False)
+            failed = await state.job_registry.get(job["id"], "u1")
+            assert (failed["state"], failed["error"]) == (jobs.FAILED, "account pool unavailable")
+            assert await state.job_registry.find_active("u1", "c1") is None
+
+        asyncio.run(scenario())
+
+    def test_unsaved_messages_are_retried(self, backend, monkeypatch):
+        """The offset stops before messages that failed to save, so the next scrape saves them"""
+        db, client = backend
+        save = scraping.save_messages_to_db
+        failures = []
+
+        def flaky(user_id, channel_id, records):
+            if not failures and any(record.message_id == 250 for record in records):
+                failures.append([record.message_id for record in records])
+                raise OSError("disk full")
+            return save(user_id, channel_id, records)
+
+        monkeypatch.setattr(scraping, "save_messages_to_db", flaky)
+
+        async def scenario():
+            await scraping.scrape_channel_task("u1", "c1", 0, False)
+            checkpoint = (await db.users.find_one({"id": "u1"}))["channels"]["c1"]
+            assert checkpoint == min(failures[0]) - 1
+            assert state.message_store.channel_stats("u1", "c1")["messages"] == MESSAGES - len(failures[0])
+
+            await scraping.scrape_channel_task("u1", "c1", checkpoint, False)
+            assert (await db.users.find_one({"id": "u1"}))["channels"]["c1"] == MESSAGES
+            assert state.message_store.channel_stats("u1", "c1")["messages"] == MESSAGES
+
+        asyncio.run(scenario())
+
+    def test_queued_jobs_stay_active(self, backend, monkeypatch):
+        """A job waiting for a slot past JOB_STALE_AFTER is still found and merged into"""
+        db, client = backend
+        monkeypatch.setattr(state, "scrape_scheduler", FairScheduler("scrape", 1, 1, 100), raising=False)
+        monkeypatch.setattr(jobs, "JOB_QUEUED_HEARTBEAT", 0.01)
+        stale = datetime.utcnow() - timedelta(seconds=2 * jobs.JOB_STALE_AFTER)
+
+        async def scenario():
+            user = await db.users.find_one({"id": "u1"})
+            async with state.scrape_scheduler.slot("u1"):
+                job = await state.job_registry.create("u1", "c1", 0)
+                _, task = await scraping.submit_job(user, job, False)
+                lost = await state.job_registry.create("u1", "c2", 0)
+                for queued in (job, lost):
+                    await db.scrape_jobs.update_one({"id": queued["id"]}, {"$set": {"updated_at": stale}})
+                await asyncio.sleep(0.05)
+                assert (await state.job_registry.find_active("u1", "c1"))["id"] == job["id"]
+                # Queued on a process that is gone
+                assert await state.job_registry.find_active("u1", "c2") is None
+            await task
+
+        asyncio.run(scenario())
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,90 @@
+import pytest
+
+from benchmarks import import_time, load_test, near_duplicates, payload_encoding, record_memory, watch_rules
+from benchmarks.fakes import ChannelSpec
+from benchmarks.scrape_throughput import compare_reports, run_scenario
+
+
+class TestScrapeBenchmark:
+    def test_run_scenario(self):
+        """Scrape a small synthetic channel through the fake backend"""
+        metrics = run_scenario(ChannelSpec(messages=120, photo_ratio=0.2, document_ratio=0.1, media_bytes=128))
+        assert metrics["rows_written"] == 120
+        assert metrics["messages_per_sec"] > 0
+        assert metrics["mongo_checkpoints"] > 0
+        assert metrics["latency_p99_ms"] >= metrics["latency_p50_ms"]
+        assert metrics["media_bytes"] > 0
+        assert metrics["job_state"] == "completed"
+
+    def test_compare_reports(self):
+        """Flag metrics that moved the wrong way by more than the tolerance"""
+        baseline = {"scenarios": {"s": {"metrics": {"messages_per_sec": 100.0, "latency_p99_ms": 10.0}}}}
+        current = {"scenarios": {"s": {"metrics": {"messages_per_sec": 80.0, "latency_p99_ms": 10.5}}}}
+        rows = {metric: regressed for _, metric, _, _, _, regressed in compare_reports(baseline, current, 10.0)}
+        assert rows == {"messages_per_sec": True, "latency_p99_ms": False}
+
+
+class TestRecordMemoryBenchmark:
+    def test_records_hold_less_than_dicts(self):
+        """Records retain less per message than dict items; the streamed export has the same rows"""
+        report = record_memory.run(300)
+        ingest, export = report["ingest"], report["export"]
+        assert ingest["record"]["retained_bytes_per_message"] < ingest["dict"]["retained_bytes_per_message"]
+        assert export["record"]["peak_mb"] < export["dict"]["peak_mb"]
+
+
+class TestPayloadEncodingBenchmark:
+    def test_run(self):
+        """Each case produces the same payload on both paths and reports both timings"""
+        report = payload_encoding.run(200, limits=(50,), repeat=1)
+        assert set(report) == {"messages", "channel_data_50", "export_json", "stream"}
+        assert report["stream"]["events"] == 200
+
+
+class TestImportTimeBudget:
+    def test_entry_points_within_budget(self):
+        """The API and the worker start within budget and without each other's heavy dependencies"""
+        report = import_time.run(["server", "worker"], repeat=2)
+        for module, result in report.items():
+            assert result["forbidden_loaded"] == [], module
+            assert result["import_ms"] <= result["budget_ms"], module
+
+
+class TestLoadTest:
+    def test_run(self):
+        """Every operation of the mix is driven through the app and reported per endpoint"""
+        mix = load_test.parse_mix("channels,channel_crud,channel_data=3,export,scrape")
+        report = load_test.run(users=2, channels=2, messages=50, concurrency=4, duration=0.5, mix=mix,
+                               post_rate=50, rate_limits=False)
+        assert set(report["endpoints"]) == {
+            "GET /api/channels", "POST /api/channels", "DELETE /api/channels/{channel_id}",
+            "GET /api/channel-data/{channel_id}", "GET /api/export-data/{channel_id}/{format}",
+            "POST /api/scrape/{channel_id}",
+        }
+        for endpoint, metrics in report["endpoints"].items():
+            assert metrics["errors"] == 0, endpoint
+            assert metrics["latency_p99_ms"] >= metrics["latency_p50_ms"]
+        assert "304" in report["endpoints"]["GET /api/channel-data/{channel_id}"]["statuses"]
+        with pytest.raises(ValueError):
+            load_test.parse_mix("delete_everything=1")
+
+
+class TestNearDuplicatesBenchmark:
+    def test_run(self):
+        """Reposts are clustered with their originals and lookups fetch few candidates as the corpus grows"""
+        report = near_duplicates.run(3000, checkpoints=3)
+        assert report["recall"] >= 0.95
+        assert report["false_merges"] == 0
+        assert [checkpoint["indexed"] for checkpoint in report["checkpoints"]][-1] == 3000
+        assert all(checkpoint["candidates_per_message"] < 2 for checkpoint in report["checkpoints"])
+
+
+class TestWatchRulesBenchmark:
+    def test_run(self):
+        """Every rule set finds what searching its rules one by one finds"""
+        report = watch_rules.run((100, 2000), messages=50, verify=10)
+        assert [row["rules"] for row in report] == [100, 2000]
+        assert all(row["mismatches"] == 0 and row["messages_per_sec"] > 0 for row in report)
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
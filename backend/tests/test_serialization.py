@@ -0,0 +1,36 @@
+import io
+import json
+
+import pytest
+
+import serialization
+from export import JSONBytesResponse
+from serialization import encode_rows, json_array, write_json_array
+
+
+class TestSerialization:
+    def test_encode_rows_matches_json(self):
+        """Row tuples encode to the same objects json would produce from dicts"""
+        columns = ("id", "message", "media_path")
+        rows = [(1, 'quote " and \\u00e9 \\n', None), (2, "", "/tmp/x")]
+        assert json.loads(json_array(encode_rows(columns, rows))) == [dict(zip(columns, row)) for row in rows]
+
+    def test_stdlib_fallback(self, monkeypatch):
+        """Without orjson the standard library encodes the same payloads"""
+        monkeypatch.setattr(serialization, "orjson", None)
+        fallback = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"), default=str)
+        assert fallback.encode({"a": [1, None, "é"]}).encode() == serialization.dumps({"a": [1, None, "é"]})
+
+    def test_json_array_file_and_response(self):
+        """Arrays are written one object per line; encoded bytes pass through the response untouched"""
+        f = io.BytesIO()
+        write_json_array(f, [b'{"a":1}', b'{"a":2}'])
+        assert json.loads(f.getvalue()) == [{"a": 1}, {"a": 2}]
+        empty = io.BytesIO()
+        write_json_array(empty, [])
+        assert empty.getvalue() == b"[]"
+        assert JSONBytesResponse(b'{"x":1}').body == b'{"x":1}'
+        assert json.loads(JSONBytesResponse({"x": [1]}).body) == {"x": [1]}
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
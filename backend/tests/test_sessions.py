@@ -0,0 +1,113 @@
+import asyncio
+
+import pytest
+from telethon.crypto import AuthKey
+from telethon.sessions import SQLiteSession
+
+from benchmarks.fakes import FakeDatabase
+from sessions import FileSessionStore, MongoSessionStore, SessionBusy
+
+
+class TestMongoSessionStore:
+    def setup_method(self):
+        self.collection = FakeDatabase().telegram_sessions
+
+    def test_lease_is_exclusive_and_state_survives(self, tmp_path):
+        """A leased session can't be taken twice and is written back on close"""
+        store = MongoSessionStore(self.collection, FileSessionStore(str(tmp_path)))
+
+        async def scenario():
+            session = await store.acquire("u1", "primary")
+            session.set_dc(2, "149.154.167.40", 443)
+            session.auth_key = AuthKey(b"k" * 256)
+            session._entities.add((-1001, 42, "chan", None, "Channel"))
+            with pytest.raises(SessionBusy):
+                await MongoSessionStore(self.collection).acquire("u1", "primary", wait=0)
+            session.close()
+            await store.drain()
+
+            other_worker = MongoSessionStore(self.collection)
+            reopened = await other_worker.acquire("u1", "primary", wait=0)
+            assert reopened.dc_id == 2 and reopened.auth_key.key == b"k" * 256
+            assert reopened.get_entity_rows_by_username("chan") == (-1001, 42)
+            reopened.close()
+            await other_worker.drain()
+
+        asyncio.run(scenario())
+
+    def test_writes_land_in_order(self, tmp_path):
+        """Saves in quick succession never leave an older state in the document"""
+        store = MongoSessionStore(self.collection, FileSessionStore(str(tmp_path)))
+        writes = []
+
+        async def scenario():
+            session = await store.acquire("u1", "primary")
+            write = store.write
+
+            async def slow_first_write(session):
+                # The first write finishes last if writes overlap
+                state = session.state()["dc_id"]
+                await asyncio.sleep(0.05 if not writes else 0)
+                writes.append(state)
+                await write(session)
+
+            store.write = slow_first_write
+            for dc_id in (1, 2, 3, 4):
+                session.set_dc(dc_id, "149.154.167.40", 443)
+                session.save()
+                await asyncio.sleep(0)
+            await asyncio.sleep(0.1)
+            assert writes == [1, 4] and self.collection.docs[0]["dc_id"] == 4
+            session.set_dc(5, "149.154.167.40", 443)
+            session.save()
+            session.close()
+            await store.drain()
+            assert self.collection.docs[0]["dc_id"] == 5 and self.collection.docs[0]["holder"] is None
+
+        asyncio.run(scenario())
+
+    def test_expired_lease_is_taken_over(self, tmp_path):
+        """A worker that died stops blocking its sessions after one TTL"""
+        async def scenario():
+            dead = await MongoSessionStore(self.collection, ttl=0).acquire("u1", "primary")
+            dead._heartbeat.cancel()
+            session = await MongoSessionStore(self.collection).acquire("u1", "primary", wait=0)
+            assert session.token != dead.token
+            session.close()
+
+        asyncio.run(scenario())
+
+    def test_imports_session_files(self, tmp_path):
+        """Logins stored in session files are carried over without a new login"""
+        legacy = SQLiteSession(str(tmp_path / "u1"))
+        legacy.set_dc(4, "149.154.167.91", 443)
+        legacy.auth_key = AuthKey(b"a" * 256)
+        legacy.save()
+        legacy.close()
+        store = MongoSessionStore(self.collection, FileSessionStore(str(tmp_path)))
+
+        async def scenario():
+            session = await store.acquire("u1", "primary")
+            assert session.dc_id == 4 and session.auth_key.key == b"a" * 256
+            session.close()
+            await store.drain()
+
+        asyncio.run(scenario())
+        assert self.collection.docs[0]["auth_key"] == b"a" * 256
+
+
+class TestFileSessionStore:
+    def test_one_client_per_session(self, tmp_path):
+        """A session file is handed out again only after it was closed"""
+        store = FileSessionStore(str(tmp_path))
+
+        async def scenario():
+            session = await store.acquire("u1", "primary")
+            with pytest.raises(SessionBusy):
+                await store.acquire("u1", "primary", wait=0.01)
+            other = await store.acquire("u1", "second", wait=0.01)
+            other.close()
+            session.close()
+            (await store.acquire("u1", "primary", wait=0.01)).close()
+
+        asyncio.run(scenario())
@@ -0,0 +1,375 @@
+import csv
+import json
+import os
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+import archive
+import storage
+from storage import PostgresMessageStore, SQLiteMessageStore, import_sqlite
+
+POSTGRES_DSN = os.environ.get("TEST_POSTGRES_DSN")
+
+
+def make_row(message_id, text="hello", media_type=None, reply_to=None, edit_date=None, fwd_from=(None, None)):
+    return (message_id, f"2024-01-01 00:00:{message_id % 60:02d}", 42, "First", None, "user",
+            text, media_type, None, reply_to, edit_date, *fwd_from)
+
+
+@pytest.fixture(params=["sqlite", "postgres"])
+def store(request, tmp_path):
+    if request.param == "sqlite":
+        return SQLiteMessageStore(base_dir=str(tmp_path / "data"))
+    if not POSTGRES_DSN:
+        pytest.skip("TEST_POSTGRES_DSN not set")
+    store = PostgresMessageStore(POSTGRES_DSN, partitions=4)
+    store.ensure_schema()
+    with store.cursor() as cur:
+        for table in ("messages", "message_links", "channel_daily_counts", "channel_sender_counts",
+                      "channel_media_counts"):
+            cur.execute(f"DELETE FROM {table} WHERE user_id LIKE 'test-%%'")
+    return store
+
+
+class TestMessageStore:
+    def test_save_and_read(self, store):
+        """Saved rows come back newest first and in id order after a given id"""
+        assert not store.has_channel("test-user", "chan")
+        saved = store.save_message("test-user", "chan", make_row(1, "tab\there\nnewline"))
+        assert saved["message_id"] == 1 and saved["id"] is not None
+        assert store.save_messages("test-user", "chan", [make_row(i) for i in range(2, 6)]) == 4
+        store.set_media_path("test-user", "chan", 3, "/tmp/photo.jpg")
+
+        assert store.has_channel("test-user", "chan")
+        latest = store.latest_messages("test-user", "chan", limit=2)
+        assert [m["message_id"] for m in latest] == [5, 4]
+        since = store.messages_since("test-user", "chan", 2)
+        assert [m["message_id"] for m in since] == [3, 4, 5]
+        assert since[0]["media_path"] == "/tmp/photo.jpg"
+        assert store.messages_since("test-user", "chan", 0, limit=1)[0]["message"] == "tab\there\nnewline"
+        assert json.loads(store.latest_messages_json("test-user", "chan", limit=10)) == \
+            store.latest_messages("test-user", "chan", limit=10)
+        assert store.latest_messages_json("test-user", "other") == b"[]"
+
+    def test_exports(self, store, tmp_path):
+        """CSV and JSON exports contain every stored message"""
+        store.save_messages("test-user", "chan", [make_row(i) for i in range(1, 4)])
+        store.export_csv("test-user", "chan", str(tmp_path / "out.csv"))
+        store.export_json("test-user", "chan", str(tmp_path / "out.json"))
+        with open(tmp_path / "out.csv", newline="", encoding="utf-8") as f:
+            rows = list(csv.reader(f))
+        assert rows[0][:3] == ["id", "message_id", "date"]
+        assert len(rows) == 4
+        with open(tmp_path / "out.json", encoding="utf-8") as f:
+            assert [m["message_id"] for m in json.load(f)] == [1, 2, 3]
+
+    def test_import_sqlite(self, store, tmp_path):
+        """Per-channel SQLite files can be bulk-loaded into another store"""
+        source = SQLiteMessageStore(base_dir=str(tmp_path / "legacy"))
+        source.save_messages("test-legacy", "chan", [make_row(i) for i in range(1, 11)])
+        import_sqlite(str(tmp_path / "legacy"), store)
+        assert len(store.messages_since("test-legacy", "chan", 0)) == 10
+
+    def test_rollups(self, store):
+        """Rollups are updated by both single and bulk inserts"""
+        assert store.channel_stats("test-user", "chan") is None
+        rows = [make_row(1), make_row(2, media_type="photo"), make_row(3, media_type="photo")]
+        store.save_messages("test-user", "chan", rows)
+        store.save_message("test-user", "chan", (4, "2024-01-02 10:00:00", None, None, None, None, "post",
+                                                 None, None, None, None, None, None))
+
+        stats = store.channel_stats("test-user", "chan")
+        assert stats["messages"] == 4 and stats["media_messages"] == 2
+        assert stats["days"] == 2 and stats["senders"] == 2
+        assert (stats["first_day"], stats["last_day"]) == ("2024-01-01", "2024-01-02")
+        assert store.daily_counts("test-user", "chan") == [
+            {"day": "2024-01-01", "messages": 3, "media": 2},
+            {"day": "2024-01-02", "messages": 1, "media": 0},
+        ]
+        assert [d["day"] for d in store.daily_counts("test-user", "chan", start="2024-01-02")] == ["2024-01-02"]
+        senders = store.top_senders("test-user", "chan", limit=1)
+        assert senders == [{"sender_id": 42, "first_name": "First", "last_name": None,
+                            "username": "user", "messages": 3}]
+        media = {m["media_type"]: m["messages"] for m in store.media_counts("test-user", "chan")}
+        assert media == {"photo": 2, "text": 2}
+
+    def test_upsert_writes_only_changed_rows(self, store):
+        """Rescans write nothing unless a message was edited"""
+        store.save_messages("test-user", "chan", [make_row(i) for i in range(1, 4)])
+        store.set_media_path("test-user", "chan", 2, "/tmp/photo.jpg")
+        assert store.save_messages("test-user", "chan", [make_row(i) for i in range(1, 4)]) == 0
+        assert store.save_message("test-user", "chan", make_row(1))["id"] is None
+
+        edited = make_row(2, "edited", edit_date="2024-01-03 00:00:00")
+        assert store.save_messages("test-user", "chan", [make_row(1), edited, make_row(4)]) == 2
+        messages = store.messages_since("test-user", "chan", 0)
+        assert [m["message_id"] for m in messages] == [1, 2, 3, 4]
+        assert messages[1]["message"] == "edited" and messages[1]["edit_date"] == "2024-01-03 00:00:00"
+        assert messages[1]["media_path"] == "/tmp/photo.jpg"
+        assert store.channel_stats("test-user", "chan")["messages"] == 4
+
+        ids = store.upsert_messages("test-user", "chan", [make_row(1), make_row(3, "edited again"), make_row(5)])
+        assert ids[0] is None and ids[1] == messages[2]["id"] and ids[2] is not None
+
+    def test_channel_version(self, store):
+        """The version moves with new messages, edits and media paths, and only then"""
+        assert store.channel_version("test-user", "chan")[1] == 0
+        store.save_messages("test-user", "chan", [make_row(i) for i in range(1, 4)])
+        version = store.channel_version("test-user", "chan")
+        assert tuple(version[:2]) == (3, 3)
+        store.save_messages("test-user", "chan", [make_row(i) for i in range(1, 4)])
+        assert store.channel_version("test-user", "chan") == version
+
+        changes = [
+            lambda: store.save_message("test-user", "chan", make_row(2, "edited")),
+            lambda: store.set_media_path("test-user", "chan", 3, "/tmp/photo.jpg"),
+            lambda: store.save_message("test-user", "chan", make_row(0)),
+        ]
+        for change in changes:
+            change()
+            assert store.channel_version("test-user", "chan") != version
+            version = store.channel_version("test-user", "chan")
+
+    def test_sender_rename_is_a_change(self, store):
+        """A rescan that only renames the sender reports the row and moves the version"""
+        store.save_messages("test-user", "chan", [make_row(i) for i in range(1, 4)])
+        version = store.channel_version("test-user", "chan")
+        renamed = (3, *make_row(3)[1:3], "Renamed", *make_row(3)[4:])
+        assert store.upsert_messages("test-user", "chan", [make_row(2), renamed]) == [
+            None, store.messages_since("test-user", "chan", 2)[0]["id"]]
+        assert store.channel_version("test-user", "chan") != version
+        assert store.latest_messages("test-user", "chan", limit=1)[0]["first_name"] == "Renamed"
+        version = store.channel_version("test-user", "chan")
+        assert store.upsert_messages("test-user", "chan", [renamed]) == [None]
+        assert store.channel_version("test-user", "chan") == version
+
+    def test_cluster_ids(self, store):
+        """Cluster ids are stored on rows, read back and move the version when they change"""
+        store.save_messages("test-user", "chan", [make_row(i) for i in range(1, 4)])
+        version = store.channel_version("test-user", "chan")
+        assert store.set_cluster_ids("test-user", "chan", {1: "chan:1", 2: "chan:1"}) == 2
+        assert store.set_cluster_ids("test-user", "chan", {1: "chan:1", 2: "other:5"}) == 1
+        assert store.channel_version("test-user", "chan") != version
+        rows = store.messages_since("test-user", "chan", 0)
+        assert [row["cluster_id"] for row in rows] == ["chan:1", "other:5", None]
+        assert store.save_messages("test-user", "chan", [make_row(1, "edited")]) == 1
+        assert store.latest_messages("test-user", "chan")[-1]["cluster_id"] == "chan:1"
+
+    def test_reply_and_forward_graph(self, store):
+        """Threads resolve to their root across batches; forwards are indexed by source"""
+        store.save_messages("test-user", "chan", [make_row(1), make_row(2, reply_to=1), make_row(3, reply_to=2),
+                                                  make_row(4, fwd_from=(-1001, 77))])
+        store.save_message("test-user", "chan", make_row(5, reply_to=3))
+        store.save_messages("test-user", "chan", [make_row(7, reply_to=6), make_row(6, reply_to=99)])
+        store.save_message("test-user", "other", make_row(1, fwd_from=(-1001, 77)))
+
+        thread = store.thread("test-user", "chan", 3)
+        assert thread["thread_root"] == 1
+        assert [m["message_id"] for m in thread["messages"]] == [1, 2, 3, 5]
+        assert [m["message_id"] for m in store.thread("test-user", "chan", 7)["messages"]] == [6, 7]
+        assert store.thread("test-user", "chan", 7)["thread_root"] == 99
+        assert store.thread("test-user", "chan", 4)["messages"][0]["fwd_from_msg_id"] == 77
+        assert store.thread("test-user", "chan", 42) is None
+
+        assert store.forward_source("test-user", "chan", 4) == {"fwd_from_id": -1001, "fwd_from_msg_id": 77}
+        assert store.forward_source("test-user", "chan", 2) is None
+        assert store.forwards_of("test-user", ["chan", "other"], -1001, 77) == [
+            {"channel_id": "chan", "message_id": 4}, {"channel_id": "other", "message_id": 1}]
+
+
+class TestSQLiteConcurrency:
+    def test_reads_while_a_write_is_committing(self, tmp_path):
+        """Files are in WAL mode: a read does not wait for a writer holding the database lock"""
+        store = SQLiteMessageStore(base_dir=str(tmp_path))
+        store.save_messages("u", "chan", [make_row(i) for i in range(1, 4)])
+        writer = sqlite3.connect(store.db_path("u", "chan"), isolation_level=None)
+        try:
+            assert writer.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+            writer.execute("BEGIN EXCLUSIVE")
+            writer.execute("DELETE FROM messages")
+            assert len(store.latest_messages("u", "chan")) == 3
+        finally:
+            writer.execute("ROLLBACK")
+            writer.close()
+
+
+class TestPostgresContentHashBackfill:
+    def test_unhashed_rows_are_hashed_on_start(self, store):
+        """Rows stored before content hashes existed are not reported changed when scraped again"""
+        if not isinstance(store, PostgresMessageStore):
+            pytest.skip("PostgreSQL only")
+        store.save_messages("test-user", "chan", [make_row(i) for i in range(1, 4)])
+        with store.cursor() as cur:
+            cur.execute("UPDATE messages SET content_hash = NULL WHERE user_id = 'test-user'")
+        store._schema_ready = False
+        store.ensure_schema()
+        assert store.upsert_messages("test-user", "chan", [make_row(i) for i in range(1, 4)]) == [None] * 3
+        assert store.upsert_messages("test-user", "chan", [make_row(2, "edited")]) != [None]
+
+
+class TestSQLiteRollupMigration:
+    def test_backfills_existing_database(self, tmp_path):
+        """Databases created before rollups existed are backfilled on first open"""
+        store = SQLiteMessageStore(base_dir=str(tmp_path))
+        os.makedirs(store.data_dir("u", "chan"))
+        conn = sqlite3.connect(store.db_path("u", "chan"))
+        conn.executescript(SQLiteMessageStore.SCHEMA)
+        conn.executemany(
+            "INSERT INTO messages (message_id, date, sender_id, first_name, last_name, username, message, "
+            "media_type, media_path, reply_to) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [make_row(1)[:10], make_row(2, media_type="document")[:10]]
+        )
+        conn.commit()
+        conn.close()
+
+        assert store.channel_stats("u", "chan")["messages"] == 2
+        store.save_message("u", "chan", make_row(3))
+        assert store.media_counts("u", "chan") == [{"media_type": "text", "messages": 2},
+                                                  {"media_type": "document", "messages": 1}]
+        assert SQLiteMessageStore(base_dir=str(tmp_path)).channel_stats("u", "chan")["messages"] == 3
+
+class TestSQLiteNormalizedMigration:
+    def test_migrates_legacy_database(self, tmp_path):
+        """Legacy files lose duplicate rows, move names to senders and keep correct rollups"""
+        store = SQLiteMessageStore(base_dir=str(tmp_path))
+        os.makedirs(store.data_dir("u", "chan"))
+        conn = sqlite3.connect(store.db_path("u", "chan"))
+        conn.executescript(SQLiteMessageStore.SCHEMA)
+        conn.executemany(
+            "INSERT INTO messages (message_id, date, sender_id, first_name, last_name, username, message, "
+            "media_type, media_path, reply_to) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (1, "2024-01-01 00:00:00", 7, "Old", None, "seven", "first", "photo", "/tmp/1.jpg", None),
+                (2, "2024-01-01 00:00:01", 8, "Eight", None, None, "second", None, None, None),
+                (1, "2024-01-01 00:00:00", 7, "New", None, "seven", "first, edited", "photo", None, None),
+            ]
+        )
+        conn.commit()
+        conn.close()
+
+        assert store.schema_version("u", "chan") == len(SQLiteMessageStore.MIGRATIONS)
+        messages = store.messages_since("u", "chan", 0)
+        assert [m["message_id"] for m in messages] == [1, 2]
+        assert messages[0]["message"] == "first, edited" and messages[0]["first_name"] == "New"
+        assert messages[0]["media_path"] == "/tmp/1.jpg"
+        assert store.channel_stats("u", "chan")["messages"] == 2
+        assert {m["media_type"]: m["messages"] for m in store.media_counts("u", "chan")} == {"photo": 1, "text": 1}
+        # Migrated messages are hashed, so scraping them again changes nothing
+        assert store.upsert_messages("u", "chan", [(2, "2024-01-01 00:00:01", 8, "Eight", None, None, "second",
+                                                    None, None, None, None, None, None)]) == [None]
+
+        store.save_message("u", "chan", (3, "2024-01-02 00:00:00", 7, "Newest", None, "seven", "third",
+                                         None, None, None, None, None, None))
+        senders = {s["sender_id"]: s for s in store.top_senders("u", "chan")}
+        assert senders[7]["messages"] == 2 and senders[7]["first_name"] == "Newest"
+        assert store.messages_since("u", "chan", 0)[0]["first_name"] == "Newest"
+
+
+class TestSQLiteThreadMigration:
+    def test_backfills_thread_roots(self, tmp_path):
+        """Reply chains stored before the graph existed get their thread roots on first open"""
+        store = SQLiteMessageStore(base_dir=str(tmp_path))
+        os.makedirs(store.data_dir("u", "chan"))
+        conn = sqlite3.connect(store.db_path("u", "chan"))
+        conn.executescript(SQLiteMessageStore.SCHEMA)
+        conn.executemany(
+            "INSERT INTO messages (message_id, date, sender_id, first_name, last_name, username, message, "
+            "media_type, media_path, reply_to) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [make_row(1)[:10], make_row(2, reply_to=1)[:10], make_row(3, reply_to=2)[:10],
+             make_row(5, reply_to=4)[:10]]
+        )
+        conn.commit()
+        conn.close()
+
+        assert [m["message_id"] for m in store.thread("u", "chan", 3)["messages"]] == [1, 2, 3]
+        assert store.thread("u", "chan", 5)["thread_root"] == 4
+        store.save_message("u", "chan", make_row(6, reply_to=3))
+        assert store.thread("u", "chan", 6)["thread_root"] == 1
+
+
+def dated_row(message_id, day, media_type=None):
+    return (message_id, f"2024-01-{day:02d} 12:00:00", 42, "First", None, "user", f"message {message_id}",
+            media_type, None, None, None, None, None)
+
+
+class TestSQLiteArchive:
+    @pytest.fixture
+    def store(self, tmp_path):
+        store = SQLiteMessageStore(base_dir=str(tmp_path))
+        store.save_messages("u", "chan", [dated_row(i, 1 + i // 10) for i in range(1, 50)])
+        return store
+
+    def test_reads_fall_through_to_segments(self, store, tmp_path):
+        """Archived messages stay readable through every read path"""
+        result = store.archive("u", "chan", datetime(2024, 1, 3), segment_rows=8)
+        assert result["messages"] == 19 and result["segments"] == 3
+        assert result["bytes"] < result["raw_bytes"]
+        assert store.archive_stats("u", "chan")["last_message_id"] == 19
+
+        assert [m["message_id"] for m in store.messages_since("u", "chan", 15, limit=6)] == [16, 17, 18, 19, 20, 21]
+        assert len(store.messages_since("u", "chan", 0, limit=100)) == 49
+        latest = store.latest_messages("u", "chan", limit=40)
+        assert len(latest) == 40 and latest[0]["message_id"] == 49
+        assert json.loads(store.latest_messages_json("u", "chan", limit=40)) == latest
+        assert sum(len(rows) for rows in store.iter_rows("u", "chan", chunk_size=7)) == 49
+        store.export_json("u", "chan", str(tmp_path / "out.json"))
+        with open(tmp_path / "out.json", encoding="utf-8") as f:
+            assert [m["message_id"] for m in json.load(f)] == list(range(1, 50))
+        store.export_csv("u", "chan", str(tmp_path / "out.csv"))
+        with open(tmp_path / "out.csv", newline="", encoding="utf-8") as f:
+            assert len(list(csv.reader(f))) == 50
+        assert store.channel_stats("u", "chan")["messages"] == 49
+
+    def test_archived_ids_are_immutable(self, store):
+        """Re-inserting an archived message is ignored and nothing is archived twice"""
+        store.archive("u", "chan", datetime(2024, 1, 3))
+        assert store.save_messages("u", "chan", [dated_row(5, 1)]) == 0
+        assert len(store.messages_since("u", "chan", 0, limit=100)) == 49
+        assert store.archive("u", "chan", datetime(2024, 1, 3))["messages"] == 0
+
+    def test_changes_while_copying_are_archived(self, store, monkeypatch):
+        """An edit, a rename or a cluster made while segments are written is copied again, not lost"""
+        write = storage.write_segment
+        changes = [
+            lambda: store.save_message("u", "chan", dated_row(3, 1)[:6] + ("edited",) + dated_row(3, 1)[7:]),
+            lambda: (store.save_message("u", "chan", dated_row(4, 1)[:3] + ("Renamed",) + dated_row(4, 1)[4:]),
+                     store.set_cluster_ids("u", "chan", {5: "chan:1"})),
+        ]
+        copies = []
+
+        def changing(*args, **kwargs):
+            copies.append(args[2][0][1])
+            if len(copies) <= len(changes):
+                changes[len(copies) - 1]()
+            return write(*args, **kwargs)
+
+        monkeypatch.setattr(storage, "write_segment", changing)
+        assert store.archive("u", "chan", datetime(2024, 1, 2), vacuum=False)["messages"] == 9
+        assert copies == [1, 1, 1]
+        assert len(os.listdir(store.archive_dir("u", "chan"))) == 1
+        archived = {m["message_id"]: m for m in store.messages_since("u", "chan", 0, limit=9)}
+        assert (archived[3]["message"], archived[4]["first_name"], archived[5]["cluster_id"]) == \
+            ("edited", "Renamed", "chan:1")
+
+        store.save_messages("u", "chan", [dated_row(i, 2) for i in range(60, 63)])
+        copies.clear()
+        changes[:] = [lambda: store.save_message("u", "chan", dated_row(62, 2)[:6] + (f"edit {len(copies)}",)
+                                                 + dated_row(62, 2)[7:])] * 5
+        with pytest.raises(RuntimeError):
+            store.archive("u", "chan", datetime(2024, 1, 3), vacuum=False)
+        assert len(copies) == storage.ARCHIVE_ATTEMPTS
+        assert len(os.listdir(store.archive_dir("u", "chan"))) == 1
+        assert store.archive_stats("u", "chan")["last_message_id"] == 9
+
+    def test_zlib_segments(self, store, monkeypatch):
+        """Segments fall back to zlib without zstandard and stay readable"""
+        monkeypatch.setattr(archive, "zstandard", None)
+        store.archive("u", "chan", datetime(2024, 1, 2))
+        assert all(name.endswith(".zlib") for name in os.listdir(store.archive_dir("u", "chan")))
+        assert store.messages_since("u", "chan", 0, limit=1)[0]["message"] == "message 1"
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,197 @@
+import asyncio
+import random
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import regex
+
+import scraping
+import state
+import watch
+from benchmarks.fakes import ChannelSpec
+from watch import RuleMatcher, WatchRules
+
+
+def rule(rule_id, pattern, kind="keyword", **options):
+    return {"id": rule_id, "kind": kind, "pattern": pattern, **options}
+
+
+class TestRuleMatcher:
+    @pytest.fixture(params=["pyahocorasick", "python"])
+    def backend(self, request, monkeypatch):
+        if request.param == "python":
+            monkeypatch.setattr(watch, "ahocorasick", None)
+        elif watch.ahocorasick is None:
+            pytest.skip("pyahocorasick is not installed")
+
+    def test_keywords(self, backend):
+        """Keywords match case-insensitively and, unless told otherwise, as whole words"""
+        matcher = RuleMatcher([
+            rule("crypto", "Crypto"), rule("he", "he"), rule("she", "she"),
+            rule("price", "price", whole_word=False), rule("news", "news", channels=["c2"]),
+        ])
+        assert sorted(matcher.scan("c1", "CRYPTO prices, she said: news")) == [
+            ("crypto", "crypto"), ("price", "price"), ("she", "she")]
+        assert matcher.scan("c2", "Breaking news") == [("news", "news")]
+        assert matcher.scan("c1", "") == []
+
+    def test_automaton_finds_every_keyword(self, backend):
+        """Overlapping keywords are all found, as a substring search would"""
+        words = ["ab", "abc", "bca", "c", "aab", "ba", "cab"]
+        matcher = RuleMatcher([rule(word, word, whole_word=False) for word in words])
+        generator = random.Random(1)
+        for _ in range(500):
+            text = "".join(generator.choice("abc ") for _ in range(generator.randint(0, 20)))
+            assert sorted(matcher.scan("c1", text)) == sorted((word, word) for word in words if word in text)
+
+    def test_regexes(self):
+        """Regexes share one alternation where they can and are checked one by one after it"""
+        matcher = RuleMatcher([
+            rule("amount", r"\$\d+", "regex"), rule("repeat", r"(\w)\1\1", "regex"),
+            rule("flags", "(?i)alert", "regex"), rule("exact", "BTC", "regex", case_sensitive=True),
+        ])
+        assert sorted(matcher.scan("c1", "ALERT: zzz costs $100, btc")) == [
+            ("amount", "$100"), ("flags", "ALERT"), ("repeat", "zzz")]
+        assert matcher.scan("c1", "BTC") == [("exact", "BTC")]
+        assert matcher.scan("c1", "nothing to see") == []
+        with pytest.raises(ValueError):
+            watch.validate_rule({"kind": "regex", "pattern": "(unclosed"})
+        with pytest.raises(ValueError):
+            watch.validate_rule({"kind": "keyword", "pattern": " "})
+
+    def test_case_sensitive_keywords(self, backend):
+        """Case-sensitive keywords only match as written"""
+        matcher = RuleMatcher([rule("ton", "TON", case_sensitive=True), rule("any", "ton")])
+        assert sorted(matcher.scan("c1", "TON and ton")) == [("any", "ton"), ("ton", "TON")]
+        assert matcher.scan("c1", "Ton") == [("any", "ton")]
+
+    def test_regexes_match_as_searched_alone(self):
+        """Literal prefiltering, chunked alternations and shared patterns find what each pattern finds alone"""
+        templates = [r"\b{w}\s+\d+", r"{w}(?:s|ed)?\b", r"(?:buy|sell)\s+{w}", r"\d{{2,}}[.,]\d+", r"[A-Z]{{3}}\b",
+                     r"(\w)\1{w}", r"(?i)İ{w}", r"ı{w}", r"(?:{w})+x?", r"{w}|\$\d+"]
+        words = ["ab", "Ab", "ba", "I", "ı", "a b", "ß", "ẞ"]
+        generator = random.Random(2)
+        rules = [rule(f"r{index}", generator.choice(templates).format(w=generator.choice(words)), "regex",
+                      case_sensitive=generator.random() < 0.3) for index in range(120)]
+        matcher = RuleMatcher(rules, chunk=4)
+        compiled = {r["id"]: regex.compile(r["pattern"], 0 if r["case_sensitive"] else regex.IGNORECASE)
+                    for r in rules}
+        for _ in range(300):
+            text = " ".join(generator.choice(words + ["12.5", "$7", "BUY", "sell", "aab", "11"])
+                            for _ in range(generator.randint(1, 8)))
+            expected = {rule_id for rule_id, pattern in compiled.items() if pattern.search(text)}
+            assert {rule_id for rule_id, _ in matcher.scan("c1", text)} == expected, text
+
+    def test_concurrent_scans(self):
+        """Scans from several threads share one matcher"""
+        matcher = RuleMatcher([rule(f"r{index}", rf"\b\d{{{index}}}\b", "regex") for index in range(1, 30)])
+        texts = [" ".join(str(10 ** index) for index in range(count)) for count in range(30)]
+        expected = [sorted(matcher.scan("c1", text)) for text in texts]
+        with ThreadPoolExecutor(8) as pool:
+            for _ in range(5):
+                assert [sorted(hits) for hits in pool.map(lambda text: matcher.scan("c1", text), texts)] == expected
+
+    def test_regex_timeout(self):
+        """A pattern that backtracks without bound is given up on and skipped from then on"""
+        matcher = RuleMatcher([rule("amount", r"\$\d+", "regex"), rule("evil", "(a|aa)+$", "regex"),
+                               rule("flagged", "a", "regex", timed_out_at="2024-01-01")], timeout=0.05)
+        text = "a" * 50 + "! $100"
+        assert matcher.scan("c1", text) == [("amount", "$100")]
+        assert matcher.take_timeouts() == {"evil"} and matcher.take_timeouts() == set()
+        assert matcher.scan("c1", text) == [("amount", "$100")]
+        assert matcher.take_timeouts() == set() and matcher.timed_out == {"evil", "flagged"}
+
+    def test_regex_timeout_in_chunk(self):
+        """A slow pattern sharing an alternation is found by halving it; the others keep matching"""
+        slow = r"(\w|\w\w)+\d{7}$"
+        rules = [rule(f"r{index}", rf"\b\d{{{index}}}\b", "regex") for index in range(1, 16)]
+        rules += [rule("evil", slow, "regex"), rule("copy", slow, "regex")]
+        matcher = RuleMatcher(rules, timeout=0.05, chunk=32)
+        text = "a" * 40 + "! 123"
+        assert matcher.scan("c1", text) == [("r3", "123")]
+        assert matcher.take_timeouts() == {"evil", "copy"}
+        assert matcher.scan("c1", text) == [("r3", "123")] and matcher.take_timeouts() == set()
+        assert all("evil" not in rule_ids for _, patterns, _ in matcher._chunks for rule_ids, _ in patterns)
+
+
+@pytest.fixture
+def rules(monkeypatch, db):
+    rules = WatchRules(db.watch_rules, db.watch_matches, db.users)
+    monkeypatch.setattr(state, "watch_rules", rules, raising=False)
+    return rules
+
+
+class TestWatchRulesApi:
+    def test_crud(self, rules, client):
+        """Rules are created, updated and deleted per user; each change bumps the rules version"""
+        created = client.post("/api/watch-rules", json={"pattern": "crypto"}).json()
+        assert (created["kind"], created["name"], created["whole_word"]) == ("keyword", "crypto", True)
+        bulk = client.post("/api/watch-rules/bulk", json={"rules": [
+            {"pattern": r"\$\d+", "kind": "regex", "name": "amounts"}, {"pattern": "news", "channels": ["c1"]},
+        ]})
+        assert len(bulk.json()["created"]) == 2
+        assert [r["name"] for r in client.get("/api/watch-rules").json()["rules"]] == ["crypto", "amounts", "news"]
+
+        updated = client.put(f"/api/watch-rules/{created['id']}", json={"pattern": "bitcoin", "whole_word": False})
+        assert (updated.json()["pattern"], updated.json()["whole_word"]) == ("bitcoin", False)
+        assert client.delete(f"/api/watch-rules/{created['id']}").status_code == 200
+        assert client.delete(f"/api/watch-rules/{created['id']}").status_code == 404
+        assert client.put("/api/watch-rules/missing", json={"pattern": "x"}).status_code == 404
+        user = asyncio.run(client.db.users.find_one({"id": "u1"}))
+        assert user["watch_rules_version"] == 4
+
+    def test_validation(self, rules, client, monkeypatch):
+        """Invalid patterns and rules beyond the per-user limit are refused"""
+        assert client.post("/api/watch-rules", json={"pattern": "(", "kind": "regex"}).status_code == 400
+        assert client.post("/api/watch-rules", json={"pattern": "x", "kind": "glob"}).status_code == 422
+        monkeypatch.setattr("alerts.MAX_WATCH_RULES", 1)
+        response = client.post("/api/watch-rules/bulk", json={"rules": [{"pattern": "a"}, {"pattern": "b"}]})
+        assert response.status_code == 400
+        assert client.get("/api/watch-rules").json()["rules"] == []
+
+
+class TestScrapeMatching:
+    def test_rules_are_matched_as_messages_are_saved(self, rules, scrape_backend):
+        """Scraped messages are matched once per rule, also when they are scraped again"""
+        client = scrape_backend({"c1": ChannelSpec(messages=300)})
+
+        async def scenario():
+            await rules.create_many("u1", [{"kind": "keyword", "pattern": "crypto"},
+                                           {"kind": "regex", "pattern": r"\bprice\b.*\bmarket\b"}])
+            await scraping.scrape_channel_task("u1", "c1", 0, False)
+            expected = {(message.id, "crypto") for message in client.messages_for("c1")
+                        if re.search(r"\bcrypto\b", message.message, re.IGNORECASE)}
+            expected |= {(message.id, "regex") for message in client.messages_for("c1")
+                         if re.search(r"\bprice\b.*\bmarket\b", message.message, re.IGNORECASE)}
+            names = {rule["id"]: rule["pattern"] for rule in await rules.list("u1")}
+            matches = await rules.list_matches("u1", limit=1000)
+            found = {(m["message_id"], "crypto" if names[m["rule_id"]] == "crypto" else "regex") for m in matches}
+            assert expected and found == expected
+
+            # A rescan stores nothing twice
+            await scraping.scrape_channel_task("u1", "c1", 0, False)
+            assert len(await rules.list_matches("u1", limit=1000)) == len(matches)
+
+        asyncio.run(scenario())
+
+    def test_timed_out_rules_are_recorded(self, rules, scrape_backend, monkeypatch):
+        """A rule whose search times out is marked on the rule and skipped until it is edited"""
+        scrape_backend({"c1": ChannelSpec(messages=50)})
+        monkeypatch.setattr(watch, "WATCH_REGEX_TIMEOUT", 0.05)
+
+        async def scenario():
+            created = await rules.create_many("u1", [{"kind": "regex", "pattern": r"(\w|\s|.)+\d{7}$"}])
+            await scraping.scrape_channel_task("u1", "c1", 0, False)
+            [stored] = await rules.list("u1")
+            assert stored["timed_out_at"] is not None
+            assert await rules.list_matches("u1", limit=1000) == []
+
+            await rules.update("u1", created[0]["id"], {**stored, "pattern": "crypto"})
+            [stored] = await rules.list("u1")
+            assert stored["timed_out_at"] is None
+
+        asyncio.run(scenario())
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
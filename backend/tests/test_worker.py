@@ -0,0 +1,43 @@
+import asyncio
+
+import pytest
+
+import scraping
+import state
+import worker
+from benchmarks.fakes import FakeDatabase
+
+
+class TestWorker:
+    def test_poll_starts_flagged_users_once(self, monkeypatch):
+        """Every flagged user of this worker gets one continuous scrape, restarted once it ends"""
+        started = []
+
+        async def scrape(user_id):
+            started.append(user_id)
+
+        async def scenario():
+            db = FakeDatabase()
+            monkeypatch.setattr(state, "db", db, raising=False)
+            monkeypatch.setattr(scraping, "continuous_scraping_task", scrape)
+            await db.users.insert_one({"id": "u1", "continuous_scraping": True})
+            await db.users.insert_one({"id": "u2", "continuous_scraping": False})
+
+            running = {}
+            assert await worker.poll(running) == ["u1"]
+            assert await worker.poll(running) == []
+            await asyncio.sleep(0)
+            assert await worker.poll(running) == ["u1"]
+            await asyncio.gather(*running.values())
+            assert started == ["u1", "u1"]
+
+        asyncio.run(scenario())
+
+    def test_users_are_split_over_workers(self):
+        """Each user belongs to exactly one of the workers"""
+        for user_id in ("u1", "u2", "u3", "another-user"):
+            assert sum(worker.owns(user_id, index, 3) for index in range(3)) == 1
+            assert worker.owns(user_id, 0, 1)
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,498 @@
+"""Watch rules: keywords and regular expressions matched against messages as they are scraped.
+
+A user's rules are compiled once into a RuleMatcher and every message the
+scraper stores or changes is scanned right after it is saved:
+
+``keyword``  literal text, matched case-insensitively (casefolded) unless
+             the rule is case sensitive, by default as whole words. All
+             keywords of a user go into one Aho-Corasick automaton per
+             case mode, so a scan costs one pass over the text however
+             many keywords there are. pyahocorasick is used when it is
+             installed, a pure Python automaton otherwise.
+``regex``    a Python regular expression, run by the ``regex`` module.
+             Most patterns contain some literal text that every match
+             must include, e.g. "price" in ``\bprice\s+\d+``. Those
+             literals go into an automaton too, and a pattern is only
+             searched when its literal occurs in the message. The
+             patterns without one are joined into alternations of at
+             most WATCH_REGEX_CHUNK patterns, which turn messages that
+             match none of them away in a single search each. Either
+             way a message costs about as much with tens of thousands of
+             rules as with a few; ``python -m benchmarks.watch_rules``
+             measures it.
+
+Every regex search gives up after WATCH_REGEX_TIMEOUT seconds, so a
+pattern that backtracks catastrophically, such as ``(a|aa)+$``, cannot
+hold up the scrape. An alternation that times out is halved until the
+pattern to blame is found; that rule is skipped from then on and its
+``timed_out_at`` set until it is edited.
+
+A rule may be limited to some of the user's channels. Hits go to the
+``watch_matches`` collection, one per rule and message however often the
+message is scraped again. Rule changes bump ``watch_rules_version`` on
+the user, which is how scrapes in any process notice that their compiled
+matcher is out of date.
+"""
+import asyncio
+import os
+import re
+import threading
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set
+
+import regex
+from pymongo import UpdateOne
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+try:
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_constants
+    import sre_parse
+
+KEYWORD = "keyword"
+REGEX = "regex"
+RULE_KINDS = (KEYWORD, REGEX)
+
+MAX_WATCH_RULES = int(os.environ.get("MAX_WATCH_RULES", 50000))
+MAX_PATTERN_LENGTH = int(os.environ.get("MAX_WATCH_PATTERN_LENGTH", 500))
+# Compiled matchers kept per process, for the users scraped most recently
+WATCH_MATCHER_CACHE = int(os.environ.get("WATCH_MATCHER_CACHE", 256))
+# Characters of the matched text kept with a hit
+MATCH_EXCERPT = 200
+# Seconds one regex search of one message may take before its rule is skipped
+WATCH_REGEX_TIMEOUT = float(os.environ.get("WATCH_REGEX_TIMEOUT", 0.1))
+# Patterns without a literal joined into one alternation
+WATCH_REGEX_CHUNK = int(os.environ.get("WATCH_REGEX_CHUNK", 64))
+
+# Patterns that cannot share an alternation with others: numbered or named
+# backreferences and named groups depend on the pattern's own group numbers
+_GROUP_DEPENDENT = re.compile(r"\\[1-9]|\(\?P[<=]|\\g<")
+# Syntax the regex module reads differently from the re parser used to find
+# literals: fuzzy matching ("(?:abc){e<=1}") and POSIX classes ("[[:alpha:]]")
+_NOT_RE_SYNTAX = re.compile(r"\{(?!\d*,?\d*\})|\[:")
+_REPEATS = {getattr(sre_constants, name) for name in ("MAX_REPEAT", "MIN_REPEAT", "POSSESSIVE_REPEAT")
+            if hasattr(sre_constants, name)}
+
+
+def validate_rule(rule):
+    """Raise ValueError if ``rule`` (kind, pattern, ...) cannot be compiled."""
+    if rule.get("kind") not in RULE_KINDS:
+        raise ValueError(f"Rule kind must be one of {', '.join(RULE_KINDS)}")
+    pattern = rule.get("pattern") or ""
+    if not pattern.strip():
+        raise ValueError("Pattern must not be empty")
+    if len(pattern) > MAX_PATTERN_LENGTH:
+        raise ValueError(f"Pattern is longer than {MAX_PATTERN_LENGTH} characters")
+    if rule["kind"] == REGEX:
+        try:
+            regex.compile(pattern, 0 if rule.get("case_sensitive") else regex.IGNORECASE)
+        except regex.error as e:
+            raise ValueError(f"Invalid regular expression: {e}")
+
+
+class Automaton:
+    """Pure Python Aho-Corasick automaton with the parts of pyahocorasick's API used here."""
+
+    def __init__(self):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[list] = [[]]
+
+    def add_word(self, word, value):
+        node = 0
+        for char in word:
+            following = self._goto[node].get(char)
+            if following is None:
+                following = len(self._goto)
+                self._goto[node][char] = following
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            node = following
+        self._output[node].append(value)
+
+    def make_automaton(self):
+        # Breadth first, so that a node's failure link is final before its children's
+        queue = list(self._goto[0].values())
+        for node in queue:
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(char, 0)
+                self._fail[child] = target if target != child else 0
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+
+    def iter(self, text):
+        """(index of the last character, value) of every word occurring in ``text``."""
+        goto, fail, output = self._goto, self._fail, self._output
+        node = 0
+        for index, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for value in output[node]:
+                yield index, value
+
+
+class _CaseFold(dict):
+    """``str.translate`` table folding every character to one its case variants share.
+
+    Characters that IGNORECASE matches with each other, such as "I" and
+    the dotless "ı", fold to the same character, and every character to
+    exactly one, so a literal occurs in a text whenever a pattern
+    containing it can match it. Filled in as characters are met.
+    """
+
+    def __missing__(self, code):
+        char = chr(code)
+        upper = char.upper()
+        folded = ((upper if len(upper) == 1 else char).lower() or char)[0]
+        self[code] = folded
+        return folded
+
+
+_CASE_FOLD = _CaseFold()
+
+
+def _literal_runs(items) -> List[str]:
+    """Runs of literal characters that every match of the parsed ``items`` contains."""
+    runs, run = [], []
+    for op, av in items:
+        if op is sre_constants.LITERAL:
+            run.append(chr(av))
+            continue
+        runs.append("".join(run))
+        run = []
+        if op is sre_constants.SUBPATTERN:
+            runs.extend(_literal_runs(av[-1]))
+        elif op in _REPEATS and av[0] >= 1:
+            runs.extend(_literal_runs(av[2]))
+        elif op is getattr(sre_constants, "ATOMIC_GROUP", None):
+            runs.extend(_literal_runs(av))
+    runs.append("".join(run))
+    return runs
+
+
+def required_literal(pattern, flags=0) -> Optional[str]:
+    """The longest literal text every match of ``pattern`` contains, case folded, or None."""
+    if _NOT_RE_SYNTAX.search(pattern):
+        return None
+    try:
+        runs = _literal_runs(sre_parse.parse(pattern, flags))
+    except Exception:
+        # Syntax only the regex module knows, such as \p{L}
+        return None
+    literal = max(runs, key=len)
+    return literal.translate(_CASE_FOLD) if literal else None
+
+
+def _alternation(patterns, flags):
+    try:
+        return regex.compile("|".join(f"(?:{pattern.pattern})" for _, pattern in patterns), flags)
+    except regex.error:
+        # e.g. inline global flags, which must start the whole pattern
+        return None
+
+
+def _new_automaton():
+    return ahocorasick.Automaton() if ahocorasick is not None else Automaton()
+
+
+def _is_word_char(char):
+    return char.isalnum() or char == "_"
+
+
+class RuleMatcher:
+    """The watch rules of one user, compiled for scanning many messages.
+
+    Rules whose search timed out are skipped by later scans;
+    ``take_timeouts`` hands their ids over once, to be recorded. Scans
+    may come from several threads at once.
+    """
+
+    def __init__(self, rules: Iterable[dict], timeout=None, chunk=WATCH_REGEX_CHUNK):
+        self.rules = {rule["id"]: rule for rule in rules}
+        self.timeout = WATCH_REGEX_TIMEOUT if timeout is None else timeout
+        self.timed_out: Set[str] = {rule_id for rule_id, rule in self.rules.items() if rule.get("timed_out_at")}
+        self._new_timeouts: Set[str] = set()
+        self._lock = threading.Lock()
+        self._channels = {rule_id: set(rule["channels"]) for rule_id, rule in self.rules.items()
+                          if rule.get("channels")}
+
+        # Keywords by whether they are matched on the casefolded text
+        keywords: Dict[bool, Dict[str, list]] = {True: {}, False: {}}
+        # Ids of the rules with each pattern and flags, which share one search
+        patterns: Dict[tuple, list] = {}
+        for rule in self.rules.values():
+            if rule["kind"] == KEYWORD:
+                folded = not rule.get("case_sensitive")
+                keyword = rule["pattern"].strip()
+                keyword = keyword.casefold() if folded else keyword
+                keywords[folded].setdefault(keyword, []).append((rule["id"], rule.get("whole_word", True)))
+            elif rule["id"] not in self.timed_out:
+                flags = 0 if rule.get("case_sensitive") else regex.IGNORECASE
+                patterns.setdefault((rule["pattern"], flags), []).append(rule["id"])
+
+        literals: Dict[str, list] = {}
+        unfiltered: Dict[int, list] = {}
+        # [(rule ids, pattern)] searched on their own whenever a message is scanned
+        self._alone = []
+        for (pattern, flags), rule_ids in patterns.items():
+            entry = (tuple(rule_ids), regex.compile(pattern, flags))
+            literal = required_literal(pattern, flags)
+            if literal:
+                literals.setdefault(literal, []).append(entry)
+            elif _GROUP_DEPENDENT.search(pattern):
+                self._alone.append(entry)
+            else:
+                unfiltered.setdefault(flags, []).append(entry)
+
+        self._keywords = []
+        for folded, words in keywords.items():
+            if words:
+                automaton = _new_automaton()
+                for keyword, entries in words.items():
+                    automaton.add_word(keyword, (len(keyword), entries))
+                automaton.make_automaton()
+                self._keywords.append((folded, automaton))
+        self._literals = None
+        if literals:
+            self._literals = _new_automaton()
+            for literal, entries in literals.items():
+                self._literals.add_word(literal, entries)
+            self._literals.make_automaton()
+        # [flags, [(rule ids, pattern)], alternation of the patterns]
+        self._chunks = []
+        for flags, patterns in unfiltered.items():
+            for start in range(0, len(patterns), chunk):
+                self._add_chunk(flags, patterns[start:start + chunk])
+
+    def _add_chunk(self, flags, patterns):
+        patterns = [(rule_ids, pattern) for rule_ids, pattern in patterns if rule_ids[0] not in self.timed_out]
+        combined = _alternation(patterns, flags) if patterns else None
+        if combined is not None:
+            self._chunks.append([flags, patterns, combined])
+        else:
+            self._alone.extend(patterns)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def take_timeouts(self) -> Set[str]:
+        """Ids of the rules that timed out since the last call."""
+        with self._lock:
+            timeouts, self._new_timeouts = self._new_timeouts, set()
+        return timeouts
+
+    def scan(self, channel_id, text) -> List[tuple]:
+        """(rule id, matched text) of the rules that match ``text``, at most one hit per rule."""
+        if not text:
+            return []
+        with self._lock:
+            hits = self._scan(text)
+        return [(rule_id, matched) for rule_id, matched in hits.items()
+                if rule_id not in self._channels or channel_id in self._channels[rule_id]]
+
+    def _scan(self, text) -> dict:
+        hits = {}
+        for folded, automaton in self._keywords:
+            scanned = text.casefold() if folded else text
+            for end, (length, entries) in automaton.iter(scanned):
+                start = end - length + 1
+                bounded = ((start == 0 or not _is_word_char(scanned[start - 1])) and
+                           (end + 1 == len(scanned) or not _is_word_char(scanned[end + 1])))
+                for rule_id, whole_word in entries:
+                    if rule_id not in hits and (bounded or not whole_word):
+                        hits[rule_id] = scanned[start:end + 1]
+
+        timed_out = len(self.timed_out)
+        if self._literals is not None:
+            found = {id(entries): entries for _, entries in self._literals.iter(text.translate(_CASE_FOLD))}
+            for entries in found.values():
+                self._search(entries, text, hits)
+        for flags, patterns, combined in self._chunks:
+            self._search_chunk(flags, patterns, combined, text, hits)
+        self._search(self._alone, text, hits)
+
+        if len(self.timed_out) > timed_out:
+            chunks, self._chunks = self._chunks, []
+            for flags, patterns, combined in chunks:
+                if any(rule_ids[0] in self.timed_out for rule_ids, _ in patterns):
+                    self._add_chunk(flags, patterns)
+                else:
+                    self._chunks.append([flags, patterns, combined])
+        return hits
+
+    def _search_chunk(self, flags, patterns, combined, text, hits):
+        """Search ``patterns`` through their alternation; halve them while it times out."""
+        try:
+            if combined.search(text, timeout=self.timeout, concurrent=True) is None:
+                return
+        except TimeoutError:
+            if len(patterns) > 1:
+                half = len(patterns) // 2
+                for part in (patterns[:half], patterns[half:]):
+                    part_combined = _alternation(part, flags)
+                    if part_combined is None:
+                        self._search(part, text, hits)
+                    else:
+                        self._search_chunk(flags, part, part_combined, text, hits)
+                return
+        self._search(patterns, text, hits)
+
+    def _search(self, patterns, text, hits):
+        for rule_ids, pattern in patterns:
+            if rule_ids[0] in hits or rule_ids[0] in self.timed_out:
+                continue
+            try:
+                match = pattern.search(text, timeout=self.timeout, concurrent=True)
+            except TimeoutError:
+                self.timed_out.update(rule_ids)
+                self._new_timeouts.update(rule_ids)
+                continue
+            if match is not None:
+                for rule_id in rule_ids:
+                    hits[rule_id] = match.group(0)[:MATCH_EXCERPT]
+
+    def scan_records(self, channel_id, records) -> List[dict]:
+        """Hits of a batch of MessageRecords, as watch_matches fields."""
+        hits = []
+        for record in records:
+            for rule_id, matched in self.scan(channel_id, record.message):
+                hits.append({"rule_id": rule_id, "rule_name": self.rules[rule_id].get("name"),
+                             "message_id": record.message_id, "date": record.date, "matched": matched})
+        return hits
+
+
+class WatchRules:
+    """The users' watch rules and their hits, in MongoDB."""
+
+    def __init__(self, rules, matches, users, cache_size=WATCH_MATCHER_CACHE):
+        self.rules = rules
+        self.matches = matches
+        self.users = users
+        self.cache_size = cache_size
+        self._matchers: "OrderedDict[str, tuple]" = OrderedDict()
+
+    async def ensure_indexes(self):
+        await self.rules.create_index("id", unique=True)
+        await self.rules.create_index([("user_id", 1), ("created_at", 1)])
+        await self.matches.create_index([("user_id", 1), ("channel_id", 1), ("message_id", 1), ("rule_id", 1)],
+                                        unique=True)
+        await self.matches.create_index([("user_id", 1), ("created_at", -1)])
+        await self.matches.create_index([("user_id", 1), ("rule_id", 1), ("created_at", -1)])
+
+    async def list(self, user_id) -> List[dict]:
+        return await self.rules.find({"user_id": user_id}, {"_id": 0}).sort("created_at", 1).to_list(None)
+
+    async def count(self, user_id) -> int:
+        return await self.rules.count_documents({"user_id": user_id})
+
+    async def create_many(self, user_id, rules: List[dict]) -> List[dict]:
+        """Store new rules (already validated) for the user."""
+        now = datetime.utcnow()
+        docs = [{
+            "id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "name": rule.get("name") or rule["pattern"],
+            "kind": rule["kind"],
+            "pattern": rule["pattern"],
+            "channels": rule.get("channels") or None,
+            "case_sensitive": bool(rule.get("case_sensitive", False)),
+            "whole_word": bool(rule.get("whole_word", True)),
+            "timed_out_at": None,
+            "created_at": now,
+            "updated_at": now,
+        } for rule in rules]
+        if docs:
+            await self.rules.insert_many([dict(doc) for doc in docs])
+            await self._changed(user_id)
+        return docs
+
+    async def update(self, user_id, rule_id, rule: dict) -> Optional[dict]:
+        fields = {key: rule.get(key) for key in ("name", "kind", "pattern", "channels", "case_sensitive", "whole_word")}
+        fields["name"] = fields["name"] or fields["pattern"]
+        fields["channels"] = fields["channels"] or None
+        fields["timed_out_at"] = None
+        fields["updated_at"] = datetime.utcnow()
+        result = await self.rules.update_one({"id": rule_id, "user_id": user_id}, {"$set": fields})
+        if not result.matched_count:
+            return None
+        await self._changed(user_id)
+        return await self.rules.find_one({"id": rule_id}, {"_id": 0})
+
+    async def delete(self, user_id, rule_id) -> bool:
+        result = await self.rules.delete_one({"id": rule_id, "user_id": user_id})
+        if not result.deleted_count:
+            return False
+        await self._changed(user_id)
+        return True
+
+    async def _changed(self, user_id):
+        await self.users.update_one({"id": user_id}, {"$inc": {"watch_rules_version": 1}})
+        self._matchers.pop(user_id, None)
+
+    async def matcher(self, user) -> Optional[RuleMatcher]:
+        """The user's compiled rules, or None if there are none.
+
+        ``user`` is the user document; its ``watch_rules_version`` tells
+        whether the matcher compiled earlier is still current.
+        """
+        version = user.get("watch_rules_version", 0)
+        if not version:
+            return None
+        cached = self._matchers.get(user["id"])
+        if cached is not None and cached[0] == version:
+            self._matchers.move_to_end(user["id"])
+            return cached[1]
+        rules = await self.list(user["id"])
+        # Compiling tens of thousands of patterns takes a while
+        matcher = await asyncio.to_thread(RuleMatcher, rules) if rules else None
+        self._matchers[user["id"]] = (version, matcher)
+        while len(self._matchers) > self.cache_size:
+            self._matchers.popitem(last=False)
+        return matcher
+
+    async def record_timeouts(self, user_id, rule_ids: Iterable[str]):
+        """Mark rules whose search timed out; matchers skip them until they are edited."""
+        now = datetime.utcnow()
+        await self.rules.bulk_write([
+            UpdateOne({"id": rule_id, "user_id": user_id}, {"$set": {"timed_out_at": now}}) for rule_id in rule_ids
+        ], ordered=False)
+
+    async def record(self, user_id, channel_id, hits: List[dict]) -> int:
+        """Store hits; a rule's hit on a message that is already stored is kept as it was."""
+        if not hits:
+            return 0
+        now = datetime.utcnow()
+        await self.matches.bulk_write([
+            UpdateOne(
+                {"user_id": user_id, "channel_id": channel_id, "message_id": hit["message_id"], "rule_id": hit["rule_id"]},
+                {"$setOnInsert": {"rule_name": hit["rule_name"], "date": hit["date"], "matched": hit["matched"],
+                                  "created_at": now}},
+                upsert=True,
+            )
+            for hit in hits
+        ], ordered=False)
+        return len(hits)
+
+    async def list_matches(self, user_id, channel_id=None, rule_id=None, before=None, limit=100) -> List[dict]:
+        """Hits newest first; ``before`` (a created_at) pages back."""
+        query = {"user_id": user_id}
+        if channel_id:
+            query["channel_id"] = channel_id
+        if rule_id:
+            query["rule_id"] = rule_id
+        if before:
+            query["created_at"] = {"$lt": before}
+        cursor = self.matches.find(query, {"_id": 0}).sort("created_at", -1).limit(limit)
+        return await cursor.to_list(limit)
@@ -0,0 +1,90 @@
+"""Scrape worker entry point: ``python worker.py``.
+
+Runs continuous scraping for every user flagged for it, outside the API
+and without the web stack. Set CONTINUOUS_SCRAPE_RUNNER=worker on the API
+so that it leaves flagged users to the workers. Users are split over
+WORKER_COUNT workers by a hash of their id; each worker takes the users of
+its WORKER_INDEX and checks for newly flagged ones every
+WORKER_POLL_INTERVAL seconds.
+
+On SIGTERM or SIGINT the worker drains its scrapes (see scraping.drain)
+before it exits; scrapes interrupted that way are resumed by the next
+worker or API process to start.
+"""
+import asyncio
+import logging
+import os
+import signal
+import zlib
+
+from dotenv import load_dotenv
+
+# Load environment variables before the modules below read their settings
+load_dotenv()
+
+import scraping  # noqa: E402
+import state  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+WORKER_INDEX = int(os.environ.get('WORKER_INDEX', 0))
+WORKER_COUNT = int(os.environ.get('WORKER_COUNT', 1))
+WORKER_POLL_INTERVAL = float(os.environ.get('WORKER_POLL_INTERVAL', 30))
+
+
+def owns(user_id, index=WORKER_INDEX, count=WORKER_COUNT) -> bool:
+    """Whether the worker ``index`` of ``count`` scrapes for ``user_id``."""
+    return count <= 1 or zlib.crc32(user_id.encode()) % count == index
+
+
+async def poll(running: dict) -> list:
+    """Start continuous scraping for this worker's flagged users that are not running yet.
+
+    ``running`` maps user ids to their scraping tasks; finished tasks are
+    dropped from it. Returns the user ids started.
+    """
+    for user_id, task in list(running.items()):
+        if task.done():
+            del running[user_id]
+    started = []
+    async for user in state.db.users.find({"continuous_scraping": True}, {"id": 1}):
+        user_id = user["id"]
+        if user_id in running or not owns(user_id):
+            continue
+        running[user_id] = asyncio.ensure_future(scraping.continuous_scraping_task(user_id))
+        started.append(user_id)
+    return started
+
+
+async def run():
+    await state.ensure_indexes("job_registry", "account_pool", "session_store", "watch_rules", "near_duplicates")
+    await state.broker.start()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+    running = scraping.continuous_tasks
+    try:
+        await scraping.resume_interrupted()
+        while not stop.is_set():
+            for user_id in await poll(running):
+                logger.info(f"Continuous scraping started for user {user_id}")
+            try:
+                await asyncio.wait_for(stop.wait(), WORKER_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+        logger.info("Stopping: draining scrapes")
+    finally:
+        await scraping.drain()
+        await state.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass